@@ -0,0 +1,38 @@
+{{ config(
+    materialized='view',
+    enabled=var('enable_fitbit_s3_sources', false)
+) }}
+
+-- 取り込みLambdaが必ず保存する raw の心拍ファイル（heart_rate_YYYYMMDD.json / .ndjson.gz）から分単位心拍を展開する
+-- 列形式の heart_rate_intraday_*.parquet は pyarrow を同梱したデプロイでしか作られないため参照しない
+-- 必要な列だけを型指定して読むので、日次サマリーなど他の項目や intraday のない日は無視される
+-- S3の認証情報が必要なため既定では無効: dbt run --vars '{enable_fitbit_s3_sources: true}'
+WITH raw_files AS (
+    SELECT
+        make_date(year::INTEGER, month::INTEGER, day::INTEGER) AS heart_rate_date,
+        data
+    FROM read_json(
+        '{{ var("s3_bucket") }}/raw/fitbit/*/*/*/heart_rate_2*json*',
+        columns = {'data': 'STRUCT("activities-heart-intraday" STRUCT(dataset STRUCT("time" VARCHAR, "value" INTEGER)[]))'},
+        format = 'auto',
+        hive_partitioning = true
+    )
+),
+
+source_data AS (
+    SELECT
+        heart_rate_date,
+        unnest(data."activities-heart-intraday".dataset) AS point
+    FROM raw_files
+)
+
+SELECT
+    heart_rate_date,
+    (hour(point."time"::TIME) * 60 + minute(point."time"::TIME))::USMALLINT AS minute_of_day,
+    heart_rate_date + point."time"::TIME AS measured_at,
+    hour(point."time"::TIME)::UTINYINT AS hour_of_day,
+    least(greatest(point."value", 0), 255)::UTINYINT AS bpm,
+    {{ get_jst_timestamp() }} AS processed_at
+FROM source_data
+WHERE point."time" IS NOT NULL
+  AND point."value" IS NOT NULL
@@ -60,6 +60,7 @@ if [ -s requirements.txt ]; then
   pip install -r requirements.txt -t package/ --quiet
 fi
 cp lambda_function.py package/
+cp ../lambda-fitbit-shared/*.py package/
 (
   cd package || exit 1
   zip -r ../function.zip . -q
@@ -81,7 +82,7 @@ if [ $? -ne 0 ]; then
     --timeout 900 \
     --memory-size 512 \
     --region "$REGION" \
-    --environment "Variables={FITBIT_CLIENT_ID=${FITBIT_CLIENT_ID},FITBIT_CLIENT_SECRET=${FITBIT_CLIENT_SECRET},S3_BUCKET=${S3_BUCKET_NAME},DYNAMODB_TABLE=fitbit_tokens,FITBIT_USER_ID=BGPGCR}" >/dev/null
+    --environment "Variables={FITBIT_CLIENT_ID=${FITBIT_CLIENT_ID},FITBIT_CLIENT_SECRET=${FITBIT_CLIENT_SECRET},S3_BUCKET=${S3_BUCKET_NAME},DYNAMODB_TABLE=fitbit_tokens,FITBIT_USER_ID=BGPGCR,FITBIT_BACKFILL_SCHEDULER_ROLE_ARN=arn:aws:iam::${ACCOUNT_ID}:role/fitbit-backfill-scheduler-role}" >/dev/null
   if [ $? -ne 0 ]; then
     echo_error "Lambda関数の作成に失敗しました"
     rm -f function.zip
@@ -101,7 +102,7 @@ else
     --timeout 900 \
     --memory-size 512 \
     --region "$REGION" \
-    --environment "Variables={FITBIT_CLIENT_ID=${FITBIT_CLIENT_ID},FITBIT_CLIENT_SECRET=${FITBIT_CLIENT_SECRET},S3_BUCKET=${S3_BUCKET_NAME},DYNAMODB_TABLE=fitbit_tokens,FITBIT_USER_ID=BGPGCR}" >/dev/null
+    --environment "Variables={FITBIT_CLIENT_ID=${FITBIT_CLIENT_ID},FITBIT_CLIENT_SECRET=${FITBIT_CLIENT_SECRET},S3_BUCKET=${S3_BUCKET_NAME},DYNAMODB_TABLE=fitbit_tokens,FITBIT_USER_ID=BGPGCR,FITBIT_BACKFILL_SCHEDULER_ROLE_ARN=arn:aws:iam::${ACCOUNT_ID}:role/fitbit-backfill-scheduler-role}" >/dev/null
   if [ $? -ne 0 ]; then
     echo_error "設定更新に失敗しました"
     rm -f function.zip
@@ -118,5 +119,8 @@ echo_success "デプロイ完了"
 echo "============================================"
 echo "1. CloudWatch Logs 監視: aws logs tail /aws/lambda/$FUNCTION_NAME --follow"
 echo "2. 手動テスト   : aws lambda invoke --function-name $FUNCTION_NAME --payload '{\"force\":false}' response.json"
-echo "3. 終了後 cleanup: rm -f response.json"
+echo "3. 長期間の取り込み: aws lambda invoke --function-name $FUNCTION_NAME --invocation-type Event --payload '{\"coordinator\":true,\"start_date\":\"2024-01-01\",\"end_date\":\"2024-12-31\"}' response.json"
+echo "   （進捗は DynamoDB fitbit_backfill_journal に記録。初回のみ ../scripts/create-fitbit-backfill-journal.sh でテーブルを作成）"
+echo "   （レート制限後の再開は EventBridge Scheduler で予約。初回のみ ../scripts/create-fitbit-backfill-scheduler-role.sh でロールを作成）"
+echo "4. 終了後 cleanup: rm -f response.json"
 echo ""
@@ -1,47 +1,113 @@
+import hashlib
 import json
 import os
-import base64
-import logging
-from datetime import datetime, timedelta, date as date_cls
-from typing import Any, Dict, List, Optional, Set
-from urllib.parse import urlencode
+import sys
 import time
-
-import boto3
-import urllib3
-from botocore.exceptions import ClientError
+import logging
+from datetime import datetime, timedelta, timezone, date as date_cls
+from typing import Any, Callable, Dict, List, Optional, Set
+
+# 共有モジュール（lambda-fitbit-shared）はデプロイ時に同梱される。ローカル実行時は兄弟ディレクトリから読み込む
+_SHARED_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda-fitbit-shared")
+if os.path.isdir(_SHARED_DIR):
+    sys.path.append(_SHARED_DIR)
+
+import aws_clients  # noqa: E402
+import backfill_journal  # noqa: E402
+import fitbit_api  # noqa: E402
+import fitbit_collections  # noqa: E402
+import fitbit_ranges  # noqa: E402
+import metrics  # noqa: E402
+import raw_store  # noqa: E402
+import s3_index  # noqa: E402
+import upload_pipeline  # noqa: E402
+from rate_limiter import RateLimitExceeded, rate_limiter_from_env  # noqa: E402
+from token_manager import FitbitTokenManager  # noqa: E402
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-http = urllib3.PoolManager()
+# エンドポイントの並列取得数（FITBIT_FETCH_CONCURRENCY=1で従来どおり逐次取得）
+FETCH_CONCURRENCY = fitbit_api.fetch_concurrency_from_env()
+
+http = fitbit_api.build_pool_manager(FETCH_CONCURRENCY)
+
+# 日次Lambda 2回分（8リクエスト）を残してバックフィルが時間枠を使い切る
+# ウォーム起動をまたいで同じ時間枠を共有するためモジュールスコープで保持する
+fitbit_rate_limiter = rate_limiter_from_env(default_reserve=8)
+
+# S3保存などの後処理のためにLambdaの残り時間から差し引く秒数
+LAMBDA_TIME_MARGIN_SECONDS = 30
 
 DEFAULT_START_DATE = date_cls(2025, 1, 1)
 DEFAULT_END_DATE = date_cls(2025, 9, 27)
 DEFAULT_EXCLUDE = {date_cls(2025, 8, 5)}
 
-# レート制限対策: デフォルトを10日に削減
+# 処理日数の上限。実際の打ち切りはレート制限の残り枠とLambdaの残り時間で判断する
 try:
-    DEFAULT_MAX_DAYS = int(os.environ.get("FITBIT_BACKFILL_MAX_DAYS", "10"))
+    DEFAULT_MAX_DAYS = int(os.environ.get("FITBIT_BACKFILL_MAX_DAYS", "365"))
 except ValueError:
-    DEFAULT_MAX_DAYS = 10
+    DEFAULT_MAX_DAYS = 365
 DEFAULT_MAX_DAYS = max(1, min(DEFAULT_MAX_DAYS, 365))
 
+# daily: 1日ごとに日付指定エンドポイントで取得 / range: 期間指定エンドポイントで最大100日分をまとめて取得
+FETCH_MODES = ("daily", "range")
+DEFAULT_FETCH_MODE = os.environ.get("FITBIT_BACKFILL_FETCH_MODE", "daily")
+if DEFAULT_FETCH_MODE not in FETCH_MODES:
+    DEFAULT_FETCH_MODE = "daily"
+
+# 取得と並行して保存できる日数（0 で取得→保存を逐次実行）
+PIPELINE_DEPTH = upload_pipeline.pipeline_depth_from_env()
+
+# S3に保存するコレクション（FITBIT_COLLECTIONS。日次Lambdaと同じ登録簿・同じ順序）
+COLLECTIONS = fitbit_collections.enabled_collections()
+DATA_TYPES = tuple(collection.name for collection in COLLECTIONS)
+
+# コーディネーターモードのシャード日数と、自己再起動の上限回数（暴走防止）
+try:
+    COORDINATOR_SHARD_DAYS = int(os.environ.get("FITBIT_BACKFILL_SHARD_DAYS", str(backfill_journal.DEFAULT_SHARD_DAYS)))
+except ValueError:
+    COORDINATOR_SHARD_DAYS = backfill_journal.DEFAULT_SHARD_DAYS
+try:
+    COORDINATOR_MAX_INVOCATIONS = int(os.environ.get("FITBIT_BACKFILL_MAX_INVOCATIONS", "200"))
+except ValueError:
+    COORDINATOR_MAX_INVOCATIONS = 200
+
+# レート制限のリセットまでの待ちがこの秒数以下なら実行中に待ち、それより長ければ
+# EventBridge Scheduler に再開を予約して終了する（待機中のLambdaの実行時間に課金されないように）
+COORDINATOR_MAX_SLEEP_SECONDS = 60
+# 予約した再開でこのLambdaを起動するための EventBridge Scheduler の実行ロール
+SCHEDULER_ROLE_ARN = os.environ.get("FITBIT_BACKFILL_SCHEDULER_ROLE_ARN")
+SCHEDULE_NAME_PREFIX = "fitbit-backfill-resume-"
+
 def lambda_handler(event, context):
     """指定期間のFitbitデータをまとめて取得するバックフィルLambda"""
     logger.info("🚀 FitbitバックフィルLambdaを開始")
+    metrics.start_invocation("fitbit-backfill")
+    try:
+        return _handle(event, context)
+    finally:
+        metrics.flush(context)
+
+
+def _handle(event, context):
+    """イベントに応じてコーディネーターモードか期間指定のバックフィルを実行する"""
+    if (event or {}).get("coordinator"):
+        return run_coordinator(event, context)
 
     config = _parse_event(event)
     logger.info(
-        "📋 処理設定: start=%s end=%s exclude=%s force=%s",
+        "📋 処理設定: start=%s end=%s exclude=%s force=%s mode=%s",
         config["start"],
         config["end"],
         sorted(d.isoformat() for d in config["exclude"]),
         config["force"],
+        config["fetch_mode"],
     )
 
-    tokens = get_fitbit_tokens()
-    if not tokens:
+    # トークンは呼び出し中メモリに保持し、401と期限切れ間近のときだけDynamoDBを読み直す
+    token_manager = FitbitTokenManager.from_env(http)
+    if not token_manager.load():
         logger.error("❌ DynamoDBからトークンを取得できませんでした")
         return _build_response(400, {"error": "No tokens found in DynamoDB"})
 
@@ -54,101 +120,254 @@ def lambda_handler(event, context):
         "exclude_dates": sorted(d.isoformat() for d in config["exclude"]),
         "force": config["force"],
         "max_days": config["max_days"],
+        "fetch_mode": config["fetch_mode"],
         "processed_dates": 0,
         "rate_limit_reached": False,
         "next_start_date": None,
     }
 
-    current_date = config["start"]
-    processed = 0
-    rate_limit_hit = False
-    next_start: Optional[date_cls] = None
+    existing_dates = _load_existing_dates(config)
 
-    while current_date <= config["end"]:
-        if current_date in config["exclude"]:
-            logger.info("⏭️ %s は除外対象のためスキップ", current_date.isoformat())
-            current_date += timedelta(days=1)
-            continue
+    if config["fetch_mode"] == "range":
+        processed, rate_limit_hit, next_start = _backfill_by_range(
+            config, token_manager, context, results, existing_dates
+        )
+    else:
+        processed, rate_limit_hit, next_start = _backfill_daily(
+            config, token_manager, context, results, existing_dates
+        )
 
-        if processed >= config["max_days"]:
-            next_start = current_date
-            break
+    results["processed_dates"] = processed
+    if rate_limit_hit:
+        results["rate_limit_reached"] = True
+    if next_start and next_start <= config["end"]:
+        results["next_start_date"] = next_start.isoformat()
+
+    status = 200 if not results["errors"] else 207
+    logger.info("📦 バックフィル結果: %s", json.dumps(results, ensure_ascii=False))
+    return _build_response(status, results)
 
-        date_str = current_date.isoformat()
-        logger.info("📅 %s の処理を開始", date_str)
 
-        try:
-            tokens = ensure_valid_token(tokens)
-            bucket = os.environ.get(
-                "S3_BUCKET",
-                os.environ.get("S3_BUCKET_NAME", "moderation-craft-data-800860245583"),
-            )
+def run_coordinator(event: Dict, context):
+    """
+    コーディネーターモード: 期間をシャードに分割し、進捗をジャーナルに記録しながら処理する
 
-            if not config["force"] and data_exists_in_s3(bucket, current_date):
-                logger.info("↪️ %s は既にS3に保存済みのためスキップ", date_str)
-                results["skipped"].append({"date": date_str, "reason": "already_exists"})
-                processed += 1
-                current_date += timedelta(days=1)
-                continue
+    Lambdaの残り時間が尽きた場合はジャーナルに位置を残して自分自身を非同期で再起動し、
+    レート制限で止まった場合はリセット時刻に EventBridge Scheduler で再開を予約して終了する。
+    すべてのシャードが終わるまで人手は不要。
+    """
+    event = event or {}
+    config = _parse_event(event)
+    job_id = event.get("job_id") or (
+        f"{config['start'].isoformat()}_{config['end'].isoformat()}_{config['fetch_mode']}"
+    )
+    journal = backfill_journal.BackfillJournal.from_env(job_id)
+    job = journal.ensure_job(
+        config["start"], config["end"], COORDINATOR_SHARD_DAYS, settings=_journal_settings(config)
+    )
+    # 再開時は最初に登録した設定で処理する
+    config = _parse_event({
+        **job["settings"],
+        "start_date": job["start_date"],
+        "end_date": job["end_date"],
+    })
+
+    if job["status"] == "completed":
+        logger.info("✅ ジョブ %s は完了済みです", job_id)
+        return _build_response(200, {"job_id": job_id, "status": "completed", "summary": job.get("summary")})
+
+    # リースはこの実行の終了時刻まで（ローカル実行はLambdaの最大実行時間）
+    remaining_seconds = _remaining_seconds(context)
+    lease_seconds = remaining_seconds + LAMBDA_TIME_MARGIN_SECONDS if remaining_seconds is not None else 900
+    invocation = journal.claim(lease_seconds)
+    if invocation is None:
+        return _build_response(409, {"job_id": job_id, "error": "job is already running"})
+    if invocation > COORDINATOR_MAX_INVOCATIONS:
+        logger.error("❌ 再起動回数が上限（%s回）に達したため停止します", COORDINATOR_MAX_INVOCATIONS)
+        journal.release()
+        return _build_response(500, {"job_id": job_id, "error": "max invocations reached"})
+
+    logger.info("🧭 ジョブ %s の%s回目の実行を開始", job_id, invocation)
+    results = {
+        "job_id": job_id,
+        "invocation": invocation,
+        "fetched": [],
+        "skipped": [],
+        "errors": [],
+        "start_date": config["start"].isoformat(),
+        "end_date": config["end"].isoformat(),
+        "fetch_mode": config["fetch_mode"],
+        "processed_dates": 0,
+        "rate_limit_reached": False,
+    }
 
-            fitbit_data, status_map = fetch_all_fitbit_data(tokens["access_token"], date_str)
-
-            if any(status == 401 for status in status_map.values()):
-                logger.info("401 が検出されたためトークンをリフレッシュします: %s", status_map)
-                refreshed = refresh_fitbit_token(tokens["refresh_token"])
-                if not refreshed:
-                    raise RuntimeError("Token refresh failed after 401")
-                tokens.update(refreshed)
-                fitbit_data, status_map = fetch_all_fitbit_data(tokens["access_token"], date_str)
-
-            if any(status == 429 for status in status_map.values()):
-                logger.warning("Fitbit API のレートリミットに到達しました (%s)", status_map)
-                results["errors"].append({
-                    "date": date_str,
-                    "error": "rate_limited",
-                    "status_map": status_map,
-                })
-                rate_limit_hit = True
-                next_start = current_date
-                break
+    # 前回の実行がレート制限で止まった場合、リセットが近ければ待ってから取得を始める。
+    # 予約より前に起動された（手動での再実行など）場合は待たずに再開を予約し直す
+    wait = job.get("resume_after", 0) - time.time()
+    if wait > COORDINATOR_MAX_SLEEP_SECONDS:
+        logger.info("⏰ レート制限のリセットまで%.0f秒あるため再開を予約して終了します", wait)
+        return _continue_job(journal, context, event, results, "rate_limit", resume_after=job["resume_after"])
+    if wait > 0:
+        logger.info("⏰ レート制限のリセットまで%.0f秒待機します", wait)
+        time.sleep(wait)
 
-            if all(status != 200 for status in status_map.values()):
-                logger.warning("%s のデータ取得がすべて失敗しました: %s", date_str, status_map)
-                results["errors"].append({
-                    "date": date_str,
-                    "error": "no_successful_dataset",
-                    "status_map": status_map,
-                })
-                processed += 1
-                current_date += timedelta(days=1)
-                continue
+    try:
+        token_manager = FitbitTokenManager.from_env(http)
+        if not token_manager.load():
+            logger.error("❌ DynamoDBからトークンを取得できませんでした")
+            journal.release()
+            return _build_response(400, {"job_id": job_id, "error": "No tokens found in DynamoDB"})
+
+        stop_reason = _run_shards(journal, config, token_manager, context, results)
+    except Exception:
+        journal.release()
+        raise
 
-            saved_paths = save_to_s3(date_str, fitbit_data, context)
+    if stop_reason == "rate_limit":
+        resume_after = time.time() + fitbit_rate_limiter.seconds_until_reset()
+        return _continue_job(journal, context, event, results, stop_reason, resume_after=resume_after)
+    if stop_reason is not None or journal.pending_shards():
+        # 時間切れ、または再試行できる失敗日が残っている
+        return _continue_job(journal, context, event, results, stop_reason or "retry_failed_days")
 
-            results["fetched"].append({
-                "date": date_str,
-                "files": saved_paths,
-                "status_map": status_map,
-            })
-            logger.info("✅ %s の保存が完了", date_str)
-        except Exception as exc:  # pylint: disable=broad-except
-            logger.exception("❌ %s の処理でエラー", date_str)
-            results["errors"].append({"date": date_str, "error": str(exc)})
+    summary = {
+        "invocations": invocation,
+        "completed_at": datetime.now().isoformat(),
+    }
+    journal.complete_job(summary)
+    journal.release()
+    results["status"] = "completed"
+    logger.info("🎉 ジョブ %s が完了しました: %s", job_id, json.dumps(results, ensure_ascii=False))
+    return _build_response(200 if not results["errors"] else 207, results)
+
+
+def _run_shards(journal, config: Dict, token_manager: FitbitTokenManager, context, results: Dict) -> Optional[str]:
+    """未完了のシャードを順に処理する。途中で止めた場合は理由（timeout / rate_limit）を返す"""
+    for shard in journal.pending_shards():
+        days = backfill_journal.remaining_days(shard, config["exclude"])
+        if not days:
+            journal.complete_shard(shard["key"])
+            continue
 
-        processed += 1
-        current_date += timedelta(days=1)
+        remaining_seconds = _remaining_seconds(context)
+        if remaining_seconds is not None and remaining_seconds <= 0:
+            return "timeout"
+
+        logger.info("🧩 %s（%s〜%s、残り%s日）を処理", shard["key"], days[0], days[-1], len(days))
+        pending = set(days)
+        # 完了済みの日はS3の一覧と同様にスキップし、失敗回数が上限に達した日は除外する
+        exhausted = {
+            days[0] + timedelta(days=offset)
+            for offset in range((days[-1] - days[0]).days + 1)
+        } - pending - shard["completed"]
+        shard_config = {
+            **config,
+            "start": days[0],
+            "end": days[-1],
+            "exclude": config["exclude"] | exhausted,
+            "max_days": (days[-1] - days[0]).days + 1,
+            # 長い待ちは実行中に sleep せず、rate_limit で止めて再開を予約する
+            "max_rate_limit_wait": COORDINATOR_MAX_SLEEP_SECONDS,
+        }
+        existing_dates = _load_existing_dates(shard_config) | shard["completed"]
 
-    results["processed_dates"] = processed
-    if rate_limit_hit:
-        results["rate_limit_reached"] = True
-    if next_start is None and current_date <= config["end"]:
-        next_start = current_date
-    if next_start and next_start <= config["end"]:
-        results["next_start_date"] = next_start.isoformat()
+        retry_later: Set[date_cls] = set()
+
+        def on_day_done(target: date_cls, outcome: str, shard=shard, retry_later=retry_later) -> None:
+            journal.mark_day(shard["key"], target, outcome)
+            attempts = shard["failures"].get(target.isoformat(), 0) + 1
+            if outcome == backfill_journal.DAY_FAILED and attempts < backfill_journal.MAX_DAY_ATTEMPTS:
+                retry_later.add(target)
+
+        backfill = _backfill_by_range if config["fetch_mode"] == "range" else _backfill_daily
+        processed, rate_limit_hit, next_start = backfill(
+            shard_config, token_manager, context, results, existing_dates, on_day_done
+        )
+        results["processed_dates"] += processed
+
+        if rate_limit_hit:
+            results["rate_limit_reached"] = True
+            return "rate_limit"
+        if next_start is not None:
+            return "timeout"
+        if not retry_later:
+            journal.complete_shard(shard["key"])
+    return None
+
+
+def _continue_job(journal, context, event: Dict, results: Dict, reason: str, resume_after: Optional[float] = None):
+    """
+    リースを解放し、残りの期間を処理するために自分自身を再起動する
+
+    resume_after（レート制限のリセット時刻）が先の場合は、その時刻に起動する一回限りのスケジュールを
+    EventBridge Scheduler に作成してすぐに終了する。それ以外は非同期で即座に再起動する。
+    """
+    journal.release(resume_after=resume_after)
+    results["status"] = "continuing"
+    results["stop_reason"] = reason
+
+    function_arn = getattr(context, "invoked_function_arn", None)
+    payload = {**event, "coordinator": True, "job_id": journal.job_id}
+    wait = resume_after - time.time() if resume_after is not None else 0
+    if not function_arn:
+        # ローカル実行では再起動しない。同じ job_id で再実行すればジャーナルの位置から再開する
+        results["status"] = "paused"
+        logger.info("⏸️ ローカル実行のため再起動せずに終了します（理由: %s）", reason)
+    elif wait > COORDINATOR_MAX_SLEEP_SECONDS:
+        if SCHEDULER_ROLE_ARN:
+            results["resume_at"] = _schedule_resume(function_arn, payload, resume_after, results.get("invocation"))
+        else:
+            # 予約できない場合も待機はしない（課金される待ち時間を作らない）。resume_after 以降に同じ job_id で再実行する
+            results["status"] = "paused"
+            logger.error(
+                "❌ FITBIT_BACKFILL_SCHEDULER_ROLE_ARN が未設定のため再開を予約できません。"
+                "%s 以降に job_id=%s で再実行してください",
+                datetime.fromtimestamp(resume_after, timezone.utc).isoformat(),
+                journal.job_id,
+            )
+    else:
+        aws_clients.client("lambda").invoke(
+            FunctionName=function_arn,
+            InvocationType="Event",
+            Payload=json.dumps(payload).encode("utf-8"),
+        )
+        logger.info("🔁 残りの期間を処理するため再起動しました（理由: %s）", reason)
 
-    status = 200 if not results["errors"] else 207
     logger.info("📦 バックフィル結果: %s", json.dumps(results, ensure_ascii=False))
-    return _build_response(status, results)
+    return _build_response(202, results)
+
+
+def _schedule_resume(function_arn: str, payload: Dict, resume_after: float, invocation: Optional[int]) -> str:
+    """resume_after（epoch秒）にこのLambdaを payload で起動する一回限りのスケジュールを作成し、起動時刻（UTC）を返す"""
+    resume_at = datetime.fromtimestamp(int(resume_after) + 1, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+    # スケジュール名は64文字以内・英数字と -_. のみのため job_id のハッシュと起動回数から作る
+    job_hash = hashlib.sha256(payload["job_id"].encode("utf-8")).hexdigest()[:16]
+    name = f"{SCHEDULE_NAME_PREFIX}{job_hash}-{invocation or 0}"
+    aws_clients.client("scheduler").create_schedule(
+        Name=name,
+        ScheduleExpression=f"at({resume_at})",
+        ScheduleExpressionTimezone="UTC",
+        FlexibleTimeWindow={"Mode": "OFF"},
+        Target={
+            "Arn": function_arn,
+            "RoleArn": SCHEDULER_ROLE_ARN,
+            "Input": json.dumps(payload),
+        },
+        # 起動後にスケジュールを削除する
+        ActionAfterCompletion="DELETE",
+    )
+    logger.info("⏰ レート制限のリセット後（%s UTC）の再開を予約しました: %s", resume_at, name)
+    return resume_at
+
+
+def _journal_settings(config: Dict) -> Dict[str, Any]:
+    """ジャーナルに保存する取得設定（再開時に _parse_event へ渡せる形）"""
+    return {
+        "exclude_dates": sorted(d.isoformat() for d in config["exclude"]),
+        "force": config["force"],
+        "fetch_mode": config["fetch_mode"],
+        "heart_intraday": config["heart_intraday"],
+    }
 
 
 def _parse_event(event: Dict) -> Dict:
@@ -176,256 +395,397 @@ def _parse_event(event: Dict) -> Dict:
     if max_days <= 0:
         max_days = DEFAULT_MAX_DAYS
 
+    fetch_mode = event.get("fetch_mode", DEFAULT_FETCH_MODE)
+    if fetch_mode not in FETCH_MODES:
+        raise ValueError(f"fetch_mode は {FETCH_MODES} のいずれかである必要があります")
+
     return {
         "start": start,
         "end": end,
         "exclude": exclude,
         "force": force,
         "max_days": max_days,
+        "fetch_mode": fetch_mode,
+        # range モードでも心拍の分単位データは日付指定でしか取れないため、既定では日ごとに取得する
+        "heart_intraday": bool(event.get("heart_intraday", True)),
     }
 
 
-def _coerce_date(raw_date: str, fallback: date_cls) -> date_cls:
-    if not raw_date:
-        return fallback
-    return datetime.strptime(raw_date, "%Y-%m-%d").date()
+def _backfill_daily(
+    config: Dict,
+    token_manager: FitbitTokenManager,
+    context,
+    results: Dict,
+    existing_dates: Set[date_cls],
+    on_day_done: Optional[Callable[[date_cls, str], None]] = None,
+):
+    """
+    1日ごとに日付指定エンドポイント（fitbit_collections.plan_day の最小集合）で取得して保存する
+
+    戻り値は (処理日数, レート制限で中断したか, 次回の開始日)。
+    """
+    on_day_done = on_day_done or _ignore_day
+    current_date = config["start"]
+    processed = 0
+    next_start: Optional[date_cls] = None
 
+    with _upload_pipeline(results, on_day_done, context) as pipeline:
+        while current_date <= config["end"]:
+            if current_date in config["exclude"]:
+                logger.info("⏭️ %s は除外対象のためスキップ", current_date.isoformat())
+                current_date += timedelta(days=1)
+                continue
 
-def ensure_valid_token(tokens: Dict) -> Dict:
-    # 常に最新のトークンをDynamoDBから取得して競合を防ぐ
-    latest_tokens = get_fitbit_tokens()
-    if latest_tokens:
-        logger.info("📋 最新のトークンをDynamoDBから取得")
-        tokens = latest_tokens
+            if processed >= config["max_days"]:
+                next_start = current_date
+                break
 
-    if is_token_expired(tokens):
-        logger.info("🔄 トークンが期限切れのためリフレッシュします")
-        refreshed = refresh_fitbit_token(tokens["refresh_token"])
-        if not refreshed:
-            raise RuntimeError("Token refresh failed")
-        tokens.update(refreshed)
-    return tokens
+            remaining_seconds = _remaining_seconds(context)
+            if remaining_seconds is not None and remaining_seconds <= 0:
+                logger.info("⏱️ Lambdaの残り時間が少ないため %s で中断します", current_date.isoformat())
+                next_start = current_date
+                break
 
+            date_str = current_date.isoformat()
+            logger.info("📅 %s の処理を開始", date_str)
+
+            try:
+                if current_date in existing_dates:
+                    logger.info("↪️ %s は既にS3に保存済みのためスキップ", date_str)
+                    pipeline.flush()
+                    results["skipped"].append({"date": date_str, "reason": "already_exists"})
+                    on_day_done(current_date, backfill_journal.DAY_DONE)
+                    processed += 1
+                    current_date += timedelta(days=1)
+                    continue
+
+                tokens = ensure_valid_token(token_manager)
+                fitbit_data, status_map = fetch_all_fitbit_data(
+                    tokens["access_token"],
+                    date_str,
+                    max_wait=_fetch_max_wait(config, context),
+                    user_id=token_manager.user_id,
+                )
+
+                if any(status == 401 for status in status_map.values()):
+                    logger.info("401 が検出されたためトークンをリフレッシュします: %s", status_map)
+                    tokens = token_manager.handle_unauthorized()
+                    fitbit_data, status_map = fetch_all_fitbit_data(
+                        tokens["access_token"],
+                        date_str,
+                        max_wait=_fetch_max_wait(config, context),
+                        user_id=token_manager.user_id,
+                    )
+
+                if any(status == 429 for status in status_map.values()):
+                    # リミッターがRetry-Afterとリセット時刻を反映済みなので、待てる範囲で1回だけ再取得する
+                    logger.info("429 が検出されたためリセットを待って再取得します: %s", status_map)
+                    fitbit_data, status_map = fetch_all_fitbit_data(
+                        tokens["access_token"],
+                        date_str,
+                        max_wait=_fetch_max_wait(config, context),
+                        user_id=token_manager.user_id,
+                    )
+
+                if any(status == 429 for status in status_map.values()):
+                    logger.warning("Fitbit API のレートリミットに到達しました (%s)", status_map)
+                    pipeline.flush()
+                    results["errors"].append({
+                        "date": date_str,
+                        "error": "rate_limited",
+                        "status_map": status_map,
+                    })
+                    return processed, True, current_date
+
+                if all(status != 200 for status in status_map.values()):
+                    logger.warning("%s のデータ取得がすべて失敗しました: %s", date_str, status_map)
+                    pipeline.flush()
+                    results["errors"].append({
+                        "date": date_str,
+                        "error": "no_successful_dataset",
+                        "status_map": status_map,
+                    })
+                    on_day_done(current_date, backfill_journal.DAY_FAILED)
+                    processed += 1
+                    current_date += timedelta(days=1)
+                    continue
+
+                # 保存はバックグラウンドで行い、その間に次の日の取得に進む
+                pipeline.submit(current_date, fitbit_data, status_map)
+            except RateLimitExceeded as exc:
+                logger.warning("⏰ %s: Lambdaの残り時間内にレート制限がリセットされないため中断します", exc)
+                return processed, True, current_date
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.exception("❌ %s の処理でエラー", date_str)
+                pipeline.flush()
+                results["errors"].append({"date": date_str, "error": str(exc)})
+                on_day_done(current_date, backfill_journal.DAY_FAILED)
+
+            processed += 1
+            current_date += timedelta(days=1)
 
-def data_exists_in_s3(bucket: str, target_date: date_cls) -> bool:
-    client = boto3.client("s3")
-    key = _summary_key(target_date)
-    try:
-        client.head_object(Bucket=bucket, Key=key)
-        return True
-    except ClientError as err:
-        if err.response["Error"]["Code"] == "404":
-            return False
-        raise
+    return processed, False, next_start
 
 
-def _summary_key(target_date: date_cls) -> str:
-    return (
-        f"raw/fitbit/year={target_date.year}/"
-        f"month={target_date.month:02d}/"
-        f"day={target_date.day:02d}/_summary.json"
-    )
+def _backfill_by_range(
+    config: Dict,
+    token_manager: FitbitTokenManager,
+    context,
+    results: Dict,
+    existing_dates: Set[date_cls],
+    on_day_done: Optional[Callable[[date_cls, str], None]] = None,
+):
+    """
+    期間指定エンドポイントでまとめて取得し、日ごとに分割して既存のS3レイアウトに保存する
 
+    戻り値は (処理日数, レート制限で中断したか, 次回の開始日)。
+    """
+    on_day_done = on_day_done or _ignore_day
+    targets: List[date_cls] = []
+    processed = 0
+    next_start: Optional[date_cls] = None
+    current_date = config["start"]
+    while current_date <= config["end"]:
+        if current_date in config["exclude"]:
+            logger.info("⏭️ %s は除外対象のためスキップ", current_date.isoformat())
+        elif processed >= config["max_days"]:
+            next_start = current_date
+            break
+        else:
+            if current_date in existing_dates:
+                logger.info("↪️ %s は既にS3に保存済みのためスキップ", current_date.isoformat())
+                results["skipped"].append({"date": current_date.isoformat(), "reason": "already_exists"})
+                on_day_done(current_date, backfill_journal.DAY_DONE)
+            else:
+                targets.append(current_date)
+            processed += 1
+        current_date += timedelta(days=1)
 
-def _build_response(status_code: int, payload: Dict) -> Dict:
-    return {"statusCode": status_code, "body": json.dumps(payload, ensure_ascii=False)}
+    done = 0
+    with _upload_pipeline(results, on_day_done, context) as pipeline:
+        for chunk in fitbit_ranges.chunk_dates(targets):
+            remaining_seconds = _remaining_seconds(context)
+            if remaining_seconds is not None and remaining_seconds <= 0:
+                logger.info("⏱️ Lambdaの残り時間が少ないため %s で中断します", chunk[0].isoformat())
+                return processed - (len(targets) - done), False, chunk[0]
+
+            # 日数が少ないまとまりは日ごとに取得したほうがリクエスト数が少ない
+            plan = fitbit_collections.plan_range(chunk, COLLECTIONS, include_intraday=config["heart_intraday"])
+            daily_calls = sum(fitbit_collections.plan_day(target, COLLECTIONS).call_count for target in chunk)
+            if not plan.collections or plan.call_count >= daily_calls:
+                day_data = {target: None for target in chunk}
+                range_status: Dict[str, int] = {}
+            else:
+                logger.info("📅 %s 〜 %s を期間指定で取得", chunk[0].isoformat(), chunk[-1].isoformat())
+                try:
+                    tokens = ensure_valid_token(token_manager)
+                    day_data, range_status = fetch_range_fitbit_data(
+                        tokens["access_token"],
+                        plan,
+                        max_wait=_fetch_max_wait(config, context),
+                        user_id=token_manager.user_id,
+                    )
+                    if any(status == 401 for status in range_status.values()):
+                        logger.info("401 が検出されたためトークンをリフレッシュします: %s", range_status)
+                        tokens = token_manager.handle_unauthorized()
+                        day_data, range_status = fetch_range_fitbit_data(
+                            tokens["access_token"],
+                            plan,
+                            max_wait=_fetch_max_wait(config, context),
+                            user_id=token_manager.user_id,
+                        )
+                except RateLimitExceeded as exc:
+                    logger.warning("⏰ %s: Lambdaの残り時間内にレート制限がリセットされないため中断します", exc)
+                    return processed - (len(targets) - done), True, chunk[0]
+                except Exception as exc:  # pylint: disable=broad-except
+                    logger.exception("❌ %s 〜 %s の期間取得でエラー", chunk[0].isoformat(), chunk[-1].isoformat())
+                    pipeline.flush()
+                    for target in chunk:
+                        results["errors"].append({"date": target.isoformat(), "error": str(exc)})
+                        on_day_done(target, backfill_journal.DAY_FAILED)
+                    done += len(chunk)
+                    continue
+
+                if any(status == 429 for status in range_status.values()):
+                    logger.warning("Fitbit API のレートリミットに到達しました (%s)", range_status)
+                    pipeline.flush()
+                    results["errors"].append({
+                        "date": chunk[0].isoformat(),
+                        "error": "rate_limited",
+                        "status_map": range_status,
+                    })
+                    return processed - (len(targets) - done), True, chunk[0]
+
+            for target in chunk:
+                date_str = target.isoformat()
+                try:
+                    data = day_data[target]
+                    if data is None:
+                        # 期間取得を使わない場合は日ごとに取得
+                        tokens = ensure_valid_token(token_manager)
+                        data, status_map = fetch_all_fitbit_data(
+                            tokens["access_token"],
+                            date_str,
+                            max_wait=_fetch_max_wait(config, context),
+                            user_id=token_manager.user_id,
+                        )
+                        range_types = []
+                    else:
+                        status_map = dict(range_status)
+                        if plan.per_day:
+                            # 分単位の心拍など、期間指定では取れないコレクションは日ごとに取得
+                            per_day_data, per_day_status = fetch_all_fitbit_data(
+                                tokens["access_token"],
+                                date_str,
+                                max_wait=_fetch_max_wait(config, context),
+                                collections=plan.per_day,
+                                user_id=token_manager.user_id,
+                            )
+                            data.update(per_day_data)
+                            status_map.update(per_day_status)
+                        data = {data_type: data[data_type] for data_type in DATA_TYPES if data_type in data}
+                        status_map = {data_type: status_map[data_type] for data_type in DATA_TYPES if data_type in status_map}
+                        # 時系列から組み立てたデータは日付指定で保存済みのデータを置き換えない
+                        range_types = plan.partial
+
+                    if any(status == 429 for status in status_map.values()):
+                        logger.warning("Fitbit API のレートリミットに到達しました (%s)", status_map)
+                        pipeline.flush()
+                        results["errors"].append({
+                            "date": date_str,
+                            "error": "rate_limited",
+                            "status_map": status_map,
+                        })
+                        return processed - (len(targets) - done), True, target
+
+                    if all(status != 200 for status in status_map.values()):
+                        logger.warning("%s のデータ取得がすべて失敗しました: %s", date_str, status_map)
+                        pipeline.flush()
+                        results["errors"].append({
+                            "date": date_str,
+                            "error": "no_successful_dataset",
+                            "status_map": status_map,
+                        })
+                        on_day_done(target, backfill_journal.DAY_FAILED)
+                    else:
+                        pipeline.submit(target, data, status_map, range_types=range_types)
+                except RateLimitExceeded as exc:
+                    logger.warning("⏰ %s: Lambdaの残り時間内にレート制限がリセットされないため中断します", exc)
+                    return processed - (len(targets) - done), True, target
+                except Exception as exc:  # pylint: disable=broad-except
+                    logger.exception("❌ %s の処理でエラー", date_str)
+                    pipeline.flush()
+                    results["errors"].append({"date": date_str, "error": str(exc)})
+                    on_day_done(target, backfill_journal.DAY_FAILED)
+                done += 1
+
+    return processed, False, next_start
+
+
+def _upload_pipeline(results: Dict, on_day_done: Callable[[date_cls, str], None], context) -> upload_pipeline.UploadPipeline:
+    """取得中に前の日のS3保存を進めるパイプライン（FITBIT_BACKFILL_PIPELINE_DEPTH=0 で逐次保存）"""
+    return upload_pipeline.UploadPipeline(
+        lambda date_str, data, **kwargs: save_to_s3(date_str, data, context, **kwargs),
+        results,
+        on_day_done,
+        depth=PIPELINE_DEPTH,
+        done=backfill_journal.DAY_DONE,
+        failed=backfill_journal.DAY_FAILED,
+    )
 
 
-# --- 以下は既存の日次Lambdaと同じヘルパー群 ---
+def _ignore_day(target: date_cls, outcome: str) -> None:
+    """ジャーナルを使わない通常モードの on_day_done"""
 
-def get_fitbit_tokens():
-    try:
-        dynamodb = boto3.resource("dynamodb")
-        table = dynamodb.Table(os.environ.get("DYNAMODB_TABLE", "fitbit_tokens"))
-        response = table.get_item(Key={"user_id": os.environ.get("FITBIT_USER_ID", "BGPGCR")})
-        if "Item" in response:
-            item = response["Item"]
-            if "expires_at" in item:
-                item["expires_at"] = int(item["expires_at"])
-            return item
-        return None
-    except Exception as exc:  # pylint: disable=broad-except
-        logger.error("DynamoDB error: %s", exc)
-        return None
 
+def _coerce_date(raw_date: str, fallback: date_cls) -> date_cls:
+    if not raw_date:
+        return fallback
+    return datetime.strptime(raw_date, "%Y-%m-%d").date()
 
-def is_token_expired(tokens):
-    try:
-        expires_at = tokens.get("expires_at", 0)
-        now = datetime.now().timestamp()
-        is_expired = now >= (expires_at - 300)
-        if is_expired:
-            logger.info("トークン期限切れ: 現在=%s 期限=%s", int(now), expires_at)
-        return is_expired
-    except Exception as exc:  # pylint: disable=broad-except
-        logger.error("期限チェックエラー: %s", exc)
-        return True
-
-
-def refresh_fitbit_token(refresh_token):
-    try:
-        client_id = os.environ.get("FITBIT_CLIENT_ID", "23QQC2")
-        client_secret = os.environ.get("FITBIT_CLIENT_SECRET")
-        if not client_secret:
-            logger.error("FITBIT_CLIENT_SECRET 環境変数が未設定です")
-            return None
-
-        auth_bytes = f"{client_id}:{client_secret}".encode("ascii")
-        auth_b64 = base64.b64encode(auth_bytes).decode("ascii")
-        url = "https://api.fitbit.com/oauth2/token"
-        headers = {
-            "Authorization": f"Basic {auth_b64}",
-            "Content-Type": "application/x-www-form-urlencoded",
-        }
-        # URLエンコーディングして特殊文字を正しく処理
-        body = urlencode({
-            'grant_type': 'refresh_token',
-            'refresh_token': refresh_token
-        })
-
-        response = http.request("POST", url, headers=headers, body=body)
-        if response.status == 200:
-            new_tokens = json.loads(response.data.decode("utf-8"))
-            logger.info("トークンリフレッシュ成功")
-            save_tokens_to_dynamodb(new_tokens)
-            return {
-                "access_token": new_tokens["access_token"],
-                "refresh_token": new_tokens["refresh_token"],
-                "expires_at": int(datetime.now().timestamp() + new_tokens["expires_in"]),
-            }
-
-        logger.error("リフレッシュ失敗: %s - %s", response.status, response.data)
-        return None
-    except Exception as exc:  # pylint: disable=broad-except
-        logger.error("リフレッシュエラー: %s", exc)
-        return None
 
+def ensure_valid_token(token_manager: FitbitTokenManager) -> Dict:
+    tokens = token_manager.get_valid_tokens()
+    if not tokens:
+        raise RuntimeError("No tokens found in DynamoDB")
+    return tokens
 
-def save_tokens_to_dynamodb(token_data):
-    try:
-        dynamodb = boto3.resource("dynamodb")
-        table = dynamodb.Table(os.environ.get("DYNAMODB_TABLE", "fitbit_tokens"))
-        expires_at = int(datetime.now().timestamp() + token_data["expires_in"])
-        table.put_item(
-            Item={
-                "user_id": os.environ.get("FITBIT_USER_ID", "BGPGCR"),
-                "access_token": token_data["access_token"],
-                "refresh_token": token_data["refresh_token"],
-                "expires_at": expires_at,
-                "scope": token_data.get("scope", ""),
-                "updated_at": datetime.now().isoformat(),
-            }
-        )
-        logger.info("新しいトークンをDynamoDBに保存しました")
-    except Exception as exc:  # pylint: disable=broad-except
-        logger.error("トークン保存エラー: %s", exc)
-
-
-def fetch_all_fitbit_data(access_token, date_str):
-    data = {}
-    status_map = {}
-    endpoints = {
-        "sleep": f"/1.2/user/-/sleep/date/{date_str}.json",
-        "activity": f"/1/user/-/activities/date/{date_str}.json",
-        "heart_rate": f"/1/user/-/activities/heart/date/{date_str}/1d/1min.json",
-        "steps": f"/1/user/-/activities/steps/date/{date_str}/1d.json",
-    }
 
-    headers = {"Authorization": f"Bearer {access_token}", "Accept": "application/json"}
+def _load_existing_dates(config: Dict) -> Set[date_cls]:
+    """取り込み済みの日付を月ごとのプレフィックス一覧でまとめて取得（force 時は空集合）"""
+    if config["force"]:
+        return set()
 
-    for data_type, endpoint in endpoints.items():
-        try:
-            logger.info("  📥 %s データを取得中", data_type)
-            url = f"https://api.fitbit.com{endpoint}"
-            response = http.request("GET", url, headers=headers)
-            status_map[data_type] = response.status
-
-            # レート制限ヘッダーを確認
-            remaining = int(response.headers.get('Fitbit-Rate-Limit-Remaining', '150'))
-            if remaining < 20:  # 残り20リクエスト未満で警告
-                wait_time = 30 if remaining < 10 else 5
-                logger.warning(f"⏰ レート制限に近づいています（残り{remaining}）。{wait_time}秒待機")
-                time.sleep(wait_time)
-
-            if response.status == 200:
-                data[data_type] = json.loads(response.data.decode("utf-8"))
-                logger.info("  ✅ %s データ取得成功", data_type)
-            elif response.status == 429:
-                # レート制限エラー時は長めに待機
-                retry_after = int(response.headers.get('Retry-After', '60'))
-                logger.warning(f"  ⚠️ %s で429エラー。{retry_after}秒待機します", data_type)
-                data[data_type] = None
-            else:
-                logger.warning("  ⚠️ %s データ取得失敗: %s", data_type, response.status)
-                data[data_type] = None
+    existing = s3_index.list_ingested_dates(
+        aws_clients.client("s3"), raw_store.bucket_from_env(), config["start"], config["end"]
+    )
+    logger.info("🗂️ S3に保存済みの日付: %s件", len(existing))
+    return existing
 
-            # 各API呼び出し間に短い遅延を挿入（レート制限対策）
-            time.sleep(0.5)
 
-        except Exception as exc:  # pylint: disable=broad-except
-            logger.error("  ❌ %s データ取得エラー: %s", data_type, exc)
-            data[data_type] = None
-            status_map[data_type] = 0
+def _fetch_max_wait(config: Dict, context) -> Optional[float]:
+    """
+    取得時にレート制限のリセットを待てる秒数（Lambdaの残り時間まで）
 
-    return data, status_map
+    コーディネーターモードでは max_rate_limit_wait（COORDINATOR_MAX_SLEEP_SECONDS）までに抑え、
+    それより長い待ちは RateLimitExceeded にして EventBridge Scheduler での再開に回す。
+    """
+    remaining_seconds = _remaining_seconds(context)
+    cap = config.get("max_rate_limit_wait")
+    if cap is None:
+        return remaining_seconds
+    return cap if remaining_seconds is None else min(remaining_seconds, cap)
 
 
-def save_to_s3(date_str, data, context=None):
-    s3 = boto3.client("s3")
-    bucket = os.environ.get(
-        "S3_BUCKET", os.environ.get("S3_BUCKET_NAME", "moderation-craft-data-800860245583")
-    )
+def _remaining_seconds(context) -> Optional[float]:
+    """Lambdaの残り実行時間（秒、後処理分を差し引き）。ローカル実行時は None"""
+    if context is None or not hasattr(context, "get_remaining_time_in_millis"):
+        return None
+    return context.get_remaining_time_in_millis() / 1000 - LAMBDA_TIME_MARGIN_SECONDS
 
-    date_obj = datetime.strptime(date_str, "%Y-%m-%d")
-    year = date_obj.year
-    month = f"{date_obj.month:02d}"
-    day = f"{date_obj.day:02d}"
 
-    saved_files: List[str] = []
-    for data_type, content in data.items():
-        if content is None:
-            continue
+def _build_response(status_code: int, payload: Dict) -> Dict:
+    # Fitbit・S3・DynamoDBの呼び出しと待機の内訳（EMF にも同じ記録を出力する）
+    payload = {**payload, "metrics": metrics.summary()}
+    return {"statusCode": status_code, "body": json.dumps(payload, ensure_ascii=False)}
 
-        key = f"raw/fitbit/year={year}/month={month}/day={day}/{data_type}_{date_str.replace('-', '')}.json"
-        enriched_data = {
-            "metadata": {
-                "extraction_timestamp": datetime.now().isoformat(),
-                "data_date": date_str,
-                "data_type": data_type,
-                "source": "fitbit_api",
-                "lambda_execution_id": context.aws_request_id if context else "local_test",
-            },
-            "data": content,
-        }
 
-        s3.put_object(
-            Bucket=bucket,
-            Key=key,
-            Body=json.dumps(enriched_data, indent=2),
-            ContentType="application/json",
-            Metadata={"data-date": date_str, "data-type": data_type},
-        )
-        saved_files.append(f"s3://{bucket}/{key}")
-        logger.info("  ✅ %s を保存: %s", data_type, key)
-
-    summary_key = _summary_key(datetime.strptime(date_str, "%Y-%m-%d").date())
-    summary_data = {
-        "extraction_date": datetime.now().isoformat(),
-        "data_date": date_str,
-        "files_created": len(saved_files),
-        "data_types": list(data.keys()),
-        "status": "success" if saved_files else "partial",
-        "files": saved_files,
-    }
-    s3.put_object(
-        Bucket=bucket,
-        Key=summary_key,
-        Body=json.dumps(summary_data, indent=2),
-        ContentType="application/json",
+def fetch_all_fitbit_data(access_token, date_str, max_wait=None, collections=None, user_id=None):
+    """date_str の日のコレクションを取得する（他のレスポンスから組み立てられるものは呼ばない）"""
+    plan = fitbit_collections.plan_day(date_str, collections or COLLECTIONS)
+    data, status_map = fitbit_api.fetch_endpoints(
+        http,
+        access_token,
+        plan.endpoints,
+        max_workers=FETCH_CONCURRENCY,
+        rate_limiter=fitbit_rate_limiter,
+        max_wait=max_wait,
+        user_id=user_id,
+    )
+    return plan.complete(data, status_map)
+
+
+def fetch_range_fitbit_data(access_token, plan, max_wait=None, user_id=None):
+    """期間指定エンドポイントで取得し、(日付ごとのデータ, 期間全体のステータス) を返す"""
+    raw, raw_status = fitbit_api.fetch_endpoints(
+        http,
+        access_token,
+        plan.endpoints,
+        max_workers=FETCH_CONCURRENCY,
+        rate_limiter=fitbit_rate_limiter,
+        max_wait=max_wait,
+        user_id=user_id,
     )
-    logger.info("📋 サマリーファイルを保存: %s", summary_key)
+    return plan.split(raw, raw_status)
 
-    return saved_files
+
+def save_to_s3(date_str, data, context=None, range_types=()):
+    return raw_store.save_day(
+        date_str,
+        data,
+        execution_id=context.aws_request_id if context else "local_test",
+        range_types=range_types,
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,95 @@
+"""
+AWSクライアントのレジストリ
+
+boto3 のクライアント・リソース・DynamoDBテーブルをモジュールスコープに1つずつ保持し、
+最初に使われたときに作成してウォーム起動をまたいで再利用する。呼び出しのたびに
+boto3.client() / boto3.resource() でセッションとエンドポイント設定を組み立て直すコストをなくす。
+
+クライアントの作成はスレッドセーフではないため、作成はロック内で行う。
+作成済みのクライアントはスレッド間で共有してよい。Table は get_item / put_item / update_item / query / scan の
+呼び出し（内部のクライアントに委譲するだけの操作）に限ってスレッド間で共有する。
+作成したクライアントには metrics の計測用ハンドラーを登録する（全操作の所要時間・ステータス・バイト数を記録）。
+"""
+import threading
+import time
+from typing import Any, Dict
+
+import boto3
+from botocore.config import Config
+
+import metrics
+
+_CONFIG = Config(
+    retries={"max_attempts": 3, "mode": "standard"},
+    # バックフィルの保存スレッドと取得スレッドが同じS3クライアントを使う
+    max_pool_connections=16,
+)
+
+_lock = threading.Lock()
+_session = None
+_clients: Dict[str, Any] = {}
+_resources: Dict[str, Any] = {}
+_tables: Dict[str, Any] = {}
+
+# 作成にかかった秒数（初回呼び出しのレイテンシ計測用）
+build_seconds: Dict[str, float] = {}
+
+
+def client(service_name: str):
+    """サービスごとに1つの boto3 クライアント"""
+    cached = _clients.get(service_name)
+    if cached is not None:
+        return cached
+    with _lock:
+        if service_name not in _clients:
+            started = time.perf_counter()
+            _clients[service_name] = _get_session().client(service_name, config=_CONFIG)
+            metrics.instrument(_clients[service_name])
+            build_seconds[f"client:{service_name}"] = time.perf_counter() - started
+        return _clients[service_name]
+
+
+def resource(service_name: str):
+    """サービスごとに1つの boto3 リソース"""
+    cached = _resources.get(service_name)
+    if cached is not None:
+        return cached
+    with _lock:
+        if service_name not in _resources:
+            started = time.perf_counter()
+            _resources[service_name] = _get_session().resource(service_name, config=_CONFIG)
+            metrics.instrument(_resources[service_name].meta.client)
+            build_seconds[f"resource:{service_name}"] = time.perf_counter() - started
+        return _resources[service_name]
+
+
+def table(table_name: str):
+    """テーブル名ごとに1つの DynamoDB Table"""
+    cached = _tables.get(table_name)
+    if cached is not None:
+        return cached
+    dynamodb = resource("dynamodb")
+    with _lock:
+        if table_name not in _tables:
+            _tables[table_name] = dynamodb.Table(table_name)
+        return _tables[table_name]
+
+
+def reset() -> None:
+    """保持しているクライアントを破棄する（ベンチマークやモック環境の切り替え用）"""
+    global _session
+    with _lock:
+        _session = None
+        _clients.clear()
+        _resources.clear()
+        _tables.clear()
+        build_seconds.clear()
+
+
+def _get_session():
+    global _session
+    if _session is None:
+        started = time.perf_counter()
+        _session = boto3.session.Session()
+        build_seconds["session"] = time.perf_counter() - started
+    return _session
@@ -0,0 +1,247 @@
+"""
+バックフィルの進捗ジャーナル（DynamoDB fitbit_backfill_journal テーブル）
+
+コーディネーターモードのバックフィルは [start_date, end_date] をシャードに分割し、
+日ごとの完了状況をこのテーブルに記録しながら処理する。Lambdaがタイムアウトしても
+ジャーナルに残った位置から再開できるため、自分自身を再起動するだけで長期間の取り込みを完走できる。
+
+テーブル構成（パーティションキー job_id / ソートキー item_key）
+- item_key = "job": 期間・取得設定・起動回数・実行中のリース・レート制限の解除予定時刻
+- item_key = "shard#NNNN": シャードの期間・状態と、完了日（completed, 文字列セット）・日ごとの失敗回数（failures）
+"""
+import logging
+import os
+import time
+import uuid
+from datetime import date as date_cls, datetime, timedelta
+from decimal import Decimal
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+import aws_clients
+
+logger = logging.getLogger()
+
+DEFAULT_JOURNAL_TABLE = "fitbit_backfill_journal"
+DEFAULT_SHARD_DAYS = 30
+JOB_ITEM_KEY = "job"
+SHARD_KEY_PREFIX = "shard#"
+
+# 同じ日の取得がこの回数失敗したら、その日は諦めてシャードを完了扱いにする
+MAX_DAY_ATTEMPTS = 3
+
+DAY_DONE = "done"
+DAY_FAILED = "failed"
+
+
+class BackfillJournal:
+    """1ジョブ分の進捗をDynamoDBに記録する"""
+
+    def __init__(self, table, job_id: str, clock: Callable[[], float] = time.time):
+        self.table = table
+        self.job_id = job_id
+        self._clock = clock
+        self._owner = uuid.uuid4().hex
+
+    @classmethod
+    def from_env(cls, job_id: str, dynamodb=None) -> "BackfillJournal":
+        table_name = os.environ.get("FITBIT_BACKFILL_JOURNAL_TABLE", DEFAULT_JOURNAL_TABLE)
+        table = dynamodb.Table(table_name) if dynamodb is not None else aws_clients.table(table_name)
+        return cls(table, job_id)
+
+    def ensure_job(self, start: date_cls, end: date_cls, shard_days: int, settings: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        ジョブが未登録ならシャードと一緒に作成し、登録済みなら既存のジョブを返す
+
+        再開時は最初に登録した期間と設定を使うため、イベントの内容は新規作成時にしか使われない。
+        """
+        job = self.load_job()
+        if job is not None:
+            return job
+
+        shards = shard_ranges(start, end, shard_days)
+        now = datetime.now().isoformat()
+        job = {
+            "job_id": self.job_id,
+            "item_key": JOB_ITEM_KEY,
+            "start_date": start.isoformat(),
+            "end_date": end.isoformat(),
+            "shard_days": shard_days,
+            "shard_count": len(shards),
+            "settings": settings,
+            "status": "running",
+            "invocations": 0,
+            "created_at": now,
+            "updated_at": now,
+        }
+        try:
+            self.table.put_item(Item=job, ConditionExpression="attribute_not_exists(job_id)")
+        except ClientError as err:
+            if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            # 同時に起動された別の実行が先に作成した
+            return self.load_job()
+
+        with self.table.batch_writer() as batch:
+            for index, (shard_start, shard_end) in enumerate(shards):
+                batch.put_item(Item={
+                    "job_id": self.job_id,
+                    "item_key": f"{SHARD_KEY_PREFIX}{index:04d}",
+                    "start_date": shard_start.isoformat(),
+                    "end_date": shard_end.isoformat(),
+                    "status": "pending",
+                    "failures": {},
+                })
+        logger.info("🗒️ ジャーナルにジョブ %s を作成（%s〜%s、%sシャード）", self.job_id, start, end, len(shards))
+        return job
+
+    def load_job(self) -> Optional[Dict[str, Any]]:
+        response = self.table.get_item(
+            Key={"job_id": self.job_id, "item_key": JOB_ITEM_KEY}, ConsistentRead=True
+        )
+        item = response.get("Item")
+        if item is not None:
+            for key in ("shard_days", "shard_count", "invocations", "lease_expires", "resume_after"):
+                if key in item:
+                    item[key] = int(item[key])
+            if "summary" in item:
+                item["summary"] = {
+                    key: int(value) if isinstance(value, Decimal) else value
+                    for key, value in item["summary"].items()
+                }
+        return item
+
+    def claim(self, lease_seconds: float) -> Optional[int]:
+        """
+        実行中リースを確保して起動回数を1増やす（戻り値は今回の起動回数）
+
+        別の実行がリースを保持している場合は None。リースは release() で解放するか、期限切れで失効する。
+        """
+        now = int(self._clock())
+        try:
+            response = self.table.update_item(
+                Key={"job_id": self.job_id, "item_key": JOB_ITEM_KEY},
+                UpdateExpression=(
+                    "SET lease_owner = :owner, lease_expires = :lease_expires, updated_at = :updated_at "
+                    "ADD invocations :one"
+                ),
+                ConditionExpression="attribute_not_exists(lease_expires) OR lease_expires < :now",
+                ExpressionAttributeValues={
+                    ":owner": self._owner,
+                    ":lease_expires": now + int(lease_seconds),
+                    ":updated_at": datetime.now().isoformat(),
+                    ":one": 1,
+                    ":now": now,
+                },
+                ReturnValues="UPDATED_NEW",
+            )
+        except ClientError as err:
+            if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            logger.info("⏳ ジョブ %s は別の実行が処理中です", self.job_id)
+            return None
+        return int(response["Attributes"]["invocations"])
+
+    def release(self, resume_after: Optional[float] = None) -> None:
+        """リースを解放する。resume_after（epoch秒）を渡すと次の実行はその時刻まで取得を控える"""
+        update = "REMOVE lease_owner, lease_expires SET updated_at = :updated_at"
+        values: Dict[str, Any] = {":owner": self._owner, ":updated_at": datetime.now().isoformat()}
+        if resume_after is not None:
+            update += ", resume_after = :resume_after"
+            values[":resume_after"] = int(resume_after)
+        try:
+            self.table.update_item(
+                Key={"job_id": self.job_id, "item_key": JOB_ITEM_KEY},
+                UpdateExpression=update,
+                ConditionExpression="lease_owner = :owner",
+                ExpressionAttributeValues=values,
+            )
+        except ClientError as err:
+            logger.warning("ジャーナルのリース解放に失敗: %s", err)
+
+    def pending_shards(self) -> List[Dict[str, Any]]:
+        """未完了のシャードを期間順に返す（completed は date の集合、failures は日付文字列 -> 回数）"""
+        shards: List[Dict[str, Any]] = []
+        query = {
+            "KeyConditionExpression": Key("job_id").eq(self.job_id) & Key("item_key").begins_with(SHARD_KEY_PREFIX),
+            "ConsistentRead": True,
+        }
+        while True:
+            response = self.table.query(**query)
+            for item in response.get("Items", []):
+                if item.get("status") == "done":
+                    continue
+                shards.append({
+                    "key": item["item_key"],
+                    "start": date_cls.fromisoformat(item["start_date"]),
+                    "end": date_cls.fromisoformat(item["end_date"]),
+                    "completed": {date_cls.fromisoformat(day) for day in item.get("completed", set())},
+                    "failures": {day: int(count) for day, count in (item.get("failures") or {}).items()},
+                })
+            if "LastEvaluatedKey" not in response:
+                break
+            query["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+        return shards
+
+    def mark_day(self, shard_key: str, target: date_cls, outcome: str) -> None:
+        """1日分の結果を記録する（done は完了日のセットに追加、failed は失敗回数を加算）"""
+        key = {"job_id": self.job_id, "item_key": shard_key}
+        if outcome == DAY_DONE:
+            self.table.update_item(
+                Key=key,
+                UpdateExpression="ADD completed :day",
+                ExpressionAttributeValues={":day": {target.isoformat()}},
+            )
+        else:
+            self.table.update_item(
+                Key=key,
+                UpdateExpression="SET failures.#day = if_not_exists(failures.#day, :zero) + :one",
+                ExpressionAttributeNames={"#day": target.isoformat()},
+                ExpressionAttributeValues={":zero": 0, ":one": 1},
+            )
+
+    def complete_shard(self, shard_key: str) -> None:
+        self.table.update_item(
+            Key={"job_id": self.job_id, "item_key": shard_key},
+            UpdateExpression="SET #status = :done",
+            ExpressionAttributeNames={"#status": "status"},
+            ExpressionAttributeValues={":done": "done"},
+        )
+
+    def complete_job(self, summary: Dict[str, Any]) -> None:
+        self.table.update_item(
+            Key={"job_id": self.job_id, "item_key": JOB_ITEM_KEY},
+            UpdateExpression="SET #status = :completed, summary = :summary, updated_at = :updated_at",
+            ExpressionAttributeNames={"#status": "status"},
+            ExpressionAttributeValues={
+                ":completed": "completed",
+                ":summary": summary,
+                ":updated_at": datetime.now().isoformat(),
+            },
+        )
+
+
+def shard_ranges(start: date_cls, end: date_cls, shard_days: int) -> List[tuple]:
+    """[start, end] を shard_days 日ごとの (開始日, 終了日) に分割"""
+    shard_days = max(1, shard_days)
+    shards = []
+    current = start
+    while current <= end:
+        shard_end = min(end, current + timedelta(days=shard_days - 1))
+        shards.append((current, shard_end))
+        current = shard_end + timedelta(days=1)
+    return shards
+
+
+def remaining_days(shard: Dict[str, Any], exclude: Iterable[date_cls] = ()) -> List[date_cls]:
+    """シャード内でまだ処理が必要な日（完了済み・除外日・失敗回数の上限に達した日を除く）"""
+    skip: Set[date_cls] = set(exclude) | shard["completed"]
+    days = []
+    current = shard["start"]
+    while current <= shard["end"]:
+        if current not in skip and shard["failures"].get(current.isoformat(), 0) < MAX_DAY_ATTEMPTS:
+            days.append(current)
+        current += timedelta(days=1)
+    return days
@@ -0,0 +1,542 @@
+"""
+Fitbit Web API のローカル代替サーバー（取り込みのベンチマーク・負荷試験用）
+
+日次Lambda・バックフィルが呼ぶエンドポイント（fitbit_collections の登録簿と oauth2/token）に、
+実データに近い形・サイズの応答を返す。値は日付から決まる乱数で作るため、同じ日付には同じ応答を返す。
+- 応答の遅延（--latency-ms ± --jitter-ms）
+- ユーザー（アクセストークン）ごとのレート制限と Fitbit-Rate-Limit-* ヘッダー（超えたら 429 + Retry-After）
+- 一定の割合で 429 / 5xx を返すエラー注入（--error-rate / --error-statuses）
+- inject() で指定したエンドポイントの次のリクエストに決まった順でステータスを返す（テスト用）
+- 失効させたリフレッシュトークン（revoked_refresh_tokens）でのトークン更新には 400 invalid_grant を返す
+- GET /__stats で集計（リクエスト数・エンドポイント別・ステータス別・送信バイト数）、POST /__reset でリセット
+
+使い方:
+    python lambda-fitbit-shared/benchmarks/fake_fitbit.py --port 8765 --latency-ms 80 --error-rate 0.02
+    FITBIT_API_BASE=http://127.0.0.1:8765 python lambda-fitbit/lambda_function.py
+
+ingest_throughput.py からは FakeFitbitServer をスレッドで起動して使う。
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from datetime import date as date_cls, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+DEFAULT_RATE_LIMIT = 150
+DEFAULT_RATE_WINDOW_SECONDS = 3600
+# sleep/list.json の1ページの件数の上限（Fitbitと同じ）
+SLEEP_LIST_MAX_LIMIT = 100
+
+_ACTIVITY_SERIES = (
+    "steps", "distance", "floors", "elevation", "calories", "caloriesBMR", "activityCalories",
+    "minutesSedentary", "minutesLightlyActive", "minutesFairlyActive", "minutesVeryActive",
+)
+
+
+class FakeFitbitServer:
+    """Fitbit APIの代わりに応答するHTTPサーバー（start() でバックグラウンドのスレッドで起動）"""
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency_ms: float = 0.0,
+        jitter_ms: float = 0.0,
+        rate_limit: int = DEFAULT_RATE_LIMIT,
+        rate_window_seconds: float = DEFAULT_RATE_WINDOW_SECONDS,
+        error_rate: float = 0.0,
+        error_statuses: Iterable[int] = (429, 500, 502, 503),
+        seed: int = 0,
+        revoked_refresh_tokens: Iterable[str] = (),
+    ):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate_limit = rate_limit
+        self.rate_window_seconds = rate_window_seconds
+        self.error_rate = error_rate
+        self.error_statuses = tuple(error_statuses)
+        self.revoked_refresh_tokens = set(revoked_refresh_tokens)
+        self._rand = random.Random(seed)
+        self._lock = threading.Lock()
+        self._windows: Dict[str, Tuple[float, int]] = {}
+        self._stats: Dict[str, Any] = {}
+        self._injected: Dict[str, List[int]] = {}
+        self.reset()
+
+        handler = type("Handler", (_Handler,), {"fake": self})
+        self._httpd = ThreadingHTTPServer((host, port), handler)
+        self._httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeFitbitServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="fake-fitbit", daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self) -> None:
+        self._httpd.serve_forever()
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def reset(self) -> None:
+        """集計・レート制限の枠・inject() の残りをリセットする"""
+        with self._lock:
+            self._windows.clear()
+            self._injected.clear()
+            self._stats = {
+                "requests": 0,
+                "api_requests": 0,
+                "token_requests": 0,
+                "rate_limited": 0,
+                "injected_errors": 0,
+                "bytes_sent": 0,
+                "by_endpoint": {},
+                "statuses": {},
+            }
+
+    def inject(self, route: str, statuses: Iterable[int]) -> None:
+        """route（/__stats の by_endpoint と同じ名前）への次のリクエストから順に statuses を返す"""
+        with self._lock:
+            self._injected.setdefault(route, []).extend(statuses)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return json.loads(json.dumps(self._stats))
+
+    def handle(
+        self, method: str, raw_path: str, authorization: str, request_body: bytes = b""
+    ) -> Tuple[int, Dict[str, str], bytes]:
+        """1リクエスト分の (ステータス, ヘッダー, 本文)"""
+        url = urlparse(raw_path)
+        route, body = _route(method, url.path, parse_qs(url.query))
+        is_token = route == "oauth2_token"
+
+        headers: Dict[str, str] = {"Content-Type": "application/json"}
+        status = 200 if body is not None else 404
+        if isinstance(body, dict) and "errors" in body:
+            status = 400
+        if is_token and status == 200:
+            refresh_token = parse_qs(request_body.decode("utf-8")).get("refresh_token", [""])[0]
+            if refresh_token in self.revoked_refresh_tokens:
+                status, body = 400, {"errors": [{"errorType": "invalid_grant", "message": "Refresh token invalid"}]}
+        with self._lock:
+            if not is_token:
+                remaining, reset_in = self._consume_locked(authorization)
+                headers.update({
+                    "Fitbit-Rate-Limit-Limit": str(self.rate_limit),
+                    "Fitbit-Rate-Limit-Remaining": str(max(0, remaining)),
+                    "Fitbit-Rate-Limit-Reset": str(int(reset_in) + 1),
+                })
+                if remaining < 0:
+                    status, body = 429, {"errors": [{"errorType": "system", "message": "Too Many Requests"}]}
+                    headers["Retry-After"] = str(int(reset_in) + 1)
+                    self._stats["rate_limited"] += 1
+            injected = None
+            if status == 200 and self._injected.get(route):
+                injected = self._injected[route].pop(0)
+            elif status == 200 and self.error_rate > 0 and self._rand.random() < self.error_rate:
+                injected = self._rand.choice(self.error_statuses)
+            if injected is not None:
+                status = injected
+                body = {"errors": [{"errorType": "system", "message": f"injected {status}"}]}
+                if status == 429:
+                    headers["Retry-After"] = "1"
+                self._stats["injected_errors"] += 1
+            delay = max(0.0, self.latency_ms + self._rand.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+
+        payload = json.dumps(body if body is not None else {"errors": [{"errorType": "not_found"}]}).encode("utf-8")
+        if delay:
+            time.sleep(delay)
+
+        with self._lock:
+            self._stats["requests"] += 1
+            self._stats["token_requests" if is_token else "api_requests"] += 1
+            self._stats["bytes_sent"] += len(payload)
+            self._stats["by_endpoint"][route] = self._stats["by_endpoint"].get(route, 0) + 1
+            self._stats["statuses"][str(status)] = self._stats["statuses"].get(str(status), 0) + 1
+        return status, headers, payload
+
+    def _consume_locked(self, authorization: str) -> Tuple[int, float]:
+        """トークンごとの固定ウィンドウで1件消費し、(残り件数, リセットまでの秒数) を返す（残りが負なら超過）"""
+        now = time.monotonic()
+        started, used = self._windows.get(authorization, (now, 0))
+        if now - started >= self.rate_window_seconds:
+            started, used = now, 0
+        used += 1
+        self._windows[authorization] = (started, used)
+        return self.rate_limit - used, self.rate_window_seconds - (now - started)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    fake: FakeFitbitServer
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:  # noqa: N802
+        if self.path == "/__stats":
+            self._send(200, {"Content-Type": "application/json"}, json.dumps(self.fake.stats()).encode("utf-8"))
+            return
+        self._send(*self.fake.handle("GET", self.path, self.headers.get("Authorization", "")))
+
+    def do_POST(self) -> None:  # noqa: N802
+        length = int(self.headers.get("Content-Length") or 0)
+        request_body = self.rfile.read(length) if length else b""
+        if self.path == "/__reset":
+            self.fake.reset()
+            self._send(200, {"Content-Type": "application/json"}, b"{}")
+            return
+        self._send(*self.fake.handle("POST", self.path, self.headers.get("Authorization", ""), request_body))
+
+    def _send(self, status: int, headers: Dict[str, str], payload: bytes) -> None:
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args) -> None:  # pylint: disable=redefined-builtin
+        pass
+
+
+_DATE = r"(\d{4}-\d{2}-\d{2})"
+_ROUTES = (
+    ("oauth2_token", re.compile(r"^/oauth2/token$")),
+    ("sleep_list", re.compile(r"^/1\.2/user/-/sleep/list\.json$")),
+    ("sleep_range", re.compile(rf"^/1\.2/user/-/sleep/date/{_DATE}/{_DATE}\.json$")),
+    ("sleep", re.compile(rf"^/1\.2/user/-/sleep/date/{_DATE}\.json$")),
+    ("heart_intraday", re.compile(rf"^/1/user/-/activities/heart/date/{_DATE}/1d/1min\.json$")),
+    ("heart_range", re.compile(rf"^/1/user/-/activities/heart/date/{_DATE}/{_DATE}\.json$")),
+    ("activity_series", re.compile(rf"^/1/user/-/activities/(\w+)/date/{_DATE}/(\d{{4}}-\d{{2}}-\d{{2}}|1d)\.json$")),
+    ("activity", re.compile(rf"^/1/user/-/activities/date/{_DATE}\.json$")),
+    ("spo2_range", re.compile(rf"^/1/user/-/spo2/date/{_DATE}/{_DATE}\.json$")),
+    ("spo2", re.compile(rf"^/1/user/-/spo2/date/{_DATE}\.json$")),
+    ("hrv", re.compile(rf"^/1/user/-/hrv/date/{_DATE}(?:/{_DATE})?\.json$")),
+    ("weight", re.compile(rf"^/1/user/-/body/log/weight/date/{_DATE}/7d\.json$")),
+)
+
+
+def _route(method: str, path: str, query: Dict[str, List[str]]) -> Tuple[str, Optional[Any]]:
+    for name, pattern in _ROUTES:
+        match = pattern.match(path)
+        if not match:
+            continue
+        groups = match.groups()
+        if name == "oauth2_token":
+            return name, _token() if method == "POST" else None
+        if name == "sleep_list":
+            return name, _sleep_list(query)
+        if name == "sleep":
+            return name, _sleep_day(_parse(groups[0]))
+        if name == "sleep_range":
+            logs = [log for day in _days(groups[0], groups[1]) for log in _sleep_logs(day)]
+            return name, {"sleep": logs}
+        if name == "heart_intraday":
+            return name, _heart(_parse(groups[0]), intraday=True)
+        if name == "heart_range":
+            return name, {"activities-heart": [_heart_summary(day) for day in _days(groups[0], groups[1])]}
+        if name == "activity":
+            return name, _activity(_parse(groups[0]))
+        if name == "activity_series":
+            resource, start, end = groups
+            if resource not in _ACTIVITY_SERIES:
+                return name, None
+            days = [_parse(start)] if end == "1d" else _days(start, end)
+            return f"series_{resource}", {f"activities-{resource}": [_series_entry(resource, day) for day in days]}
+        if name == "spo2":
+            return name, _spo2(_parse(groups[0]))
+        if name == "spo2_range":
+            return name, [_spo2(day) for day in _days(groups[0], groups[1])]
+        if name == "hrv":
+            days = _days(groups[0], groups[1]) if groups[1] else [_parse(groups[0])]
+            return name, {"hrv": [_hrv(day) for day in days]}
+        if name == "weight":
+            end = _parse(groups[0])
+            return name, {"weight": [_weight(end - timedelta(days=offset)) for offset in range(6, -1, -1)]}
+    return "unknown", None
+
+
+def _parse(value: str) -> date_cls:
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def _days(start: str, end: str) -> List[date_cls]:
+    first, last = _parse(start), _parse(end)
+    return [first + timedelta(days=offset) for offset in range((last - first).days + 1)]
+
+
+def _rng(day: date_cls, salt: str) -> random.Random:
+    return random.Random(f"{day.isoformat()}:{salt}")
+
+
+def _token() -> Dict[str, Any]:
+    suffix = f"{time.time_ns():x}"
+    return {
+        "access_token": f"fake-access-{suffix}",
+        "refresh_token": f"fake-refresh-{suffix}",
+        "expires_in": 28800,
+        "token_type": "Bearer",
+        "scope": "sleep activity heartrate oxygen_saturation weight",
+        "user_id": "BGPGCR",
+    }
+
+
+def _sleep_logs(day: date_cls) -> List[Dict[str, Any]]:
+    """1晩分のステージ付き睡眠ログ（30秒単位の shortData を含む実データ程度の大きさ）"""
+    rng = _rng(day, "sleep")
+    start = datetime.combine(day - timedelta(days=1), datetime.min.time()) + timedelta(
+        hours=22, minutes=rng.randint(0, 150)
+    )
+    data, short_data = [], []
+    minutes = {"deep": 0, "light": 0, "rem": 0, "wake": 0}
+    counts = {"deep": 0, "light": 0, "rem": 0, "wake": 0}
+    cursor = start
+    for _ in range(rng.randint(28, 40)):
+        level = rng.choices(("light", "deep", "rem", "wake"), weights=(50, 18, 20, 12))[0]
+        seconds = rng.randint(4, 40) * 30
+        data.append({"dateTime": cursor.isoformat(timespec="milliseconds"), "level": level, "seconds": seconds})
+        minutes[level] += seconds // 60
+        counts[level] += 1
+        if level != "wake" and rng.random() < 0.3:
+            short_data.append({
+                "dateTime": (cursor + timedelta(seconds=30)).isoformat(timespec="milliseconds"),
+                "level": "wake",
+                "seconds": 30 * rng.randint(1, 4),
+            })
+        cursor += timedelta(seconds=seconds)
+    in_bed = int((cursor - start).total_seconds() // 60)
+    asleep = in_bed - minutes["wake"]
+    return [{
+        "dateOfSleep": day.isoformat(),
+        "duration": in_bed * 60000,
+        "efficiency": round(100 * asleep / max(1, in_bed)),
+        "startTime": start.isoformat(timespec="milliseconds"),
+        "endTime": cursor.isoformat(timespec="milliseconds"),
+        "infoCode": 0,
+        "isMainSleep": True,
+        "levels": {
+            "data": data,
+            "shortData": short_data,
+            "summary": {
+                level: {"count": counts[level], "minutes": minutes[level], "thirtyDayAvgMinutes": minutes[level]}
+                for level in minutes
+            },
+        },
+        "logId": int(day.strftime("%Y%m%d")) * 10,
+        "logType": "auto_detected",
+        "minutesAfterWakeup": 0,
+        "minutesAsleep": asleep,
+        "minutesAwake": minutes["wake"],
+        "minutesToFallAsleep": 0,
+        "timeInBed": in_bed,
+        "type": "stages",
+    }]
+
+
+def _sleep_day(day: date_cls) -> Dict[str, Any]:
+    logs = _sleep_logs(day)
+    stages = {level: value["minutes"] for level, value in logs[0]["levels"]["summary"].items()}
+    return {
+        "sleep": logs,
+        "summary": {
+            "stages": stages,
+            "totalMinutesAsleep": sum(log["minutesAsleep"] for log in logs),
+            "totalSleepRecords": len(logs),
+            "totalTimeInBed": sum(log["timeInBed"] for log in logs),
+        },
+    }
+
+
+def _sleep_list(query: Dict[str, List[str]]) -> Optional[Dict[str, Any]]:
+    """
+    afterDate より後の睡眠ログ（limit 日分ずつ）
+
+    Fitbitと同じく offset は 0 しか受け付けず、次のページは pagination.next の完全なURL
+    （afterDate をそのページの最後の日に進めたもの）で返す。
+    """
+    after = query.get("afterDate", [None])[0]
+    if after is None:
+        return None
+    if query.get("offset", ["0"])[0] != "0":
+        return {"errors": [{"errorType": "validation", "fieldName": "offset", "message": "Only offset=0 is supported"}]}
+    limit = min(SLEEP_LIST_MAX_LIMIT, int(query.get("limit", [str(SLEEP_LIST_MAX_LIMIT)])[0]))
+    yesterday = date_cls.today() - timedelta(days=1)
+    days = _days((_parse(after) + timedelta(days=1)).isoformat(), yesterday.isoformat())
+    page_days = days[:limit]
+    page = [log for day in page_days for log in _sleep_logs(day)]
+    next_url = ""
+    if len(days) > limit:
+        next_url = (
+            f"https://api.fitbit.com/1.2/user/-/sleep/list.json?afterDate={page_days[-1].isoformat()}"
+            f"&offset=0&limit={limit}&sort=asc"
+        )
+    return {
+        "sleep": page,
+        "pagination": {
+            "afterDate": after,
+            "limit": limit,
+            "next": next_url,
+            "offset": 0,
+            "previous": "",
+            "sort": "asc",
+        },
+    }
+
+
+def _heart_summary(day: date_cls) -> Dict[str, Any]:
+    rng = _rng(day, "heart")
+    zones = []
+    for name, low, high in (("Out of Range", 30, 97), ("Fat Burn", 97, 127), ("Cardio", 127, 154), ("Peak", 154, 220)):
+        zones.append({
+            "caloriesOut": round(rng.uniform(10, 1800), 5),
+            "max": high,
+            "min": low,
+            "minutes": rng.randint(0, 1200 if name == "Out of Range" else 90),
+            "name": name,
+        })
+    return {
+        "dateTime": day.isoformat(),
+        "value": {"customHeartRateZones": [], "heartRateZones": zones, "restingHeartRate": rng.randint(52, 68)},
+    }
+
+
+def _heart(day: date_cls, intraday: bool) -> Dict[str, Any]:
+    payload: Dict[str, Any] = {"activities-heart": [_heart_summary(day)]}
+    if intraday:
+        rng = _rng(day, "heart-intraday")
+        dataset = []
+        bpm = 60
+        for minute in range(1440):
+            # 装着していない時間帯は記録がない
+            if rng.random() < 0.04:
+                continue
+            bpm = max(40, min(180, bpm + rng.randint(-4, 4)))
+            dataset.append({"time": f"{minute // 60:02d}:{minute % 60:02d}:00", "value": bpm})
+        payload["activities-heart-intraday"] = {"dataset": dataset, "datasetInterval": 1, "datasetType": "minute"}
+    return payload
+
+
+def _series_value(resource: str, day: date_cls) -> Any:
+    rng = _rng(day, "activity")
+    values = {
+        "steps": rng.randint(2000, 16000),
+        "distance": round(rng.uniform(1.5, 12.0), 2),
+        "floors": rng.randint(0, 30),
+        "elevation": round(rng.uniform(0, 90), 1),
+        "calories": rng.randint(1700, 3200),
+        "caloriesBMR": rng.randint(1400, 1600),
+        "activityCalories": rng.randint(200, 1500),
+        "minutesSedentary": rng.randint(500, 900),
+        "minutesLightlyActive": rng.randint(100, 300),
+        "minutesFairlyActive": rng.randint(0, 60),
+        "minutesVeryActive": rng.randint(0, 90),
+    }
+    return values[resource]
+
+
+def _series_entry(resource: str, day: date_cls) -> Dict[str, str]:
+    return {"dateTime": day.isoformat(), "value": str(_series_value(resource, day))}
+
+
+def _activity(day: date_cls) -> Dict[str, Any]:
+    value = lambda resource: _series_value(resource, day)  # noqa: E731
+    return {
+        "activities": [],
+        "goals": {"activeMinutes": 30, "caloriesOut": 2500, "distance": 8.05, "floors": 10, "steps": 10000},
+        "summary": {
+            "activeScore": -1,
+            "activityCalories": value("activityCalories"),
+            "caloriesBMR": value("caloriesBMR"),
+            "caloriesOut": value("calories"),
+            "distances": [
+                {"activity": "total", "distance": value("distance")},
+                {"activity": "tracker", "distance": value("distance")},
+                {"activity": "loggedActivities", "distance": 0},
+            ],
+            "elevation": value("elevation"),
+            "fairlyActiveMinutes": value("minutesFairlyActive"),
+            "floors": value("floors"),
+            "heartRateZones": _heart_summary(day)["value"]["heartRateZones"],
+            "lightlyActiveMinutes": value("minutesLightlyActive"),
+            "marginalCalories": value("activityCalories") // 2,
+            "restingHeartRate": _heart_summary(day)["value"]["restingHeartRate"],
+            "sedentaryMinutes": value("minutesSedentary"),
+            "steps": value("steps"),
+            "veryActiveMinutes": value("minutesVeryActive"),
+        },
+    }
+
+
+def _spo2(day: date_cls) -> Dict[str, Any]:
+    rng = _rng(day, "spo2")
+    avg = round(rng.uniform(94, 98), 1)
+    return {"dateTime": day.isoformat(), "value": {"avg": avg, "min": round(avg - 2, 1), "max": round(avg + 1.5, 1)}}
+
+
+def _hrv(day: date_cls) -> Dict[str, Any]:
+    rng = _rng(day, "hrv")
+    return {
+        "dateTime": day.isoformat(),
+        "value": {"dailyRmssd": round(rng.uniform(20, 60), 3), "deepRmssd": round(rng.uniform(20, 70), 3)},
+    }
+
+
+def _weight(day: date_cls) -> Dict[str, Any]:
+    rng = _rng(day, "weight")
+    weight = round(rng.uniform(60, 62), 1)
+    return {
+        "bmi": round(weight / 1.7 ** 2, 2),
+        "date": day.isoformat(),
+        "logId": int(day.strftime("%Y%m%d")),
+        "source": "Aria",
+        "time": "07:00:00",
+        "weight": weight,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="応答の遅延（ミリ秒）")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="遅延のばらつき（±ミリ秒）")
+    parser.add_argument("--rate-limit", type=int, default=DEFAULT_RATE_LIMIT, help="ウィンドウあたりのリクエスト数")
+    parser.add_argument("--rate-window", type=float, default=DEFAULT_RATE_WINDOW_SECONDS, help="レート制限のウィンドウ（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="429 / 5xx を返す割合（0〜1）")
+    parser.add_argument("--error-statuses", default="429,500,502,503", help="注入するステータス（カンマ区切り）")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server = FakeFitbitServer(
+        host=args.host,
+        port=args.port,
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        rate_limit=args.rate_limit,
+        rate_window_seconds=args.rate_window,
+        error_rate=args.error_rate,
+        error_statuses=[int(status) for status in args.error_statuses.split(",") if status],
+        seed=args.seed,
+    )
+    print(f"🩺 Fitbit APIの代替サーバーを起動しました: {server.base_url}（FITBIT_API_BASE に指定）", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
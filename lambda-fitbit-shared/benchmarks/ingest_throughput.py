@@ -0,0 +1,245 @@
+"""
+Fitbit Lambda（日次・バックフィル）の取り込みスループットのベンチマーク
+
+fake_fitbit.py の代替サーバーをこのプロセスで起動し、シナリオごとに新しいPythonプロセスで
+moto上のS3/DynamoDBに対して lambda_handler を呼び出す。Fitbit APIにもAWSにもアクセスしない。
+- days/hour: 取り込んだ日数 / ハンドラーの所要時間（レート制限による待機を含む）
+- requests/day: 代替サーバーが受けたFitbit API呼び出し数（トークンのリフレッシュを除く） / 日数
+- peak_rss_mb: 子プロセスの最大RSS（moto を含む）。handler_rss_mb はハンドラー実行中に増えた分
+- py_peak_mb: --tracemalloc 指定時、ハンドラー実行中のPythonオブジェクトのメモリのピーク
+
+シナリオ:
+- daily: 日次Lambda（前日 + 欠損日の補完で --days 日分。S3が空なので遡った日はすべて欠損になる）
+- backfill-daily / backfill-range: バックフィルLambdaの daily / range モードで --days 日分
+
+使い方:
+    python lambda-fitbit-shared/benchmarks/ingest_throughput.py [--days 30] [--latency-ms 80] [--error-rate 0.02]
+    python lambda-fitbit-shared/benchmarks/ingest_throughput.py --scenario backfill-range --days 90 --json
+
+レート制限に当たるとLambdaはリセットまで待つため、日数を増やす場合は --rate-limit も上げる。
+moto はベンチマーク専用（Lambdaの requirements.txt には含めない）。
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from datetime import date as date_cls, timedelta
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_fitbit import FakeFitbitServer  # noqa: E402
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+BUCKET = "ingest-throughput-bench"
+BACKFILL_START = date_cls(2025, 1, 1)
+SCENARIOS = {
+    "daily": "lambda-fitbit",
+    "backfill-daily": "lambda-fitbit-backfill",
+    "backfill-range": "lambda-fitbit-backfill",
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", default=",".join(SCENARIOS), help="カンマ区切りのシナリオ")
+    parser.add_argument("--days", type=int, default=30, help="1回の呼び出しで取り込む日数（daily は最大91）")
+    parser.add_argument("--runs", type=int, default=1, help="シナリオごとの実行回数")
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="代替サーバーの応答遅延（ミリ秒）")
+    parser.add_argument("--jitter-ms", type=float, default=10.0, help="応答遅延のばらつき（±ミリ秒）")
+    parser.add_argument("--rate-limit", type=int, default=1000, help="代替サーバーのユーザーごとのレート制限（件/時）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="429 / 5xx を返す割合（0〜1）")
+    parser.add_argument("--error-statuses", default="429,500,502,503", help="注入するステータス（カンマ区切り）")
+    parser.add_argument("--raw-format", help="FITBIT_RAW_FORMAT（例: ndjson.gz）")
+    parser.add_argument("--tracemalloc", action="store_true", help="Pythonオブジェクトのメモリのピークも計測する（遅くなる）")
+    parser.add_argument("--json", action="store_true", help="結果をJSONで出力する")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--base-url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(_measure(args.child, args)))
+        return
+
+    results = []
+    for scenario in [name.strip() for name in args.scenario.split(",") if name.strip()]:
+        if scenario not in SCENARIOS:
+            parser.error(f"不明なシナリオ: {scenario}（{', '.join(SCENARIOS)}）")
+        for _ in range(args.runs):
+            results.append(_run_scenario(scenario, args))
+
+    if args.json:
+        print(json.dumps(results, indent=2, ensure_ascii=False))
+    else:
+        _report(results, args)
+
+
+def _run_scenario(scenario: str, args) -> Dict[str, Any]:
+    """代替サーバーを起動し、子プロセスでハンドラーを1回呼び出す"""
+    server = FakeFitbitServer(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        rate_limit=args.rate_limit,
+        error_rate=args.error_rate,
+        error_statuses=[int(status) for status in args.error_statuses.split(",") if status],
+    ).start()
+    try:
+        command = [
+            sys.executable, os.path.abspath(__file__),
+            "--child", scenario,
+            "--base-url", server.base_url,
+            "--days", str(args.days),
+        ]
+        if args.raw_format:
+            command += ["--raw-format", args.raw_format]
+        if args.tracemalloc:
+            command.append("--tracemalloc")
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        fitbit = server.stats()
+    finally:
+        server.stop()
+
+    days = result["days"]
+    seconds = result["handler_seconds"]
+    result.update({
+        "scenario": scenario,
+        "fitbit_requests": fitbit["api_requests"],
+        "token_requests": fitbit["token_requests"],
+        "fitbit_statuses": fitbit["statuses"],
+        "injected_errors": fitbit["injected_errors"],
+        "days_per_hour": round(days / seconds * 3600, 1) if seconds and days else 0.0,
+        "requests_per_day": round(fitbit["api_requests"] / days, 2) if days else None,
+    })
+    return result
+
+
+def _measure(scenario: str, args) -> Dict[str, Any]:
+    """子プロセス: moto上でハンドラーを1回呼び出して計測する"""
+    os.environ.update({
+        "AWS_DEFAULT_REGION": "ap-northeast-1",
+        "AWS_ACCESS_KEY_ID": "bench",
+        "AWS_SECRET_ACCESS_KEY": "bench",
+        "FITBIT_CLIENT_SECRET": "bench",
+        "FITBIT_API_BASE": args.base_url,
+        "S3_BUCKET": BUCKET,
+        # EMF は標準出力に書かれ、結果のJSONと混ざるため止める（集計はレスポンスの metrics で受け取る）
+        "FITBIT_METRICS": "off",
+    })
+    if args.raw_format:
+        os.environ["FITBIT_RAW_FORMAT"] = args.raw_format
+    sys.path.insert(0, os.path.join(REPO_ROOT, SCENARIOS[scenario]))
+
+    from moto import mock_aws  # pylint: disable=import-outside-toplevel
+
+    with mock_aws():
+        import lambda_function  # noqa: E402  pylint: disable=import-outside-toplevel
+        import aws_clients  # noqa: E402  pylint: disable=import-outside-toplevel
+
+        _create_fixtures(aws_clients)
+        event = _event(scenario, args.days)
+        context = type("Context", (object,), {
+            "aws_request_id": "bench",
+            "function_name": SCENARIOS[scenario],
+            "get_remaining_time_in_millis": lambda self: 900000,
+        })()
+
+        if args.tracemalloc:
+            import tracemalloc  # pylint: disable=import-outside-toplevel
+            tracemalloc.start()
+        rss_before = _max_rss_mb()
+        started = time.perf_counter()
+        response = lambda_function.lambda_handler(event, context)
+        handler_seconds = time.perf_counter() - started
+        result: Dict[str, Any] = {
+            "status": response["statusCode"],
+            "handler_seconds": round(handler_seconds, 3),
+            "peak_rss_mb": _max_rss_mb(),
+            "handler_rss_mb": round(_max_rss_mb() - rss_before, 1),
+        }
+        if args.tracemalloc:
+            result["py_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+            tracemalloc.stop()
+
+        body = json.loads(response["body"])
+        result["days"] = _days_ingested(scenario, body)
+        result["objects_written"] = len(_iter_keys(aws_clients.client("s3")))
+        result["time_by_service_ms"] = (body.get("metrics") or {}).get("time_by_service_ms", {})
+        return result
+
+
+def _event(scenario: str, days: int) -> Dict[str, Any]:
+    if scenario == "daily":
+        return {"gap_lookback_days": max(0, days - 1)}
+    return {
+        "start_date": BACKFILL_START.isoformat(),
+        "end_date": (BACKFILL_START + timedelta(days=days - 1)).isoformat(),
+        "force": True,
+        "fetch_mode": scenario.split("-", 1)[1],
+    }
+
+
+def _days_ingested(scenario: str, body: Dict[str, Any]) -> int:
+    if scenario == "daily":
+        saved = 1 if body.get("files_saved") else 0
+        return saved + len((body.get("gaps") or {}).get("filled_dates", []))
+    return len(body.get("fetched", []))
+
+
+def _create_fixtures(aws_clients) -> None:
+    aws_clients.client("s3").create_bucket(
+        Bucket=BUCKET, CreateBucketConfiguration={"LocationConstraint": "ap-northeast-1"}
+    )
+    aws_clients.client("dynamodb").create_table(
+        TableName="fitbit_tokens",
+        KeySchema=[{"AttributeName": "user_id", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "user_id", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    aws_clients.table("fitbit_tokens").put_item(Item={
+        "user_id": "BGPGCR",
+        "access_token": "bench",
+        "refresh_token": "bench",
+        "expires_at": int(time.time()) + 3600,
+    })
+
+
+def _iter_keys(s3) -> List[str]:
+    keys = []
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=BUCKET):
+        keys.extend(item["Key"] for item in page.get("Contents", []))
+    return keys
+
+
+def _max_rss_mb() -> float:
+    # Linux の ru_maxrss はKiB、macOS はバイト
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1)
+
+
+def _report(results: List[Dict[str, Any]], args) -> None:
+    print(
+        f"== latency={args.latency_ms}±{args.jitter_ms}ms error_rate={args.error_rate} "
+        f"days={args.days} raw_format={args.raw_format or 'json'}"
+    )
+    header = f"  {'scenario':<16}{'status':>7}{'days':>6}{'sec':>9}{'days/h':>10}{'req/day':>9}{'peakMB':>8}{'handlerMB':>11}"
+    if args.tracemalloc:
+        header += f"{'pyPeakMB':>10}"
+    print(header)
+    for result in results:
+        line = (
+            f"  {result['scenario']:<16}{result['status']:>7}{result['days']:>6}{result['handler_seconds']:>9}"
+            f"{result['days_per_hour']:>10}{str(result['requests_per_day']):>9}"
+            f"{result['peak_rss_mb']:>8}{result['handler_rss_mb']:>11}"
+        )
+        if args.tracemalloc:
+            line += f"{result.get('py_peak_mb', ''):>10}"
+        print(line)
+        print(f"  {'':<16}fitbit statuses={result['fitbit_statuses']} time_by_service_ms={result['time_by_service_ms']}")
+
+
+if __name__ == "__main__":
+    main()
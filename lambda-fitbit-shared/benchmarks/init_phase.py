@@ -0,0 +1,160 @@
+"""
+Fitbit Lambda（日次・バックフィル）の初期化フェーズのベンチマーク
+
+Lambdaのコールドスタートを模して、毎回新しいPythonプロセスで以下を計測する。
+- import: lambda_function の読み込み時間（boto3・共有モジュールの import を含む）
+- aws_clients: レジストリの初回呼び出し（セッション・クライアント作成）と2回目以降の呼び出し
+- invoke: moto が使える場合、moto上のS3/DynamoDBとダミーのFitbit応答でハンドラーを2回呼び出した時間（1回目=コールド、2回目=ウォーム）
+
+使い方:
+    python lambda-fitbit-shared/benchmarks/init_phase.py [--runs 5] [--no-invoke]
+
+moto はベンチマーク専用（Lambdaの requirements.txt には含めない）。
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+LAMBDA_DIRS = ("lambda-fitbit", "lambda-fitbit-backfill")
+BUCKET = "init-phase-bench"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="Lambdaごとのコールドスタート回数")
+    parser.add_argument("--no-invoke", action="store_true", help="ハンドラーの呼び出しを計測しない")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(_measure(args.child, invoke=not args.no_invoke)))
+        return
+
+    for lambda_dir in LAMBDA_DIRS:
+        samples = []
+        for _ in range(args.runs):
+            command = [sys.executable, os.path.abspath(__file__), "--child", lambda_dir]
+            if args.no_invoke:
+                command.append("--no-invoke")
+            output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+            samples.append(json.loads(output.strip().splitlines()[-1]))
+        _report(lambda_dir, samples)
+
+
+def _measure(lambda_dir: str, invoke: bool) -> dict:
+    os.environ.update({
+        "AWS_DEFAULT_REGION": "ap-northeast-1",
+        "AWS_ACCESS_KEY_ID": "bench",
+        "AWS_SECRET_ACCESS_KEY": "bench",
+        "FITBIT_CLIENT_SECRET": "bench",
+        "S3_BUCKET": BUCKET,
+    })
+    sys.path.insert(0, os.path.join(REPO_ROOT, lambda_dir))
+
+    started = time.perf_counter()
+    import lambda_function  # noqa: E402  pylint: disable=import-outside-toplevel
+    import aws_clients  # noqa: E402  pylint: disable=import-outside-toplevel
+    result = {"import_ms": _ms(time.perf_counter() - started)}
+
+    started = time.perf_counter()
+    aws_clients.client("s3")
+    result["first_client_ms"] = _ms(time.perf_counter() - started)
+    started = time.perf_counter()
+    for _ in range(100):
+        aws_clients.client("s3")
+    result["cached_client_us"] = round((time.perf_counter() - started) * 10000, 2)
+
+    if invoke:
+        result.update(_measure_invoke(lambda_function, aws_clients))
+    return result
+
+
+def _measure_invoke(lambda_function, aws_clients) -> dict:
+    try:
+        from moto import mock_aws  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return {}
+
+    with mock_aws():
+        aws_clients.reset()
+        _create_fixtures(aws_clients)
+        # 計測対象の「初回呼び出し」にクライアント作成を含めるため、準備に使ったものは破棄する
+        aws_clients.reset()
+        lambda_function.http = _FakeFitbit()
+
+        context = type("Context", (object,), {
+            "aws_request_id": "bench",
+            "get_remaining_time_in_millis": lambda self: 900000,
+        })()
+        event = {"start_date": "2025-01-01", "end_date": "2025-01-01", "force": True}
+
+        timings = {}
+        for label in ("cold", "warm"):
+            started = time.perf_counter()
+            response = lambda_function.lambda_handler(event, context)
+            timings[f"invoke_{label}_ms"] = _ms(time.perf_counter() - started)
+            timings[f"invoke_{label}_status"] = response["statusCode"]
+        timings["clients_built"] = sorted(aws_clients.build_seconds)
+        return timings
+
+
+def _create_fixtures(aws_clients) -> None:
+    aws_clients.client("s3").create_bucket(
+        Bucket=BUCKET, CreateBucketConfiguration={"LocationConstraint": "ap-northeast-1"}
+    )
+    aws_clients.client("dynamodb").create_table(
+        TableName="fitbit_tokens",
+        KeySchema=[{"AttributeName": "user_id", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "user_id", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    aws_clients.table("fitbit_tokens").put_item(Item={
+        "user_id": "BGPGCR",
+        "access_token": "bench",
+        "refresh_token": "bench",
+        "expires_at": int(time.time()) + 3600,
+    })
+
+
+class _FakeResponse:
+    def __init__(self, body: dict):
+        self.status = 200
+        self.data = json.dumps(body).encode("utf-8")
+        self.headers = {"Fitbit-Rate-Limit-Remaining": "149", "Fitbit-Rate-Limit-Reset": "3600"}
+
+
+class _FakeFitbit:
+    """Fitbit APIの代わりに固定の応答を返す（ネットワーク待ちを含めない）"""
+
+    def request(self, method, url, headers=None, body=None, **kwargs):
+        if "oauth2/token" in url:
+            return _FakeResponse({"access_token": "bench", "refresh_token": "bench", "expires_in": 28800})
+        if "heart" in url:
+            dataset = [{"time": f"{i // 60:02d}:{i % 60:02d}:00", "value": 60 + i % 50} for i in range(1440)]
+            return _FakeResponse({"activities-heart": [], "activities-heart-intraday": {"dataset": dataset}})
+        return _FakeResponse({"summary": {}, "sleep": [], "activities-steps": []})
+
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 1)
+
+
+def _report(lambda_dir: str, samples: list) -> None:
+    print(f"== {lambda_dir} ({len(samples)} runs)")
+    for key in samples[0]:
+        values = [sample[key] for sample in samples if isinstance(sample.get(key), (int, float))]
+        if not values or key.endswith("_status"):
+            continue
+        print(f"  {key:<20} median={statistics.median(values):>8}  min={min(values):>8}  max={max(values):>8}")
+    built = samples[0].get("clients_built")
+    if built:
+        print(f"  {'clients_built':<20} {', '.join(built)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+"""
+Fitbitサブスクリプション通知（webhook.py）の再生ツール
+
+Fitbitが同期のたびに送ってくる通知のバースト（同じユーザー・コレクション・日付の重複を含む）を、
+署名付きのPOSTとして並列に送り、受信の応答時間と、まとめた後の取得件数を計測する。
+- ローカル（既定）: fake_fitbit.py の代替サーバーと moto 上の DynamoDB/S3 を使い、webhook.lambda_handler を
+  関数URLのイベントに変換して呼ぶHTTPサーバーをこのプロセスで起動する。送信後に drain を1回実行する
+- --target URL: デプロイ済みの関数URLに送る（受信の応答だけを計測する。--client-secret が必要）
+
+結果:
+- 204 の件数と応答時間（p50 / p95 / max）。Fitbitは5秒以内に応答しない通知を再送・停止する
+- queued / coalesced: 新しく取得待ちになった項目数と、既存の項目にまとめた通知数
+- fitbit_requests: drain が代替サーバーに送ったAPI呼び出し数（トークンのリフレッシュを除く）
+- objects_written: S3に書き込んだオブジェクト数
+
+使い方:
+    python lambda-fitbit-shared/benchmarks/webhook_replay.py [--notifications 300] [--users 3] [--days 3]
+    python lambda-fitbit-shared/benchmarks/webhook_replay.py --target https://xxxx.lambda-url.ap-northeast-1.on.aws/ --client-secret ...
+
+moto はベンチマーク専用（Lambdaの requirements.txt には含めない）。
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date as date_cls, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Tuple
+from urllib import request as urllib_request
+from urllib.error import HTTPError
+from urllib.parse import parse_qsl, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_fitbit import FakeFitbitServer  # noqa: E402
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+BUCKET = "webhook-replay-bench"
+PENDING_TABLE = "fitbit_webhook_pending"
+CLIENT_SECRET = "bench"
+# Fitbitが通知を送るコレクション（foods は取得対象外として捨てられることの確認用）
+COLLECTION_TYPES = ("activities", "sleep", "body", "foods")
+COLLECTION_WEIGHTS = (6, 3, 1, 1)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--notifications", type=int, default=300, help="送る通知の数")
+    parser.add_argument("--batch-size", type=int, default=3, help="1回のPOSTに含める通知の数")
+    parser.add_argument("--users", type=int, default=3, help="通知を送るユーザー数")
+    parser.add_argument("--days", type=int, default=3, help="通知の日付の範囲（今日から遡る日数）")
+    parser.add_argument("--concurrency", type=int, default=16, help="同時に送るPOSTの数")
+    parser.add_argument("--coalesce-seconds", type=int, default=1, help="FITBIT_WEBHOOK_COALESCE_SECONDS")
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="代替サーバーの応答遅延（ミリ秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="代替サーバーが 429 / 5xx を返す割合（0〜1）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--target", help="デプロイ済みの関数URL（指定するとローカルの代替環境を使わない）")
+    parser.add_argument("--client-secret", default=CLIENT_SECRET, help="署名に使う FITBIT_CLIENT_SECRET")
+    parser.add_argument("--json", action="store_true", help="結果をJSONで出力する")
+    args = parser.parse_args()
+
+    bodies = _bursts(args)
+    if args.target:
+        result = {"target": args.target, **_send_all(args.target, bodies, args)}
+    else:
+        result = _replay_locally(bodies, args)
+
+    if args.json:
+        print(json.dumps(result, indent=2, ensure_ascii=False))
+    else:
+        _report(result)
+
+
+def _bursts(args) -> List[bytes]:
+    """通知の本文（JSON配列）のリスト。少ない (ユーザー, コレクション, 日付) から選ぶので重複が多くなる"""
+    rand = random.Random(args.seed)
+    users = [f"REPLAY{index:02d}" for index in range(args.users)]
+    today = date_cls.today()
+    notifications = []
+    for index in range(args.notifications):
+        collection_type = rand.choices(COLLECTION_TYPES, weights=COLLECTION_WEIGHTS)[0]
+        owner_id = rand.choice(users)
+        notifications.append({
+            "collectionType": collection_type,
+            "date": (today - timedelta(days=rand.randrange(args.days))).isoformat(),
+            "ownerId": owner_id,
+            "ownerType": "user",
+            "subscriptionId": f"{owner_id}-{collection_type}",
+        })
+    size = max(1, args.batch_size)
+    return [json.dumps(notifications[i:i + size]).encode("utf-8") for i in range(0, len(notifications), size)]
+
+
+def _sign(body: bytes, client_secret: str) -> str:
+    digest = hmac.new(f"{client_secret}&".encode("utf-8"), body, hashlib.sha1).digest()
+    return base64.b64encode(digest).decode("ascii")
+
+
+def _send_all(url: str, bodies: List[bytes], args) -> Dict[str, Any]:
+    """通知を並列にPOSTし、ステータスと応答時間を集計する"""
+
+    def send(body: bytes) -> Tuple[int, float]:
+        req = urllib_request.Request(url, data=body, method="POST", headers={
+            "Content-Type": "application/json",
+            "X-Fitbit-Signature": _sign(body, args.client_secret),
+        })
+        started = time.perf_counter()
+        try:
+            with urllib_request.urlopen(req, timeout=30) as response:
+                status = response.status
+        except HTTPError as err:
+            status = err.code
+        return status, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        responses = list(executor.map(send, bodies))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(seconds * 1000 for _, seconds in responses)
+    statuses: Dict[str, int] = {}
+    for status, _ in responses:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        "posts": len(bodies),
+        "notifications": sum(len(json.loads(body)) for body in bodies),
+        "statuses": statuses,
+        "accepted_204": statuses.get("204", 0),
+        "send_seconds": round(elapsed, 3),
+        "latency_ms": {
+            "p50": round(_percentile(latencies, 0.50), 1),
+            "p95": round(_percentile(latencies, 0.95), 1),
+            "max": round(latencies[-1], 1) if latencies else 0.0,
+        },
+    }
+
+
+def _replay_locally(bodies: List[bytes], args) -> Dict[str, Any]:
+    """代替サーバー・moto・関数URLの代わりのHTTPサーバーで、受信から drain までを通して実行する"""
+    fake = FakeFitbitServer(latency_ms=args.latency_ms, jitter_ms=args.latency_ms / 5, rate_limit=1000,
+                            error_rate=args.error_rate, seed=args.seed).start()
+    os.environ.update({
+        "AWS_DEFAULT_REGION": "ap-northeast-1",
+        "AWS_ACCESS_KEY_ID": "bench",
+        "AWS_SECRET_ACCESS_KEY": "bench",
+        "FITBIT_CLIENT_SECRET": args.client_secret,
+        "FITBIT_API_BASE": fake.base_url,
+        "FITBIT_WEBHOOK_TABLE": PENDING_TABLE,
+        "FITBIT_WEBHOOK_COALESCE_SECONDS": str(args.coalesce_seconds),
+        "S3_BUCKET": BUCKET,
+        "FITBIT_METRICS": "off",
+    })
+    sys.path.insert(0, os.path.join(REPO_ROOT, "lambda-fitbit"))
+
+    from moto import mock_aws  # pylint: disable=import-outside-toplevel
+
+    with mock_aws():
+        import webhook  # noqa: E402  pylint: disable=import-outside-toplevel
+        import aws_clients  # noqa: E402  pylint: disable=import-outside-toplevel
+
+        _create_fixtures(aws_clients, args.users)
+        httpd = _function_url_server(webhook)
+        threading.Thread(target=httpd.serve_forever, name="function-url", daemon=True).start()
+        try:
+            host, port = httpd.server_address[:2]
+            result = {"target": "local", **_send_all(f"http://{host}:{port}/", bodies, args)}
+            queued = len(webhook.webhook_queue.PendingQueue.from_env().pending_items())
+
+            context = type("Context", (object,), {
+                "aws_request_id": "replay",
+                "function_name": "moderation-craft-fitbit-webhook",
+                "get_remaining_time_in_millis": lambda self: 300000,
+            })()
+            started = time.perf_counter()
+            response = webhook.lambda_handler({"webhook_drain": True}, context)
+            drain_seconds = time.perf_counter() - started
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+
+        body = json.loads(response["body"])
+        stats = fake.stats()
+        fake.stop()
+        accepted = sum(len(json.loads(raw)) for raw in bodies)
+        skipped = sum(1 for raw in bodies for entry in json.loads(raw) if entry["collectionType"] == "foods")
+        result.update({
+            "queued": queued,
+            "coalesced": accepted - skipped - queued,
+            "not_subscribed": skipped,
+            "drain_status": response["statusCode"],
+            "drain_seconds": round(drain_seconds, 3),
+            "ingested": len(body.get("ingested", [])),
+            "failed": body.get("failed", []),
+            "fitbit_requests": stats["api_requests"],
+            "fitbit_statuses": stats["statuses"],
+            "objects_written": len(_iter_keys(aws_clients.client("s3"))),
+        })
+        return result
+
+
+def _function_url_server(webhook) -> ThreadingHTTPServer:
+    """受けたリクエストを Lambda関数URL（ペイロード v2.0）のイベントにして webhook.lambda_handler を呼ぶ"""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self) -> None:  # noqa: N802
+            self._invoke("GET", b"")
+
+        def do_POST(self) -> None:  # noqa: N802
+            self._invoke("POST", self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+
+        def _invoke(self, method: str, body: bytes) -> None:
+            url = urlparse(self.path)
+            event = {
+                "version": "2.0",
+                "rawPath": url.path,
+                "rawQueryString": url.query,
+                "queryStringParameters": dict(parse_qsl(url.query)) or None,
+                "headers": {name.lower(): value for name, value in self.headers.items()},
+                "requestContext": {"http": {"method": method, "path": url.path}},
+                "body": base64.b64encode(body).decode("ascii"),
+                "isBase64Encoded": True,
+            }
+            response = webhook.lambda_handler(event, None)
+            payload = (response.get("body") or "").encode("utf-8")
+            self.send_response(response["statusCode"])
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args) -> None:  # pylint: disable=redefined-builtin
+            pass
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    httpd.daemon_threads = True
+    return httpd
+
+
+def _create_fixtures(aws_clients, users: int) -> None:
+    aws_clients.client("s3").create_bucket(
+        Bucket=BUCKET, CreateBucketConfiguration={"LocationConstraint": "ap-northeast-1"}
+    )
+    dynamodb = aws_clients.client("dynamodb")
+    dynamodb.create_table(
+        TableName="fitbit_tokens",
+        KeySchema=[{"AttributeName": "user_id", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "user_id", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    dynamodb.create_table(
+        TableName=PENDING_TABLE,
+        KeySchema=[
+            {"AttributeName": "user_id", "KeyType": "HASH"},
+            {"AttributeName": "item_key", "KeyType": "RANGE"},
+        ],
+        AttributeDefinitions=[
+            {"AttributeName": "user_id", "AttributeType": "S"},
+            {"AttributeName": "item_key", "AttributeType": "S"},
+            {"AttributeName": "queue", "AttributeType": "S"},
+            {"AttributeName": "due_at", "AttributeType": "N"},
+        ],
+        GlobalSecondaryIndexes=[{
+            "IndexName": "due_at-index",
+            "KeySchema": [
+                {"AttributeName": "queue", "KeyType": "HASH"},
+                {"AttributeName": "due_at", "KeyType": "RANGE"},
+            ],
+            "Projection": {"ProjectionType": "ALL"},
+        }],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    # 代替サーバーはアクセストークンごとにレート制限するため、ユーザーごとに別のトークンにする
+    for index in range(users):
+        aws_clients.table("fitbit_tokens").put_item(Item={
+            "user_id": f"REPLAY{index:02d}",
+            "access_token": f"replay-{index}",
+            "refresh_token": f"replay-{index}",
+            "expires_at": int(time.time()) + 3600,
+        })
+
+
+def _iter_keys(s3) -> List[str]:
+    keys = []
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=BUCKET):
+        keys.extend(item["Key"] for item in page.get("Contents", []))
+    return keys
+
+
+def _percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def _report(result: Dict[str, Any]) -> None:
+    latency = result["latency_ms"]
+    print(f"== target={result['target']} posts={result['posts']} notifications={result['notifications']}")
+    print(
+        f"  receive: 204={result['accepted_204']}/{result['posts']} statuses={result['statuses']} "
+        f"send={result['send_seconds']}s latency p50={latency['p50']}ms p95={latency['p95']}ms max={latency['max']}ms"
+    )
+    if result["target"] != "local":
+        return
+    print(
+        f"  queue  : queued={result['queued']} coalesced={result['coalesced']} "
+        f"not_subscribed={result['not_subscribed']}"
+    )
+    print(
+        f"  drain  : status={result['drain_status']} {result['drain_seconds']}s ingested={result['ingested']} "
+        f"failed={len(result['failed'])} fitbit_requests={result['fitbit_requests']} "
+        f"objects_written={result['objects_written']} fitbit statuses={result['fitbit_statuses']}"
+    )
+
+
+if __name__ == "__main__":
+    main()
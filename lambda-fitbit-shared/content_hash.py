@@ -0,0 +1,60 @@
+"""
+rawレイヤーの内容ハッシュによる重複書き込みの抑止
+
+データタイプごとに data 部分（metadata を除く）のハッシュを計算し、日付パーティションの
+_summary.json に content_hashes として記録する。再実行や force=True のバックフィルで
+Fitbitが同じ内容を返した場合は PUT を省略し、extraction_timestamp も更新しない。
+すべてのデータタイプが変わっていなければ _summary.json 自体も書き直さない。
+"""
+import hashlib
+import json
+import logging
+from typing import Any, Dict, Optional
+
+from botocore.exceptions import ClientError
+
+import json_stream
+
+logger = logging.getLogger()
+
+# 各オブジェクトのユーザー定義メタデータにも同じハッシュを残す（x-amz-meta-content-sha256）
+HASH_METADATA_KEY = "content-sha256"
+
+
+def payload_hash(content: Any) -> str:
+    """
+    キー順に依存しない正規化JSONの SHA-256
+
+    正規化JSON（sort_keys・区切り文字なし・ensure_ascii=False の json.dumps と同じ）を文字列全体を作らずにハッシュする。
+    """
+    digest = hashlib.sha256()
+    for block in json_stream.iter_bytes(json_stream.iter_compact(content, sort_keys=True, ensure_ascii=False)):
+        digest.update(block)
+    return digest.hexdigest()
+
+
+def load_manifest(s3_client, bucket: str, summary_key: str) -> Optional[Dict[str, Dict[str, Any]]]:
+    """
+    既存の _summary.json から content_hashes を読み込む
+
+    戻り値はデータタイプ -> {"sha256", "format", "key"}。_summary.json がなければ None
+    （ハッシュ導入前のサマリーは空の辞書として扱い、最初の実行で書き直す）。
+    """
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=summary_key)
+    except ClientError as err:
+        if err.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None
+        raise
+
+    try:
+        summary = json.loads(response["Body"].read())
+    except ValueError:
+        logger.warning("⚠️ %s を読み込めないため全データを書き直します", summary_key)
+        return {}
+    return summary.get("content_hashes") or {}
+
+
+def is_unchanged(previous: Optional[Dict[str, Any]], content_hash: str, raw_format: str) -> bool:
+    """前回と同じ内容・同じ出力形式で保存済みか"""
+    return bool(previous) and previous.get("sha256") == content_hash and previous.get("format") == raw_format
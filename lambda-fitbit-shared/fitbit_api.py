@@ -0,0 +1,121 @@
+"""
+Fitbit Web API 呼び出しの共通ヘルパー
+日次Lambdaとバックフィルの両方から利用する
+"""
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Tuple
+
+import urllib3
+
+import retry_policy
+from rate_limiter import FitbitRateLimiter
+from retry_policy import CircuitOpenError, Deadline, RetryPolicy
+
+logger = logging.getLogger()
+
+# ローカルの代替サーバー（benchmarks/fake_fitbit.py）で計測するときだけ FITBIT_API_BASE で上書きする
+FITBIT_API_BASE = os.environ.get("FITBIT_API_BASE", "https://api.fitbit.com").rstrip("/")
+
+# 1日分のエンドポイント数（sleep/activity/heart_rate/steps）を上限の目安とする
+DEFAULT_FETCH_CONCURRENCY = 4
+MAX_FETCH_CONCURRENCY = 8
+
+# 429 / 5xx / 通信エラーの再試行（FITBIT_RETRY_MAX_ATTEMPTS=1 で従来どおり1回のみ）
+DEFAULT_RETRY_POLICY = RetryPolicy.from_env()
+
+
+def fetch_concurrency_from_env(default: int = DEFAULT_FETCH_CONCURRENCY) -> int:
+    """FITBIT_FETCH_CONCURRENCY から並列取得数を読み込む（1で逐次取得）"""
+    try:
+        value = int(os.environ.get("FITBIT_FETCH_CONCURRENCY", str(default)))
+    except ValueError:
+        value = default
+    return max(1, min(value, MAX_FETCH_CONCURRENCY))
+
+
+def build_pool_manager(concurrency: int) -> urllib3.PoolManager:
+    """並列数ぶんの接続を保持できるPoolManagerを作成"""
+    # maxsizeが1のままだと並列リクエストごとに接続が破棄・再作成されてしまう
+    return urllib3.PoolManager(maxsize=max(1, concurrency))
+
+
+def fetch_endpoints(
+    http: urllib3.PoolManager,
+    access_token: str,
+    endpoints: Dict[str, str],
+    max_workers: int = 1,
+    rate_limiter: Optional[FitbitRateLimiter] = None,
+    max_wait: Optional[float] = None,
+    retry: Optional[RetryPolicy] = None,
+    user_id: Optional[str] = None,
+) -> Tuple[Dict[str, Any | None], Dict[str, int]]:
+    """
+    複数エンドポイントを取得し、(データ, HTTPステータス) を返す
+
+    max_workers が2以上の場合はスレッドプールで並列に取得する。
+    rate_limiter を渡すと全エンドポイント分の枠を先に確保し（最大 max_wait 秒待機）、
+    確保できなければ1件もリクエストせずに RateLimitExceeded を送出する。
+    429 / 5xx / 通信エラーは retry（デフォルト: DEFAULT_RETRY_POLICY）で max_wait 秒の期限内に再試行する。
+    サーキットブレーカーは (user_id, データタイプ) ごとで、開いている間はステータス 0 を返す
+    （あるユーザーの失敗が他のユーザーの取得を止めないよう、user_id には取得対象のユーザーを渡す）。
+    """
+    if not endpoints:
+        # その日に取得するものがない（weekly のコレクションだけの計画など）場合は枠も確保しない
+        return {}, {}
+
+    headers = {"Authorization": f"Bearer {access_token}", "Accept": "application/json"}
+    retry = retry or DEFAULT_RETRY_POLICY
+    deadline = Deadline(max_wait)
+
+    if rate_limiter:
+        rate_limiter.acquire(len(endpoints), max_wait=max_wait)
+
+    def fetch_one(data_type: str, endpoint: str) -> Tuple[int, Any | None]:
+        try:
+            logger.info("  📥 %s データを取得中", data_type)
+            response = retry.request(
+                http,
+                "GET",
+                f"{FITBIT_API_BASE}{endpoint}",
+                key=data_type,
+                deadline=deadline,
+                breaker=retry_policy.breaker_for(data_type, user_id),
+                rate_limiter=rate_limiter,
+                headers=headers,
+            )
+
+            if response.status == 200:
+                payload = json.loads(response.data.decode("utf-8"))
+                logger.info("  ✅ %s データ取得成功", data_type)
+                return response.status, payload
+
+            logger.warning("  ⚠️ %s データ取得失敗: %s", data_type, response.status)
+            return response.status, None
+        except CircuitOpenError as exc:
+            logger.warning("  🚧 %s は連続して失敗しているため取得を見送ります: %s", data_type, exc)
+            return 0, None
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.error("  ❌ %s データ取得エラー: %s", data_type, exc)
+            return 0, None
+
+    workers = max(1, min(max_workers, len(endpoints)))
+    if workers == 1:
+        results = {data_type: fetch_one(data_type, endpoint) for data_type, endpoint in endpoints.items()}
+    else:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fitbit-fetch") as executor:
+            futures = {
+                data_type: executor.submit(fetch_one, data_type, endpoint)
+                for data_type, endpoint in endpoints.items()
+            }
+            results = {data_type: future.result() for data_type, future in futures.items()}
+
+    # 呼び出し側が期待するキー順（エンドポイント定義順）を維持する
+    data: Dict[str, Any | None] = {}
+    status_map: Dict[str, int] = {}
+    for data_type in endpoints:
+        status_map[data_type], data[data_type] = results[data_type]
+
+    return data, status_map
@@ -0,0 +1,360 @@
+"""
+Fitbitのコレクション（S3に保存するデータタイプ）の宣言的な登録簿
+
+日次Lambdaとバックフィルは、ここに登録したコレクションから1回の実行で呼ぶエンドポイントを組み立てる。
+- path: 日付指定エンドポイント（{date} を置換）
+- cadence: daily（毎日） / intraday（分単位。期間指定では要約しか取れないため日ごとに取得） / weekly（週1回）
+- range_endpoints / split_range: 期間指定エンドポイントと、そのレスポンスを日ごとに分ける関数（なければ期間取得不可）
+- range_complete: 期間指定から分けたデータが日付指定エンドポイントと同じ内容になるか。False なら
+  日付指定で保存済みのデータを置き換えない（raw_store.save_day の range_types）
+- derived_from / derive: 他のコレクションのレスポンスに同じ値が含まれる場合、その元コレクションと取り出す関数。
+  元コレクションを取得する日は API を呼ばずに元のレスポンスから組み立てる
+- subscription: 変更を通知する Fitbit サブスクリプションの collectionType（activities / sleep / body。なければ通知されない）
+
+FITBIT_COLLECTIONS（カンマ区切り）で保存するコレクションを指定できる（デフォルト: optional でないもの）。
+SpO2・HRV などの追加は、ここに Collection を1件登録して FITBIT_COLLECTIONS に名前を加えるだけでよい。
+"""
+import logging
+import os
+from datetime import date as date_cls, datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import fitbit_ranges
+
+logger = logging.getLogger()
+
+DAILY = "daily"
+INTRADAY = "intraday"
+WEEKLY = "weekly"
+CADENCES = (DAILY, INTRADAY, WEEKLY)
+
+
+class Collection:
+    """1つのデータタイプの取得方法"""
+
+    def __init__(
+        self,
+        name: str,
+        path: str,
+        cadence: str = DAILY,
+        range_endpoints: Optional[Callable[[date_cls, date_cls], Dict[str, str]]] = None,
+        split_range: Optional[Callable[[Dict[str, Any], Sequence[date_cls]], Dict[date_cls, Any]]] = None,
+        range_max_days: int = fitbit_ranges.RANGE_MAX_DAYS,
+        range_complete: bool = True,
+        derived_from: Optional[str] = None,
+        derive: Optional[Callable[[Any, str], Any]] = None,
+        weekday: int = 0,
+        subscription: Optional[str] = None,
+        optional: bool = False,
+    ):
+        if cadence not in CADENCES:
+            raise ValueError(f"cadence は {CADENCES} のいずれかである必要があります: {cadence}")
+        if (range_endpoints is None) != (split_range is None):
+            raise ValueError(f"{name}: range_endpoints と split_range は両方指定してください")
+        if (derived_from is None) != (derive is None):
+            raise ValueError(f"{name}: derived_from と derive は両方指定してください")
+        self.name = name
+        self.path = path
+        self.cadence = cadence
+        self.range_endpoints = range_endpoints
+        self.split_range = split_range
+        self.range_max_days = range_max_days
+        self.range_complete = range_complete
+        self.derived_from = derived_from
+        self.derive = derive
+        self.weekday = weekday
+        self.subscription = subscription
+        self.optional = optional
+
+    @property
+    def supports_range(self) -> bool:
+        return self.range_endpoints is not None
+
+    def due_on(self, target: date_cls) -> bool:
+        """target の日に取得するか（weekly は weekday の曜日だけ。0 が月曜）"""
+        return self.cadence != WEEKLY or target.weekday() == self.weekday
+
+    def endpoint(self, date_str: str) -> str:
+        return self.path.format(date=date_str)
+
+    def __repr__(self) -> str:
+        return f"Collection({self.name!r}, cadence={self.cadence!r})"
+
+
+def _steps_from_activity(activity: Any, date_str: str) -> Any:
+    """日次アクティビティの summary.steps を steps の1日分エンドポイントと同じ形にする"""
+    summary = (activity or {}).get("summary")
+    if not isinstance(summary, dict) or "steps" not in summary:
+        return None
+    return {"activities-steps": [{"dateTime": date_str, "value": str(summary["steps"])}]}
+
+
+def _single_range(key: str, template: str) -> Callable[[date_cls, date_cls], Dict[str, str]]:
+    def endpoints(start: date_cls, end: date_cls) -> Dict[str, str]:
+        return {key: template.format(start=start.isoformat(), end=end.isoformat())}
+    return endpoints
+
+
+def _split_series(key: str, series_key: str) -> Callable[[Dict[str, Any], Sequence[date_cls]], Dict[date_cls, Any]]:
+    def split(raw: Dict[str, Any], dates: Sequence[date_cls]) -> Dict[date_cls, Any]:
+        return fitbit_ranges.split_time_series(raw.get(key), series_key, dates)
+    return split
+
+
+def _activity_range_endpoints(start: date_cls, end: date_cls) -> Dict[str, str]:
+    return {
+        key: endpoint
+        for key, endpoint in fitbit_ranges.range_endpoints(start, end).items()
+        if key.startswith("series_")
+    }
+
+
+def _split_activity(raw: Dict[str, Any], dates: Sequence[date_cls]) -> Dict[date_cls, Any]:
+    series = {resource: raw.get(f"series_{resource}") for resource in fitbit_ranges.ACTIVITY_SERIES_FIELDS}
+    return fitbit_ranges.build_activity_summaries(series, dates)
+
+
+def _split_sleep(raw: Dict[str, Any], dates: Sequence[date_cls]) -> Dict[date_cls, Any]:
+    return fitbit_ranges.split_sleep_by_date(raw.get("sleep"), dates)
+
+
+def _split_spo2(raw: Dict[str, Any], dates: Sequence[date_cls]) -> Dict[date_cls, Any]:
+    """SpO2 の期間レスポンス（dateTime を持つ要素のリスト）を、1日分のレスポンスと同じ1要素に分ける"""
+    payload = raw.get("spo2")
+    if payload is None:
+        return {target: None for target in dates}
+    entries = {entry.get("dateTime"): entry for entry in payload if isinstance(entry, dict)}
+    return {target: entries.get(target.isoformat(), {}) for target in dates}
+
+
+# 登録順が S3 の保存順・_summary.json の data_types の順になる
+REGISTRY: Dict[str, Collection] = {
+    collection.name: collection
+    for collection in (
+        Collection(
+            "sleep",
+            "/1.2/user/-/sleep/date/{date}.json",
+            range_endpoints=_single_range("sleep", "/1.2/user/-/sleep/date/{start}/{end}.json"),
+            split_range=_split_sleep,
+            subscription="sleep",
+        ),
+        Collection(
+            "activity",
+            "/1/user/-/activities/date/{date}.json",
+            # 期間指定では時系列リソースから summary を組み立てる（記録したエクササイズ・目標・心拍ゾーンは含まれない）
+            range_endpoints=_activity_range_endpoints,
+            split_range=_split_activity,
+            range_complete=False,
+            subscription="activities",
+        ),
+        Collection(
+            "heart_rate",
+            "/1/user/-/activities/heart/date/{date}/1d/1min.json",
+            cadence=INTRADAY,
+            # 期間指定は日ごとの要約（心拍ゾーン・安静時心拍）のみ
+            range_endpoints=_single_range("heart_rate", "/1/user/-/activities/heart/date/{start}/{end}.json"),
+            split_range=_split_series("heart_rate", "activities-heart"),
+            range_complete=False,
+            subscription="activities",
+        ),
+        Collection(
+            "steps",
+            "/1/user/-/activities/steps/date/{date}/1d.json",
+            range_endpoints=_single_range("series_steps", "/1/user/-/activities/steps/date/{start}/{end}.json"),
+            split_range=_split_series("series_steps", "activities-steps"),
+            # activity の summary.steps と同じ値
+            derived_from="activity",
+            derive=_steps_from_activity,
+            subscription="activities",
+        ),
+        Collection(
+            "spo2",
+            "/1/user/-/spo2/date/{date}.json",
+            range_endpoints=_single_range("spo2", "/1/user/-/spo2/date/{start}/{end}.json"),
+            split_range=_split_spo2,
+            range_max_days=30,
+            optional=True,
+        ),
+        Collection(
+            "hrv",
+            "/1/user/-/hrv/date/{date}.json",
+            range_endpoints=_single_range("hrv", "/1/user/-/hrv/date/{start}/{end}.json"),
+            split_range=_split_series("hrv", "hrv"),
+            range_max_days=30,
+            optional=True,
+        ),
+        Collection(
+            "weight",
+            # 月曜に直近7日分の体重ログをまとめて取得する
+            "/1/user/-/body/log/weight/date/{date}/7d.json",
+            cadence=WEEKLY,
+            subscription="body",
+            optional=True,
+        ),
+    )
+}
+
+
+def enabled_collections(names: Optional[Iterable[str]] = None) -> List[Collection]:
+    """
+    保存するコレクション（登録順）
+
+    names がなければ FITBIT_COLLECTIONS（カンマ区切り）、それもなければ optional でないもの。
+    """
+    if names is None:
+        value = os.environ.get("FITBIT_COLLECTIONS", "").strip()
+        names = [name.strip() for name in value.split(",") if name.strip()] if value else None
+    if names is None:
+        return [collection for collection in REGISTRY.values() if not collection.optional]
+
+    wanted = set(names)
+    for unknown in sorted(wanted - set(REGISTRY)):
+        logger.warning("⚠️ 未登録のコレクション %s は無視します（登録済み: %s）", unknown, ", ".join(REGISTRY))
+    return [collection for collection in REGISTRY.values() if collection.name in wanted]
+
+
+def for_subscription(collection_type: str, collections: Optional[Sequence[Collection]] = None) -> List[Collection]:
+    """
+    サブスクリプション通知の collectionType で内容が変わりうるコレクション
+
+    weekly のコレクションは通知された日ではなく決まった曜日に取得するため含めない。
+    """
+    return [
+        collection
+        for collection in (collections or enabled_collections())
+        if collection.subscription == collection_type and collection.cadence != WEEKLY
+    ]
+
+
+class CallPlan:
+    """
+    1日分の取得計画
+
+    endpoints を fitbit_api.fetch_endpoints に渡し、その結果を complete() に渡すと
+    派生コレクションを補った (データ, HTTPステータス) になる。
+    """
+
+    def __init__(self, date_str: str, endpoints: Dict[str, str], derived: Dict[str, Collection]):
+        self.date_str = date_str
+        self.endpoints = endpoints
+        self.derived = derived
+
+    @property
+    def call_count(self) -> int:
+        return len(self.endpoints)
+
+    def complete(
+        self, data: Dict[str, Any], status_map: Dict[str, int]
+    ) -> Tuple[Dict[str, Any], Dict[str, int]]:
+        data, status_map = dict(data), dict(status_map)
+        for name, collection in self.derived.items():
+            source_status = status_map.get(collection.derived_from, 0)
+            value = collection.derive(data.get(collection.derived_from), self.date_str) if source_status == 200 else None
+            data[name] = value
+            # 元のレスポンスに値がなかった場合は取得失敗と同じ扱い（ステータスは元コレクションのもの）
+            status_map[name] = source_status if value is not None or source_status != 200 else 0
+        return data, status_map
+
+
+def plan_day(target: Any, collections: Optional[Sequence[Collection]] = None) -> CallPlan:
+    """
+    target の日に呼ぶエンドポイントの最小集合
+
+    その日に取得しない weekly コレクションは含めない。元コレクションも取得する派生コレクションは呼ばない。
+    """
+    target_date = target if isinstance(target, date_cls) else datetime.strptime(target, "%Y-%m-%d").date()
+    date_str = target_date.isoformat()
+    due = [collection for collection in (collections or enabled_collections()) if collection.due_on(target_date)]
+    due_names = {collection.name for collection in due}
+
+    endpoints: Dict[str, str] = {}
+    derived: Dict[str, Collection] = {}
+    for collection in due:
+        if collection.derived_from in due_names:
+            derived[collection.name] = collection
+        else:
+            endpoints[collection.name] = collection.endpoint(date_str)
+    return CallPlan(date_str, endpoints, derived)
+
+
+class RangePlan:
+    """
+    期間（1まとまり）の取得計画
+
+    endpoints で期間全体を取得し、split() で日ごとのデータに分ける。
+    per_day は期間取得できない（または期間取得では足りない）ため日ごとに plan_day で取得するコレクション。
+    """
+
+    def __init__(self, dates: Sequence[date_cls], collections: Sequence[Collection], per_day: Sequence[Collection]):
+        self.dates = list(dates)
+        self.collections = list(collections)
+        self.per_day = list(per_day)
+        self.endpoints: Dict[str, str] = {}
+        self._keys: Dict[str, List[str]] = {}
+        for collection in self.collections:
+            collection_endpoints = collection.range_endpoints(self.dates[0], self.dates[-1])
+            self.endpoints.update(collection_endpoints)
+            self._keys[collection.name] = list(collection_endpoints)
+
+    @property
+    def call_count(self) -> int:
+        """期間取得と日ごとの取得を合わせたリクエスト数"""
+        if not self.per_day:
+            # plan_day は空のコレクションを「既定のコレクション」として扱うため呼ばない
+            return len(self.endpoints)
+        return len(self.endpoints) + sum(plan_day(target, self.per_day).call_count for target in self.dates)
+
+    @property
+    def partial(self) -> List[str]:
+        """期間指定から分けると日付指定より項目が少なくなるコレクション（raw_store.save_day の range_types）"""
+        return [collection.name for collection in self.collections if not collection.range_complete]
+
+    def split(
+        self, raw: Dict[str, Any], raw_status: Dict[str, int]
+    ) -> Tuple[Dict[date_cls, Dict[str, Any]], Dict[str, int]]:
+        """(日付 -> {コレクション名: データ}, コレクションごとのステータス)"""
+        status_map: Dict[str, int] = {}
+        per_type: Dict[str, Dict[date_cls, Any]] = {}
+        for collection in self.collections:
+            statuses = [raw_status.get(key, 0) for key in self._keys[collection.name]]
+            # 複数のエンドポイントからなるコレクションは、失敗したものがあればそのステータス
+            status_map[collection.name] = next((status for status in statuses if status != 200), 200)
+            per_type[collection.name] = collection.split_range(raw, self.dates)
+        day_data = {
+            target: {name: values[target] for name, values in per_type.items()}
+            for target in self.dates
+        }
+        return day_data, status_map
+
+
+def plan_range(
+    dates: Sequence[date_cls],
+    collections: Optional[Sequence[Collection]] = None,
+    include_intraday: bool = True,
+) -> RangePlan:
+    """
+    昇順の日付（1まとまり）を期間指定で取得する計画
+
+    include_intraday が True なら intraday コレクションは日ごとに取得し、False なら期間指定の要約で代える。
+    期間に対応しない・期間が range_max_days を超える・weekly のコレクションは日ごとに取得する。
+    派生コレクションは元コレクションと同じ方法で取得する（期間取得では元の時系列に含まれる）。
+    """
+    collections = list(collections or enabled_collections())
+    span = (dates[-1] - dates[0]).days + 1
+
+    def by_range(collection: Collection) -> bool:
+        if not collection.supports_range or collection.cadence == WEEKLY or span > collection.range_max_days:
+            return False
+        return not (collection.cadence == INTRADAY and include_intraday)
+
+    ranged: List[Collection] = []
+    per_day: List[Collection] = []
+    for collection in collections:
+        source = REGISTRY.get(collection.derived_from) if collection.derived_from else None
+        if source is not None and source in collections:
+            # 期間取得なら元コレクションの時系列から分け、日ごとなら元のレスポンスから派生させる
+            (ranged if by_range(source) else per_day).append(collection)
+        else:
+            (ranged if by_range(collection) else per_day).append(collection)
+    # steps の series_steps のように元コレクションと同じキーのエンドポイントは1回だけ呼ぶ
+    return RangePlan(dates, ranged, per_day)
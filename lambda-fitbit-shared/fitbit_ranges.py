@@ -0,0 +1,139 @@
+"""
+Fitbit APIの期間指定（date range）エンドポイント用ヘルパー
+
+期間レスポンスを日ごとに分割し、1日単位のエンドポイントと同じ形のペイロードに組み立てる。
+"""
+from datetime import date as date_cls
+from typing import Any, Dict, Iterable, List, Optional
+
+# sleep の期間指定は最大100日。時系列も同じ単位でまとめて取得する
+RANGE_MAX_DAYS = 100
+
+# 時系列リソース名 -> 日次アクティビティの summary キー
+ACTIVITY_SERIES_FIELDS = {
+    "steps": "steps",
+    "distance": "distances",
+    "floors": "floors",
+    "elevation": "elevation",
+    "calories": "caloriesOut",
+    "caloriesBMR": "caloriesBMR",
+    "activityCalories": "activityCalories",
+    "minutesSedentary": "sedentaryMinutes",
+    "minutesLightlyActive": "lightlyActiveMinutes",
+    "minutesFairlyActive": "fairlyActiveMinutes",
+    "minutesVeryActive": "veryActiveMinutes",
+}
+
+_FLOAT_SERIES = {"distance", "elevation"}
+
+
+def chunk_dates(dates: Iterable[date_cls], max_days: int = RANGE_MAX_DAYS) -> List[List[date_cls]]:
+    """昇順の日付列を、先頭から末尾までが max_days 日以内に収まるまとまりに分割"""
+    chunks: List[List[date_cls]] = []
+    for target in dates:
+        if chunks and (target - chunks[-1][0]).days < max_days:
+            chunks[-1].append(target)
+        else:
+            chunks.append([target])
+    return chunks
+
+
+def range_endpoints(start: date_cls, end: date_cls, include_heart_summary: bool = False) -> Dict[str, str]:
+    """期間取得に使うエンドポイント一覧（キーは series 名）"""
+    start_str, end_str = start.isoformat(), end.isoformat()
+    endpoints = {"sleep": f"/1.2/user/-/sleep/date/{start_str}/{end_str}.json"}
+    for resource in ACTIVITY_SERIES_FIELDS:
+        endpoints[f"series_{resource}"] = f"/1/user/-/activities/{resource}/date/{start_str}/{end_str}.json"
+    if include_heart_summary:
+        endpoints["heart_rate"] = f"/1/user/-/activities/heart/date/{start_str}/{end_str}.json"
+    return endpoints
+
+
+def summarize_sleep_logs(logs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """1日分の睡眠ログから、日付指定エンドポイントと同じ summary を組み立てる"""
+    summary: Dict[str, Any] = {
+        "totalMinutesAsleep": sum(int(log.get("minutesAsleep", 0)) for log in logs),
+        "totalSleepRecords": len(logs),
+        "totalTimeInBed": sum(int(log.get("timeInBed", 0)) for log in logs),
+    }
+
+    stages: Dict[str, int] = {}
+    for log in logs:
+        level_summary = (log.get("levels") or {}).get("summary") or {}
+        if "deep" not in level_summary:
+            continue  # classic形式のログにはステージ情報がない
+        for stage in ("deep", "light", "rem", "wake"):
+            stages[stage] = stages.get(stage, 0) + int((level_summary.get(stage) or {}).get("minutes", 0))
+    if stages:
+        summary["stages"] = stages
+
+    return summary
+
+
+def split_sleep_by_date(payload: Optional[Dict[str, Any]], dates: Iterable[date_cls]) -> Dict[date_cls, Any]:
+    """sleep の期間レスポンスを dateOfSleep ごとに分割"""
+    if payload is None:
+        return {target: None for target in dates}
+
+    by_date: Dict[str, List[Dict[str, Any]]] = {}
+    for log in payload.get("sleep", []):
+        by_date.setdefault(log.get("dateOfSleep"), []).append(log)
+
+    result = {}
+    for target in dates:
+        logs = by_date.get(target.isoformat(), [])
+        result[target] = {"sleep": logs, "summary": summarize_sleep_logs(logs)}
+    return result
+
+
+def split_time_series(payload: Optional[Dict[str, Any]], key: str, dates: Iterable[date_cls]) -> Dict[date_cls, Any]:
+    """activities-xxx 形式の時系列を1日1要素のペイロードに分割"""
+    if payload is None:
+        return {target: None for target in dates}
+
+    entries = {entry.get("dateTime"): entry for entry in payload.get(key, [])}
+    return {
+        target: {key: [entries[target.isoformat()]] if target.isoformat() in entries else []}
+        for target in dates
+    }
+
+
+def build_activity_summaries(
+    series_payloads: Dict[str, Optional[Dict[str, Any]]], dates: Iterable[date_cls]
+) -> Dict[date_cls, Any]:
+    """
+    時系列リソースから日次アクティビティの summary を再構成
+
+    記録したエクササイズ（activities）は時系列に含まれないため空になる。
+    いずれかのリソースが取得できなかった場合、その日のアクティビティは None とする。
+    """
+    dates = list(dates)
+    if any(series_payloads.get(resource) is None for resource in ACTIVITY_SERIES_FIELDS):
+        return {target: None for target in dates}
+
+    values: Dict[str, Dict[str, Any]] = {}
+    for resource in ACTIVITY_SERIES_FIELDS:
+        for entry in series_payloads[resource].get(f"activities-{resource}", []):
+            values.setdefault(entry.get("dateTime"), {})[resource] = entry.get("value")
+
+    result = {}
+    for target in dates:
+        day_values = values.get(target.isoformat(), {})
+        summary: Dict[str, Any] = {}
+        for resource, field in ACTIVITY_SERIES_FIELDS.items():
+            value = _to_number(day_values.get(resource), resource in _FLOAT_SERIES)
+            if resource == "distance":
+                summary[field] = [{"activity": "total", "distance": value}]
+            else:
+                summary[field] = value
+        result[target] = {"activities": [], "summary": summary}
+    return result
+
+
+def _to_number(raw: Any, as_float: bool) -> Any:
+    if raw is None:
+        return 0.0 if as_float else 0
+    try:
+        return float(raw) if as_float else int(float(raw))
+    except (TypeError, ValueError):
+        return 0.0 if as_float else 0
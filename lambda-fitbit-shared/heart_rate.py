@@ -0,0 +1,143 @@
+"""
+分単位心拍データ（activities-heart-intraday）の型付き列への変換
+
+取得時に dataset を「0時からの経過分（uint16）」と「心拍数（uint8）」の配列に変換し、
+rawのJSONと同じパーティションに以下を保存する。
+- heart_rate_intraday_YYYYMMDD.parquet: minute_of_day / bpm の2列（pyarrow がある場合のみ）
+- heart_rate_hourly_YYYYMMDD.json: 時間帯ごとの最小・平均・最大と心拍ゾーン別の分数
+"""
+import io
+import json
+import logging
+import os
+from array import array
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - Lambdaランタイムには含まれない
+    pa = None
+    pq = None
+
+logger = logging.getLogger()
+
+INTRADAY_KEY = "activities-heart-intraday"
+
+
+def derived_enabled() -> bool:
+    """FITBIT_HEART_RATE_DERIVED=false で派生ファイルの作成を止められる"""
+    return os.environ.get("FITBIT_HEART_RATE_DERIVED", "true").lower() not in ("0", "false", "no")
+
+
+def extract_intraday(payload: Dict[str, Any]) -> Tuple[array, array]:
+    """dataset を (minute_of_day: uint16, bpm: uint8) の配列に変換"""
+    minutes = array("H")
+    bpm = array("B")
+    for point in (payload.get(INTRADAY_KEY) or {}).get("dataset", []):
+        try:
+            hour, minute = point["time"].split(":")[:2]
+            value = int(point["value"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        minutes.append(int(hour) * 60 + int(minute))
+        bpm.append(max(0, min(value, 255)))
+    return minutes, bpm
+
+
+def heart_rate_zones(payload: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """日次サマリーの心拍ゾーン定義（name/min/max）"""
+    days = payload.get("activities-heart") or []
+    if not days:
+        return []
+    return [
+        zone for zone in (days[0].get("value") or {}).get("heartRateZones", [])
+        if "min" in zone and "max" in zone
+    ]
+
+
+def hourly_summary(minutes: array, bpm: array, zones: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """時間帯（0〜23時）ごとの min/mean/max と心拍ゾーン別の分数"""
+    hours: List[Dict[str, Any]] = [
+        {"hour": hour, "samples": 0, "min": None, "mean": None, "max": None,
+         "zone_minutes": {zone["name"]: 0 for zone in zones}}
+        for hour in range(24)
+    ]
+    totals = [0] * 24
+
+    for minute_of_day, value in zip(minutes, bpm):
+        bucket = hours[minute_of_day // 60]
+        bucket["samples"] += 1
+        totals[minute_of_day // 60] += value
+        bucket["min"] = value if bucket["min"] is None else min(bucket["min"], value)
+        bucket["max"] = value if bucket["max"] is None else max(bucket["max"], value)
+        zone_name = _zone_for(value, zones)
+        if zone_name is not None:
+            bucket["zone_minutes"][zone_name] += 1
+
+    for hour, bucket in enumerate(hours):
+        if bucket["samples"]:
+            bucket["mean"] = round(totals[hour] / bucket["samples"], 1)
+    return hours
+
+
+def derived_objects(
+    prefix: str, date_str: str, payload: Dict[str, Any], metadata: Dict[str, Any]
+) -> List[Tuple[str, bytes, str]]:
+    """rawの横に保存する派生ファイルの (キー, 本文, Content-Type) 一覧"""
+    if not derived_enabled() or not isinstance(payload, dict) or INTRADAY_KEY not in payload:
+        return []
+
+    minutes, bpm = extract_intraday(payload)
+    zones = heart_rate_zones(payload)
+    compact_date = date_str.replace("-", "")
+    objects: List[Tuple[str, bytes, str]] = []
+
+    columnar = _to_parquet(date_str, minutes, bpm)
+    if columnar is not None:
+        objects.append((
+            f"{prefix}/heart_rate_intraday_{compact_date}.parquet",
+            columnar,
+            "application/vnd.apache.parquet",
+        ))
+
+    hourly = {
+        "metadata": {**metadata, "data_type": "heart_rate_hourly"},
+        "data": {
+            "samples": len(bpm),
+            "resting_heart_rate": ((payload.get("activities-heart") or [{}])[0].get("value") or {}).get(
+                "restingHeartRate"
+            ),
+            "zones": zones,
+            "hours": hourly_summary(minutes, bpm, zones),
+        },
+    }
+    objects.append((
+        f"{prefix}/heart_rate_hourly_{compact_date}.json",
+        json.dumps(hourly, indent=2).encode("utf-8"),
+        "application/json",
+    ))
+    return objects
+
+
+def _zone_for(value: int, zones: List[Dict[str, Any]]) -> Optional[str]:
+    for index, zone in enumerate(zones):
+        upper_inclusive = index == len(zones) - 1
+        if zone["min"] <= value < zone["max"] or (upper_inclusive and value == zone["max"]):
+            return zone["name"]
+    return None
+
+
+def _to_parquet(date_str: str, minutes: array, bpm: array) -> Optional[bytes]:
+    if pa is None:
+        logger.warning("⚠️ pyarrow が未導入のため分単位心拍の列形式ファイルは作成しません")
+        return None
+
+    table = pa.table({
+        "minute_of_day": pa.array(minutes, pa.uint16()),
+        "bpm": pa.array(bpm, pa.uint8()),
+    })
+    table = table.replace_schema_metadata({"data_date": date_str})
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression="zstd")
+    return buffer.getvalue()
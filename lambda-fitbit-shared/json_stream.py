@@ -0,0 +1,90 @@
+"""
+JSONを文字列全体を作らずに少しずつ書き出すエンコーダー
+
+json.JSONEncoder.iterencode は純Pythonの実装になり、json.dumps（C実装）の5倍ほど遅い。
+ここではコンテナだけをたどり、スカラーだけを含む最も内側の辞書・リストは json.dumps で一度に
+エンコードする。出力は同じ引数の json.dumps と1バイトも違わない（content_hash のハッシュを変えないため）。
+"""
+import json
+from typing import Any, Iterable, Iterator
+
+# 書き出し先に渡すかたまりの目安（バイト）
+DEFAULT_CHUNK_SIZE = 64 * 1024
+# リスト内の平らな要素を1回の json.dumps でまとめてエンコードする数
+LEAF_BATCH_SIZE = 512
+
+
+def iter_compact(obj: Any, sort_keys: bool = False, ensure_ascii: bool = True) -> Iterator[str]:
+    """json.dumps(obj, separators=(",", ":"), sort_keys=..., ensure_ascii=...) と同じ文字列を分割して返す"""
+
+    def dumps(value: Any) -> str:
+        return json.dumps(value, separators=(",", ":"), sort_keys=sort_keys, ensure_ascii=ensure_ascii)
+
+    def walk(value: Any) -> Iterator[str]:
+        if isinstance(value, dict) and not _is_flat(value.values()):
+            yield "{"
+            items = sorted(value.items()) if sort_keys else value.items()
+            for index, (key, item) in enumerate(items):
+                yield ("," if index else "") + dumps(key if isinstance(key, str) else _key_string(key)) + ":"
+                yield from walk(item)
+            yield "}"
+        elif isinstance(value, (list, tuple)) and not _is_flat(value):
+            yield "["
+            # 分単位の dataset のように平らな要素が続く部分は、まとめて json.dumps して括弧を外す
+            run = []
+            first = True
+            for item in value:
+                if _is_leaf(item) and len(run) < LEAF_BATCH_SIZE:
+                    run.append(item)
+                    continue
+                if run:
+                    yield ("" if first else ",") + dumps(run)[1:-1]
+                    first = False
+                    run = []
+                if _is_leaf(item):
+                    run.append(item)
+                    continue
+                if not first:
+                    yield ","
+                first = False
+                yield from walk(item)
+            if run:
+                yield ("" if first else ",") + dumps(run)[1:-1]
+            yield "]"
+        else:
+            yield dumps(value)
+
+    return walk(obj)
+
+
+def iter_bytes(chunks: Iterable[str], chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[bytes]:
+    """細かい文字列をまとめ、chunk_size 程度のUTF-8のバイト列にして返す"""
+    pending = []
+    pending_size = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        pending_size += len(chunk)
+        if pending_size >= chunk_size:
+            yield "".join(pending).encode("utf-8")
+            pending = []
+            pending_size = 0
+    if pending:
+        yield "".join(pending).encode("utf-8")
+
+
+def _is_flat(values: Iterable[Any]) -> bool:
+    return not any(isinstance(value, (dict, list, tuple)) for value in values)
+
+
+def _is_leaf(value: Any) -> bool:
+    """スカラーか、スカラーだけを含む辞書・リスト"""
+    if isinstance(value, dict):
+        return _is_flat(value.values())
+    if isinstance(value, (list, tuple)):
+        return _is_flat(value)
+    return True
+
+
+def _key_string(key: Any) -> str:
+    """json.dumps と同じ規則で辞書のキー（str 以外）を文字列にする"""
+    return next(iter(json.loads(json.dumps({key: None}))))
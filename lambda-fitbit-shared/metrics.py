@@ -0,0 +1,251 @@
+"""
+呼び出しごとの所要時間・バイト数のメトリクス（CloudWatch Embedded Metric Format）
+
+Fitbit API・S3・DynamoDBの各呼び出しと、レート制限や再試行のための待機を1件ずつ記録し、
+ハンドラーの終了時に以下を出力する。
+- EMF: サービス・操作ごとのJSONを標準出力に書く（CloudWatch Logs がメトリクスとして取り込む）
+- FITBIT_METRICS_FILE: 指定したパスに記録そのものと集計をNDJSONで追記する（ローカルでの分析用）
+- summary(): サービス・操作ごとの件数・合計時間・バイト数をハンドラーのレスポンスに含める
+
+boto3 のクライアントは aws_clients が instrument() で計測用のイベントハンドラーを登録する。
+記録はプロセス内で1つ（スレッドセーフ）で、start_invocation() で呼び出しごとにリセットする。
+"""
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger()
+
+DEFAULT_NAMESPACE = "ModerationCraft/Fitbit"
+# EMF の1メトリクスあたりの値の上限
+EMF_MAX_VALUES = 100
+# 記録をメモリに保持する上限（集計は上限を超えても続ける）
+MAX_RECORDS = 50000
+
+SLEEP_SERVICE = "sleep"
+
+_lock = threading.Lock()
+_function = "fitbit"
+_started_at = time.perf_counter()
+_records: List[Dict[str, Any]] = []
+_totals: Dict[Tuple[str, str], Dict[str, Any]] = {}
+
+
+def enabled() -> bool:
+    """FITBIT_METRICS=off で EMF の出力を止める（レスポンスのサマリーは常に返す）"""
+    return os.environ.get("FITBIT_METRICS", "emf").lower() not in ("0", "off", "false", "none")
+
+
+def start_invocation(function: str) -> None:
+    """ハンドラーの開始時に呼び、前回の呼び出しの記録を破棄する"""
+    global _function, _started_at
+    with _lock:
+        _function = function
+        _started_at = time.perf_counter()
+        _records.clear()
+        _totals.clear()
+
+
+def record(
+    service: str,
+    operation: str,
+    duration: float,
+    status: Optional[int] = None,
+    bytes_sent: int = 0,
+    bytes_received: int = 0,
+    rate_limit_remaining: Optional[int] = None,
+) -> None:
+    """
+    1回の呼び出し（duration は秒）を記録する
+
+    status が None / 0（通信エラー）か 404 以外の400以上ならエラーとして数える
+    （404 は _summary.json の初回読み込みなど想定どおりの「なし」のため除く）。
+    """
+    error = _is_error(status)
+    entry = {
+        "service": service,
+        "operation": operation,
+        "duration_ms": round(duration * 1000, 2),
+        "status": status,
+        "bytes_sent": bytes_sent,
+        "bytes_received": bytes_received,
+    }
+    if rate_limit_remaining is not None:
+        entry["rate_limit_remaining"] = rate_limit_remaining
+
+    with _lock:
+        if len(_records) < MAX_RECORDS:
+            _records.append(entry)
+        totals = _totals.setdefault((service, operation), {
+            "calls": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0, "bytes_sent": 0, "bytes_received": 0,
+        })
+        totals["calls"] += 1
+        totals["errors"] += 1 if error and service != SLEEP_SERVICE else 0
+        totals["total_ms"] += entry["duration_ms"]
+        totals["max_ms"] = max(totals["max_ms"], entry["duration_ms"])
+        totals["bytes_sent"] += bytes_sent
+        totals["bytes_received"] += bytes_received
+        if rate_limit_remaining is not None:
+            totals["rate_limit_remaining"] = min(totals.get("rate_limit_remaining", rate_limit_remaining), rate_limit_remaining)
+
+
+def record_sleep(reason: str, seconds: float) -> None:
+    """レート制限・再試行などによる意図的な待機を記録する"""
+    if seconds > 0:
+        record(SLEEP_SERVICE, reason, seconds, status=200)
+
+
+def summary() -> Dict[str, Any]:
+    """サービス・操作ごとの集計と、サービスごとの合計時間"""
+    with _lock:
+        elapsed_ms = round((time.perf_counter() - _started_at) * 1000, 1)
+        operations = {
+            f"{service}.{operation}": {**totals, "total_ms": round(totals["total_ms"], 1)}
+            for (service, operation), totals in sorted(_totals.items())
+        }
+        by_service: Dict[str, float] = {}
+        for (service, _), totals in _totals.items():
+            by_service[service] = by_service.get(service, 0.0) + totals["total_ms"]
+
+    # 並列に実行した呼び出しの時間は重なるため、サービスごとの合計は経過時間を超えることがある
+    return {
+        "elapsed_ms": elapsed_ms,
+        "time_by_service_ms": {service: round(total, 1) for service, total in sorted(by_service.items())},
+        "operations": operations,
+    }
+
+
+def flush(context=None) -> None:
+    """EMF を標準出力に書き、FITBIT_METRICS_FILE があれば記録と集計を追記する"""
+    with _lock:
+        records = list(_records)
+    request_id = getattr(context, "aws_request_id", None)
+
+    if enabled():
+        for document in emf_documents(records, request_id):
+            # Lambdaのロガーは行頭にレベルなどを付けるため、EMF は print で1行ずつ書く
+            print(json.dumps(document, ensure_ascii=False), flush=True)
+
+    path = os.environ.get("FITBIT_METRICS_FILE")
+    if path:
+        try:
+            with open(path, "a", encoding="utf-8") as dump:
+                for entry in records:
+                    dump.write(json.dumps({"function": _function, "request_id": request_id, **entry}) + "\n")
+                dump.write(json.dumps({"function": _function, "request_id": request_id, "summary": summary()}) + "\n")
+        except OSError as exc:
+            logger.warning("⚠️ メトリクスファイル %s に書き込めませんでした: %s", path, exc)
+
+
+def emf_documents(records: List[Dict[str, Any]], request_id: Optional[str] = None) -> List[Dict[str, Any]]:
+    """サービス・操作ごとに、最大100件ずつの Duration を持つ EMF ドキュメントを作る"""
+    namespace = os.environ.get("FITBIT_METRICS_NAMESPACE", DEFAULT_NAMESPACE)
+    grouped: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+    for entry in records:
+        grouped.setdefault((entry["service"], entry["operation"]), []).append(entry)
+
+    documents = []
+    timestamp = int(time.time() * 1000)
+    for (service, operation), entries in sorted(grouped.items()):
+        for offset in range(0, len(entries), EMF_MAX_VALUES):
+            chunk = entries[offset:offset + EMF_MAX_VALUES]
+            metrics = [
+                {"Name": "Duration", "Unit": "Milliseconds"},
+                {"Name": "Calls", "Unit": "Count"},
+                {"Name": "Errors", "Unit": "Count"},
+                {"Name": "BytesSent", "Unit": "Bytes"},
+                {"Name": "BytesReceived", "Unit": "Bytes"},
+            ]
+            document = {
+                "_aws": {
+                    "Timestamp": timestamp,
+                    "CloudWatchMetrics": [{
+                        "Namespace": namespace,
+                        "Dimensions": [["Function", "Service", "Operation"]],
+                        "Metrics": metrics,
+                    }],
+                },
+                "Function": _function,
+                "Service": service,
+                "Operation": operation,
+                "Duration": [entry["duration_ms"] for entry in chunk],
+                "Calls": len(chunk),
+                "Errors": sum(1 for entry in chunk if service != SLEEP_SERVICE and _is_error(entry["status"])),
+                "BytesSent": sum(entry["bytes_sent"] for entry in chunk),
+                "BytesReceived": sum(entry["bytes_received"] for entry in chunk),
+            }
+            remaining = [entry["rate_limit_remaining"] for entry in chunk if "rate_limit_remaining" in entry]
+            if remaining:
+                metrics.append({"Name": "RateLimitRemaining", "Unit": "Count"})
+                document["RateLimitRemaining"] = min(remaining)
+            if request_id:
+                document["RequestId"] = request_id
+            documents.append(document)
+    return documents
+
+
+def instrument(client) -> None:
+    """boto3 クライアントの全操作の所要時間・ステータス・バイト数を記録するハンドラーを登録する"""
+    service = client.meta.service_model.service_name
+    events = client.meta.events
+
+    def before_call(model=None, params=None, context=None, **_kwargs):
+        if context is not None:
+            context["metrics_started"] = time.perf_counter()
+            context["metrics_operation"] = model.name if model is not None else "unknown"
+            context["metrics_bytes_sent"] = _body_length((params or {}).get("body"))
+
+    def after_call(http_response=None, context=None, **_kwargs):
+        if context is None or "metrics_started" not in context:
+            return
+        headers = getattr(http_response, "headers", None) or {}
+        try:
+            received = int(headers.get("content-length", 0))
+        except (TypeError, ValueError):
+            received = 0
+        record(
+            service,
+            context["metrics_operation"],
+            time.perf_counter() - context["metrics_started"],
+            status=getattr(http_response, "status_code", None),
+            bytes_sent=context["metrics_bytes_sent"],
+            bytes_received=received,
+        )
+
+    def after_call_error(context=None, **_kwargs):
+        if context is None or "metrics_started" not in context:
+            return
+        record(
+            service,
+            context["metrics_operation"],
+            time.perf_counter() - context["metrics_started"],
+            status=0,
+            bytes_sent=context["metrics_bytes_sent"],
+        )
+
+    events.register("before-call", before_call, unique_id="fitbit-metrics-before-call")
+    events.register("after-call", after_call, unique_id="fitbit-metrics-after-call")
+    events.register("after-call-error", after_call_error, unique_id="fitbit-metrics-after-call-error")
+
+
+def _is_error(status: Optional[int]) -> bool:
+    return not status or (status >= 400 and status != 404)
+
+
+def _body_length(body: Any) -> int:
+    if isinstance(body, (bytes, bytearray, str)):
+        return len(body)
+    # S3 の PutObject は BytesIO などのファイルオブジェクトになっている
+    if hasattr(body, "seek") and hasattr(body, "tell"):
+        try:
+            position = body.tell()
+            body.seek(0, os.SEEK_END)
+            size = body.tell() - position
+            body.seek(position)
+            return size
+        except (OSError, ValueError):
+            return 0
+    return 0
@@ -0,0 +1,142 @@
+"""
+Fitbit APIのレート制限ヘッダーに追従するトークンバケット
+
+Fitbitはユーザーごとに1時間あたり150リクエストの固定ウィンドウで制限しており、
+レスポンスの Fitbit-Rate-Limit-Remaining / Fitbit-Rate-Limit-Reset で残量とリセットまでの秒数を返す。
+残量がある間は待たずに消費し、尽きたらリセット時刻まで待つのが最速かつ安全なペースになる。
+"""
+import logging
+import os
+import threading
+import time
+from typing import Callable, Mapping, Optional
+
+import metrics
+
+logger = logging.getLogger()
+
+FITBIT_HOURLY_LIMIT = 150
+RATE_LIMIT_WINDOW_SECONDS = 3600
+
+
+class RateLimitExceeded(Exception):
+    """許容された待ち時間内にリクエスト枠を確保できない場合に送出"""
+
+    def __init__(self, wait_seconds: float):
+        super().__init__(f"rate limit budget exhausted (reset in {wait_seconds:.0f}s)")
+        self.wait_seconds = wait_seconds
+
+
+class FitbitRateLimiter:
+    """ヘッダー駆動のトークンバケット（スレッドセーフ）"""
+
+    def __init__(
+        self,
+        limit: int = FITBIT_HOURLY_LIMIT,
+        reserve: int = 0,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.limit = limit
+        # 他のLambda（日次実行など）のために残しておくリクエスト数
+        self.reserve = max(0, min(reserve, limit - 1))
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = limit
+        self._in_flight = 0
+        self._reset_at = clock() + RATE_LIMIT_WINDOW_SECONDS
+
+    @property
+    def remaining(self) -> int:
+        with self._lock:
+            self._refill_locked()
+            return self._tokens
+
+    def seconds_until_reset(self) -> float:
+        with self._lock:
+            return max(0.0, self._reset_at - self._clock())
+
+    def acquire(self, count: int = 1, max_wait: Optional[float] = None) -> None:
+        """
+        count 件分のリクエスト枠を確保する
+
+        枠が足りなければウィンドウのリセットまで待つ。待ち時間が max_wait 秒を超える場合は
+        待たずに RateLimitExceeded を送出する。
+        """
+        count = max(1, min(count, self.limit - self.reserve))
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill_locked()
+                if self._tokens - count >= self.reserve:
+                    self._tokens -= count
+                    self._in_flight += count
+                    return
+                wait = max(0.0, self._reset_at - self._clock())
+
+            if max_wait is not None and waited + wait > max_wait:
+                raise RateLimitExceeded(wait)
+
+            logger.warning("⏰ レート制限の残り枠が不足（残り%s）。%.0f秒待機します", self._tokens, wait)
+            self._sleep(wait)
+            metrics.record_sleep("rate_limit", wait)
+            waited += wait
+
+    def release(self, count: int = 1) -> None:
+        """acquire で確保したが送らなかった count 件分の枠を戻す（observe の代わりに呼ぶ）"""
+        with self._lock:
+            self._in_flight = max(0, self._in_flight - count)
+            self._tokens = min(self.limit, self._tokens + count)
+
+    def observe(self, status: Optional[int], headers: Optional[Mapping[str, str]] = None) -> None:
+        """レスポンスのステータスとヘッダーでバケットを補正する（acquire 1件につき1回呼ぶ）"""
+        headers = headers or {}
+        with self._lock:
+            self._in_flight = max(0, self._in_flight - 1)
+            now = self._clock()
+
+            reset = _int_header(headers, "Fitbit-Rate-Limit-Reset")
+            if reset is not None:
+                self._reset_at = now + reset
+
+            limit = _int_header(headers, "Fitbit-Rate-Limit-Limit")
+            if limit:
+                self.limit = limit
+
+            remaining = _int_header(headers, "Fitbit-Rate-Limit-Remaining")
+            if remaining is not None:
+                # 応答待ちのリクエストはまだサーバー側の残量に反映されていない可能性がある
+                self._tokens = max(0, remaining - self._in_flight)
+
+            if status == 429:
+                retry_after = _int_header(headers, "Retry-After")
+                if retry_after is not None:
+                    self._reset_at = max(self._reset_at, now + retry_after)
+                self._tokens = 0
+                logger.warning("⚠️ 429を受信。%.0f秒後のリセットまで新規リクエストを止めます", self._reset_at - now)
+
+    def _refill_locked(self) -> None:
+        now = self._clock()
+        if now >= self._reset_at:
+            self._tokens = self.limit
+            self._reset_at = now + RATE_LIMIT_WINDOW_SECONDS
+
+
+def rate_limiter_from_env(default_reserve: int = 0) -> FitbitRateLimiter:
+    """FITBIT_RATE_LIMIT_RESERVE から予約枠を読み込んでリミッターを作成"""
+    try:
+        reserve = int(os.environ.get("FITBIT_RATE_LIMIT_RESERVE", str(default_reserve)))
+    except ValueError:
+        reserve = default_reserve
+    return FitbitRateLimiter(reserve=reserve)
+
+
+def _int_header(headers: Mapping[str, str], name: str) -> Optional[int]:
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,167 @@
+"""
+rawレイヤー（raw/fitbit/[user_id=/]year=/month=/day=）への1日分の保存
+
+日次Lambda・Webhook・バックフィルが同じ手順で保存する。
+- データタイプごとに raw_writer の形式でストリーミング保存する（大きい場合はマルチパート）
+- 内容ハッシュが前回と同じデータタイプは書き込まない（content_hash）
+- 分単位心拍は列形式ファイルと時間帯別サマリーも保存する（heart_rate）
+- 今回取得しなかったデータタイプは、前回保存したファイルを _summary.json に引き継ぐ
+
+バックフィルの range モードが時系列から組み立てたデータ（range_types）は日付指定エンドポイントより項目が少ないため、
+content_hashes の項目に source="range" を付け、日付指定で保存済みのデータは置き換えない。
+"""
+import json
+import logging
+import os
+from datetime import datetime
+from typing import Any, Collection, Dict, List, Optional
+
+import aws_clients
+import content_hash
+import heart_rate
+import raw_writer
+import s3_upload
+
+logger = logging.getLogger()
+
+DEFAULT_BUCKET = "moderation-craft-data-800860245583"
+
+# 期間指定エンドポイントから組み立てたデータの content_hashes の source
+RANGE_SOURCE = "range"
+
+
+def bucket_from_env() -> str:
+    """保存先のバケット（S3_BUCKET、なければ S3_BUCKET_NAME）"""
+    return os.environ.get("S3_BUCKET", os.environ.get("S3_BUCKET_NAME", DEFAULT_BUCKET))
+
+
+def summary_key(date_str: str, user_id: Optional[str] = None) -> str:
+    return f"{raw_writer.raw_prefix(date_str, user_id)}/_summary.json"
+
+
+def save_day(
+    date_str: str,
+    data: Dict[str, Any],
+    execution_id: str = "local_test",
+    user_id: Optional[str] = None,
+    metadata: Optional[Dict[str, Any]] = None,
+    range_types: Collection[str] = (),
+) -> List[str]:
+    """
+    1日分のデータを保存し、_summary.json に載せた今回のファイル（s3://...）の一覧を返す
+
+    user_id を渡すと user_id= パーティションの下に保存する（主ユーザーは None）。
+    metadata は各オブジェクトの metadata に加える項目。range_types は期間指定から組み立てたデータタイプで、
+    日付指定で保存済みならそちらを残す。保存に失敗したデータタイプがあれば例外を送出し、
+    _summary.json は書かない（欠損日として次回の実行で取り直される）。保存するデータが1件もない場合も書かない。
+    """
+    s3 = aws_clients.client("s3")
+    bucket = bucket_from_env()
+    prefix = raw_writer.raw_prefix(date_str, user_id)
+    manifest_key = f"{prefix}/_summary.json"
+
+    # 前回保存した内容のハッシュ。force=True の再取得でも内容が同じなら書き込まない
+    try:
+        previous_hashes = content_hash.load_manifest(s3, bucket, manifest_key)
+    except Exception:  # pylint: disable=broad-except
+        logger.warning("⚠️ %s の読み込みに失敗したため全データを書き直します", manifest_key, exc_info=True)
+        previous_hashes = None
+
+    saved_files: List[str] = []
+    content_hashes: Dict[str, Dict[str, Any]] = {}
+    written_count = 0
+    for data_type, content in data.items():
+        if content is None:
+            continue
+
+        raw_format = raw_writer.format_for(data_type)
+        data_hash = content_hash.payload_hash(content)
+        previous = (previous_hashes or {}).get(data_type)
+        from_range = data_type in range_types
+        if from_range and previous and previous.get("source") != RANGE_SOURCE:
+            content_hashes[data_type] = previous
+            saved_files.extend(_entry_files(bucket, previous))
+            logger.info("  ⏭️ %s は日付指定で保存済みのため期間指定のデータで置き換えません", data_type)
+            continue
+        if content_hash.is_unchanged(previous, data_hash, raw_format):
+            content_hashes[data_type] = previous
+            saved_files.extend(_entry_files(bucket, previous))
+            logger.info("  ⏭️ %s は前回から変更がないためスキップ", data_type)
+            continue
+
+        object_metadata = {
+            "extraction_timestamp": datetime.now().isoformat(),
+            "data_date": date_str,
+            "data_type": data_type,
+            "source": "fitbit_api_range" if from_range else "fitbit_api",
+            **(metadata or {}),
+            "lambda_execution_id": execution_id,
+        }
+        write_format = raw_writer.resolve_format(raw_format, content)
+        extension, content_type = raw_writer.describe(write_format)
+        key = f"{prefix}/{data_type}_{date_str.replace('-', '')}{extension}"
+
+        # {"metadata", "data"} のJSON全体を作らずにエンコード・圧縮しながら保存する
+        with s3_upload.StreamingUpload(s3, bucket, key, content_type, metadata={
+            "data-date": date_str,
+            "data-type": data_type,
+            content_hash.HASH_METADATA_KEY: data_hash,
+        }) as upload:
+            raw_writer.write(upload, object_metadata, content, write_format)
+        saved_files.append(f"s3://{bucket}/{key}")
+        written_count += 1
+        logger.info("  ✅ %s を保存: %s", data_type, key)
+
+        derived_keys: List[str] = []
+        if data_type == "heart_rate":
+            for derived_key, derived_body, derived_type in heart_rate.derived_objects(
+                prefix, date_str, content, object_metadata
+            ):
+                s3.put_object(Bucket=bucket, Key=derived_key, Body=derived_body, ContentType=derived_type)
+                saved_files.append(f"s3://{bucket}/{derived_key}")
+                derived_keys.append(derived_key)
+                logger.info("  ✅ %s の派生ファイルを保存: %s", data_type, derived_key)
+
+        content_hashes[data_type] = {"sha256": data_hash, "format": raw_format, "key": key, "derived": derived_keys}
+        if from_range:
+            content_hashes[data_type]["source"] = RANGE_SOURCE
+
+    # 今回取得できなかった（または対象外の）データタイプは、前回保存したファイルをサマリーに引き継ぐ
+    carried_files: List[str] = []
+    for data_type, previous in (previous_hashes or {}).items():
+        if data_type not in content_hashes:
+            content_hashes[data_type] = previous
+            carried_files.extend(_entry_files(bucket, previous))
+
+    # 1件も保存していない日にサマリーを書くと取り込み済みとして扱われ、欠損日の補完で取り直されなくなる
+    if not content_hashes:
+        logger.warning("⚠️ %s は保存したデータがないためサマリーを作成しません", date_str)
+        return saved_files
+
+    # すべて前回と同じ内容ならサマリーも書き直さない
+    if previous_hashes is not None and written_count == 0 and content_hashes:
+        logger.info("📋 %s は前回から変更がないためサマリーの更新をスキップ", date_str)
+        return saved_files
+
+    summary_data = {
+        "extraction_date": datetime.now().isoformat(),
+        "data_date": date_str,
+        "files_created": len(saved_files),
+        "data_types": list(dict.fromkeys([*data.keys(), *content_hashes.keys()])),
+        "status": "success" if saved_files else "partial",
+        "files": saved_files + carried_files,
+        "content_hashes": content_hashes,
+    }
+    s3.put_object(
+        Bucket=bucket,
+        Key=manifest_key,
+        Body=json.dumps(summary_data, indent=2),
+        ContentType="application/json",
+    )
+    logger.info("📋 サマリーファイルを保存: %s", manifest_key)
+    return saved_files
+
+
+def _entry_files(bucket: str, entry: Dict[str, Any]) -> List[str]:
+    """content_hashes の1項目が指すオブジェクトと派生ファイル"""
+    return [f"s3://{bucket}/{key}" for key in (entry["key"], *entry.get("derived", []))]
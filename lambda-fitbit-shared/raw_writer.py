@@ -0,0 +1,206 @@
+"""
+rawレイヤー（raw/fitbit/year=/month=/day=）に保存するオブジェクトのシリアライズ
+
+データタイプごとに出力形式を環境変数で選べる。
+- json: 従来どおりのインデント付きJSON（デフォルト）
+- ndjson.gz / ndjson.zst: メタデータとデータを1行にまとめたNDJSONを圧縮
+- parquet: 分単位などの intraday 時系列を列形式で保存（その他の項目はParquetのメタデータに保持）
+
+zstd と Parquet はそれぞれ zstandard / pyarrow が必要。デプロイパッケージにない形式を指定した場合は
+RawFormatUnavailable を送出する（黙って別の形式で保存すると、読み込み側が想定するファイルができないため）。
+
+write() はメタデータとデータを包んだJSON文字列全体を作らず、少しずつエンコード・圧縮して
+書き出し先（s3_upload.StreamingUpload など）に渡す。
+"""
+import io
+import json
+import logging
+import os
+import zlib
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple
+
+import json_stream
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - Lambdaランタイムには含まれない
+    zstandard = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - Lambdaランタイムには含まれない
+    pa = None
+    pq = None
+
+logger = logging.getLogger()
+
+
+class RawFormatUnavailable(RuntimeError):
+    """指定された出力形式に必要なライブラリがデプロイパッケージに含まれていない"""
+
+RAW_FORMATS = ("json", "ndjson.gz", "ndjson.zst", "parquet")
+DEFAULT_RAW_FORMAT = "json"
+
+_EXTENSIONS = {
+    "json": ".json",
+    "ndjson.gz": ".ndjson.gz",
+    "ndjson.zst": ".ndjson.zst",
+    "parquet": ".parquet",
+}
+
+# 形式ごとに必要なライブラリ（Lambdaランタイムには含まれない）
+_REQUIRED_MODULES = {
+    "ndjson.zst": "zstandard",
+    "parquet": "pyarrow",
+}
+
+_CONTENT_TYPES = {
+    "json": "application/json",
+    "ndjson.gz": "application/gzip",
+    "ndjson.zst": "application/zstd",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+def raw_prefix(date_str: str, user_id: Optional[str] = None) -> str:
+    """
+    日付パーティションのプレフィックス（末尾スラッシュなし）
+
+    user_id を渡すと raw/fitbit/user_id=<id>/year=... に分ける（主ユーザーは従来どおり user_id なし）。
+    """
+    date_obj = datetime.strptime(date_str, "%Y-%m-%d")
+    user_part = f"user_id={user_id}/" if user_id else ""
+    return f"raw/fitbit/{user_part}year={date_obj.year}/month={date_obj.month:02d}/day={date_obj.day:02d}"
+
+
+def format_for(data_type: str) -> str:
+    """
+    データタイプの出力形式を返す
+
+    FITBIT_RAW_FORMAT_<DATA_TYPE>（例: FITBIT_RAW_FORMAT_HEART_RATE=parquet）が優先され、
+    なければ FITBIT_RAW_FORMAT、どちらもなければ json。必要なライブラリがない形式なら RawFormatUnavailable。
+    """
+    fmt = os.environ.get(f"FITBIT_RAW_FORMAT_{data_type.upper()}") or os.environ.get(
+        "FITBIT_RAW_FORMAT", DEFAULT_RAW_FORMAT
+    )
+    if fmt not in RAW_FORMATS:
+        logger.warning("⚠️ 不明な出力形式 %s（%s）。json で保存します", fmt, data_type)
+        return DEFAULT_RAW_FORMAT
+    _require(fmt, data_type)
+    return fmt
+
+
+def resolve_format(fmt: str, data: Any) -> str:
+    """
+    実際に書き出す形式（intraday データがないペイロードは Parquet にできないため ndjson.gz）
+
+    必要なライブラリがない形式は RawFormatUnavailable を送出する。
+    """
+    _require(fmt)
+    if fmt == "parquet" and _find_intraday_key(data) is None:
+        logger.warning("⚠️ intraday データがないため Parquet の代わりに ndjson.gz で保存します")
+        return "ndjson.gz"
+    return fmt
+
+
+def describe(fmt: str) -> Tuple[str, str]:
+    """resolve_format 済みの形式の (拡張子, Content-Type)"""
+    return _EXTENSIONS[fmt], _CONTENT_TYPES[fmt]
+
+
+def write(sink, metadata: Dict[str, Any], data: Any, fmt: str) -> None:
+    """
+    {"metadata": ..., "data": ...} を resolve_format 済みの形式で sink.write() に少しずつ書く
+
+    json はインデント付き、ndjson.* は1行のJSONを圧縮しながら書く。Parquet は列を組み立てる必要があるため
+    ファイル全体を作ってから書く（intraday の数値列なので JSON より十分小さい）。
+    """
+    if fmt == "parquet":
+        sink.write(_to_parquet(metadata, data))
+        return
+
+    envelope = {"metadata": metadata, "data": data}
+    if fmt == "json":
+        chunks = json.JSONEncoder(indent=2).iterencode(envelope)
+        for block in json_stream.iter_bytes(chunks):
+            sink.write(block)
+        return
+
+    if fmt == "ndjson.zst":
+        compressor = zstandard.ZstdCompressor().compressobj()
+    else:
+        # wbits=31 で gzip 形式（gzip.compress と同じくどの gzip 実装でも読める）
+        compressor = zlib.compressobj(wbits=31)
+    lines = _with_newline(json_stream.iter_compact(envelope, ensure_ascii=False))
+    for block in json_stream.iter_bytes(lines):
+        compressed = compressor.compress(block)
+        if compressed:
+            sink.write(compressed)
+    sink.write(compressor.flush())
+
+
+def serialize(envelope: Dict[str, Any], fmt: str) -> Tuple[bytes, str, str]:
+    """
+    {"metadata": ..., "data": ...} を指定形式でシリアライズする（小さいデータ向け、本文全体をメモリに作る）
+
+    戻り値は (本文, 拡張子, Content-Type)。指定形式が使えない場合はフォールバック後の形式で返す。
+    """
+    fmt = resolve_format(fmt, envelope["data"])
+    buffer = io.BytesIO()
+    write(buffer, envelope["metadata"], envelope["data"], fmt)
+    extension, content_type = describe(fmt)
+    return buffer.getvalue(), extension, content_type
+
+
+def _require(fmt: str, data_type: Optional[str] = None) -> None:
+    module = _REQUIRED_MODULES.get(fmt)
+    if module is None:
+        return
+    if (fmt == "parquet" and pa is None) or (fmt == "ndjson.zst" and zstandard is None):
+        target = f"（{data_type}）" if data_type else ""
+        raise RawFormatUnavailable(
+            f"出力形式 {fmt}{target} には {module} が必要です。requirements.txt に追加してデプロイするか、"
+            "FITBIT_RAW_FORMAT を json / ndjson.gz にしてください"
+        )
+
+
+def _with_newline(chunks):
+    yield from chunks
+    yield "\n"
+
+
+def _find_intraday_key(payload: Any) -> Optional[str]:
+    if not isinstance(payload, dict):
+        return None
+    for key, value in payload.items():
+        if key.endswith("-intraday") and isinstance(value, dict) and "dataset" in value:
+            return key
+    return None
+
+
+def _to_parquet(metadata: Dict[str, Any], payload: Dict[str, Any]) -> bytes:
+    """intraday の dataset を (data_date, time, value) の列に展開してParquet化する（resolve_format 済みが前提）"""
+    intraday_key = _find_intraday_key(payload)
+    intraday = payload[intraday_key]
+    dataset = intraday.get("dataset", [])
+    data_date = metadata["data_date"]
+    table = pa.table({
+        "data_date": pa.array([data_date] * len(dataset), pa.string()),
+        "time": pa.array([point.get("time") for point in dataset], pa.string()),
+        "value": pa.array([point.get("value") for point in dataset]),
+    })
+
+    # 日次サマリーなど dataset 以外の項目はファイルのメタデータとして保持する
+    rest = {key: value for key, value in payload.items() if key != intraday_key}
+    rest[intraday_key] = {key: value for key, value in intraday.items() if key != "dataset"}
+    table = table.replace_schema_metadata({
+        "metadata": json.dumps(metadata, ensure_ascii=False),
+        "data": json.dumps(rest, ensure_ascii=False),
+        "intraday_key": intraday_key,
+    })
+
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression="zstd")
+    return buffer.getvalue()
@@ -0,0 +1,320 @@
+"""
+Fitbit APIの再試行ポリシー（指数バックオフ + Retry-After + サーキットブレーカー + 期限）
+
+日次Lambda・バックフィル・トークンのリフレッシュで共通に使う。
+- 429 / 5xx / 通信エラーは、ジッター付き指数バックオフ（full jitter）で max_attempts 回まで試す
+- Retry-After があればその秒数を待つ（レート制限のリミッターを渡した場合はリミッターがリセットまで待つ）
+- 待ち時間が期限（Lambdaの残り時間から求めた Deadline）を超える場合は待たずに最後の結果を返す
+- ユーザー・エンドポイントごとのサーキットブレーカーが、連続して失敗しているエンドポイントへの呼び出しを一定時間止める
+  （429 はレート制限のリミッターが扱うため失敗に数えない）
+
+401 などの4xxは再試行しない（呼び出し側がトークンの取り直しなどで対処する）。
+AWSの呼び出しは aws_clients の botocore 設定（standard モードのジッター付き再試行）に任せる。
+"""
+import email.utils
+import logging
+import os
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, Mapping, Optional, Tuple
+
+import metrics
+from rate_limiter import FitbitRateLimiter, RateLimitExceeded
+
+logger = logging.getLogger()
+
+RETRYABLE_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+DEFAULT_MAX_ATTEMPTS = 4
+DEFAULT_BASE_DELAY = 1.0
+DEFAULT_MAX_DELAY = 30.0
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 60.0
+
+
+class CircuitOpenError(Exception):
+    """サーキットブレーカーが開いているため呼び出しを行わなかった"""
+
+    def __init__(self, key: str, retry_in: float):
+        super().__init__(f"circuit open for {key} (retry in {retry_in:.0f}s)")
+        self.key = key
+        self.retry_in = retry_in
+
+
+class Deadline:
+    """呼び出し全体の期限（None は無期限）"""
+
+    def __init__(self, seconds: Optional[float] = None, clock: Callable[[], float] = time.monotonic):
+        self._clock = clock
+        self._expires_at = None if seconds is None else clock() + max(0.0, seconds)
+
+    @classmethod
+    def from_context(cls, context, margin_seconds: float = 10.0) -> "Deadline":
+        """Lambdaの残り時間から margin_seconds を引いた期限"""
+        if context is None or not hasattr(context, "get_remaining_time_in_millis"):
+            return cls()
+        return cls(context.get_remaining_time_in_millis() / 1000 - margin_seconds)
+
+    def remaining(self) -> Optional[float]:
+        if self._expires_at is None:
+            return None
+        return max(0.0, self._expires_at - self._clock())
+
+    def allows(self, wait_seconds: float) -> bool:
+        remaining = self.remaining()
+        return remaining is None or wait_seconds <= remaining
+
+
+class CircuitBreaker:
+    """
+    連続失敗回数によるサーキットブレーカー（スレッドセーフ）
+
+    failure_threshold 回続けて失敗すると開き、reset_timeout 秒後に1回だけ試行を許す（半開）。
+    その試行が成功すれば閉じ、失敗すればまた reset_timeout 秒開く。
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+        reset_timeout: float = DEFAULT_RESET_TIMEOUT,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if self._clock() - self._opened_at >= self.reset_timeout:
+                return "half_open"
+            return "open"
+
+    def retry_in(self) -> float:
+        with self._lock:
+            if self._opened_at is None:
+                return 0.0
+            return max(0.0, self.reset_timeout - (self._clock() - self._opened_at))
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._clock() - self._opened_at < self.reset_timeout or self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_ignored(self) -> None:
+        """成功にも失敗にも数えない結果（429）。半開の試行だった場合は次の試行を許す"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or self._failures >= self.failure_threshold:
+                self._opened_at = self._clock()
+            self._trial_in_flight = False
+
+
+class RetryPolicy:
+    """ジッター付き指数バックオフの再試行ポリシー"""
+
+    def __init__(
+        self,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+        base_delay: float = DEFAULT_BASE_DELAY,
+        max_delay: float = DEFAULT_MAX_DELAY,
+        retry_statuses=RETRYABLE_STATUSES,
+        sleep: Callable[[float], None] = time.sleep,
+        rand: Callable[[], float] = random.random,
+    ):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_statuses = frozenset(retry_statuses)
+        self._sleep = sleep
+        self._rand = rand
+
+    @classmethod
+    def from_env(cls) -> "RetryPolicy":
+        """FITBIT_RETRY_MAX_ATTEMPTS / FITBIT_RETRY_BASE_DELAY から作成"""
+        try:
+            max_attempts = int(os.environ.get("FITBIT_RETRY_MAX_ATTEMPTS", str(DEFAULT_MAX_ATTEMPTS)))
+        except ValueError:
+            max_attempts = DEFAULT_MAX_ATTEMPTS
+        try:
+            base_delay = float(os.environ.get("FITBIT_RETRY_BASE_DELAY", str(DEFAULT_BASE_DELAY)))
+        except ValueError:
+            base_delay = DEFAULT_BASE_DELAY
+        return cls(max_attempts=max_attempts, base_delay=base_delay)
+
+    def backoff(self, attempt: int) -> float:
+        """attempt 回目（0始まり）の失敗後の待ち時間（0〜上限の一様乱数）"""
+        return self._rand() * min(self.max_delay, self.base_delay * (2 ** attempt))
+
+    def delay_for(self, attempt: int, headers: Optional[Mapping[str, str]] = None) -> float:
+        """Retry-After があればそれを、なければバックオフを待ち時間にする"""
+        retry_after = retry_after_seconds(headers)
+        if retry_after is not None:
+            return retry_after
+        return self.backoff(attempt)
+
+    def request(
+        self,
+        http,
+        method: str,
+        url: str,
+        key: str,
+        deadline: Optional[Deadline] = None,
+        breaker: Optional[CircuitBreaker] = None,
+        rate_limiter: Optional[FitbitRateLimiter] = None,
+        **kwargs: Any,
+    ):
+        """
+        http.request を再試行付きで呼び出し、最後のレスポンスを返す（各試行を metrics に "fitbit" として記録する）
+
+        最後の試行が通信エラーならその例外を送出する。ブレーカーが開いていれば CircuitOpenError。
+        rate_limiter を渡した場合、1回目の枠は呼び出し側で確保済みとし、2回目以降はここで1件ずつ確保する
+        （期限内に確保できなければ再試行をやめる）。各レスポンスは rate_limiter.observe に渡し、
+        ブレーカーが開いていて送らなかった試行の枠は rate_limiter.release で戻す。
+        """
+        deadline = deadline or Deadline()
+        # 再試行はこのポリシーで行う（urllib3 の既定の再試行は 429/503 の Retry-After を期限に関係なく待ってしまう）
+        kwargs.setdefault("retries", False)
+        attempt = 0
+        response = None
+        error: Optional[Exception] = None
+        while True:
+            if breaker is not None and not breaker.allow():
+                if rate_limiter is not None:
+                    # この試行のために確保した枠は使わなかったので戻す
+                    rate_limiter.release(1)
+                if attempt == 0:
+                    raise CircuitOpenError(key, breaker.retry_in())
+                # 再試行中にブレーカーが開いた場合は最後の結果を返す
+                logger.warning("🚧 %s: サーキットブレーカーが開いたため再試行を中断", key)
+                return _result(response, error)
+
+            response = None
+            error = None
+            started = time.perf_counter()
+            try:
+                response = http.request(method, url, **kwargs)
+            except Exception as exc:  # pylint: disable=broad-except
+                error = exc
+            finally:
+                _record_attempt(key, time.perf_counter() - started, response, kwargs.get("body"))
+                if rate_limiter is not None:
+                    if response is not None:
+                        rate_limiter.observe(response.status, response.headers)
+                    else:
+                        rate_limiter.observe(None)
+
+            if error is None and response.status not in self.retry_statuses:
+                if breaker is not None:
+                    breaker.record_success()
+                return response
+
+            if breaker is not None:
+                if response is not None and response.status == 429:
+                    # レート制限はエンドポイントの障害ではない（待ちはリミッターと Retry-After で行う）
+                    breaker.record_ignored()
+                else:
+                    breaker.record_failure()
+            attempt += 1
+            outcome = error if error is not None else response.status
+            if attempt >= self.max_attempts:
+                logger.warning("⚠️ %s: %s回試行して失敗（%s）", key, attempt, outcome)
+                return _result(response, error)
+
+            headers = response.headers if response is not None else None
+            if rate_limiter is not None and response is not None and response.status == 429:
+                # 429 はリミッターがリセット時刻（Retry-After）まで待つ
+                delay = 0.0
+            else:
+                delay = self.delay_for(attempt - 1, headers)
+            if not deadline.allows(delay):
+                logger.warning("⏳ %s: 再試行の待ち時間（%.1f秒）が期限を超えるため中断（%s）", key, delay, outcome)
+                return _result(response, error)
+
+            logger.info("🔁 %s: %.1f秒後に再試行します（%s回目の失敗: %s）", key, delay, attempt, outcome)
+            if delay > 0:
+                self._sleep(delay)
+                metrics.record_sleep("retry_backoff", delay)
+            if rate_limiter is not None:
+                try:
+                    rate_limiter.acquire(1, max_wait=deadline.remaining())
+                except RateLimitExceeded as exc:
+                    logger.warning("⏰ %s: レート制限の枠を期限内に確保できないため再試行を中断（%s）", key, exc)
+                    return _result(response, error)
+
+
+_breakers: Dict[Tuple[Optional[str], str], CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker_for(key: str, user_id: Optional[str] = None) -> CircuitBreaker:
+    """
+    ユーザー・エンドポイントごとのブレーカー（ウォーム起動をまたいで状態を保持する）
+
+    Fitbitの障害やトークンの問題はユーザー単位で起きることがあるため、あるユーザーの連続失敗で
+    他のユーザーの同じエンドポイントを止めないよう (user_id, key) で分ける。
+    """
+    with _breakers_lock:
+        if (user_id, key) not in _breakers:
+            _breakers[(user_id, key)] = CircuitBreaker()
+        return _breakers[(user_id, key)]
+
+
+def retry_after_seconds(headers: Optional[Mapping[str, str]]) -> Optional[float]:
+    """Retry-After（秒数またはHTTP日付）を秒数に変換する"""
+    value = (headers or {}).get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def _record_attempt(key: str, duration: float, response, body: Any) -> None:
+    headers = getattr(response, "headers", None) or {}
+    try:
+        remaining = int(headers["Fitbit-Rate-Limit-Remaining"]) if "Fitbit-Rate-Limit-Remaining" in headers else None
+    except (TypeError, ValueError):
+        remaining = None
+    metrics.record(
+        "fitbit",
+        key,
+        duration,
+        status=response.status if response is not None else 0,
+        bytes_sent=len(body) if isinstance(body, (bytes, str)) else 0,
+        bytes_received=len(response.data or b"") if response is not None else 0,
+        rate_limit_remaining=remaining,
+    )
+
+
+def _result(response, error: Optional[Exception]):
+    if error is not None:
+        raise error
+    return response
@@ -0,0 +1,81 @@
+"""
+S3上の取り込み済み日付インデックス
+
+raw/fitbit/year=YYYY/month=MM/ プレフィックスごとに list_objects_v2 を1回（ページング込み）発行し、
+_summary.json が存在する日付の集合を作る。日ごとの head_object を置き換えるためのもの。
+
+日次Lambdaの欠損日チェックのように直近の数日だけを調べる場合は、list_recent_ingested_dates で
+StartAfter を使った1回の一覧（月をまたいでも1回）にまとめる。キーは year=/month=/day= の順に並ぶため、
+end より後の日付に達した時点で一覧を打ち切れる。
+"""
+import re
+from datetime import date as date_cls
+from typing import Iterator, Optional, Set, Tuple
+
+RAW_FITBIT_PREFIX = "raw/fitbit"
+
+_SUMMARY_KEY_PATTERN = re.compile(
+    r"^raw/fitbit/year=(\d{4})/month=(\d{2})/day=(\d{2})/_summary\.json$"
+)
+
+# user_id= パーティションを含む任意のキー（日付より後ろは問わない）
+_PARTITION_KEY_PATTERN = re.compile(
+    r"^raw/fitbit/(?:user_id=[^/]+/)?year=(\d{4})/month=(\d{2})/day=(\d{2})/(.+)$"
+)
+
+
+def list_ingested_dates(s3_client, bucket: str, start: date_cls, end: date_cls) -> Set[date_cls]:
+    """start〜end の範囲で _summary.json が保存済みの日付を返す"""
+    ingested: Set[date_cls] = set()
+    paginator = s3_client.get_paginator("list_objects_v2")
+
+    for year, month in _months_between(start, end):
+        prefix = f"{RAW_FITBIT_PREFIX}/year={year}/month={month:02d}/"
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                match = _SUMMARY_KEY_PATTERN.match(obj["Key"])
+                if not match:
+                    continue
+                ingested_date = date_cls(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+                if start <= ingested_date <= end:
+                    ingested.add(ingested_date)
+
+    return ingested
+
+
+def list_recent_ingested_dates(
+    s3_client, bucket: str, start: date_cls, end: date_cls, user_id: Optional[str] = None
+) -> Set[date_cls]:
+    """
+    start〜end の範囲で _summary.json が保存済みの日付を1回のプレフィックス一覧で返す
+
+    user_id を渡すと raw/fitbit/user_id=<id>/ 配下を調べる（主ユーザーは従来どおり user_id なし）。
+    """
+    user_part = f"user_id={user_id}/" if user_id else ""
+    prefix = f"{RAW_FITBIT_PREFIX}/{user_part}year="
+    # start の日付パーティション内のキーはすべてこの文字列より後ろに並ぶ
+    start_after = f"{prefix}{start.year}/month={start.month:02d}/day={start.day:02d}"
+
+    ingested: Set[date_cls] = set()
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, StartAfter=start_after):
+        for obj in page.get("Contents", []):
+            match = _PARTITION_KEY_PATTERN.match(obj["Key"])
+            if not match:
+                continue
+            ingested_date = date_cls(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+            if ingested_date > end:
+                return ingested
+            if match.group(4) == "_summary.json" and ingested_date >= start:
+                ingested.add(ingested_date)
+
+    return ingested
+
+
+def _months_between(start: date_cls, end: date_cls) -> Iterator[Tuple[int, int]]:
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        yield year, month
+        month += 1
+        if month > 12:
+            year, month = year + 1, 1
@@ -0,0 +1,122 @@
+"""
+S3へのストリーミングアップロード
+
+write() で受け取ったバイト列を part_size までバッファし、超えたらマルチパートアップロードに切り替えて
+パートごとに送る。最後まで part_size に達しなければ従来どおり put_object を1回だけ呼ぶ。
+本文全体をメモリに持たないため、メモリ使用量のピークは part_size 程度に収まる。
+"""
+import logging
+import os
+from typing import Dict, List, Optional
+
+logger = logging.getLogger()
+
+# S3のマルチパートの最小パートサイズ（最後のパートを除く）は 5 MiB
+MIN_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+
+
+def part_size_from_env() -> int:
+    """FITBIT_S3_PART_SIZE_MB（MiB、最小5）"""
+    try:
+        size = int(float(os.environ.get("FITBIT_S3_PART_SIZE_MB", "8")) * 1024 * 1024)
+    except ValueError:
+        size = DEFAULT_PART_SIZE
+    return max(MIN_PART_SIZE, size)
+
+
+class StreamingUpload:
+    """
+    ファイルのように write() できるS3オブジェクト
+
+    with 文で使い、正常に抜けたときにアップロードを完了する。例外で抜けた場合は
+    開始済みのマルチパートアップロードを中止する（途中のパートが課金対象として残らないように）。
+    """
+
+    def __init__(
+        self,
+        s3_client,
+        bucket: str,
+        key: str,
+        content_type: str,
+        metadata: Optional[Dict[str, str]] = None,
+        part_size: Optional[int] = None,
+    ):
+        self._s3 = s3_client
+        self.bucket = bucket
+        self.key = key
+        self._content_type = content_type
+        self._metadata = metadata or {}
+        self._part_size = max(MIN_PART_SIZE, part_size or part_size_from_env())
+        self._buffer = bytearray()
+        self._upload_id: Optional[str] = None
+        self._parts: List[Dict[str, object]] = []
+        self.bytes_written = 0
+
+    def __enter__(self) -> "StreamingUpload":
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data: bytes) -> int:
+        self._buffer += data
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self._part_size:
+            self._upload_part(bytes(self._buffer[:self._part_size]))
+            del self._buffer[:self._part_size]
+        return len(data)
+
+    def close(self) -> None:
+        """残りを送ってアップロードを完了する（小さい本文は put_object 1回）"""
+        if self._upload_id is None:
+            self._s3.put_object(
+                Bucket=self.bucket,
+                Key=self.key,
+                Body=bytes(self._buffer),
+                ContentType=self._content_type,
+                Metadata=self._metadata,
+            )
+        else:
+            if self._buffer:
+                self._upload_part(bytes(self._buffer))
+            self._s3.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self._upload_id,
+                MultipartUpload={"Parts": self._parts},
+            )
+            logger.info("  📦 %s を%sパートでアップロード（%sバイト）", self.key, len(self._parts), self.bytes_written)
+        self._buffer = bytearray()
+
+    def abort(self) -> None:
+        self._buffer = bytearray()
+        if self._upload_id is None:
+            return
+        try:
+            self._s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+        except Exception:  # pylint: disable=broad-except
+            logger.warning("⚠️ %s のマルチパートアップロードを中止できませんでした", self.key, exc_info=True)
+        self._upload_id = None
+
+    def _upload_part(self, body: bytes) -> None:
+        if self._upload_id is None:
+            response = self._s3.create_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                ContentType=self._content_type,
+                Metadata=self._metadata,
+            )
+            self._upload_id = response["UploadId"]
+        part_number = len(self._parts) + 1
+        response = self._s3.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=body,
+        )
+        self._parts.append({"ETag": response["ETag"], "PartNumber": part_number})
@@ -0,0 +1,164 @@
+"""
+睡眠ログの差分同期（/1.2/user/-/sleep/list.json?afterDate=）
+
+日次エクスポートは前日分しか取得しないため、後から同期・編集された過去の睡眠ログを取りこぼす。
+このモジュールは fitbit_tokens の sleep_sync_cursor（最後に取り込んだ dateOfSleep）から
+遡り期間（FITBIT_SLEEP_SYNC_LOOKBACK_DAYS）を含めて睡眠ログ一覧をページングで取得し、
+日付ごとに日付指定エンドポイントと同じ形のペイロードへまとめ直す。
+一覧APIは offset=0 しか受け付けないため、2ページ目以降はレスポンスの pagination.next のURLをそのまま辿る。
+
+afterDate は同期日時ではなく睡眠の日付で絞り込むため、遅れて同期されたログを拾うには
+カーソルより前の数日を毎回取り直す必要がある。取り直した日のうち内容が変わった日だけを
+content_hash で判定して書き直す。
+"""
+import logging
+import os
+from datetime import date as date_cls, datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from botocore.exceptions import ClientError
+
+import fitbit_api
+import fitbit_ranges
+
+logger = logging.getLogger()
+
+CURSOR_ATTRIBUTE = "sleep_sync_cursor"
+PAGE_LIMIT = 100
+# 1回の同期で取得するページ数の上限（100件 × 10ページ）
+MAX_PAGES = 10
+DEFAULT_LOOKBACK_DAYS = 7
+
+
+def enabled(event: Any = None) -> bool:
+    """イベントの sleep_sync、なければ FITBIT_SLEEP_SYNC（デフォルト: false）"""
+    if isinstance(event, dict) and "sleep_sync" in event:
+        return bool(event["sleep_sync"])
+    return os.environ.get("FITBIT_SLEEP_SYNC", "false").lower() in ("1", "true", "yes")
+
+
+def lookback_days_from_env() -> int:
+    try:
+        return max(0, int(os.environ.get("FITBIT_SLEEP_SYNC_LOOKBACK_DAYS", str(DEFAULT_LOOKBACK_DAYS))))
+    except ValueError:
+        return DEFAULT_LOOKBACK_DAYS
+
+
+def after_date_for(cursor: Optional[str], until: date_cls, lookback_days: int) -> date_cls:
+    """
+    afterDate に渡す日付（この日より後のログが返る）
+
+    カーソル（取り込み済みの最後の日）の翌日を起点に、遡り期間分を取り直す。カーソルがなければ until が起点。
+    """
+    base = until
+    if cursor:
+        base = min(until, datetime.strptime(cursor, "%Y-%m-%d").date() + timedelta(days=1))
+    return base - timedelta(days=lookback_days + 1)
+
+
+def list_endpoint(after: date_cls) -> str:
+    """1ページ目のエンドポイント（Fitbitは offset=0 のみ対応）"""
+    return f"/1.2/user/-/sleep/list.json?afterDate={after.isoformat()}&sort=asc&offset=0&limit={PAGE_LIMIT}"
+
+
+def next_endpoint(pagination: Optional[Dict[str, Any]]) -> Optional[str]:
+    """pagination.next（https://api.fitbit.com/1.2/... の完全なURL）をエンドポイントのパスに直す。最後のページは None"""
+    next_url = (pagination or {}).get("next")
+    if not next_url:
+        return None
+    parsed = urlparse(next_url)
+    return f"{parsed.path}?{parsed.query}" if parsed.query else parsed.path
+
+
+def fetch_logs_after(
+    http,
+    access_token: str,
+    after: date_cls,
+    rate_limiter=None,
+    max_wait: Optional[float] = None,
+    user_id: Optional[str] = None,
+) -> Tuple[List[Dict[str, Any]], int, bool]:
+    """
+    afterDate 以降の睡眠ログを昇順にすべて取得する
+
+    戻り値は (ログ, 最後のHTTPステータス, 最後のページまで取得できたか)。
+    """
+    logs: List[Dict[str, Any]] = []
+    endpoint = list_endpoint(after)
+    for _ in range(MAX_PAGES):
+        data, status_map = fitbit_api.fetch_endpoints(
+            http,
+            access_token,
+            {"sleep_list": endpoint},
+            rate_limiter=rate_limiter,
+            max_wait=max_wait,
+            user_id=user_id,
+        )
+        status = status_map["sleep_list"]
+        payload = data["sleep_list"]
+        if status != 200 or payload is None:
+            return logs, status, False
+
+        page = payload.get("sleep", [])
+        logs.extend(page)
+        following = next_endpoint(payload.get("pagination"))
+        if following is None or following == endpoint or not page:
+            return logs, status, True
+        endpoint = following
+
+    logger.warning("⚠️ 睡眠ログ一覧が%sページを超えたため残りは次回に取得します", MAX_PAGES)
+    return logs, 200, False
+
+
+def group_by_date(
+    logs: List[Dict[str, Any]], after: date_cls, until: date_cls, complete: bool
+) -> Dict[str, Dict[str, Any]]:
+    """
+    dateOfSleep ごとに {"sleep": [...], "summary": {...}} にまとめる
+
+    最後のページまで取得できた場合は、ログのない日も空のペイロードとして返す（削除されたログを反映するため）。
+    途中で打ち切った場合は取得できた最後の日までに限る。until の日は含めない。
+    """
+    if complete:
+        last = until - timedelta(days=1)
+    else:
+        seen = [log.get("dateOfSleep") for log in logs if log.get("dateOfSleep")]
+        if not seen:
+            return {}
+        # 最後の日はページの途中で切れている可能性がある
+        last = datetime.strptime(max(seen), "%Y-%m-%d").date() - timedelta(days=1)
+
+    days = []
+    current = after + timedelta(days=1)
+    while current <= last:
+        days.append(current)
+        current += timedelta(days=1)
+    return {
+        target.isoformat(): payload
+        for target, payload in fitbit_ranges.split_sleep_by_date({"sleep": logs}, days).items()
+    }
+
+
+def next_cursor(cursor: Optional[str], days: Dict[str, Any]) -> Optional[str]:
+    """取り込んだ最後の日（ログの有無にかかわらず）。カーソルは後退させない"""
+    if not days:
+        return cursor
+    latest = max(days)
+    return latest if cursor is None or latest > cursor else cursor
+
+
+def save_cursor(table, user_id: str, cursor: str) -> None:
+    """fitbit_tokens の同じ項目にカーソルを保存する（トークンの version 管理とは独立した属性）"""
+    try:
+        table.update_item(
+            Key={"user_id": user_id},
+            UpdateExpression="SET #cursor = :cursor, sleep_sync_at = :synced_at",
+            ConditionExpression="attribute_not_exists(#cursor) OR #cursor < :cursor",
+            ExpressionAttributeNames={"#cursor": CURSOR_ATTRIBUTE},
+            ExpressionAttributeValues={":cursor": cursor, ":synced_at": datetime.now().isoformat()},
+        )
+    except ClientError as err:
+        if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        logger.info("📋 睡眠同期カーソルは既に %s 以降まで進んでいます", cursor)
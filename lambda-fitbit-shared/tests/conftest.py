@@ -0,0 +1,141 @@
+"""
+lambda-fitbit-shared のテスト共通設定
+
+Lambdaのデプロイパッケージと同じく、共有モジュールをトップレベルでimportできるようにする。
+各Lambdaの lambda_function.py は同じモジュール名のため、load_lambda() でディレクトリ名から別名を付けて読み込む。
+"""
+import importlib.util
+import os
+import sys
+import time
+
+import pytest
+
+SHARED_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPO_ROOT = os.path.dirname(SHARED_DIR)
+if SHARED_DIR not in sys.path:
+    sys.path.insert(0, SHARED_DIR)
+BENCHMARKS_DIR = os.path.join(SHARED_DIR, "benchmarks")
+if BENCHMARKS_DIR not in sys.path:
+    sys.path.insert(0, BENCHMARKS_DIR)
+
+TEST_BUCKET = "fitbit-test-bucket"
+PRIMARY_USER_ID = "BGPGCR"
+
+
+def load_lambda(directory: str):
+    """リポジトリ直下の directory/lambda_function.py を読み込む（テストのセッション中は同じモジュールを返す）"""
+    name = directory.replace("-", "_") + "_lambda_function"
+    if name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(name, os.path.join(REPO_ROOT, directory, "lambda_function.py"))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+    return sys.modules[name]
+
+
+def create_tokens_table(aws_clients, user_ids=(PRIMARY_USER_ID,)) -> None:
+    """fitbit_tokens を作成し、user_ids ごとに有効期限内のトークンを登録する（アクセストークンはユーザーIDと同じ）"""
+    aws_clients.client("dynamodb").create_table(
+        TableName="fitbit_tokens",
+        KeySchema=[{"AttributeName": "user_id", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "user_id", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    for user_id in user_ids:
+        aws_clients.table("fitbit_tokens").put_item(Item={
+            "user_id": user_id,
+            "access_token": user_id,
+            "refresh_token": f"{user_id}-refresh",
+            "expires_at": int(time.time()) + 3600,
+        })
+
+
+def create_pending_table(aws_clients):
+    """fitbit_webhook_pending を due_at-index 付きで作成する（scripts/create-fitbit-webhook-pending.sh と同じ構成）"""
+    import webhook_queue
+
+    aws_clients.client("dynamodb").create_table(
+        TableName=webhook_queue.DEFAULT_PENDING_TABLE,
+        KeySchema=[
+            {"AttributeName": "user_id", "KeyType": "HASH"},
+            {"AttributeName": "item_key", "KeyType": "RANGE"},
+        ],
+        AttributeDefinitions=[
+            {"AttributeName": "user_id", "AttributeType": "S"},
+            {"AttributeName": "item_key", "AttributeType": "S"},
+            {"AttributeName": webhook_queue.QUEUE_ATTRIBUTE, "AttributeType": "S"},
+            {"AttributeName": "due_at", "AttributeType": "N"},
+        ],
+        GlobalSecondaryIndexes=[{
+            "IndexName": webhook_queue.DUE_INDEX,
+            "KeySchema": [
+                {"AttributeName": webhook_queue.QUEUE_ATTRIBUTE, "KeyType": "HASH"},
+                {"AttributeName": "due_at", "KeyType": "RANGE"},
+            ],
+            "Projection": {"ProjectionType": "ALL"},
+        }],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    return aws_clients.table(webhook_queue.DEFAULT_PENDING_TABLE)
+
+
+def list_keys(aws_clients, prefix: str = ""):
+    keys = []
+    for page in aws_clients.client("s3").get_paginator("list_objects_v2").paginate(Bucket=TEST_BUCKET, Prefix=prefix):
+        keys.extend(item["Key"] for item in page.get("Contents", []))
+    return keys
+
+
+@pytest.fixture(autouse=True)
+def fresh_breakers(monkeypatch):
+    """サーキットブレーカーはウォーム起動をまたいで保持されるため、テストごとに空にする"""
+    import retry_policy
+
+    monkeypatch.setattr(retry_policy, "_breakers", {})
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    """moto 上の S3・DynamoDB（テストごとに空のバケット）。aws_clients のキャッシュも作り直す"""
+    moto = pytest.importorskip("moto")
+    import aws_clients
+
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "ap-northeast-1")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "test")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "test")
+    monkeypatch.setenv("S3_BUCKET", TEST_BUCKET)
+    monkeypatch.setenv("FITBIT_CLIENT_SECRET", "test")
+    monkeypatch.setenv("FITBIT_METRICS", "off")
+    with moto.mock_aws():
+        aws_clients.reset()
+        aws_clients.client("s3").create_bucket(
+            Bucket=TEST_BUCKET, CreateBucketConfiguration={"LocationConstraint": "ap-northeast-1"}
+        )
+        yield aws_clients
+        aws_clients.reset()
+
+
+@pytest.fixture
+def fake_fitbit(monkeypatch):
+    """
+    benchmarks/fake_fitbit.py の代替サーバーを起動し、Fitbit API とトークンのURLをそちらに向ける
+
+    テストごとにサーバーの設定（rate_limit・error_rate など）を変えられるよう、起動関数を返す。
+    """
+    import fitbit_api
+    import token_manager
+    from fake_fitbit import FakeFitbitServer
+
+    servers = []
+
+    def start(**kwargs) -> FakeFitbitServer:
+        server = FakeFitbitServer(**kwargs).start()
+        servers.append(server)
+        monkeypatch.setattr(fitbit_api, "FITBIT_API_BASE", server.base_url)
+        monkeypatch.setattr(token_manager, "FITBIT_TOKEN_URL", f"{server.base_url}/oauth2/token")
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
@@ -0,0 +1,224 @@
+"""バックフィルLambdaのコーディネーターモード（moto 上のジャーナル・S3・EventBridge Scheduler と代替Fitbitサーバー）"""
+import json
+import time
+
+import pytest
+
+from conftest import create_tokens_table, list_keys, load_lambda
+
+FUNCTION_ARN = "arn:aws:lambda:ap-northeast-1:123456789012:function:moderation-craft-fitbit-backfill"
+SCHEDULER_ROLE_ARN = "arn:aws:iam::123456789012:role/fitbit-backfill-scheduler-role"
+EVENT = {"coordinator": True, "start_date": "2025-03-01", "end_date": "2025-03-05", "force": True}
+
+
+class FakeContext:
+    aws_request_id = "test-request"
+
+    def __init__(self, invoked_function_arn=None, remaining_ms=900_000):
+        self.invoked_function_arn = invoked_function_arn
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_ms
+
+
+@pytest.fixture
+def backfill(aws, monkeypatch):
+    """ジャーナル・トークンのテーブルを作成し、ウォーム起動の状態（リミッター）を初期化したバックフィルLambda"""
+    import backfill_journal
+    import rate_limiter
+
+    module = load_lambda("lambda-fitbit-backfill")
+    create_tokens_table(aws)
+    aws.client("dynamodb").create_table(
+        TableName=backfill_journal.DEFAULT_JOURNAL_TABLE,
+        KeySchema=[
+            {"AttributeName": "job_id", "KeyType": "HASH"},
+            {"AttributeName": "item_key", "KeyType": "RANGE"},
+        ],
+        AttributeDefinitions=[
+            {"AttributeName": "job_id", "AttributeType": "S"},
+            {"AttributeName": "item_key", "AttributeType": "S"},
+        ],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    monkeypatch.setattr(module, "fitbit_rate_limiter", rate_limiter.rate_limiter_from_env(default_reserve=8))
+    monkeypatch.setattr(module, "SCHEDULER_ROLE_ARN", SCHEDULER_ROLE_ARN)
+    monkeypatch.setattr(module, "COORDINATOR_SHARD_DAYS", 2)
+    return module
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """time.sleep の呼び出しを記録する（実際には待たない）"""
+    calls = []
+    monkeypatch.setattr(time, "sleep", calls.append)
+    return calls
+
+
+@pytest.fixture
+def invokes(aws, monkeypatch):
+    """Lambdaの非同期再起動を記録する（moto には起動先の関数がないため）"""
+    calls = []
+
+    class RecordingLambda:
+        def invoke(self, **kwargs):
+            calls.append(kwargs)
+            return {"StatusCode": 202}
+
+    original = aws.client
+    monkeypatch.setattr(aws, "client", lambda name: RecordingLambda() if name == "lambda" else original(name))
+    return calls
+
+
+def _schedules(aws):
+    return aws.client("scheduler").list_schedules()["Schedules"]
+
+
+def _job(job_id):
+    import backfill_journal
+
+    return backfill_journal.BackfillJournal.from_env(job_id).load_job()
+
+
+def test_completes_job_and_records_every_day(backfill, fake_fitbit, aws, sleeps):
+    fake_fitbit()
+    response = backfill.lambda_handler(EVENT, FakeContext())
+    body = json.loads(response["body"])
+
+    assert response["statusCode"] == 200
+    assert body["status"] == "completed"
+    assert sorted(entry["date"] for entry in body["fetched"]) == [f"2025-03-0{day}" for day in range(1, 6)]
+    for day in range(1, 6):
+        assert f"raw/fitbit/year=2025/month=03/day=0{day}/_summary.json" in list_keys(aws)
+
+    import backfill_journal
+
+    journal = backfill_journal.BackfillJournal.from_env(body["job_id"])
+    assert journal.pending_shards() == []
+    assert journal.load_job()["status"] == "completed"
+
+    # 完了済みのジョブは取得せずに返す
+    again = json.loads(backfill.lambda_handler(EVENT, FakeContext())["body"])
+    assert again["status"] == "completed"
+
+
+def test_timeout_reinvokes_and_resumes_from_journal(backfill, fake_fitbit, aws, sleeps, invokes):
+    server = fake_fitbit()
+    # 後処理分の余裕しか残っていない実行は取得せずに再起動する
+    response = backfill.lambda_handler(
+        EVENT, FakeContext(FUNCTION_ARN, remaining_ms=backfill.LAMBDA_TIME_MARGIN_SECONDS * 1000)
+    )
+    body = json.loads(response["body"])
+
+    assert response["statusCode"] == 202
+    assert body["stop_reason"] == "timeout"
+    assert server.stats()["api_requests"] == 0
+    assert len(invokes) == 1
+    payload = json.loads(invokes[0]["Payload"])
+    assert invokes[0]["InvocationType"] == "Event"
+    assert payload["job_id"] == body["job_id"] and payload["coordinator"] is True
+    assert _schedules(aws) == []
+
+    # 再起動された実行はジャーナルのリースを取り直して完了する
+    resumed = json.loads(backfill.lambda_handler(payload, FakeContext(FUNCTION_ARN))["body"])
+    assert resumed["status"] == "completed"
+    assert resumed["invocation"] == 2
+    assert len(resumed["fetched"]) == 5
+
+
+def test_rate_limit_schedules_resume_instead_of_sleeping(backfill, fake_fitbit, aws, sleeps, invokes):
+    # 1日分（4リクエスト）強で1時間の枠を使い切るサーバー
+    fake_fitbit(rate_limit=6)
+    started = time.time()
+    response = backfill.lambda_handler(EVENT, FakeContext(FUNCTION_ARN))
+    body = json.loads(response["body"])
+
+    assert response["statusCode"] == 202
+    assert body["stop_reason"] == "rate_limit"
+    assert body["status"] == "continuing"
+    assert not any(seconds > backfill.COORDINATOR_MAX_SLEEP_SECONDS for seconds in sleeps)
+    assert invokes == []
+
+    job = _job(body["job_id"])
+    assert job["resume_after"] > started + backfill.COORDINATOR_MAX_SLEEP_SECONDS
+    assert "lease_owner" not in job
+
+    schedules = _schedules(aws)
+    assert len(schedules) == 1
+    schedule = aws.client("scheduler").get_schedule(Name=schedules[0]["Name"])
+    assert schedule["Name"].startswith(backfill.SCHEDULE_NAME_PREFIX)
+    assert schedule["ScheduleExpression"] == f"at({body['resume_at']})"
+    assert schedule["ScheduleExpressionTimezone"] == "UTC"
+    assert schedule["ActionAfterCompletion"] == "DELETE"
+    assert schedule["Target"]["Arn"] == FUNCTION_ARN
+    assert schedule["Target"]["RoleArn"] == SCHEDULER_ROLE_ARN
+    assert json.loads(schedule["Target"]["Input"])["job_id"] == body["job_id"]
+
+
+def test_early_invocation_reschedules_without_fetching(backfill, fake_fitbit, aws, sleeps, invokes):
+    server = fake_fitbit(rate_limit=6)
+    first = json.loads(backfill.lambda_handler(EVENT, FakeContext(FUNCTION_ARN))["body"])
+    requests_before = server.stats()["api_requests"]
+
+    # 予約した時刻より前に同じジョブが起動された
+    response = backfill.lambda_handler({**EVENT, "job_id": first["job_id"]}, FakeContext(FUNCTION_ARN))
+    body = json.loads(response["body"])
+
+    assert response["statusCode"] == 202
+    assert body["stop_reason"] == "rate_limit"
+    assert server.stats()["api_requests"] == requests_before
+    assert not any(seconds > backfill.COORDINATOR_MAX_SLEEP_SECONDS for seconds in sleeps)
+    assert len(_schedules(aws)) == 2
+    assert _job(first["job_id"])["resume_after"] == _job(body["job_id"])["resume_after"]
+
+
+def test_short_wait_sleeps_then_fetches(backfill, fake_fitbit, aws, sleeps):
+    import backfill_journal
+
+    fake_fitbit()
+    job_id = "short-wait"
+    journal = backfill_journal.BackfillJournal.from_env(job_id)
+    config = backfill._parse_event(EVENT)
+    journal.ensure_job(config["start"], config["end"], 2, backfill._journal_settings(config))
+    journal.claim(60)
+    journal.release(resume_after=time.time() + 20)
+
+    body = json.loads(backfill.lambda_handler({**EVENT, "job_id": job_id}, FakeContext(FUNCTION_ARN))["body"])
+
+    assert body["status"] == "completed"
+    assert any(0 < seconds <= 21 for seconds in sleeps)
+    assert _schedules(aws) == []
+
+
+def test_rate_limit_without_scheduler_role_pauses(backfill, fake_fitbit, aws, sleeps, invokes, monkeypatch):
+    monkeypatch.setattr(backfill, "SCHEDULER_ROLE_ARN", None)
+    fake_fitbit(rate_limit=6)
+    response = backfill.lambda_handler(EVENT, FakeContext(FUNCTION_ARN))
+    body = json.loads(response["body"])
+
+    assert response["statusCode"] == 202
+    assert body["status"] == "paused"
+    assert body["stop_reason"] == "rate_limit"
+    assert invokes == []
+    assert _schedules(aws) == []
+    assert not any(seconds > backfill.COORDINATOR_MAX_SLEEP_SECONDS for seconds in sleeps)
+    assert _job(body["job_id"])["resume_after"] > time.time()
+
+
+def test_long_retry_after_schedules_resume_instead_of_sleeping(backfill, fake_fitbit, aws, sleeps, invokes, monkeypatch):
+    from rate_limiter import FitbitRateLimiter
+
+    # リセットまで10分（Lambdaの残り時間内に待てる長さ）の Retry-After。実行中に待たずに再開を予約する
+    limiter_sleeps = []
+    monkeypatch.setattr(backfill, "fitbit_rate_limiter", FitbitRateLimiter(reserve=8, sleep=limiter_sleeps.append))
+    fake_fitbit(rate_limit=6, rate_window_seconds=600)
+    response = backfill.lambda_handler(EVENT, FakeContext(FUNCTION_ARN))
+    body = json.loads(response["body"])
+
+    assert response["statusCode"] == 202
+    assert body["stop_reason"] == "rate_limit"
+    assert not any(seconds > backfill.COORDINATOR_MAX_SLEEP_SECONDS for seconds in limiter_sleeps + sleeps)
+    assert invokes == []
+    [schedule] = _schedules(aws)
+    assert schedule["Name"].startswith(backfill.SCHEDULE_NAME_PREFIX)
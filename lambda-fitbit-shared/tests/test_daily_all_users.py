@@ -0,0 +1,95 @@
+"""日次Lambdaの全ユーザーモード（moto 上の fitbit_tokens・S3 と代替Fitbitサーバー）"""
+import json
+
+import pytest
+
+from conftest import PRIMARY_USER_ID, TEST_BUCKET, create_tokens_table, list_keys, load_lambda
+
+DATE = "2025-03-10"
+DAY_PREFIX = "year=2025/month=03/day=10"
+OTHER_USERS = ("USERA", "USERB")
+REVOKED_USER = "USERC"
+
+
+class FakeContext:
+    aws_request_id = "test-request"
+
+    def get_remaining_time_in_millis(self):
+        return 900_000
+
+
+@pytest.fixture
+def daily(aws, monkeypatch):
+    """全ユーザー分のトークンを登録し、ユーザーごとのリミッターを空にした日次Lambda"""
+    import rate_limiter
+
+    module = load_lambda("lambda-fitbit")
+    create_tokens_table(aws, (PRIMARY_USER_ID, *OTHER_USERS, REVOKED_USER))
+    monkeypatch.setattr(module, "fitbit_rate_limiter", rate_limiter.rate_limiter_from_env())
+    monkeypatch.setattr(module, "_user_rate_limiters", {})
+    return module
+
+
+def test_each_user_is_saved_under_own_prefix_and_failure_is_isolated(daily, fake_fitbit, aws):
+    server = fake_fitbit(revoked_refresh_tokens={f"{REVOKED_USER}-refresh"})
+
+    status_code, body = daily.export_all_users(DATE, FakeContext())
+
+    assert status_code == 207
+    assert body["user_count"] == 4
+    assert body["succeeded"] == sorted([PRIMARY_USER_ID, *OTHER_USERS])
+    assert body["failed"] == [REVOKED_USER]
+    assert body["users"][REVOKED_USER]["status_code"] == 401
+
+    # 主ユーザーは従来どおりパーティションなし、それ以外は user_id= パーティションの下
+    assert f"raw/fitbit/{DAY_PREFIX}/_summary.json" in list_keys(aws)
+    for user_id in OTHER_USERS:
+        keys = list_keys(aws, f"raw/fitbit/user_id={user_id}/")
+        assert f"raw/fitbit/user_id={user_id}/{DAY_PREFIX}/_summary.json" in keys
+        assert all(path.startswith(f"s3://{TEST_BUCKET}/raw/fitbit/user_id={user_id}/")
+                   for path in body["users"][user_id]["s3_paths"])
+        obj = aws.client("s3").get_object(
+            Bucket=TEST_BUCKET, Key=f"raw/fitbit/user_id={user_id}/{DAY_PREFIX}/sleep_20250310.json"
+        )
+        assert json.loads(obj["Body"].read())["metadata"]["user_id"] == user_id
+    assert list_keys(aws, f"raw/fitbit/user_id={REVOKED_USER}/") == []
+    assert list_keys(aws, f"raw/fitbit/user_id={PRIMARY_USER_ID}/") == []
+
+    # トークン更新は失効したユーザーも含めて全員分行う
+    assert server.stats()["token_requests"] == 4
+
+
+def test_rate_limiters_are_per_user(daily, fake_fitbit, aws):
+    import fitbit_collections
+
+    fake_fitbit(revoked_refresh_tokens={f"{REVOKED_USER}-refresh"})
+
+    daily.export_all_users(DATE, FakeContext())
+
+    limiters = {user_id: daily.rate_limiter_for(user_id) for user_id in (PRIMARY_USER_ID, *OTHER_USERS)}
+    assert limiters[PRIMARY_USER_ID] is daily.fitbit_rate_limiter
+    assert len({id(limiter) for limiter in limiters.values()}) == 3
+    # 各ユーザーの枠は自分の1日分のリクエストまでしか減らない（共有していれば3人分減る）
+    calls_per_user = len(fitbit_collections.plan_day(DATE, daily.COLLECTIONS).endpoints)
+    for limiter in limiters.values():
+        assert 0 < limiter.limit - limiter.remaining <= calls_per_user
+    # 取得まで進まなかったユーザーの枠は消費されない
+    revoked = daily.rate_limiter_for(REVOKED_USER)
+    assert revoked.remaining == revoked.limit
+
+
+def test_one_user_rate_limited_does_not_block_others(daily, fake_fitbit, aws):
+    import rate_limiter
+
+    fake_fitbit()
+    exhausted = rate_limiter.rate_limiter_from_env()
+    exhausted.observe(429, {"Retry-After": "3600"})
+    daily._user_rate_limiters["USERA"] = exhausted
+
+    status_code, body = daily.export_all_users(DATE, FakeContext())
+
+    assert status_code == 207
+    assert body["failed"] == ["USERA"]
+    assert body["users"]["USERA"]["status_code"] == 429
+    assert list_keys(aws, "raw/fitbit/user_id=USERA/") == []
+    assert f"raw/fitbit/user_id=USERB/{DAY_PREFIX}/_summary.json" in list_keys(aws)
@@ -0,0 +1,82 @@
+"""日次Lambdaの1ユーザー分のエクスポートと欠損日の補完（moto 上のS3・fitbit_tokens と代替Fitbitサーバー）"""
+import pytest
+
+from conftest import PRIMARY_USER_ID, create_tokens_table, list_keys, load_lambda
+
+DATE = "2025-03-10"
+NEXT_DATE = "2025-03-11"
+DAY_PREFIX = "raw/fitbit/year=2025/month=03/day=10/"
+# 既定のコレクション（sleep / activity / heart_rate）の日付指定エンドポイント
+DAY_ROUTES = ("sleep", "activity", "heart_intraday")
+
+
+class FakeContext:
+    aws_request_id = "test-request"
+
+    def get_remaining_time_in_millis(self):
+        return 900_000
+
+
+@pytest.fixture
+def daily(aws, monkeypatch):
+    """再試行の待ち時間なし・空のリミッターの日次Lambda"""
+    import fitbit_api
+    import rate_limiter
+    import retry_policy
+
+    module = load_lambda("lambda-fitbit")
+    create_tokens_table(aws)
+    monkeypatch.setattr(module, "fitbit_rate_limiter", rate_limiter.rate_limiter_from_env())
+    monkeypatch.setattr(fitbit_api, "DEFAULT_RETRY_POLICY", retry_policy.RetryPolicy(base_delay=0))
+    return module
+
+
+def test_all_requests_failing_writes_nothing_and_day_is_refetched(daily, fake_fitbit, aws):
+    server = fake_fitbit()
+    for route in DAY_ROUTES:
+        server.inject(route, [503] * 4)
+
+    status_code, body = daily.export_user(PRIMARY_USER_ID, DATE, FakeContext())
+
+    assert status_code == 502
+    assert set(body["status_map"].values()) == {503}
+    # サマリーがないので、この日は取り込み済みとして扱われない
+    assert list_keys(aws, DAY_PREFIX) == []
+
+    # 翌日の実行の欠損日の補完で取り直す
+    status_code, body = daily.export_user(PRIMARY_USER_ID, NEXT_DATE, FakeContext(), gap_lookback_days=1)
+
+    assert status_code == 200
+    assert body["gaps"]["missing_dates"] == [DATE]
+    assert body["gaps"]["filled_dates"] == [DATE]
+    assert f"{DAY_PREFIX}_summary.json" in list_keys(aws, DAY_PREFIX)
+
+
+def test_partial_failure_still_saves_successful_types(daily, fake_fitbit, aws):
+    server = fake_fitbit()
+    server.inject("sleep", [503] * 4)
+
+    status_code, body = daily.export_user(PRIMARY_USER_ID, DATE, FakeContext())
+
+    assert status_code == 200
+    keys = list_keys(aws, DAY_PREFIX)
+    assert f"{DAY_PREFIX}activity_20250310.json" in keys
+    assert f"{DAY_PREFIX}sleep_20250310.json" not in keys
+
+
+def test_sleep_sync_does_not_create_summary_for_day_not_ingested(daily, fake_fitbit, aws, monkeypatch):
+    monkeypatch.setenv("FITBIT_SLEEP_SYNC_LOOKBACK_DAYS", "3")
+    fake_fitbit()
+    status_code, _ = daily.export_user(PRIMARY_USER_ID, "2025-03-09", FakeContext())
+    assert status_code == 200
+
+    status_code, body = daily.export_user(PRIMARY_USER_ID, DATE, FakeContext(), with_sleep_sync=True)
+
+    assert status_code == 200
+    # 取り込み済みの 3/9 だけが同期の対象。3/7・3/8 は sleep だけのサマリーを作らず、欠損日として残す
+    assert body["sleep_sync"]["not_ingested_dates"] == ["2025-03-07", "2025-03-08"]
+    assert list_keys(aws, "raw/fitbit/year=2025/month=03/day=07/") == []
+    assert list_keys(aws, "raw/fitbit/year=2025/month=03/day=08/") == []
+
+    status_code, body = daily.export_user(PRIMARY_USER_ID, "2025-03-11", FakeContext(), gap_lookback_days=4)
+    assert body["gaps"]["missing_dates"] == ["2025-03-07", "2025-03-08"]
@@ -0,0 +1,56 @@
+"""fitbit_collections の呼び出し計画のテスト"""
+from datetime import date, timedelta
+
+import fitbit_collections
+import fitbit_ranges
+
+
+def days(start: date, count: int):
+    return [start + timedelta(days=offset) for offset in range(count)]
+
+
+def test_plan_day_derives_steps_from_activity():
+    plan = fitbit_collections.plan_day("2025-03-04")
+
+    assert set(plan.endpoints) == {"sleep", "activity", "heart_rate"}
+    assert set(plan.derived) == {"steps"}
+
+
+def test_range_call_count_with_intraday_heart_rate():
+    dates = days(date(2025, 1, 1), 100)
+
+    plan = fitbit_collections.plan_range(dates, include_intraday=True)
+
+    # sleep 1 + activity の時系列11（steps は series_steps を共有）+ 分単位心拍は日ごとに100
+    assert plan.call_count == 12 + 100
+    assert [collection.name for collection in plan.per_day] == ["heart_rate"]
+
+
+def test_range_call_count_without_intraday_does_not_plan_per_day_calls():
+    dates = days(date(2025, 1, 1), 100)
+
+    plan = fitbit_collections.plan_range(dates, include_intraday=False)
+
+    assert plan.per_day == []
+    assert plan.call_count == 13
+
+
+def test_partial_collections_are_marked_for_raw_store():
+    dates = days(date(2025, 1, 1), 30)
+
+    assert fitbit_collections.plan_range(dates, include_intraday=True).partial == ["activity"]
+    assert fitbit_collections.plan_range(dates, include_intraday=False).partial == ["activity", "heart_rate"]
+
+
+def test_backfill_period_request_counts():
+    dates = [
+        target for target in days(date(2025, 1, 1), 270)
+        if target != date(2025, 8, 5)
+    ]
+    chunks = fitbit_ranges.chunk_dates(dates)
+
+    daily = sum(fitbit_collections.plan_day(target).call_count for target in dates)
+    with_intraday = sum(fitbit_collections.plan_range(chunk, include_intraday=True).call_count for chunk in chunks)
+    summary_only = sum(fitbit_collections.plan_range(chunk, include_intraday=False).call_count for chunk in chunks)
+
+    assert (daily, with_intraday, summary_only) == (807, 305, 39)
@@ -0,0 +1,164 @@
+"""rate_limiter.FitbitRateLimiter のテスト（時計と sleep を差し替えて実時間では待たない）"""
+import pytest
+
+from rate_limiter import FitbitRateLimiter, RateLimitExceeded
+
+
+class FakeClock:
+    """sleep() で時刻が進む時計"""
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+        self.sleeps = []
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def make_limiter(clock, **kwargs) -> FitbitRateLimiter:
+    return FitbitRateLimiter(clock=clock, sleep=clock.sleep, **kwargs)
+
+
+def test_acquire_consumes_tokens_without_waiting(clock):
+    limiter = make_limiter(clock, limit=5)
+
+    for _ in range(5):
+        limiter.acquire()
+
+    assert limiter.remaining == 0
+    assert clock.sleeps == []
+
+
+def test_acquire_waits_until_window_reset(clock):
+    limiter = make_limiter(clock, limit=2)
+    limiter.acquire(2)
+
+    limiter.acquire()
+
+    assert clock.sleeps == [3600]
+    # リセット後のウィンドウで1件消費している
+    assert limiter.remaining == 1
+
+
+def test_acquire_raises_when_wait_exceeds_max_wait(clock):
+    limiter = make_limiter(clock, limit=1)
+    limiter.acquire()
+
+    with pytest.raises(RateLimitExceeded) as excinfo:
+        limiter.acquire(max_wait=60)
+
+    assert excinfo.value.wait_seconds == pytest.approx(3600)
+    assert clock.sleeps == []
+
+
+def test_reserve_is_left_for_other_lambdas(clock):
+    limiter = make_limiter(clock, limit=10, reserve=8)
+    limiter.acquire(2)
+
+    with pytest.raises(RateLimitExceeded):
+        limiter.acquire(max_wait=0)
+    assert limiter.remaining == 8
+
+
+def test_reserve_is_capped_below_limit(clock):
+    limiter = make_limiter(clock, limit=3, reserve=10)
+
+    assert limiter.reserve == 2
+    limiter.acquire()
+    assert limiter.remaining == 2
+
+
+def test_acquire_count_is_capped_to_usable_tokens(clock):
+    limiter = make_limiter(clock, limit=10, reserve=4)
+
+    # 使える枠（6件）より大きい要求は6件として扱い、永久に待たない
+    limiter.acquire(50)
+
+    assert limiter.remaining == 4
+    assert clock.sleeps == []
+
+
+def test_observe_resyncs_from_headers(clock):
+    limiter = make_limiter(clock)
+    limiter.acquire()
+
+    limiter.observe(200, {
+        "Fitbit-Rate-Limit-Limit": "150",
+        "Fitbit-Rate-Limit-Remaining": "42",
+        "Fitbit-Rate-Limit-Reset": "120",
+    })
+
+    assert limiter.remaining == 42
+    assert limiter.seconds_until_reset() == pytest.approx(120)
+
+
+def test_observe_subtracts_requests_still_in_flight(clock):
+    limiter = make_limiter(clock)
+    limiter.acquire(3)
+
+    # 1件目の応答の残量には、まだ応答していない2件が反映されていない
+    limiter.observe(200, {"Fitbit-Rate-Limit-Remaining": "100"})
+
+    assert limiter.remaining == 98
+
+
+def test_observe_updates_limit(clock):
+    limiter = make_limiter(clock, limit=150)
+    limiter.acquire()
+
+    limiter.observe(200, {"Fitbit-Rate-Limit-Limit": "300", "Fitbit-Rate-Limit-Reset": "10"})
+    clock.sleep(10)
+
+    assert limiter.limit == 300
+    assert limiter.remaining == 300
+
+
+def test_observe_429_blocks_until_retry_after(clock):
+    limiter = make_limiter(clock)
+    limiter.acquire()
+
+    limiter.observe(429, {"Fitbit-Rate-Limit-Reset": "30", "Retry-After": "90"})
+
+    assert limiter.remaining == 0
+    assert limiter.seconds_until_reset() == pytest.approx(90)
+    limiter.acquire()
+    assert clock.sleeps == [pytest.approx(90)]
+
+
+def test_observe_ignores_malformed_headers(clock):
+    limiter = make_limiter(clock, limit=10)
+    limiter.acquire()
+
+    limiter.observe(200, {"Fitbit-Rate-Limit-Remaining": "n/a", "Fitbit-Rate-Limit-Reset": ""})
+
+    assert limiter.remaining == 9
+    assert limiter.seconds_until_reset() == pytest.approx(3600)
+
+
+def test_window_refills_after_reset(clock):
+    limiter = make_limiter(clock, limit=4)
+    limiter.acquire(4)
+    limiter.observe(200, {"Fitbit-Rate-Limit-Remaining": "0", "Fitbit-Rate-Limit-Reset": "5"})
+
+    clock.sleep(5)
+
+    assert limiter.remaining == 4
+
+
+def test_rate_limiter_from_env_reads_reserve(monkeypatch):
+    from rate_limiter import rate_limiter_from_env
+
+    monkeypatch.setenv("FITBIT_RATE_LIMIT_RESERVE", "8")
+    assert rate_limiter_from_env().reserve == 8
+
+    monkeypatch.setenv("FITBIT_RATE_LIMIT_RESERVE", "invalid")
+    assert rate_limiter_from_env(default_reserve=3).reserve == 3
@@ -0,0 +1,85 @@
+"""raw_store.save_day のテスト（moto 上のS3）"""
+import json
+
+import raw_store
+from conftest import TEST_BUCKET, list_keys
+
+DATE = "2025-03-04"
+DAILY_ACTIVITY = {
+    "activities": [{"name": "Run", "duration": 1800000}],
+    "goals": {"steps": 10000},
+    "summary": {"steps": 9000, "restingHeartRate": 58},
+}
+RANGE_ACTIVITY = {"activities": [], "summary": {"steps": 9000}}
+
+
+def read_json(aws, key):
+    return json.loads(aws.client("s3").get_object(Bucket=TEST_BUCKET, Key=key)["Body"].read())
+
+
+def test_save_day_writes_objects_and_summary(aws):
+    saved = raw_store.save_day(DATE, {"activity": DAILY_ACTIVITY, "sleep": None}, execution_id="req-1")
+
+    key = "raw/fitbit/year=2025/month=03/day=04/activity_20250304.json"
+    assert saved == [f"s3://{TEST_BUCKET}/{key}"]
+    body = read_json(aws, key)
+    assert body["data"] == DAILY_ACTIVITY
+    assert body["metadata"]["source"] == "fitbit_api"
+    assert body["metadata"]["lambda_execution_id"] == "req-1"
+
+    summary = read_json(aws, raw_store.summary_key(DATE))
+    assert summary["files"] == saved
+    assert "source" not in summary["content_hashes"]["activity"]
+
+
+def test_save_day_uses_user_partition(aws):
+    raw_store.save_day(DATE, {"activity": DAILY_ACTIVITY}, user_id="USER2", metadata={"user_id": "USER2"})
+
+    key = "raw/fitbit/user_id=USER2/year=2025/month=03/day=04/activity_20250304.json"
+    assert read_json(aws, key)["metadata"]["user_id"] == "USER2"
+    assert read_json(aws, raw_store.summary_key(DATE, "USER2"))["data_types"] == ["activity"]
+
+
+def test_unchanged_content_is_not_rewritten(aws):
+    raw_store.save_day(DATE, {"activity": DAILY_ACTIVITY})
+    first = read_json(aws, raw_store.summary_key(DATE))
+
+    saved = raw_store.save_day(DATE, {"activity": DAILY_ACTIVITY})
+
+    assert saved == first["files"]
+    assert read_json(aws, raw_store.summary_key(DATE))["extraction_date"] == first["extraction_date"]
+
+
+def test_range_data_is_marked_in_summary(aws):
+    raw_store.save_day(DATE, {"activity": RANGE_ACTIVITY}, range_types=["activity"])
+
+    entry = read_json(aws, raw_store.summary_key(DATE))["content_hashes"]["activity"]
+    assert entry["source"] == raw_store.RANGE_SOURCE
+    assert read_json(aws, entry["key"])["metadata"]["source"] == "fitbit_api_range"
+
+
+def test_range_data_never_replaces_daily_endpoint_data(aws):
+    raw_store.save_day(DATE, {"activity": DAILY_ACTIVITY})
+
+    raw_store.save_day(DATE, {"activity": RANGE_ACTIVITY, "sleep": {"sleep": []}}, range_types=["activity"])
+
+    summary = read_json(aws, raw_store.summary_key(DATE))
+    assert "source" not in summary["content_hashes"]["activity"]
+    assert read_json(aws, summary["content_hashes"]["activity"]["key"])["data"] == DAILY_ACTIVITY
+    assert set(summary["content_hashes"]) == {"activity", "sleep"}
+
+
+def test_daily_endpoint_data_replaces_range_data(aws):
+    raw_store.save_day(DATE, {"activity": RANGE_ACTIVITY}, range_types=["activity"])
+
+    raw_store.save_day(DATE, {"activity": DAILY_ACTIVITY})
+
+    entry = read_json(aws, raw_store.summary_key(DATE))["content_hashes"]["activity"]
+    assert "source" not in entry
+    assert read_json(aws, entry["key"])["data"] == DAILY_ACTIVITY
+
+
+def test_no_summary_when_nothing_was_saved(aws):
+    assert raw_store.save_day(DATE, {"activity": None, "sleep": None}) == []
+
+    assert list_keys(aws) == []
@@ -0,0 +1,76 @@
+"""raw_writer の出力形式の選択とシリアライズのテスト"""
+import gzip
+import io
+import json
+
+import pytest
+
+import raw_writer
+
+ENVELOPE = {
+    "metadata": {"data_date": "2025-03-04", "data_type": "heart_rate"},
+    "data": {
+        "activities-heart": [{"dateTime": "2025-03-04", "value": {"restingHeartRate": 58}}],
+        "activities-heart-intraday": {"dataset": [{"time": "00:00:00", "value": 61}], "datasetInterval": 1},
+    },
+}
+
+
+def test_format_for_prefers_data_type_setting(monkeypatch):
+    monkeypatch.setenv("FITBIT_RAW_FORMAT", "ndjson.gz")
+    monkeypatch.setenv("FITBIT_RAW_FORMAT_SLEEP", "json")
+
+    assert raw_writer.format_for("sleep") == "json"
+    assert raw_writer.format_for("activity") == "ndjson.gz"
+
+
+def test_unknown_format_falls_back_to_json(monkeypatch):
+    monkeypatch.setenv("FITBIT_RAW_FORMAT", "csv")
+
+    assert raw_writer.format_for("sleep") == "json"
+
+
+@pytest.mark.parametrize("fmt, attribute", [("ndjson.zst", "zstandard"), ("parquet", "pa")])
+def test_missing_library_fails_loudly(monkeypatch, fmt, attribute):
+    monkeypatch.setattr(raw_writer, attribute, None)
+    monkeypatch.setenv("FITBIT_RAW_FORMAT", fmt)
+
+    with pytest.raises(raw_writer.RawFormatUnavailable):
+        raw_writer.format_for("heart_rate")
+    with pytest.raises(raw_writer.RawFormatUnavailable):
+        raw_writer.serialize(ENVELOPE, fmt)
+
+
+def test_json_matches_indented_dump():
+    body, extension, content_type = raw_writer.serialize(ENVELOPE, "json")
+
+    assert (extension, content_type) == (".json", "application/json")
+    assert body.decode("utf-8") == json.dumps(ENVELOPE, indent=2)
+
+
+def test_ndjson_gz_is_one_compressed_line():
+    body, extension, _ = raw_writer.serialize(ENVELOPE, "ndjson.gz")
+
+    lines = gzip.decompress(body).decode("utf-8").splitlines()
+    assert extension == ".ndjson.gz"
+    assert [json.loads(line) for line in lines] == [ENVELOPE]
+
+
+def test_parquet_without_intraday_uses_ndjson_gz():
+    pytest.importorskip("pyarrow")
+    envelope = {"metadata": ENVELOPE["metadata"], "data": {"sleep": []}}
+
+    _, extension, _ = raw_writer.serialize(envelope, "parquet")
+
+    assert extension == ".ndjson.gz"
+
+
+def test_parquet_expands_intraday_dataset():
+    pq = pytest.importorskip("pyarrow.parquet")
+
+    body, extension, _ = raw_writer.serialize(ENVELOPE, "parquet")
+
+    table = pq.read_table(io.BytesIO(body))
+    assert extension == ".parquet"
+    assert table.column("time").to_pylist() == ["00:00:00"]
+    assert table.column("value").to_pylist() == [61]
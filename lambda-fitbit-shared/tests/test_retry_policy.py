@@ -0,0 +1,117 @@
+"""再試行とサーキットブレーカー（代替Fitbitサーバーに 429 / 5xx の並びを注入する）"""
+import fitbit_api
+import pytest
+import retry_policy
+from rate_limiter import FitbitRateLimiter
+
+DATE = "2025-03-10"
+SLEEP_ENDPOINT = {"sleep": f"/1.2/user/-/sleep/date/{DATE}.json"}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def server(fake_fitbit):
+    return fake_fitbit()
+
+
+@pytest.fixture
+def http():
+    return fitbit_api.build_pool_manager(1)
+
+
+def fetch(http, user_id, **kwargs):
+    """再試行の待ち時間なしで sleep を取得し、ステータスを返す"""
+    kwargs.setdefault("retry", retry_policy.RetryPolicy(base_delay=0, sleep=lambda seconds: None))
+    _, status_map = fitbit_api.fetch_endpoints(http, f"token-{user_id}", SLEEP_ENDPOINT, user_id=user_id, **kwargs)
+    return status_map["sleep"]
+
+
+def test_retries_5xx_until_success(server, http):
+    server.inject("sleep", [503, 500])
+
+    assert fetch(http, "USERA") == 200
+    assert server.stats()["statuses"] == {"503": 1, "500": 1, "200": 1}
+    assert retry_policy.breaker_for("sleep", "USERA").state == "closed"
+
+
+def test_consecutive_5xx_open_breaker_for_that_user_only(server, http):
+    server.inject("sleep", [503] * 8)
+
+    # 4回 × 2呼び出しで閾値（5回）を超える
+    assert fetch(http, "USERA") == 503
+    assert fetch(http, "USERA") == 503
+    assert retry_policy.breaker_for("sleep", "USERA").state == "open"
+    requests = server.stats()["api_requests"]
+
+    # 開いている間は送らずにステータス 0
+    assert fetch(http, "USERA") == 0
+    assert server.stats()["api_requests"] == requests
+
+    # 他のユーザーの同じエンドポイントは止めない
+    assert fetch(http, "USERB") == 200
+    assert retry_policy.breaker_for("sleep", "USERB").state == "closed"
+
+
+def test_429_does_not_open_breaker(server, http):
+    server.inject("sleep", [429] * 8)
+
+    assert fetch(http, "USERA") == 429
+    assert fetch(http, "USERA") == 429
+    assert retry_policy.breaker_for("sleep", "USERA").state == "closed"
+    assert fetch(http, "USERA") == 200
+
+
+def test_429_on_half_open_trial_allows_next_trial(server, http):
+    clock = FakeClock()
+    breaker = retry_policy.CircuitBreaker(failure_threshold=1, reset_timeout=60, clock=clock)
+    retry_policy._breakers[("USERA", "sleep")] = breaker
+    server.inject("sleep", [503, 429])
+    no_retry = retry_policy.RetryPolicy(max_attempts=1)
+
+    assert fetch(http, "USERA", retry=no_retry) == 503
+    assert breaker.state == "open"
+
+    clock.sleep(60)
+    assert fetch(http, "USERA", retry=no_retry) == 429
+    # 429 の試行は失敗に数えず、試行中のまま残さない
+    assert breaker.state == "half_open"
+    assert fetch(http, "USERA", retry=no_retry) == 200
+    assert breaker.state == "closed"
+
+
+def test_open_breaker_returns_rate_limiter_token(server, http):
+    clock = FakeClock()
+    limiter = FitbitRateLimiter(limit=150, clock=clock, sleep=clock.sleep)
+    breaker = retry_policy.breaker_for("sleep", "USERA")
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+    before = limiter.remaining
+
+    assert fetch(http, "USERA", rate_limiter=limiter) == 0
+
+    assert limiter.remaining == before
+    assert server.stats()["api_requests"] == 0
+
+
+def test_breaker_opening_during_retries_returns_retry_token(server, http):
+    clock = FakeClock()
+    limiter = FitbitRateLimiter(limit=150, clock=clock, sleep=clock.sleep)
+    breaker = retry_policy.CircuitBreaker(failure_threshold=2, clock=clock)
+    retry_policy._breakers[("USERA", "sleep")] = breaker
+    server.inject("sleep", [503] * 4)
+
+    assert fetch(http, "USERA", rate_limiter=limiter) == 503
+
+    # 2回目の失敗で開き、3回目の試行のために確保した枠は戻される
+    assert server.stats()["api_requests"] == 2
+    assert limiter.remaining == 150 - 2
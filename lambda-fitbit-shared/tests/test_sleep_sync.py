@@ -0,0 +1,100 @@
+"""sleep_sync のページングと、トークン項目に保存した睡眠同期カーソル"""
+import importlib.util
+import os
+from datetime import date as date_cls, timedelta
+
+import fitbit_api
+import pytest
+import sleep_sync
+
+from conftest import PRIMARY_USER_ID, REPO_ROOT, create_tokens_table
+
+
+def test_next_endpoint_strips_host_from_full_url():
+    pagination = {"next": "https://api.fitbit.com/1.2/user/-/sleep/list.json?afterDate=2025-03-05&offset=0&limit=3&sort=asc"}
+    assert sleep_sync.next_endpoint(pagination) == (
+        "/1.2/user/-/sleep/list.json?afterDate=2025-03-05&offset=0&limit=3&sort=asc"
+    )
+    assert sleep_sync.next_endpoint({"next": ""}) is None
+    assert sleep_sync.next_endpoint(None) is None
+
+
+def test_list_endpoint_always_starts_at_offset_zero():
+    assert "offset=0" in sleep_sync.list_endpoint(date_cls(2025, 3, 1))
+
+
+def test_fetch_logs_after_follows_pagination_next(fake_fitbit, monkeypatch):
+    server = fake_fitbit()
+    monkeypatch.setattr(sleep_sync, "PAGE_LIMIT", 3)
+    after = date_cls.today() - timedelta(days=11)
+
+    logs, status, complete = sleep_sync.fetch_logs_after(fitbit_api.build_pool_manager(1), "token", after)
+
+    assert (status, complete) == (200, True)
+    # 10日分（afterDate の翌日から前日まで）を3日ずつ4ページで取得する
+    assert server.stats()["by_endpoint"]["sleep_list"] == 4
+    assert server.stats()["statuses"] == {"200": 4}
+    dates = sorted({log["dateOfSleep"] for log in logs})
+    expected = [(after + timedelta(days=offset)).isoformat() for offset in range(1, 11)]
+    assert set(dates) <= set(expected)
+    assert len(logs) == len({log["logId"] for log in logs})
+
+
+def test_fetch_logs_after_stops_at_max_pages(fake_fitbit, monkeypatch):
+    fake_fitbit()
+    monkeypatch.setattr(sleep_sync, "PAGE_LIMIT", 1)
+    monkeypatch.setattr(sleep_sync, "MAX_PAGES", 2)
+
+    _, status, complete = sleep_sync.fetch_logs_after(
+        fitbit_api.build_pool_manager(1), "token", date_cls.today() - timedelta(days=6)
+    )
+
+    assert (status, complete) == (200, False)
+
+
+def _load_save_initial_token():
+    spec = importlib.util.spec_from_file_location("save_initial_token", os.path.join(REPO_ROOT, "save_initial_token.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_save_initial_token_keeps_sleep_sync_cursor(aws):
+    create_tokens_table(aws)
+    table = aws.table("fitbit_tokens")
+    table.update_item(
+        Key={"user_id": PRIMARY_USER_ID},
+        UpdateExpression="SET version = :version",
+        ExpressionAttributeValues={":version": 5},
+    )
+    sleep_sync.save_cursor(table, PRIMARY_USER_ID, "2025-03-01")
+
+    module = _load_save_initial_token()
+    assert module.save_to_dynamodb({"access_token": "new-access", "refresh_token": "new-refresh", "scope": "sleep"})
+
+    item = table.get_item(Key={"user_id": PRIMARY_USER_ID})["Item"]
+    assert item["access_token"] == "new-access"
+    assert item["refresh_token"] == "new-refresh"
+    assert item[sleep_sync.CURSOR_ATTRIBUTE] == "2025-03-01"
+    # 実行中のリフレッシュが古いトークンの結果で上書きしないよう version を進める
+    assert item["version"] == 6
+
+
+@pytest.mark.parametrize("existing", [False, True])
+def test_save_initial_token_creates_or_updates_item(aws, existing):
+    aws.client("dynamodb").create_table(
+        TableName="fitbit_tokens",
+        KeySchema=[{"AttributeName": "user_id", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "user_id", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    table = aws.table("fitbit_tokens")
+    if existing:
+        table.put_item(Item={"user_id": PRIMARY_USER_ID, "access_token": "old", "created_at": "2025-01-01T00:00:00"})
+
+    assert _load_save_initial_token().save_to_dynamodb({"access_token": "new-access"})
+
+    item = table.get_item(Key={"user_id": PRIMARY_USER_ID})["Item"]
+    assert item["access_token"] == "new-access"
+    assert item["version"] == 1
+    assert (item["created_at"] == "2025-01-01T00:00:00") is existing
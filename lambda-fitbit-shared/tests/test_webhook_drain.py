@@ -0,0 +1,133 @@
+"""Webhook Lambda の drain の終了処理（moto 上の fitbit_webhook_pending・EventBridge Scheduler）"""
+import importlib.util
+import json
+import os
+import sys
+import time
+
+import pytest
+
+from conftest import REPO_ROOT, create_pending_table, create_tokens_table, list_keys, load_lambda
+
+FUNCTION_ARN = "arn:aws:lambda:ap-northeast-1:123456789012:function:moderation-craft-fitbit-webhook"
+SCHEDULER_ROLE_ARN = "arn:aws:iam::123456789012:role/fitbit-backfill-scheduler-role"
+DATE = "2025-03-10"
+
+
+class FakeContext:
+    aws_request_id = "test-request"
+    invoked_function_arn = FUNCTION_ARN
+
+    def __init__(self, remaining_ms=300_000):
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_ms
+
+
+def _load_webhook():
+    """webhook.py は日次Lambdaを lambda_function として import するため、同じモジュールを登録してから読み込む"""
+    if "webhook" not in sys.modules:
+        sys.modules.setdefault("lambda_function", load_lambda("lambda-fitbit"))
+        spec = importlib.util.spec_from_file_location("webhook", os.path.join(REPO_ROOT, "lambda-fitbit", "webhook.py"))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules["webhook"] = module
+        spec.loader.exec_module(module)
+    return sys.modules["webhook"]
+
+
+@pytest.fixture
+def webhook(aws, monkeypatch):
+    module = _load_webhook()
+    create_pending_table(aws)
+    monkeypatch.setattr(module, "SCHEDULER_ROLE_ARN", SCHEDULER_ROLE_ARN)
+    return module
+
+
+@pytest.fixture
+def invokes(aws, monkeypatch):
+    """Lambdaの非同期起動を記録する（moto には起動先の関数がないため）"""
+    calls = []
+
+    class RecordingLambda:
+        def invoke(self, **kwargs):
+            calls.append(kwargs)
+            return {"StatusCode": 202}
+
+    original = aws.client
+    monkeypatch.setattr(aws, "client", lambda name: RecordingLambda() if name == "lambda" else original(name))
+    return calls
+
+
+def _enqueue(webhook, due_in):
+    webhook.webhook_queue.PendingQueue.from_env().enqueue("USERA", "sleep", DATE, due_in)
+
+
+def _schedules(aws):
+    return aws.client("scheduler").list_schedules()["Schedules"]
+
+
+def test_far_future_item_schedules_drain_instead_of_reinvoking(webhook, aws, invokes):
+    # レート制限で1時間後に延期された項目だけが残っている
+    _enqueue(webhook, 3600)
+
+    status_code, body = webhook.drain(FakeContext())
+
+    assert status_code == 200
+    assert body["stop_reason"] == "wait_limit"
+    assert body["pending"] == 1
+    assert invokes == []
+    [summary] = _schedules(aws)
+    schedule = aws.client("scheduler").get_schedule(Name=summary["Name"])
+    assert schedule["Name"].startswith(webhook.SCHEDULE_NAME_PREFIX)
+    assert schedule["ScheduleExpression"] == f"at({body['drain_at']})"
+    assert schedule["ActionAfterCompletion"] == "DELETE"
+    assert schedule["Target"]["Arn"] == FUNCTION_ARN
+    assert json.loads(schedule["Target"]["Input"]) == {"webhook_drain": True}
+
+    # 同じ時刻の予約は増やさない
+    webhook.drain(FakeContext())
+    assert len(_schedules(aws)) == 1
+    assert invokes == []
+
+
+def test_far_future_item_without_scheduler_role_waits_for_next_notification(webhook, aws, invokes, monkeypatch):
+    monkeypatch.setattr(webhook, "SCHEDULER_ROLE_ARN", None)
+    _enqueue(webhook, 3600)
+
+    _, body = webhook.drain(FakeContext())
+
+    assert body["stop_reason"] == "wait_limit"
+    assert invokes == []
+    assert _schedules(aws) == []
+
+
+def test_timeout_reinvokes_drain(webhook, aws, invokes, monkeypatch):
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    _enqueue(webhook, 30)
+
+    # 次の通知を待つだけの残り時間がない
+    _, body = webhook.drain(FakeContext(remaining_ms=(webhook.DRAIN_TIME_MARGIN_SECONDS + 5) * 1000))
+
+    assert body["stop_reason"] == "timeout"
+    assert len(invokes) == 1
+    assert json.loads(invokes[0]["Payload"]) == {"webhook_drain": True}
+    assert _schedules(aws) == []
+
+
+def test_ingest_fetches_every_collection_for_day_not_ingested(webhook, aws, fake_fitbit):
+    import fitbit_collections
+
+    create_tokens_table(aws, ("USERA",))
+    server = fake_fitbit()
+    day_prefix = "raw/fitbit/user_id=USERA/year=2025/month=03/day=10/"
+
+    # まだサマリーのない日は、sleep の通知でも日次と同じ全コレクションを取得する
+    assert webhook.ingest("USERA", DATE, ["sleep"], FakeContext()) is True
+    all_endpoints = len(fitbit_collections.plan_day(DATE, webhook.lambda_function.COLLECTIONS).endpoints)
+    assert server.stats()["api_requests"] == all_endpoints
+    assert f"{day_prefix}activity_20250310.json" in list_keys(aws, day_prefix)
+
+    # 取り込み済みの日は通知されたコレクションだけ
+    assert webhook.ingest("USERA", DATE, ["sleep"], FakeContext()) is True
+    assert server.stats()["api_requests"] == all_endpoints + 1
@@ -0,0 +1,122 @@
+"""サブスクリプション通知の取得待ちキュー（moto 上の fitbit_webhook_pending）"""
+import json
+
+import pytest
+import webhook_queue
+
+from conftest import create_pending_table
+
+USER_ID = "USERA"
+DATE = "2025-03-10"
+COALESCE_SECONDS = 30
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def table(aws):
+    return create_pending_table(aws)
+
+
+@pytest.fixture
+def queue(table, clock):
+    return webhook_queue.PendingQueue(table, clock=clock)
+
+
+def test_parse_notifications_rejects_missing_date():
+    body = json.dumps([
+        {"collectionType": "sleep", "date": DATE, "ownerId": USER_ID},
+        {"collectionType": "sleep", "date": None, "ownerId": USER_ID},
+        {"collectionType": "activities", "ownerId": USER_ID},
+        {"collectionType": "activities", "date": "2025-13-01", "ownerId": USER_ID},
+    ]).encode("utf-8")
+
+    notifications = webhook_queue.parse_notifications(body)
+
+    assert [notification["date"] for notification in notifications] == [DATE]
+
+
+def test_enqueue_coalesces_until_due(queue, table, clock):
+    assert queue.enqueue(USER_ID, "sleep", DATE, COALESCE_SECONDS)
+    clock.now += 10
+    assert not queue.enqueue(USER_ID, "sleep", DATE, COALESCE_SECONDS)
+
+    item = table.get_item(Key={"user_id": USER_ID, "item_key": f"sleep#{DATE}"})["Item"]
+    assert item["notifications"] == 2
+    assert float(item["notified_at"]) == clock.now
+
+
+def test_enqueue_restarts_drain_for_item_left_behind(queue, clock):
+    # 通知を受けたが drain が起動しなかった（または落ちた）まま due_at を過ぎた
+    assert queue.enqueue(USER_ID, "sleep", DATE, COALESCE_SECONDS)
+    clock.now += COALESCE_SECONDS + 1
+
+    assert queue.enqueue(USER_ID, "sleep", DATE, COALESCE_SECONDS)
+
+
+def test_enqueue_restarts_drain_when_claim_expired(queue, clock):
+    assert queue.enqueue(USER_ID, "sleep", DATE, COALESCE_SECONDS)
+    clock.now += COALESCE_SECONDS
+    [item] = queue.pending_items()
+    assert queue.claim(item)
+
+    # 取得中の drain がいる間はまとめるだけ
+    clock.now += 1
+    assert not queue.enqueue(USER_ID, "sleep", DATE, COALESCE_SECONDS)
+
+    # drain が落ちてリースが切れた項目は、次の通知で drain を起動し直す
+    clock.now += webhook_queue.CLAIM_SECONDS
+    assert queue.enqueue(USER_ID, "sleep", DATE, COALESCE_SECONDS)
+    [item] = queue.pending_items()
+    assert queue.claim(item)
+
+
+def test_pending_items_queries_index_in_due_order(queue, table, clock, monkeypatch):
+    monkeypatch.setattr(table, "scan", lambda **kwargs: pytest.fail("pending_items must not scan the table"))
+    assert queue.enqueue("USERB", "sleep", DATE, COALESCE_SECONDS)
+    clock.now += 5
+    assert queue.enqueue(USER_ID, "activities", DATE, COALESCE_SECONDS)
+    clock.now += 5
+    assert queue.enqueue(USER_ID, "sleep", DATE, COALESCE_SECONDS)
+    assert queue.acquire_drain_lease(60)
+
+    items = queue.pending_items()
+
+    assert [(item["user_id"], item["item_key"]) for item in items] == [
+        ("USERB", f"sleep#{DATE}"),
+        (USER_ID, f"activities#{DATE}"),
+        (USER_ID, f"sleep#{DATE}"),
+    ]
+    # 取得中の項目は除く
+    clock.now += COALESCE_SECONDS
+    assert queue.claim(items[0])
+    assert [item["user_id"] for item in queue.pending_items()] == [USER_ID, USER_ID]
+
+
+def test_item_created_before_index_is_indexed_by_next_notification(queue, table, clock):
+    table.put_item(Item={
+        "user_id": USER_ID,
+        "item_key": f"sleep#{DATE}",
+        "collection_type": "sleep",
+        "date": DATE,
+        "due_at": 900,
+        "notified_at": 900,
+        "notifications": 1,
+        "attempts": 0,
+    })
+    assert queue.pending_items() == []
+
+    assert queue.enqueue(USER_ID, "sleep", DATE, COALESCE_SECONDS)
+
+    assert [item["item_key"] for item in queue.pending_items()] == [f"sleep#{DATE}"]
@@ -0,0 +1,283 @@
+"""
+Fitbitトークンの管理（DynamoDB fitbit_tokens テーブル）
+
+呼び出し中はトークンをメモリに保持し、DynamoDBを読み直すのは401受信時と期限切れ間近のときだけにする。
+Fitbitのリフレッシュトークンは1回しか使えないため、リフレッシュは version 属性と
+条件付き更新による排他（リフレッシュ権の確保 → Fitbit呼び出し → 新トークンの書き込み）で行い、
+日次Lambdaとバックフィルが同時に動いても二重にリフレッシュしないようにする。
+"""
+import base64
+import json
+import logging
+import os
+import time
+import uuid
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional
+from urllib.parse import urlencode
+
+from botocore.exceptions import ClientError
+
+import aws_clients
+from retry_policy import Deadline, RetryPolicy
+
+logger = logging.getLogger()
+
+FITBIT_TOKEN_URL = os.environ.get("FITBIT_API_BASE", "https://api.fitbit.com").rstrip("/") + "/oauth2/token"
+DEFAULT_USER_ID = "BGPGCR"
+
+# 期限切れとみなす余裕（秒）
+EXPIRY_MARGIN_SECONDS = 300
+# リフレッシュ権の有効期間。保持したままLambdaが落ちても、この時間が過ぎれば他の実行が引き継げる
+REFRESH_CLAIM_SECONDS = 60
+# 他の実行のリフレッシュ完了を待つ上限
+REFRESH_WAIT_SECONDS = 30
+# トークンエンドポイントの再試行にかける上限（リフレッシュ権の有効期間内に収める）
+REFRESH_RETRY_SECONDS = 20
+
+TOKEN_RETRY_POLICY = RetryPolicy(max_attempts=3)
+
+
+class TokenRefreshError(Exception):
+    """トークンのリフレッシュに失敗した（invalid_grant の場合は再認証が必要）"""
+
+    def __init__(self, message: str, error_type: Optional[str] = None):
+        super().__init__(message)
+        self.error_type = error_type
+
+
+class FitbitTokenManager:
+    """1ユーザー分のトークンをキャッシュし、version 付きの条件付き更新でリフレッシュする"""
+
+    def __init__(
+        self,
+        table,
+        user_id: str,
+        http,
+        client_id: str,
+        client_secret: Optional[str],
+        clock: Callable[[], float] = time.time,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.table = table
+        self.user_id = user_id
+        self.http = http
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self._clock = clock
+        self._sleep = sleep
+        self._owner = uuid.uuid4().hex
+        self._tokens: Optional[Dict[str, Any]] = None
+
+    @classmethod
+    def from_env(cls, http, user_id: Optional[str] = None, dynamodb=None) -> "FitbitTokenManager":
+        table_name = os.environ.get("DYNAMODB_TABLE", "fitbit_tokens")
+        return cls(
+            table=dynamodb.Table(table_name) if dynamodb is not None else aws_clients.table(table_name),
+            user_id=user_id or os.environ.get("FITBIT_USER_ID", DEFAULT_USER_ID),
+            http=http,
+            client_id=os.environ.get("FITBIT_CLIENT_ID", "23QQC2"),
+            client_secret=os.environ.get("FITBIT_CLIENT_SECRET"),
+        )
+
+    @property
+    def tokens(self) -> Optional[Dict[str, Any]]:
+        return self._tokens
+
+    @property
+    def version(self) -> int:
+        return int((self._tokens or {}).get("version", 0))
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        """DynamoDBから最新のトークンを読み込む（強い整合性の読み込み）"""
+        response = self.table.get_item(Key={"user_id": self.user_id}, ConsistentRead=True)
+        item = response.get("Item")
+        if item is None:
+            self._tokens = None
+            return None
+
+        for key in ("expires_at", "version", "refresh_claim_expires"):
+            if key in item:
+                item[key] = int(item[key])
+        self._tokens = item
+        return item
+
+    def is_expired(self) -> bool:
+        expires_at = int((self._tokens or {}).get("expires_at", 0))
+        return self._clock() >= expires_at - EXPIRY_MARGIN_SECONDS
+
+    def get_valid_tokens(self) -> Optional[Dict[str, Any]]:
+        """キャッシュ済みのトークンを返す。未読み込み・期限切れ間近の場合のみDynamoDB/Fitbitにアクセスする"""
+        if self._tokens is None and self.load() is None:
+            return None
+
+        if self.is_expired():
+            # 他の実行がすでにリフレッシュしているかもしれないので、まず読み直す
+            self.load()
+            if self.is_expired():
+                logger.info("🔄 トークンが期限切れ間近のためリフレッシュします")
+                self.refresh()
+        return self._tokens
+
+    def handle_unauthorized(self) -> Dict[str, Any]:
+        """401を受けたときに呼ぶ。他の実行が更新済みならそれを使い、そうでなければリフレッシュする"""
+        stale_version = self.version
+        self.load()
+        if self._tokens is not None and self.version > stale_version:
+            logger.info("📋 他の実行で更新されたトークンを使用します (version=%s)", self.version)
+            return self._tokens
+        return self.refresh()
+
+    def refresh(self) -> Dict[str, Any]:
+        """リフレッシュ権を確保してからトークンをリフレッシュし、version を進めて保存する"""
+        if self._tokens is None and self.load() is None:
+            raise TokenRefreshError("No tokens found in DynamoDB")
+
+        expected_version = self.version
+        if not self._claim_refresh(expected_version):
+            return self._wait_for_peer_refresh(expected_version)
+
+        try:
+            new_tokens = request_token_refresh(
+                self.http, self.client_id, self.client_secret, self._tokens["refresh_token"]
+            )
+        except Exception:
+            self._release_claim()
+            raise
+
+        self._commit(new_tokens, expected_version)
+        return self._tokens
+
+    def _claim_refresh(self, expected_version: int) -> bool:
+        now = int(self._clock())
+        try:
+            self.table.update_item(
+                Key={"user_id": self.user_id},
+                UpdateExpression="SET refresh_claim = :owner, refresh_claim_expires = :claim_expires",
+                ConditionExpression=(
+                    "(attribute_not_exists(#version) OR #version = :expected) AND "
+                    "(attribute_not_exists(refresh_claim_expires) OR refresh_claim_expires < :now)"
+                ),
+                ExpressionAttributeNames={"#version": "version"},
+                ExpressionAttributeValues={
+                    ":owner": self._owner,
+                    ":claim_expires": now + REFRESH_CLAIM_SECONDS,
+                    ":expected": expected_version,
+                    ":now": now,
+                },
+            )
+            return True
+        except ClientError as err:
+            if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            logger.info("⏳ 他の実行がトークンをリフレッシュ中のため完了を待ちます")
+            return False
+
+    def _wait_for_peer_refresh(self, expected_version: int) -> Dict[str, Any]:
+        deadline = self._clock() + REFRESH_WAIT_SECONDS
+        while True:
+            self.load()
+            if self._tokens is not None and self.version > expected_version:
+                logger.info("📋 他の実行がリフレッシュしたトークンを使用します (version=%s)", self.version)
+                return self._tokens
+            if self._clock() >= deadline:
+                raise TokenRefreshError("Timed out waiting for concurrent token refresh")
+            claim_expires = int((self._tokens or {}).get("refresh_claim_expires", 0))
+            if claim_expires < self._clock():
+                # 相手のリフレッシュ権が失効した（途中で落ちた）場合は自分で引き継ぐ
+                return self.refresh()
+            self._sleep(1)
+
+    def _commit(self, new_tokens: Dict[str, Any], expected_version: int) -> None:
+        current_time = datetime.now().isoformat()
+        item = {
+            "access_token": new_tokens["access_token"],
+            "refresh_token": new_tokens["refresh_token"],
+            "expires_at": int(self._clock() + new_tokens["expires_in"]),
+            "scope": new_tokens.get("scope", ""),
+            "updated_at": current_time,
+            "last_refresh_at": current_time,
+            "version": expected_version + 1,
+        }
+        # scope などの予約語を避けるため属性名はプレースホルダー経由で指定する
+        assignments = ", ".join(f"#{name} = :{name}" for name in item)
+        names = {f"#{name}": name for name in item}
+        values = {f":{name}": value for name, value in item.items()}
+
+        try:
+            self.table.update_item(
+                Key={"user_id": self.user_id},
+                UpdateExpression=f"SET {assignments} REMOVE refresh_claim, refresh_claim_expires",
+                ConditionExpression="refresh_claim = :owner",
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues={**values, ":owner": self._owner},
+            )
+        except ClientError as err:
+            if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            # リフレッシュ権が失効していた。古いリフレッシュトークンは使用済みなので、
+            # まだ誰も新しい version を書いていなければ自分の結果を保存する
+            logger.warning("⚠️ リフレッシュ権が失効していたため version 条件のみで保存します")
+            self.table.update_item(
+                Key={"user_id": self.user_id},
+                UpdateExpression=f"SET {assignments} REMOVE refresh_claim, refresh_claim_expires",
+                ConditionExpression="attribute_not_exists(#version) OR #version = :expected",
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues={**values, ":expected": expected_version},
+            )
+
+        self._tokens = {**(self._tokens or {}), **item, "user_id": self.user_id}
+        self._tokens.pop("refresh_claim", None)
+        self._tokens.pop("refresh_claim_expires", None)
+        logger.info("✅ 新しいトークンペアをDynamoDBに保存しました (version=%s)", item["version"])
+        logger.info("  有効期限: %s", datetime.fromtimestamp(item["expires_at"]).isoformat())
+
+    def _release_claim(self) -> None:
+        try:
+            self.table.update_item(
+                Key={"user_id": self.user_id},
+                UpdateExpression="REMOVE refresh_claim, refresh_claim_expires",
+                ConditionExpression="refresh_claim = :owner",
+                ExpressionAttributeValues={":owner": self._owner},
+            )
+        except ClientError as err:
+            logger.warning("リフレッシュ権の解放に失敗: %s", err)
+
+
+def request_token_refresh(http, client_id: str, client_secret: Optional[str], refresh_token: str) -> Dict[str, Any]:
+    """Fitbitのトークンエンドポイントを呼び出し、新しいトークンペアを返す"""
+    if not client_secret:
+        raise TokenRefreshError("FITBIT_CLIENT_SECRET 環境変数が未設定です")
+
+    auth_b64 = base64.b64encode(f"{client_id}:{client_secret}".encode("ascii")).decode("ascii")
+    headers = {
+        "Authorization": f"Basic {auth_b64}",
+        "Content-Type": "application/x-www-form-urlencoded",
+    }
+    # URLエンコーディングして特殊文字を正しく処理
+    body = urlencode({"grant_type": "refresh_token", "refresh_token": refresh_token})
+
+    logger.info("📮 リフレッシュトークンでAPIを呼び出し中...")
+    # 5xx / 通信エラーは再試行する（Fitbitは同じリフレッシュトークンの2分以内の再利用に同じトークンペアを返す）
+    response = TOKEN_RETRY_POLICY.request(
+        http, "POST", FITBIT_TOKEN_URL, key="oauth2_token", deadline=Deadline(REFRESH_RETRY_SECONDS),
+        headers=headers, body=body,
+    )
+
+    if response.status == 200:
+        new_tokens = json.loads(response.data.decode("utf-8"))
+        logger.info("✅ 新しいトークンペアを取得成功（有効期限: %s秒）", new_tokens.get("expires_in", 0))
+        return new_tokens
+
+    error_data = {}
+    if response.data:
+        try:
+            error_data = json.loads(response.data.decode("utf-8"))
+        except ValueError:
+            error_data = {"raw": response.data.decode("utf-8", errors="replace")}
+    error_type = (error_data.get("errors") or [{}])[0].get("errorType", "unknown")
+
+    if error_type == "invalid_grant":
+        logger.error("🔒 リフレッシュトークンが無効です。ユーザーの再認証が必要です。")
+    logger.error("❌ リフレッシュ失敗: %s - %s", response.status, error_data)
+    raise TokenRefreshError(f"Token refresh failed: {response.status} {error_type}", error_type)
@@ -0,0 +1,101 @@
+"""
+バックフィルの取得とS3保存を重ねるパイプライン
+
+呼び出し元のスレッドが次の日のFitbit APIを取得している間に、バックグラウンドの1スレッドが
+前の日のシリアライズとS3保存を行う。保存待ちは depth 日分までに制限し、それを超えると
+最も古い保存の完了を待つ（メモリに保持する日数を抑えるため）。
+
+結果（fetched / skipped / errors）は日付順に記録されるよう、保存以外の結果を記録する前に
+flush() で保存待ちをすべて完了させる。
+"""
+import logging
+import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date as date_cls
+from typing import Any, Callable, Deque, Dict, List, Tuple
+
+logger = logging.getLogger()
+
+DEFAULT_PIPELINE_DEPTH = 2
+
+
+def pipeline_depth_from_env() -> int:
+    """FITBIT_BACKFILL_PIPELINE_DEPTH（0 で従来どおり取得→保存を逐次実行）"""
+    try:
+        depth = int(os.environ.get("FITBIT_BACKFILL_PIPELINE_DEPTH", str(DEFAULT_PIPELINE_DEPTH)))
+    except ValueError:
+        depth = DEFAULT_PIPELINE_DEPTH
+    return max(0, min(depth, 8))
+
+
+class UploadPipeline:
+    """save(date_str, data, **save_kwargs) をバックグラウンドで実行し、完了順ではなく投入順に結果を記録する"""
+
+    def __init__(
+        self,
+        save: Callable[..., List[str]],
+        results: Dict[str, Any],
+        on_day_done: Callable[[date_cls, str], None],
+        depth: int = DEFAULT_PIPELINE_DEPTH,
+        done: str = "done",
+        failed: str = "failed",
+    ):
+        self._save = save
+        self._results = results
+        self._on_day_done = on_day_done
+        self._depth = depth
+        self._done = done
+        self._failed = failed
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="s3-upload") if depth > 0 else None
+        self._pending: Deque[Tuple[date_cls, Dict[str, int], Future]] = deque()
+
+    def __enter__(self) -> "UploadPipeline":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def submit(self, target: date_cls, data: Dict[str, Any], status_map: Dict[str, int], **save_kwargs: Any) -> None:
+        """1日分の保存を投入する。保存待ちが depth 日分を超えたら古いものから完了を待つ"""
+        if self._executor is None:
+            future: Future = Future()
+            try:
+                future.set_result(self._save(target.isoformat(), data, **save_kwargs))
+            except Exception as exc:  # pylint: disable=broad-except
+                future.set_exception(exc)
+        else:
+            future = self._executor.submit(self._save, target.isoformat(), data, **save_kwargs)
+
+        self._pending.append((target, status_map, future))
+        while len(self._pending) > self._depth:
+            self._finish_oldest()
+
+    def flush(self) -> None:
+        """保存待ちをすべて完了させて結果を記録する"""
+        while self._pending:
+            self._finish_oldest()
+
+    def close(self) -> None:
+        self.flush()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    def _finish_oldest(self) -> None:
+        target, status_map, future = self._pending.popleft()
+        date_str = target.isoformat()
+        try:
+            saved_paths = future.result()
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.error("❌ %s の保存でエラー", date_str, exc_info=exc)
+            self._results["errors"].append({"date": date_str, "error": str(exc)})
+            self._on_day_done(target, self._failed)
+            return
+
+        self._results["fetched"].append({
+            "date": date_str,
+            "files": saved_paths,
+            "status_map": status_map,
+        })
+        self._on_day_done(target, self._done)
+        logger.info("✅ %s の保存が完了", date_str)
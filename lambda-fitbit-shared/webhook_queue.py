@@ -0,0 +1,297 @@
+"""
+Fitbitサブスクリプション通知の受信キュー（DynamoDB fitbit_webhook_pending テーブル）
+
+Fitbitは同期のたびに同じユーザー・コレクション・日付の通知を何度も送ってくるため、
+受信した通知は (ユーザー, collectionType, 日付) ごとに1項目へまとめ、最初の通知から
+coalesce 秒が過ぎてから1回だけ取得する。取得中に届いた通知は notified_at の更新で検出し、取り直す。
+
+テーブル構成（パーティションキー user_id / ソートキー item_key）
+- item_key = "<collectionType>#<YYYY-MM-DD>": 取得待ちの通知（due_at・notified_at・通知回数・取得中のリース）
+- user_id = item_key = "__drain__": 取得処理（drain）の実行中リース。同時に複数の drain を起動しないために使う
+
+取得待ちの項目だけが queue = "pending" を持ち、GSI due_at-index（queue / due_at）に載る。drain は
+テーブル全体を Scan せず、このインデックスを due_at 順に Query する（drain のリースはインデックスに載らない）。
+"""
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import time
+import uuid
+from datetime import datetime
+from decimal import Decimal
+from typing import Any, Callable, Dict, List, Optional
+
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+import aws_clients
+
+logger = logging.getLogger()
+
+DEFAULT_PENDING_TABLE = "fitbit_webhook_pending"
+DEFAULT_COALESCE_SECONDS = 30
+DRAIN_LEASE_KEY = "__drain__"
+# 取得待ちの項目を due_at 順に引くGSI（パーティションキー queue は取得待ちの項目だけが持つ）
+DUE_INDEX = "due_at-index"
+QUEUE_ATTRIBUTE = "queue"
+PENDING_QUEUE = "pending"
+# 取得中の項目のリース。取得中にLambdaが落ちても、この時間が過ぎれば次の drain が引き継ぐ
+CLAIM_SECONDS = 180
+# 同じ項目の取得がこの回数失敗したら諦めて削除する（日次Lambdaの取得・欠損日の補完に任せる）
+MAX_ATTEMPTS = 3
+
+# notified_at は complete() の条件で元の値と比較するため Decimal のまま扱う
+_FLOAT_ATTRIBUTES = ("due_at", "claimed_until")
+_INT_ATTRIBUTES = ("notifications", "attempts")
+
+
+def coalesce_seconds_from_env() -> int:
+    """FITBIT_WEBHOOK_COALESCE_SECONDS（同じ通知をまとめる秒数、デフォルト: 30）"""
+    try:
+        return max(0, int(os.environ.get("FITBIT_WEBHOOK_COALESCE_SECONDS", str(DEFAULT_COALESCE_SECONDS))))
+    except ValueError:
+        return DEFAULT_COALESCE_SECONDS
+
+
+def verify_signature(body: bytes, signature: Optional[str], client_secret: str) -> bool:
+    """X-Fitbit-Signature（本文の HMAC-SHA1、鍵は "<client_secret>&"）を検証する"""
+    if not signature or not client_secret:
+        return False
+    digest = hmac.new(f"{client_secret}&".encode("utf-8"), body, hashlib.sha1).digest()
+    return hmac.compare_digest(base64.b64encode(digest).decode("ascii"), signature.strip())
+
+
+def parse_notifications(body: bytes) -> List[Dict[str, str]]:
+    """
+    通知の本文（JSON配列）から collectionType・date・ownerId が揃ったものだけを返す
+
+    date がない通知は取得する日付が決まらないため無視する（その日は日次Lambdaの取得・欠損日の補完に任せる）。
+    """
+    try:
+        payload = json.loads(body.decode("utf-8"))
+    except (UnicodeDecodeError, ValueError):
+        logger.warning("⚠️ 通知の本文がJSONではありません")
+        return []
+    if not isinstance(payload, list):
+        payload = [payload]
+
+    notifications = []
+    for entry in payload:
+        if not isinstance(entry, dict):
+            continue
+        collection_type, date_str, owner_id = entry.get("collectionType"), entry.get("date"), entry.get("ownerId")
+        if not (collection_type and date_str and owner_id):
+            logger.warning("⚠️ 不完全な通知を無視します: %s", entry)
+            continue
+        try:
+            datetime.strptime(date_str, "%Y-%m-%d")
+        except (TypeError, ValueError):
+            logger.warning("⚠️ 日付が不正な通知を無視します: %s", entry)
+            continue
+        notifications.append({
+            "collection_type": collection_type,
+            "date": date_str,
+            "owner_id": owner_id,
+            "subscription_id": entry.get("subscriptionId"),
+        })
+    return notifications
+
+
+class PendingQueue:
+    """(ユーザー, collectionType, 日付) ごとの取得待ちの通知"""
+
+    def __init__(self, table, clock: Callable[[], float] = time.time):
+        self.table = table
+        self._clock = clock
+        self._owner = uuid.uuid4().hex
+
+    @classmethod
+    def from_env(cls, dynamodb=None) -> "PendingQueue":
+        table_name = os.environ.get("FITBIT_WEBHOOK_TABLE", DEFAULT_PENDING_TABLE)
+        table = dynamodb.Table(table_name) if dynamodb is not None else aws_clients.table(table_name)
+        return cls(table)
+
+    def enqueue(self, user_id: str, collection_type: str, date_str: str, coalesce_seconds: float) -> bool:
+        """
+        通知を記録し、drain を起動すべきなら True を返す
+
+        新しい項目なら True。取得待ちの項目にまとめた場合は、その項目が取り残されている（due_at を過ぎても
+        取得されていない、または取得中のリースが切れている）ときだけ True を返す。落ちた drain が残した項目は、
+        次の通知で drain を起動し直して拾う。まとめた場合も notified_at を進めるので、取得中に届いた通知は
+        complete() で検出される。
+        """
+        now = self._clock()
+        key = {"user_id": user_id, "item_key": f"{collection_type}#{date_str}"}
+        while True:
+            try:
+                self.table.put_item(
+                    Item={
+                        **key,
+                        QUEUE_ATTRIBUTE: PENDING_QUEUE,
+                        "collection_type": collection_type,
+                        "date": date_str,
+                        "due_at": Decimal(str(round(now + coalesce_seconds, 3))),
+                        "notified_at": Decimal(str(round(now, 3))),
+                        "notifications": 1,
+                        "attempts": 0,
+                    },
+                    ConditionExpression="attribute_not_exists(user_id)",
+                )
+                return True
+            except ClientError as err:
+                if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+            # queue は、インデックスを追加する前に作られた項目もインデックスに載せるために付け直す
+            try:
+                response = self.table.update_item(
+                    Key=key,
+                    UpdateExpression="SET notified_at = :now, #queue = :pending ADD notifications :one",
+                    ConditionExpression="attribute_exists(user_id)",
+                    ExpressionAttributeNames={"#queue": QUEUE_ATTRIBUTE},
+                    ExpressionAttributeValues={":now": Decimal(str(round(now, 3))), ":pending": PENDING_QUEUE, ":one": 1},
+                    ReturnValues="ALL_OLD",
+                )
+                break
+            except ClientError as err:
+                if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+            # put_item との間に drain が取得・削除した。新しい項目として記録し直す
+
+        existing = _to_numbers(response["Attributes"])
+        if existing.get("claimed_until", 0) > now or existing["due_at"] > now:
+            return False
+        logger.info("🔁 %s/%s は取得されずに残っていたため drain を起動します", user_id, key["item_key"])
+        return True
+
+    def pending_items(self) -> List[Dict[str, Any]]:
+        """
+        取得待ちの項目（他の drain が取得中のものを除く）を due_at 順に返す
+
+        GSI は結果整合のため、削除・取得した直後の項目が返ることがある。claim() の条件で弾かれるので二重には取得しない。
+        """
+        now = self._clock()
+        items: List[Dict[str, Any]] = []
+        query_kwargs: Dict[str, Any] = {
+            "IndexName": DUE_INDEX,
+            "KeyConditionExpression": Key(QUEUE_ATTRIBUTE).eq(PENDING_QUEUE),
+        }
+        while True:
+            response = self.table.query(**query_kwargs)
+            for item in response.get("Items", []):
+                item = _to_numbers(item)
+                if item.get("claimed_until", 0) > now:
+                    continue
+                items.append(item)
+            if "LastEvaluatedKey" not in response:
+                break
+            query_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+        return items
+
+    def claim(self, item: Dict[str, Any]) -> bool:
+        """項目の取得リースを確保する（別の drain が確保済みなら False）"""
+        now = self._clock()
+        try:
+            self.table.update_item(
+                Key=_key(item),
+                UpdateExpression="SET claimed_by = :owner, claimed_until = :until ADD attempts :one",
+                ConditionExpression="attribute_exists(user_id) AND (attribute_not_exists(claimed_until) OR claimed_until < :now)",
+                ExpressionAttributeValues={
+                    ":owner": self._owner,
+                    ":until": Decimal(str(round(now + CLAIM_SECONDS, 3))),
+                    ":now": Decimal(str(round(now, 3))),
+                    ":one": 1,
+                },
+            )
+        except ClientError as err:
+            if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            return False
+        item["attempts"] = item.get("attempts", 0) + 1
+        return True
+
+    def complete(self, item: Dict[str, Any], coalesce_seconds: float) -> bool:
+        """
+        取得済みの項目を削除する
+
+        取得中に新しい通知が届いていた（notified_at が変わった）場合は削除せずに取得待ちへ戻し、False を返す。
+        """
+        try:
+            self.table.delete_item(
+                Key=_key(item),
+                ConditionExpression="notified_at = :seen AND claimed_by = :owner",
+                ExpressionAttributeValues={
+                    ":seen": item["notified_at"],
+                    ":owner": self._owner,
+                },
+            )
+            return True
+        except ClientError as err:
+            if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+        logger.info("🔁 %s/%s は取得中に再度通知されたため取り直します", item["user_id"], item["item_key"])
+        self.release(item, retry_in=coalesce_seconds, reset_attempts=True)
+        return False
+
+    def release(self, item: Dict[str, Any], retry_in: float, reset_attempts: bool = False) -> None:
+        """リースを解放し、retry_in 秒後に取得待ちへ戻す（失敗が MAX_ATTEMPTS 回に達した項目は削除する）"""
+        if not reset_attempts and item.get("attempts", 0) >= MAX_ATTEMPTS:
+            logger.warning("⚠️ %s/%s の取得が%s回失敗したため破棄します", item["user_id"], item["item_key"], MAX_ATTEMPTS)
+            self.table.delete_item(Key=_key(item))
+            return
+        update = "REMOVE claimed_by, claimed_until SET due_at = :due"
+        values: Dict[str, Any] = {":due": Decimal(str(round(self._clock() + retry_in, 3)))}
+        if reset_attempts:
+            update += ", attempts = :zero"
+            values[":zero"] = 0
+        self.table.update_item(Key=_key(item), UpdateExpression=update, ExpressionAttributeValues=values)
+
+    def discard(self, item: Dict[str, Any]) -> None:
+        """取得対象にならない項目（トークンのないユーザーなど）を削除する"""
+        self.table.delete_item(Key=_key(item))
+
+    def acquire_drain_lease(self, lease_seconds: float) -> bool:
+        """drain の実行中リースを確保する（別の drain が実行中なら False）"""
+        now = int(self._clock())
+        try:
+            self.table.put_item(
+                Item={
+                    "user_id": DRAIN_LEASE_KEY,
+                    "item_key": DRAIN_LEASE_KEY,
+                    "lease_owner": self._owner,
+                    "lease_expires": now + int(lease_seconds),
+                },
+                ConditionExpression="attribute_not_exists(user_id) OR lease_expires < :now OR lease_owner = :owner",
+                ExpressionAttributeValues={":now": now, ":owner": self._owner},
+            )
+        except ClientError as err:
+            if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            return False
+        return True
+
+    def release_drain_lease(self) -> None:
+        try:
+            self.table.delete_item(
+                Key={"user_id": DRAIN_LEASE_KEY, "item_key": DRAIN_LEASE_KEY},
+                ConditionExpression="lease_owner = :owner",
+                ExpressionAttributeValues={":owner": self._owner},
+            )
+        except ClientError as err:
+            logger.warning("drain のリース解放に失敗: %s", err)
+
+
+def _key(item: Dict[str, Any]) -> Dict[str, str]:
+    return {"user_id": item["user_id"], "item_key": item["item_key"]}
+
+
+def _to_numbers(item: Dict[str, Any]) -> Dict[str, Any]:
+    for key in _FLOAT_ATTRIBUTES:
+        if key in item:
+            item[key] = float(item[key])
+    for key in _INT_ATTRIBUTES:
+        if key in item:
+            item[key] = int(item[key])
+    return item
@@ -0,0 +1,148 @@
+#!/bin/bash
+
+RED='\033[0;31m'
+GREEN='\033[0;32m'
+YELLOW='\033[1;33m'
+NC='\033[0m'
+
+echo_success() { echo -e "${GREEN}✅ $1${NC}"; }
+echo_error() { echo -e "${RED}❌ $1${NC}"; }
+echo_info() { echo -e "${YELLOW}📋 $1${NC}"; }
+
+ENV_FILE="../.env.local"
+if [ -f "$ENV_FILE" ]; then
+  echo_info ".env.local から環境変数を読み込み中..."
+  set -a
+  source <(grep -v '^#' "$ENV_FILE" | grep -v '^$')
+  set +a
+  echo_success "環境変数を読み込みました"
+else
+  echo_error ".env.local が見つかりません: $ENV_FILE"
+  exit 1
+fi
+
+echo_info "必須環境変数をチェック中..."
+missing=()
+[ -z "$FITBIT_CLIENT_ID" ] && missing+=("FITBIT_CLIENT_ID")
+[ -z "$FITBIT_CLIENT_SECRET" ] && missing+=("FITBIT_CLIENT_SECRET")
+[ -z "$S3_BUCKET_NAME" ] && missing+=("S3_BUCKET_NAME")
+[ -z "$FITBIT_SUBSCRIBER_VERIFY_CODE" ] && missing+=("FITBIT_SUBSCRIBER_VERIFY_CODE")
+
+if [ ${#missing[@]} -gt 0 ]; then
+  echo_error "以下を .env.local に設定してください:"
+  for var in "${missing[@]}"; do
+    echo "  - $var"
+  done
+  exit 1
+fi
+
+echo_success "必須変数チェック完了"
+
+FUNCTION_NAME="moderation-craft-fitbit-webhook"
+ROLE_NAME="fitbit-lambda-role"
+REGION="${AWS_REGION:-ap-northeast-1}"
+ACCOUNT_ID="800860245583"
+ROLE_ARN="arn:aws:iam::${ACCOUNT_ID}:role/${ROLE_NAME}"
+ENVIRONMENT="Variables={FITBIT_CLIENT_ID=${FITBIT_CLIENT_ID},FITBIT_CLIENT_SECRET=${FITBIT_CLIENT_SECRET},S3_BUCKET=${S3_BUCKET_NAME},DYNAMODB_TABLE=fitbit_tokens,FITBIT_USER_ID=BGPGCR,FITBIT_WEBHOOK_TABLE=fitbit_webhook_pending,FITBIT_WEBHOOK_COALESCE_SECONDS=${FITBIT_WEBHOOK_COALESCE_SECONDS:-30},FITBIT_SUBSCRIBER_VERIFY_CODE=${FITBIT_SUBSCRIBER_VERIFY_CODE},FITBIT_WEBHOOK_SCHEDULER_ROLE_ARN=arn:aws:iam::${ACCOUNT_ID}:role/fitbit-backfill-scheduler-role}"
+
+echo "============================================"
+echo "🚀 Fitbit Webhook Lambda デプロイ"
+echo "============================================"
+
+aws iam get-role --role-name "$ROLE_NAME" --region "$REGION" >/dev/null 2>&1
+if [ $? -ne 0 ]; then
+  echo_error "IAM Role ${ROLE_NAME} が存在しません。既存の日次Lambda用のロールを共有する想定です。必要なら先に作成してください。"
+  exit 1
+fi
+
+echo_info "パッケージを作成中..."
+# 通知の取得は日次Lambdaの fetch_all_fitbit_data / save_to_s3 を使うため、同じファイルを同梱する
+rm -rf package function.zip
+mkdir package
+if [ -s requirements.txt ]; then
+  pip install -r requirements.txt -t package/ --quiet
+fi
+cp lambda_function.py webhook.py package/
+cp ../lambda-fitbit-shared/*.py package/
+(
+  cd package || exit 1
+  zip -r ../function.zip . -q
+)
+rm -rf package
+
+echo_success "function.zip を作成しました"
+
+echo_info "Lambda関数を作成または更新します"
+aws lambda get-function --function-name "$FUNCTION_NAME" --region "$REGION" >/dev/null 2>&1
+if [ $? -ne 0 ]; then
+  echo_info "新規作成します..."
+  aws lambda create-function \
+    --function-name "$FUNCTION_NAME" \
+    --runtime python3.11 \
+    --role "$ROLE_ARN" \
+    --handler webhook.lambda_handler \
+    --zip-file fileb://function.zip \
+    --timeout 300 \
+    --memory-size 256 \
+    --region "$REGION" \
+    --environment "$ENVIRONMENT" >/dev/null
+  if [ $? -ne 0 ]; then
+    echo_error "Lambda関数の作成に失敗しました"
+    rm -f function.zip
+    exit 1
+  fi
+  echo_success "Lambda関数を作成しました"
+
+  # Fitbitからの通知を受ける関数URL（認証は X-Fitbit-Signature で行う）
+  aws lambda create-function-url-config \
+    --function-name "$FUNCTION_NAME" \
+    --auth-type NONE \
+    --region "$REGION" >/dev/null
+  aws lambda add-permission \
+    --function-name "$FUNCTION_NAME" \
+    --statement-id FunctionURLAllowPublicAccess \
+    --action lambda:InvokeFunctionUrl \
+    --principal "*" \
+    --function-url-auth-type NONE \
+    --region "$REGION" >/dev/null
+  echo_success "関数URLを作成しました"
+else
+  echo_info "既存関数を更新します..."
+  aws lambda update-function-code --function-name "$FUNCTION_NAME" --zip-file fileb://function.zip --region "$REGION" >/dev/null
+  if [ $? -ne 0 ]; then
+    echo_error "コード更新に失敗しました"
+    rm -f function.zip
+    exit 1
+  fi
+  aws lambda wait function-updated --function-name "$FUNCTION_NAME" --region "$REGION"
+  aws lambda update-function-configuration \
+    --function-name "$FUNCTION_NAME" \
+    --timeout 300 \
+    --memory-size 256 \
+    --region "$REGION" \
+    --environment "$ENVIRONMENT" >/dev/null
+  if [ $? -ne 0 ]; then
+    echo_error "設定更新に失敗しました"
+    rm -f function.zip
+    exit 1
+  fi
+  echo_success "Lambda関数を更新しました"
+fi
+
+rm -f function.zip
+
+FUNCTION_URL=$(aws lambda get-function-url-config --function-name "$FUNCTION_NAME" --region "$REGION" --query 'FunctionUrl' --output text 2>/dev/null)
+
+echo ""
+echo "============================================"
+echo_success "デプロイ完了"
+echo "============================================"
+echo "1. 初回のみ取得待ちテーブルと drain 予約用のロールを作成: ../scripts/create-fitbit-webhook-pending.sh / ../scripts/create-fitbit-backfill-scheduler-role.sh"
+echo "2. Fitbit開発者サイトのアプリ設定でサブスクライバーを登録"
+echo "   Endpoint URL: ${FUNCTION_URL}  Verification Code: FITBIT_SUBSCRIBER_VERIFY_CODE の値"
+echo "3. サブスクリプションを作成（ユーザーごと・コレクションごと）:"
+echo "   curl -X POST -H \"Authorization: Bearer <access_token>\" https://api.fitbit.com/1/user/-/activities/apiSubscriptions/<subscription-id>.json"
+echo "   curl -X POST -H \"Authorization: Bearer <access_token>\" https://api.fitbit.com/1/user/-/sleep/apiSubscriptions/<subscription-id>.json"
+echo "4. CloudWatch Logs 監視: aws logs tail /aws/lambda/$FUNCTION_NAME --follow"
+echo "5. 取得待ちの手動処理: aws lambda invoke --function-name $FUNCTION_NAME --payload '{\"webhook_drain\":true}' response.json"
+echo ""
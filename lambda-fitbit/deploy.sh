@@ -125,8 +125,9 @@ if [ -s requirements.txt ]; then
     pip install -r requirements.txt -t package/ --quiet
 fi
 
-# Lambda関数のコードをコピー
+# Lambda関数のコードと共有モジュールをコピー
 cp lambda_function.py package/
+cp ../lambda-fitbit-shared/*.py package/
 
 # ZIPファイルを作成
 cd package
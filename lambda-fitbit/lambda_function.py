@@ -1,19 +1,67 @@
 import json
 import os
-import boto3
-import urllib3
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-import base64
 import logging
-from typing import Any, Dict, Tuple
-from urllib.parse import urlencode
+from typing import Any, Dict, List, Optional, Tuple
+
+# 共有モジュール（lambda-fitbit-shared）はデプロイ時に同梱される。ローカル実行時は兄弟ディレクトリから読み込む
+_SHARED_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda-fitbit-shared')
+if os.path.isdir(_SHARED_DIR):
+    sys.path.append(_SHARED_DIR)
+
+import aws_clients  # noqa: E402
+import content_hash  # noqa: E402
+import fitbit_api  # noqa: E402
+import fitbit_collections  # noqa: E402
+import metrics  # noqa: E402
+import raw_store  # noqa: E402
+import raw_writer  # noqa: E402
+import s3_index  # noqa: E402
+import sleep_sync  # noqa: E402
+from rate_limiter import FitbitRateLimiter, RateLimitExceeded, rate_limiter_from_env  # noqa: E402
+from token_manager import DEFAULT_USER_ID, FitbitTokenManager, TokenRefreshError  # noqa: E402
 
 # ログ設定
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# エンドポイントの並列取得数（FITBIT_FETCH_CONCURRENCY=1で逐次取得）
+FETCH_CONCURRENCY = fitbit_api.fetch_concurrency_from_env()
+
+# 保存するコレクション（FITBIT_COLLECTIONS で spo2 / hrv / weight などを追加できる）
+COLLECTIONS = fitbit_collections.enabled_collections()
+
+# 全ユーザーモードで同時に処理するユーザー数（FITBIT_USER_CONCURRENCY）
+try:
+    USER_CONCURRENCY = max(1, min(int(os.environ.get('FITBIT_USER_CONCURRENCY', '4')), 16))
+except ValueError:
+    USER_CONCURRENCY = 4
+
+# 前日より前の欠損日（_summary.json がない日）を遡って補完する日数（FITBIT_GAP_LOOKBACK_DAYS、0で無効）
+try:
+    GAP_LOOKBACK_DAYS = max(0, min(int(os.environ.get('FITBIT_GAP_LOOKBACK_DAYS', '7')), 90))
+except ValueError:
+    GAP_LOOKBACK_DAYS = 7
+
+# 欠損日を1日補完するのに必要な残り時間の目安（取得と保存）
+GAP_TIME_MARGIN_SECONDS = 15
+
 # urllib3を使用（requestsの代わりに標準ライブラリで）
-http = urllib3.PoolManager()
+# 全ユーザーモードでは「ユーザー数 × エンドポイント数」の接続を同時に使う
+http = fitbit_api.build_pool_manager(FETCH_CONCURRENCY * USER_CONCURRENCY)
+
+# これまでどおり raw/fitbit/year=.../ 直下に保存する主ユーザー
+PRIMARY_USER_ID = os.environ.get('FITBIT_USER_ID', DEFAULT_USER_ID)
+
+# Fitbitのユーザー単位のレート制限（150リクエスト/時）をバックフィルと同じ方式で管理
+fitbit_rate_limiter = rate_limiter_from_env()
+
+# 主ユーザー以外のリミッター（Fitbitの制限はユーザーごとなので、ユーザーごとに独立した枠を持つ）
+_user_rate_limiters: Dict[str, FitbitRateLimiter] = {}
+_user_rate_limiters_lock = threading.Lock()
 
 def lambda_handler(event, context):
     """
@@ -21,331 +69,341 @@ def lambda_handler(event, context):
     前日のFitbitデータを取得してS3に保存
     """
     logger.info("🚀 Fitbit日次エクスポートLambda関数を開始")
+    metrics.start_invocation('fitbit-daily')
 
     # 昨日の日付を取得
     yesterday = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
     logger.info(f"📅 処理対象日付: {yesterday}")
 
+    # fitbit_tokens の全ユーザーを処理するモード（イベントの all_users か FITBIT_DAILY_ALL_USERS=true）
+    with_sleep_sync = sleep_sync.enabled(event)
+    gap_lookback_days = _gap_lookback_days(event)
+    try:
+        if _all_users_enabled(event):
+            status_code, body = export_all_users(yesterday, context, with_sleep_sync, gap_lookback_days)
+        else:
+            status_code, body = export_user(PRIMARY_USER_ID, yesterday, context, with_sleep_sync, gap_lookback_days)
+
+        # Fitbit・S3・DynamoDBの呼び出しと待機の内訳（EMF にも同じ記録を出力する）
+        body['metrics'] = metrics.summary()
+        return {
+            'statusCode': status_code,
+            'body': json.dumps(body)
+        }
+    finally:
+        metrics.flush(context)
+
+
+def export_user(
+    user_id: str, date: str, context, with_sleep_sync: bool = False, gap_lookback_days: int = 0
+) -> Tuple[int, Dict[str, Any]]:
+    """1ユーザー分の前日データを取得してS3に保存し、(ステータスコード, レスポンス本文) を返す"""
     try:
         # 1. DynamoDBからトークンを取得
-        logger.info("🔑 DynamoDBからトークンを取得中...")
-        tokens = get_fitbit_tokens()
+        logger.info(f"🔑 DynamoDBからトークンを取得中... (User ID: {user_id})")
+        token_manager = FitbitTokenManager.from_env(http, user_id=user_id)
+        tokens = token_manager.load()
 
         if not tokens:
-            logger.error("❌ トークンが見つかりません")
-            return {
-                'statusCode': 400,
-                'body': json.dumps({'error': 'No tokens found in DynamoDB'})
-            }
+            logger.error(f"❌ トークンが見つかりません (User ID: {user_id})")
+            return 400, {'error': 'No tokens found in DynamoDB'}
 
         logger.info(f"✅ トークン取得成功 (User ID: {tokens.get('user_id', 'N/A')})")
 
         # 2. 毎日実行される前提で、必ずトークンをリフレッシュ
         # Fitbitの仕様: リフレッシュトークンは一度使うと無効になるため、
         # 日次実行では必ず新しいトークンを取得する
+        # バックフィルが同時にリフレッシュしている場合は、その結果を待って使う
         logger.info("🔄 日次実行のため、トークンをリフレッシュします...")
         logger.info(f"  前回のリフレッシュ: {tokens.get('updated_at', '不明')}")
 
-
-        tokens = refresh_fitbit_token(tokens['refresh_token'])
-        if not tokens:
-            logger.error("❌ トークンのリフレッシュに失敗")
-            return {
-                'statusCode': 401,
-                'body': json.dumps({'error': 'Token refresh failed - may need re-authorization'})
-            }
+        try:
+            tokens = token_manager.refresh()
+        except TokenRefreshError as e:
+            logger.error(f"❌ トークンのリフレッシュに失敗 (User ID: {user_id}): {str(e)}")
+            return 401, {'error': 'Token refresh failed - may need re-authorization'}
         logger.info("✅ トークンのリフレッシュ成功")
 
-        # 3. Fitbit APIからデータを取得
+        # 3. Fitbit APIからデータを取得（レート制限の枠はユーザーごと）
         logger.info("📊 Fitbit APIからデータを取得中...")
-        fitbit_data, status_map = fetch_all_fitbit_data(tokens['access_token'], yesterday)
+        limiter = rate_limiter_for(user_id)
+        max_wait = context.get_remaining_time_in_millis() / 1000 - 10 if hasattr(context, 'get_remaining_time_in_millis') else None
+        fitbit_data, status_map = fetch_all_fitbit_data(tokens['access_token'], date, max_wait=max_wait, rate_limiter=limiter, user_id=user_id)
+        if any(status == 401 for status in status_map.values()):
+            logger.info(f"401 が検出されたためトークンを取り直して再取得します: {status_map}")
+            tokens = token_manager.handle_unauthorized()
+            fitbit_data, status_map = fetch_all_fitbit_data(tokens['access_token'], date, max_wait=max_wait, rate_limiter=limiter, user_id=user_id)
         if all(status != 200 for status in status_map.values()):
-            logger.warning("Fitbit APIからの取得がすべて失敗しました: %s", status_map)
+            # 1件も取得できなかった日はサマリーを作らず、欠損日として次回の実行の補完で取り直す
+            logger.error(f"❌ Fitbit APIからの取得がすべて失敗しました (User ID: {user_id}): {status_map}")
+            return 502, {'error': 'All Fitbit API requests failed', 'date': date, 'status_map': status_map}
 
         # 4. S3に保存
         logger.info("💾 S3にデータを保存中...")
-        s3_paths = save_to_s3(yesterday, fitbit_data, context)
+        s3_paths = save_to_s3(date, fitbit_data, context, user_id=user_id)
 
-        logger.info("✅ 処理完了！")
+        # 5. 前回までの実行が失敗して欠けている日を、残り時間とレート制限の枠の範囲で補完
+        gap_result = None
+        if gap_lookback_days > 0:
+            gap_result = catch_up_gaps(token_manager, tokens['access_token'], date, context, limiter, gap_lookback_days)
 
-        # 成功レスポンス
-        return {
-            'statusCode': 200,
-            'body': json.dumps({
-                'message': 'Successfully exported Fitbit data',
-                'date': yesterday,
-                'files_saved': len(s3_paths),
-                's3_paths': s3_paths
-            })
-        }
+        # 6. 過去日の睡眠ログの差分同期（後から同期・編集されたログを拾う）
+        sleep_sync_result = None
+        if with_sleep_sync:
+            sleep_sync_result = sync_sleep_logs(token_manager, tokens['access_token'], date, context, limiter, max_wait)
 
-    except Exception as e:
-        logger.error(f"❌ エラーが発生しました: {str(e)}")
-        return {
-            'statusCode': 500,
-            'body': json.dumps({'error': str(e)})
-        }
-
-
-def get_fitbit_tokens():
-    """DynamoDBからトークンを取得"""
-    try:
-        dynamodb = boto3.resource('dynamodb')
-        table = dynamodb.Table(os.environ.get('DYNAMODB_TABLE', 'fitbit_tokens'))
+        logger.info(f"✅ 処理完了！ (User ID: {user_id})")
 
-        response = table.get_item(
-            Key={'user_id': os.environ.get('FITBIT_USER_ID', 'BGPGCR')}
-        )
+        # 成功レスポンス
+        body = {
+            'message': 'Successfully exported Fitbit data',
+            'date': date,
+            'files_saved': len(s3_paths),
+            's3_paths': s3_paths
+        }
+        if gap_result is not None:
+            body['gaps'] = gap_result
+        if sleep_sync_result is not None:
+            body['sleep_sync'] = sleep_sync_result
+        return 200, body
 
-        if 'Item' in response:
-            # Decimal型をintに変換
-            item = response['Item']
-            if 'expires_at' in item:
-                item['expires_at'] = int(item['expires_at'])
-            return item
+    except RateLimitExceeded as e:
+        logger.error(f"⏰ レート制限のため取得できませんでした (User ID: {user_id}): {str(e)}")
+        return 429, {'error': str(e), 'retry_after_seconds': int(e.wait_seconds)}
 
-        return None
     except Exception as e:
-        logger.error(f"DynamoDB error: {str(e)}")
-        return None
-
+        logger.error(f"❌ エラーが発生しました (User ID: {user_id}): {str(e)}")
+        return 500, {'error': str(e)}
 
-def is_token_expired(tokens):
-    """トークンが期限切れかチェック"""
-    try:
-        expires_at = tokens.get('expires_at', 0)
-        now = datetime.now().timestamp()
 
-        # 5分の余裕を持って判定
-        is_expired = now >= (expires_at - 300)
+def export_all_users(
+    date: str, context, with_sleep_sync: bool = False, gap_lookback_days: int = 0
+) -> Tuple[int, Dict[str, Any]]:
+    """
+    fitbit_tokens の全ユーザーを最大 USER_CONCURRENCY 人ずつ並列に処理する
 
-        if is_expired:
-            logger.info(f"トークン期限切れ: 現在={int(now)}, 期限={expires_at}")
+    ユーザーごとのトークン・レート制限は独立しているため、所要時間はユーザー数ではなく
+    「ユーザー数 ÷ 並列数」に比例する。ユーザーごとの結果をまとめて (ステータスコード, レスポンス本文) で返す。
+    """
+    user_ids = list_token_user_ids()
+    logger.info(f"👥 {len(user_ids)}人のユーザーを並列数{USER_CONCURRENCY}で処理します")
 
-        return is_expired
-    except Exception as e:
-        logger.error(f"期限チェックエラー: {str(e)}")
-        return True  # エラーの場合は期限切れとして扱う
+    with ThreadPoolExecutor(max_workers=USER_CONCURRENCY, thread_name_prefix='fitbit-user') as executor:
+        futures = {user_id: executor.submit(export_user, user_id, date, context, with_sleep_sync, gap_lookback_days) for user_id in user_ids}
+        results = {user_id: future.result() for user_id, future in futures.items()}
 
+    users = {
+        user_id: {'status_code': status_code, **body}
+        for user_id, (status_code, body) in results.items()
+    }
+    succeeded = [user_id for user_id, (status_code, _) in results.items() if status_code == 200]
+    failed = [user_id for user_id in user_ids if user_id not in succeeded]
+    if failed:
+        logger.warning(f"⚠️ 失敗したユーザー: {failed}")
+    logger.info(f"✅ 全ユーザーの処理完了（成功 {len(succeeded)} / 失敗 {len(failed)}）")
+
+    return 200 if not failed else 207, {
+        'message': 'Fitbit export finished for all users',
+        'date': date,
+        'user_count': len(user_ids),
+        'succeeded': succeeded,
+        'failed': failed,
+        'users': users
+    }
 
-def refresh_fitbit_token(refresh_token):
-    """トークンをリフレッシュ"""
-    try:
-        # Fitbitの認証情報
-        client_id = os.environ.get('FITBIT_CLIENT_ID', '23QQC2')
-        client_secret = os.environ.get('FITBIT_CLIENT_SECRET')
-
-        if not client_secret:
-            logger.error("FITBIT_CLIENT_SECRET環境変数が設定されていません")
-            return None
-
-        # Basic認証ヘッダーを作成
-        auth_string = f"{client_id}:{client_secret}"
-        auth_bytes = auth_string.encode('ascii')
-        auth_b64 = base64.b64encode(auth_bytes).decode('ascii')
-
-        # リフレッシュリクエスト
-        url = 'https://api.fitbit.com/oauth2/token'
-        headers = {
-            'Authorization': f'Basic {auth_b64}',
-            'Content-Type': 'application/x-www-form-urlencoded'
-        }
-        # URLエンコーディングして特殊文字を正しく処理
-        body = urlencode({
-            'grant_type': 'refresh_token',
-            'refresh_token': refresh_token
-        })
-
-        logger.info(f"📮 リフレッシュトークンでAPIを呼び出し中...")
-        response = http.request(
-            'POST',
-            url,
-            headers=headers,
-            body=body
-        )
-
-        if response.status == 200:
-            new_tokens = json.loads(response.data.decode('utf-8'))
-            logger.info("✅ 新しいトークンペアを取得成功")
-            logger.info(f"  新しいアクセストークンの有効期限: {new_tokens.get('expires_in', 0)}秒")
-
-            # DynamoDBに新しいトークンを保存
-            # 重要: Fitbitの仕様により、古いリフレッシュトークンは無効になるため
-            # 必ず新しいトークンを保存する
-            save_tokens_to_dynamodb(new_tokens)
-
-            return {
-                'access_token': new_tokens['access_token'],
-                'refresh_token': new_tokens['refresh_token'],  # 新しいリフレッシュトークン
-                'expires_at': int(datetime.now().timestamp() + new_tokens['expires_in']),
-                'user_id': new_tokens.get('user_id', 'BGPGCR')
-            }
-        elif response.status == 401:
-            # invalid_grant: トークンが無効または取り消された
-            error_data = json.loads(response.data.decode('utf-8')) if response.data else {}
-            error_type = error_data.get('errors', [{}])[0].get('errorType', 'unknown')
-
-            if error_type == 'invalid_grant':
-                logger.error("🔒 リフレッシュトークンが無効です。ユーザーの再認証が必要です。")
-                logger.error(f"  エラー詳細: {error_data}")
-                # TODO: 通知システムがあれば、ユーザーに再認証を促す通知を送る
-            else:
-                logger.error(f"❌ 認証エラー (401): {error_data}")
-            return None
-        else:
-            logger.error(f"❌ リフレッシュ失敗: {response.status}")
-            logger.error(f"  レスポンス: {response.data.decode('utf-8') if response.data else 'No data'}")
-            return None
 
-    except Exception as e:
-        logger.error(f"リフレッシュエラー: {str(e)}")
-        return None
+def catch_up_gaps(token_manager, access_token, date, context, rate_limiter, lookback_days) -> Dict[str, Any]:
+    """
+    date の前日から lookback_days 日遡り、_summary.json がない日を新しい日から順に取得して保存する
 
+    欠損日の検出は1回のプレフィックス一覧で行う。レート制限の枠は待たずに使える分だけ使い、
+    残り時間か枠が尽きたら残りの日は次回の実行に回す（その日はまだ欠損のままなので次回も検出される）。
+    """
+    user_id = token_manager.user_id
+    latest = datetime.strptime(date, '%Y-%m-%d').date() - timedelta(days=1)
+    earliest = latest - timedelta(days=lookback_days - 1)
+    s3 = aws_clients.client('s3')
+    bucket = raw_store.bucket_from_env()
+    prefix_user = _prefix_user(user_id)
+
+    ingested = s3_index.list_recent_ingested_dates(s3, bucket, earliest, latest, user_id=prefix_user)
+    missing = [
+        (earliest + timedelta(days=offset)).isoformat()
+        for offset in range(lookback_days)
+        if earliest + timedelta(days=offset) not in ingested
+    ]
+    result = {'missing_dates': missing, 'filled_dates': [], 'failed_dates': [], 'remaining_dates': []}
+    if not missing:
+        logger.info(f"🕳️ {earliest.isoformat()}〜{latest.isoformat()} に欠損日はありません")
+        return result
+    logger.info(f"🕳️ 欠損日を{len(missing)}日検出しました: {missing}")
+
+    # 鮮度を優先し、新しい日から補完する
+    pending = list(reversed(missing))
+    while pending:
+        remaining_seconds = context.get_remaining_time_in_millis() / 1000 if hasattr(context, 'get_remaining_time_in_millis') else None
+        if remaining_seconds is not None and remaining_seconds < GAP_TIME_MARGIN_SECONDS:
+            logger.warning(f"⏳ 残り時間が少ないため欠損日の補完を中断します（残り{len(pending)}日）")
+            break
+
+        day = pending[0]
+        try:
+            fitbit_data, status_map = fetch_all_fitbit_data(access_token, day, max_wait=0, rate_limiter=rate_limiter, user_id=user_id)
+        except RateLimitExceeded as e:
+            logger.warning(f"⏰ レート制限の枠がないため欠損日の補完を中断します（残り{len(pending)}日）: {str(e)}")
+            break
+        pending.pop(0)
 
-def save_tokens_to_dynamodb(token_data):
-    """新しいトークンをDynamoDBに保存"""
-    try:
-        dynamodb = boto3.resource('dynamodb')
-        table = dynamodb.Table(os.environ.get('DYNAMODB_TABLE', 'fitbit_tokens'))
-
-        expires_at = int(datetime.now().timestamp() + token_data['expires_in'])
-        current_time = datetime.now().isoformat()
-
-        table.put_item(
-            Item={
-                'user_id': os.environ.get('FITBIT_USER_ID', 'BGPGCR'),
-                'access_token': token_data['access_token'],
-                'refresh_token': token_data['refresh_token'],
-                'expires_at': expires_at,
-                'scope': token_data.get('scope', ''),
-                'updated_at': current_time,
-                'last_refresh_at': current_time  # リフレッシュ実行時刻を記録
-            }
-        )
-        logger.info("✅ 新しいトークンペアをDynamoDBに保存しました")
-        logger.info(f"  保存時刻: {current_time}")
-        logger.info(f"  有効期限: {datetime.fromtimestamp(expires_at).isoformat()}")
+        # 1件も取得できなかった日はサマリーを作らず、次回の実行で再度欠損として扱う
+        if all(status != 200 for status in status_map.values()):
+            logger.warning(f"⚠️ {day}の補完に失敗しました: {status_map}")
+            result['failed_dates'].append(day)
+            continue
+        try:
+            save_to_s3(day, fitbit_data, context, user_id=user_id)
+        except Exception as e:
+            logger.error(f"❌ {day}の保存に失敗しました: {str(e)}")
+            result['failed_dates'].append(day)
+            continue
+        result['filled_dates'].append(day)
 
-    except Exception as e:
-        logger.error(f"❌ トークン保存エラー: {str(e)}")
-        raise  # エラーを再発生させて呼び出し元に伝播
+    result['remaining_dates'] = sorted(pending)
+    logger.info(
+        f"🕳️ 欠損日の補完完了: 補完 {len(result['filled_dates'])}日 / 失敗 {len(result['failed_dates'])}日 / "
+        f"持ち越し {len(result['remaining_dates'])}日"
+    )
+    return result
 
 
-def fetch_all_fitbit_data(access_token, date) -> Tuple[Dict[str, Any | None], Dict[str, int]]:
-    """Fitbit APIから全データを取得し、HTTPステータスも返す"""
-    data: Dict[str, dict | None] = {}
-    status_map: Dict[str, int] = {}
+def sync_sleep_logs(token_manager, access_token, date, context, rate_limiter, max_wait=None) -> Dict[str, Any]:
+    """
+    sleep_sync_cursor から遡り期間を含めて睡眠ログ一覧を取得し、内容が変わった日だけ sleep を書き直す
 
-    endpoints = {
-        'sleep': f'/1.2/user/-/sleep/date/{date}.json',
-        'activity': f'/1/user/-/activities/date/{date}.json',
-        'heart_rate': f'/1/user/-/activities/heart/date/{date}/1d/1min.json',
-        'steps': f'/1/user/-/activities/steps/date/{date}/1d.json'
-    }
+    date（日次取得した日）は日付指定エンドポイントの結果を優先するため対象外。
+    _summary.json がない（まだ取り込んでいない）日も書かない。sleep だけのサマリーを作ると欠損日の補完・
+    バックフィルが取り込み済みとみなし、他のコレクションが取得されなくなるため（その日は欠損日の補完で全体を取得する）。
+    """
+    user_id = token_manager.user_id
+    cursor = (token_manager.tokens or {}).get(sleep_sync.CURSOR_ATTRIBUTE)
+    until = datetime.strptime(date, '%Y-%m-%d').date()
+    after = sleep_sync.after_date_for(cursor, until, sleep_sync.lookback_days_from_env())
+    logger.info(f"😴 睡眠ログの差分同期: afterDate={after.isoformat()} (cursor={cursor})")
 
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Accept': 'application/json'
+    try:
+        logs, status, complete = sleep_sync.fetch_logs_after(http, access_token, after, rate_limiter, max_wait, user_id=user_id)
+    except RateLimitExceeded as e:
+        logger.warning(f"⏰ レート制限のため睡眠ログの差分同期をスキップ: {str(e)}")
+        return {'status': 429, 'cursor': cursor, 'changed_dates': []}
+
+    days = sleep_sync.group_by_date(logs, after, until, complete)
+    s3 = aws_clients.client('s3')
+    bucket = raw_store.bucket_from_env()
+    prefix_user = _prefix_user(user_id)
+
+    changed_dates = []
+    not_ingested_dates = []
+    for day, payload in days.items():
+        manifest = content_hash.load_manifest(s3, bucket, raw_store.summary_key(day, prefix_user))
+        if manifest is None:
+            not_ingested_dates.append(day)
+            continue
+        # 内容が変わった日だけ書き直す（変わった日を結果に残すため、ここでも前回のハッシュと比べる）
+        previous = manifest.get('sleep')
+        if content_hash.is_unchanged(previous, content_hash.payload_hash(payload), raw_writer.format_for('sleep')):
+            continue
+        save_to_s3(day, {'sleep': payload}, context, user_id=user_id)
+        changed_dates.append(day)
+
+    new_cursor = sleep_sync.next_cursor(cursor, days)
+    if new_cursor and new_cursor != cursor:
+        sleep_sync.save_cursor(token_manager.table, user_id, new_cursor)
+
+    if not_ingested_dates:
+        logger.info(f"⏭️ 未取り込みの日は睡眠ログの差分同期で書きません（欠損日の補完で取得）: {not_ingested_dates}")
+    logger.info(f"😴 睡眠ログの差分同期完了: {len(logs)}件のログ / {len(days)}日を確認 / {len(changed_dates)}日を更新")
+    return {
+        'status': status,
+        'after_date': after.isoformat(),
+        'logs': len(logs),
+        'checked_days': len(days),
+        'changed_dates': changed_dates,
+        'not_ingested_dates': not_ingested_dates,
+        'cursor': new_cursor
     }
 
-    for data_type, endpoint in endpoints.items():
-        try:
-            logger.info(f"  📥 {data_type}データを取得中...")
 
-            url = f'https://api.fitbit.com{endpoint}'
-            response = http.request('GET', url, headers=headers)
-            status_map[data_type] = response.status
+def list_token_user_ids() -> List[str]:
+    """fitbit_tokens に登録されているユーザーIDの一覧（user_id のみを射影してスキャン）"""
+    table = aws_clients.table(os.environ.get('DYNAMODB_TABLE', 'fitbit_tokens'))
+    user_ids = []
+    scan_kwargs = {'ProjectionExpression': 'user_id'}
+    while True:
+        response = table.scan(**scan_kwargs)
+        user_ids.extend(item['user_id'] for item in response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return sorted(user_ids)
 
-            if response.status == 200:
-                data[data_type] = json.loads(response.data.decode('utf-8'))
-                logger.info(f"  ✅ {data_type}データ取得成功")
-            else:
-                logger.warning(f"  ⚠️ {data_type}データ取得失敗: {response.status}")
-                data[data_type] = None
 
-        except Exception as e:
-            logger.error(f"  ❌ {data_type}データ取得エラー: {str(e)}")
-            data[data_type] = None
-            status_map[data_type] = 0
-
-    return data, status_map
-
-
-def save_to_s3(date, data, context=None):
-    """データをS3に保存"""
-    s3 = boto3.client('s3')
-    bucket = os.environ.get('S3_BUCKET', os.environ.get('S3_BUCKET_NAME', 'moderation-craft-data-800860245583'))
-
-    # 日付をパース
-    date_obj = datetime.strptime(date, '%Y-%m-%d')
-    year = date_obj.year
-    month = f"{date_obj.month:02d}"
-    day = f"{date_obj.day:02d}"
-
-    saved_files = []
-
-    # 各データタイプを個別に保存
-    for data_type, content in data.items():
-        if content is not None:
-            try:
-                # S3キー（パス）を作成
-                key = f"raw/fitbit/year={year}/month={month}/day={day}/{data_type}_{date.replace('-', '')}.json"
-
-                # メタデータを追加
-                enriched_data = {
-                    'metadata': {
-                        'extraction_timestamp': datetime.now().isoformat(),
-                        'data_date': date,
-                        'data_type': data_type,
-                        'source': 'fitbit_api',
-                        'lambda_execution_id': context.aws_request_id if context else 'local_test'
-                    },
-                    'data': content
-                }
-
-                # S3に保存
-                s3.put_object(
-                    Bucket=bucket,
-                    Key=key,
-                    Body=json.dumps(enriched_data, indent=2),
-                    ContentType='application/json',
-                    Metadata={
-                        'data-date': date,
-                        'data-type': data_type
-                    }
-                )
-
-                saved_files.append(f"s3://{bucket}/{key}")
-                logger.info(f"  ✅ {data_type}を保存: {key}")
-
-            except Exception as e:
-                logger.error(f"  ❌ {data_type}の保存エラー: {str(e)}")
-
-    # サマリーファイルを作成
-    try:
-        summary_key = f"raw/fitbit/year={year}/month={month}/day={day}/_summary.json"
-        summary_data = {
-            'extraction_date': datetime.now().isoformat(),
-            'data_date': date,
-            'files_created': len(saved_files),
-            'data_types': list(data.keys()),
-            'status': 'success' if saved_files else 'partial',
-            'files': saved_files
-        }
-
-        s3.put_object(
-            Bucket=bucket,
-            Key=summary_key,
-            Body=json.dumps(summary_data, indent=2),
-            ContentType='application/json'
-        )
+def _all_users_enabled(event) -> bool:
+    if isinstance(event, dict) and 'all_users' in event:
+        return bool(event['all_users'])
+    return os.environ.get('FITBIT_DAILY_ALL_USERS', 'false').lower() in ('1', 'true', 'yes')
 
-        logger.info(f"📋 サマリーファイルを保存: {summary_key}")
 
-    except Exception as e:
-        logger.error(f"サマリーファイル保存エラー: {str(e)}")
-
-    return saved_files
+def _gap_lookback_days(event) -> int:
+    """イベントの gap_lookback_days、なければ FITBIT_GAP_LOOKBACK_DAYS"""
+    if isinstance(event, dict) and 'gap_lookback_days' in event:
+        try:
+            return max(0, min(int(event['gap_lookback_days']), 90))
+        except (TypeError, ValueError):
+            logger.warning(f"⚠️ gap_lookback_days が不正なため既定値を使います: {event['gap_lookback_days']}")
+    return GAP_LOOKBACK_DAYS
+
+
+def rate_limiter_for(user_id: str) -> FitbitRateLimiter:
+    """ユーザーごとのリミッター（ウォーム起動をまたいで同じ時間枠を共有する）"""
+    if user_id == PRIMARY_USER_ID:
+        return fitbit_rate_limiter
+    with _user_rate_limiters_lock:
+        if user_id not in _user_rate_limiters:
+            _user_rate_limiters[user_id] = rate_limiter_from_env()
+        return _user_rate_limiters[user_id]
+
+
+def fetch_all_fitbit_data(access_token, date, max_wait=None, rate_limiter=None, collections=None, user_id=None) -> Tuple[Dict[str, Any | None], Dict[str, int]]:
+    """Fitbit APIから全データ（collections を渡した場合はそのコレクションだけ）を取得し、HTTPステータスも返す"""
+    # 他のコレクションのレスポンスに含まれるデータ（steps は activity の summary）は呼ばずに組み立てる
+    plan = fitbit_collections.plan_day(date, collections or COLLECTIONS)
+
+    # エンドポイントを並列に取得し、1日あたりの待ち時間を約1往復分に抑える
+    fitbit_data, status_map = fitbit_api.fetch_endpoints(
+        http,
+        access_token,
+        plan.endpoints,
+        max_workers=FETCH_CONCURRENCY,
+        rate_limiter=rate_limiter or fitbit_rate_limiter,
+        max_wait=max_wait,
+        user_id=user_id or PRIMARY_USER_ID
+    )
+    return plan.complete(fitbit_data, status_map)
+
+
+def save_to_s3(date, data, context=None, user_id: Optional[str] = None):
+    """データをS3に保存（主ユーザー以外は user_id= パーティションの下に保存）"""
+    return raw_store.save_day(
+        date,
+        data,
+        execution_id=context.aws_request_id if context else 'local_test',
+        user_id=_prefix_user(user_id),
+        metadata={'user_id': user_id or PRIMARY_USER_ID}
+    )
+
+
+def _prefix_user(user_id: Optional[str]) -> Optional[str]:
+    """S3の user_id= パーティション（主ユーザーは従来どおりパーティションなし）"""
+    return None if user_id in (None, PRIMARY_USER_ID) else user_id
 
 
 # ローカルテスト用
@@ -6,12 +6,17 @@ Fitbitトークンを手動でリフレッシュするスクリプト
 
 import os
 import sys
-import json
-import base64
+import logging
 import urllib3
 from datetime import datetime
-import boto3
-from decimal import Decimal
+
+# トークンのリフレッシュは共有モジュール（lambda-fitbit-shared）の FitbitTokenManager で行う
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda-fitbit-shared'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'ap-northeast-1')
+from token_manager import FitbitTokenManager, TokenRefreshError  # noqa: E402
+
+# FitbitTokenManager のログもそのまま表示する
+logging.basicConfig(level=logging.INFO, format='   %(message)s')
 
 # urllib3の警告を無効化
 urllib3.disable_warnings()
@@ -32,92 +37,22 @@ def load_env():
         print("❌ .env.localが見つかりません")
         sys.exit(1)
 
-def get_current_tokens():
-    """DynamoDBから現在のトークンを取得"""
-    try:
-        dynamodb = boto3.resource('dynamodb', region_name='ap-northeast-1')
-        table = dynamodb.Table('fitbit_tokens')
-
-        response = table.get_item(
-            Key={'user_id': 'BGPGCR'}
-        )
-
-        if 'Item' in response:
-            return response['Item']
-        return None
-    except Exception as e:
-        print(f"❌ DynamoDB取得エラー: {str(e)}")
-        return None
-
-def refresh_token(refresh_token_value):
-    """トークンをリフレッシュ"""
-    client_id = os.environ.get('FITBIT_CLIENT_ID', '23QQC2')
-    client_secret = os.environ.get('FITBIT_CLIENT_SECRET')
+def refresh_tokens(token_manager):
+    """
+    Lambdaと同じリフレッシュ権・version の条件付き更新でトークンをリフレッシュ
 
-    if not client_secret:
-        print("❌ FITBIT_CLIENT_SECRETが設定されていません")
-        return None
-
-    # Basic認証ヘッダーを作成
-    auth_string = f"{client_id}:{client_secret}"
-    auth_bytes = auth_string.encode('ascii')
-    auth_b64 = base64.b64encode(auth_bytes).decode('ascii')
-
-    url = 'https://api.fitbit.com/oauth2/token'
-    headers = {
-        'Authorization': f'Basic {auth_b64}',
-        'Content-Type': 'application/x-www-form-urlencoded'
-    }
-    body = f'grant_type=refresh_token&refresh_token={refresh_token_value}'
-
-    print(f"📮 Fitbit APIにリフレッシュリクエストを送信中...")
-    print(f"   Client ID: {client_id}")
-    print(f"   Client Secret: {client_secret[:10]}...")
-
-    response = http.request(
-        'POST',
-        url,
-        headers=headers,
-        body=body
-    )
-
-    if response.status == 200:
-        new_tokens = json.loads(response.data.decode('utf-8'))
-        print("✅ 新しいトークンペアを取得しました")
-        return new_tokens
-    else:
-        error_data = json.loads(response.data.decode('utf-8')) if response.data else {}
-        print(f"❌ リフレッシュ失敗 (Status: {response.status})")
-        print(f"   エラー: {json.dumps(error_data, indent=2)}")
+    Lambdaが同時にリフレッシュしている場合はその結果を待って使うため、
+    1回しか使えないリフレッシュトークンを二重に使うことはない。
+    """
+    try:
+        tokens = token_manager.refresh()
+    except TokenRefreshError as e:
+        print(f"❌ リフレッシュ失敗: {str(e)}")
         return None
 
-def save_to_dynamodb(token_data):
-    """新しいトークンをDynamoDBに保存"""
-    try:
-        dynamodb = boto3.resource('dynamodb', region_name='ap-northeast-1')
-        table = dynamodb.Table('fitbit_tokens')
-
-        expires_at = int(datetime.now().timestamp() + token_data['expires_in'])
-        current_time = datetime.now().isoformat()
-
-        table.put_item(
-            Item={
-                'user_id': 'BGPGCR',
-                'access_token': token_data['access_token'],
-                'refresh_token': token_data['refresh_token'],
-                'expires_at': Decimal(expires_at),
-                'scope': token_data.get('scope', ''),
-                'updated_at': current_time,
-                'last_refresh_at': current_time
-            }
-        )
-        print("✅ 新しいトークンをDynamoDBに保存しました")
-        print(f"   保存時刻: {current_time}")
-        print(f"   有効期限: {datetime.fromtimestamp(expires_at).isoformat()}")
-        return True
-    except Exception as e:
-        print(f"❌ DynamoDB保存エラー: {str(e)}")
-        return False
+    print(f"   version: {token_manager.version}")
+    print(f"   有効期限: {datetime.fromtimestamp(int(tokens['expires_at'])).isoformat()}")
+    return tokens
 
 def main():
     print("============================================")
@@ -130,7 +65,12 @@ def main():
 
     # 現在のトークンを取得
     print("📋 現在のトークン情報を取得中...")
-    current_tokens = get_current_tokens()
+    token_manager = FitbitTokenManager.from_env(http)
+    try:
+        current_tokens = token_manager.load()
+    except Exception as e:
+        print(f"❌ DynamoDB取得エラー: {str(e)}")
+        current_tokens = None
 
     if not current_tokens:
         print("❌ DynamoDBにトークンが見つかりません")
@@ -141,21 +81,17 @@ def main():
     print(f"   User ID: {current_tokens.get('user_id')}")
     print(f"   最終更新: {current_tokens.get('updated_at', '不明')}")
     print(f"   有効期限: {datetime.fromtimestamp(int(current_tokens.get('expires_at', 0))).isoformat()}")
+    print(f"   version: {token_manager.version}")
     print()
 
     # リフレッシュを実行
     print("🔄 トークンをリフレッシュします...")
-    new_tokens = refresh_token(current_tokens['refresh_token'])
+    new_tokens = refresh_tokens(token_manager)
 
     if new_tokens:
-        # DynamoDBに保存
-        if save_to_dynamodb(new_tokens):
-            print()
-            print("✅ トークンのリフレッシュが完了しました！")
-            print("   Lambda関数を再度実行してデータ取得をテストしてください")
-        else:
-            print("❌ トークンの保存に失敗しました")
-            sys.exit(1)
+        print()
+        print("✅ トークンのリフレッシュが完了しました！")
+        print("   Lambda関数を再度実行してデータ取得をテストしてください")
     else:
         print()
         print("❌ トークンのリフレッシュに失敗しました")
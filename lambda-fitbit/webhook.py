@@ -0,0 +1,327 @@
+"""
+Fitbitサブスクリプション通知（Webhook）のLambda
+
+日次エクスポート（lambda_function）と同じパッケージに含め、ハンドラー webhook.lambda_handler の
+別関数として Lambda関数URL の後ろに置く。
+- GET ?verify=<code>: サブスクライバーの検証（FITBIT_SUBSCRIBER_VERIFY_CODE と一致すれば 204、違えば 404）
+- POST: 通知（collectionType, date, ownerId の配列）。署名を検証して fitbit_webhook_pending にまとめ、すぐに 204 を返す
+- {"webhook_drain": true}: 取得処理。まとめる時間（FITBIT_WEBHOOK_COALESCE_SECONDS）が過ぎた通知から順に、
+  変更があったコレクション・日付だけを日次エクスポートと同じ fetch_all_fitbit_data / save_to_s3 で取得・保存する
+
+Fitbitは通知から5秒以内に応答しないと再送・停止するため、POST では取得せず、新しい通知があったとき
+（または取得されずに残っていた項目に通知がまとめられたとき）だけ自分自身を非同期（InvocationType=Event）で
+drain として起動する。drain はリースで同時に1つだけ動く。
+"""
+import base64
+import hashlib
+import json
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from botocore.exceptions import ClientError
+
+# lambda_function が共有モジュールへのパスを通す（ローカル実行時）
+import lambda_function
+import aws_clients
+import content_hash
+import fitbit_collections
+import metrics
+import raw_store
+import webhook_queue
+from rate_limiter import RateLimitExceeded
+from token_manager import FitbitTokenManager, TokenRefreshError
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+COALESCE_SECONDS = webhook_queue.coalesce_seconds_from_env()
+
+# drain が通知を待つ上限（これより先の通知は次の drain に任せる）と、取得・保存のために残す時間
+DRAIN_MAX_WAIT_SECONDS = max(COALESCE_SECONDS * 2, 60)
+DRAIN_TIME_MARGIN_SECONDS = 20
+# 取得に失敗した通知を取得待ちに戻すまでの秒数
+FAILURE_RETRY_SECONDS = 120
+# 待ち時間の上限より先の通知（レート制限・失敗で延期した項目など）は、その時刻に drain を起動する
+# 一回限りのスケジュールを EventBridge Scheduler に作成する。未設定なら次の通知で drain が起動するのを待つ
+SCHEDULER_ROLE_ARN = os.environ.get('FITBIT_WEBHOOK_SCHEDULER_ROLE_ARN')
+SCHEDULE_NAME_PREFIX = 'fitbit-webhook-drain-'
+# 取得待ちのインデックス（GSI）に取得・削除済みの項目しか見えないときに待つ秒数
+INDEX_LAG_SLEEP_SECONDS = 1
+
+
+def lambda_handler(event, context):
+    """Fitbitサブスクリプション通知の受信（HTTP）と取得処理（drain）"""
+    metrics.start_invocation('fitbit-webhook')
+    try:
+        if isinstance(event, dict) and event.get('webhook_drain'):
+            status_code, body = drain(context)
+            body['metrics'] = metrics.summary()
+            return {'statusCode': status_code, 'body': json.dumps(body)}
+        return handle_http(event or {}, context)
+    finally:
+        metrics.flush(context)
+
+
+def handle_http(event: Dict[str, Any], context) -> Dict[str, Any]:
+    """関数URL / API Gateway のリクエストを処理する（本文は Fitbit の仕様どおり空で返す）"""
+    method = (event.get('requestContext', {}).get('http', {}).get('method') or event.get('httpMethod') or 'GET').upper()
+    if method == 'GET':
+        verify = (event.get('queryStringParameters') or {}).get('verify')
+        expected = os.environ.get('FITBIT_SUBSCRIBER_VERIFY_CODE')
+        if expected and verify == expected:
+            logger.info("✅ サブスクライバーの検証に応答しました")
+            return {'statusCode': 204}
+        logger.warning("⚠️ サブスクライバーの検証コードが一致しません")
+        return {'statusCode': 404}
+
+    if method != 'POST':
+        return {'statusCode': 405}
+
+    body = event.get('body') or ''
+    body_bytes = base64.b64decode(body) if event.get('isBase64Encoded') else body.encode('utf-8')
+    headers = {name.lower(): value for name, value in (event.get('headers') or {}).items()}
+    if not webhook_queue.verify_signature(body_bytes, headers.get('x-fitbit-signature'), os.environ.get('FITBIT_CLIENT_SECRET', '')):
+        # Fitbitは署名が合わない通知に 404 を返すことを求めている
+        logger.warning("⚠️ X-Fitbit-Signature が一致しないため通知を破棄します")
+        return {'statusCode': 404}
+
+    notifications = webhook_queue.parse_notifications(body_bytes)
+    accepted, coalesced = enqueue_notifications(notifications)
+    logger.info(f"📨 通知 {len(notifications)}件を受信（drain の起動対象 {accepted}件 / まとめた {coalesced}件）")
+    if accepted:
+        start_drain(context)
+    return {'statusCode': 204}
+
+
+def enqueue_notifications(notifications: List[Dict[str, str]]) -> Tuple[int, int]:
+    """取得対象の通知を fitbit_webhook_pending に記録し、(drain の起動が必要な通知数, まとめた通知数) を返す"""
+    queue = webhook_queue.PendingQueue.from_env()
+    accepted = coalesced = 0
+    for notification in notifications:
+        collection_type = notification['collection_type']
+        if not fitbit_collections.for_subscription(collection_type, lambda_function.COLLECTIONS):
+            logger.info(f"⏭️ 取得対象外の通知です: {collection_type} (ownerId: {notification['owner_id']})")
+            continue
+        if queue.enqueue(notification['owner_id'], collection_type, notification['date'], COALESCE_SECONDS):
+            accepted += 1
+        else:
+            coalesced += 1
+    return accepted, coalesced
+
+
+def start_drain(context) -> bool:
+    """drain が動いていなければ自分自身を非同期で起動する（ローカル実行では起動しない）"""
+    function_arn = getattr(context, 'invoked_function_arn', None)
+    if not function_arn:
+        logger.info("⏸️ ローカル実行のため drain を起動しません（{\"webhook_drain\": true} で実行してください）")
+        return False
+    aws_clients.client('lambda').invoke(
+        FunctionName=function_arn,
+        InvocationType='Event',
+        Payload=json.dumps({'webhook_drain': True}).encode('utf-8'),
+    )
+    logger.info("🔁 通知の取得処理（drain）を起動しました")
+    return True
+
+
+def schedule_drain(context, due_at: float) -> Optional[str]:
+    """due_at（epoch秒）に drain を起動する一回限りのスケジュールを作成し、起動時刻（UTC）を返す"""
+    function_arn = getattr(context, 'invoked_function_arn', None)
+    if not function_arn or not SCHEDULER_ROLE_ARN:
+        logger.info("⏸️ drain の起動を予約できないため、次の通知（または手動の drain）で取得します")
+        return None
+    drain_at = datetime.fromtimestamp(int(due_at) + 1, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+    # 同じ時刻の予約は1つにまとめる（名前は64文字以内・英数字と -_. のみ）
+    function_hash = hashlib.sha256(function_arn.encode('utf-8')).hexdigest()[:12]
+    name = f"{SCHEDULE_NAME_PREFIX}{function_hash}-{drain_at.replace(':', '').replace('-', '')}"
+    try:
+        aws_clients.client('scheduler').create_schedule(
+            Name=name,
+            ScheduleExpression=f"at({drain_at})",
+            ScheduleExpressionTimezone='UTC',
+            FlexibleTimeWindow={'Mode': 'OFF'},
+            Target={
+                'Arn': function_arn,
+                'RoleArn': SCHEDULER_ROLE_ARN,
+                'Input': json.dumps({'webhook_drain': True}),
+            },
+            # 起動後にスケジュールを削除する
+            ActionAfterCompletion='DELETE',
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConflictException':
+            raise
+        logger.info(f"⏰ {drain_at} UTC の drain は予約済みです: {name}")
+        return drain_at
+    logger.info(f"⏰ {drain_at} UTC に drain を予約しました: {name}")
+    return drain_at
+
+
+def drain(context) -> Tuple[int, Dict[str, Any]]:
+    """
+    まとめる時間が過ぎた通知を、ユーザー・日付ごとに1回の取得で処理する
+
+    取得待ちがなくなるか、残り時間・待ち時間の上限に達するまで繰り返す。終了時にリースを解放してから
+    取得待ちを確認し直し、その間に届いた通知があれば処理を続ける（取りこぼしを防ぐ）。
+    """
+    queue = webhook_queue.PendingQueue.from_env()
+    lease_seconds = _remaining_seconds(context) or 900
+    if not queue.acquire_drain_lease(lease_seconds):
+        logger.info("⏭️ 別の drain が実行中のため終了します")
+        return 200, {'message': 'Another drain is running', 'ingested': [], 'failed': []}
+
+    result: Dict[str, Any] = {'ingested': [], 'skipped': [], 'failed': [], 'requeued': [], 'pending': 0}
+    holding_lease = True
+    try:
+        while True:
+            stop_reason = _drain_due(queue, context, result)
+            if stop_reason is not None:
+                result['stop_reason'] = stop_reason
+                break
+            queue.release_drain_lease()
+            holding_lease = False
+            # リースの解放前に届いた通知は新しい drain を起動しないため、ここで拾う
+            if not queue.pending_items() or not queue.acquire_drain_lease(lease_seconds):
+                break
+            holding_lease = True
+    finally:
+        if holding_lease:
+            queue.release_drain_lease()
+
+    pending = queue.pending_items()
+    result['pending'] = len(pending)
+    if pending and result.get('stop_reason') == 'timeout':
+        start_drain(context)
+    elif pending and result.get('stop_reason') == 'wait_limit':
+        # すぐに起動し直すと、次の通知の due_at まで drain が起動を繰り返すだけになる
+        result['drain_at'] = schedule_drain(context, min(item['due_at'] for item in pending))
+    logger.info(f"📦 通知の取得結果: {json.dumps(result, ensure_ascii=False)}")
+    return (200 if not result['failed'] else 207), {'message': 'Webhook drain finished', **result}
+
+
+def _drain_due(queue: webhook_queue.PendingQueue, context, result: Dict[str, Any]) -> Optional[str]:
+    """取得待ちがなくなるまで処理する。途中で打ち切った場合はその理由を返す"""
+    while True:
+        items = queue.pending_items()
+        if not items:
+            return None
+
+        now = time.time()
+        due = [item for item in items if item['due_at'] <= now]
+        remaining = _remaining_seconds(context)
+        if not due:
+            wait = items[0]['due_at'] - now
+            if wait > DRAIN_MAX_WAIT_SECONDS:
+                return 'wait_limit'
+            if remaining is not None and wait > remaining - DRAIN_TIME_MARGIN_SECONDS:
+                return 'timeout'
+            time.sleep(wait)
+            metrics.record_sleep('webhook_coalesce', wait)
+            continue
+        if remaining is not None and remaining < DRAIN_TIME_MARGIN_SECONDS:
+            return 'timeout'
+
+        # 同じユーザー・日付の通知（activities と sleep など）は1回の取得にまとめる
+        groups: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+        for item in due:
+            if queue.claim(item):
+                groups.setdefault((item['user_id'], item['date']), []).append(item)
+        if not groups:
+            # インデックスが直前の取得・削除をまだ反映していない
+            time.sleep(INDEX_LAG_SLEEP_SECONDS)
+            continue
+
+        for (user_id, date), group in groups.items():
+            collection_types = sorted({item['collection_type'] for item in group})
+            label = f"{user_id}/{date}/{'+'.join(collection_types)}"
+            try:
+                saved = ingest(user_id, date, collection_types, context)
+            except RateLimitExceeded as e:
+                logger.warning(f"⏰ レート制限のため {label} の取得を延期します: {str(e)}")
+                for item in group:
+                    queue.release(item, retry_in=e.wait_seconds, reset_attempts=True)
+                result['requeued'].append(label)
+                continue
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error(f"❌ {label} の取得でエラー: {str(e)}")
+                saved = None
+
+            if saved is None:
+                for item in group:
+                    queue.release(item, retry_in=FAILURE_RETRY_SECONDS)
+                result['failed'].append(label)
+                continue
+            if not saved:
+                for item in group:
+                    queue.discard(item)
+                result['skipped'].append(label)
+                continue
+            for item in group:
+                if not queue.complete(item, COALESCE_SECONDS):
+                    result['requeued'].append(label)
+            result['ingested'].append(label)
+
+
+def ingest(user_id: str, date: str, collection_types: List[str], context) -> Optional[bool]:
+    """
+    通知されたコレクション・日付だけを取得して保存する
+
+    戻り値は、保存した（True）/ 取得対象がない・トークンのないユーザー（False）/ 取得に失敗した（None）。
+    内容が前回と同じデータタイプは save_to_s3 が書き込みを省く。
+
+    まだ _summary.json がない日は、通知されたコレクションだけのサマリーを作ると欠損日の補完・バックフィルが
+    取り込み済みとみなすため、日次エクスポートと同じく全コレクションを取得する。
+    """
+    collections = [
+        collection
+        for collection_type in collection_types
+        for collection in fitbit_collections.for_subscription(collection_type, lambda_function.COLLECTIONS)
+    ]
+    if not collections:
+        return False
+    summary_key = raw_store.summary_key(date, lambda_function._prefix_user(user_id))
+    if content_hash.load_manifest(aws_clients.client('s3'), raw_store.bucket_from_env(), summary_key) is None:
+        logger.info(f"🆕 {user_id}/{date} は未取り込みのため全コレクションを取得します")
+        collections = list(lambda_function.COLLECTIONS)
+
+    token_manager = FitbitTokenManager.from_env(lambda_function.http, user_id=user_id)
+    try:
+        tokens = token_manager.get_valid_tokens()
+    except TokenRefreshError as e:
+        logger.error(f"❌ トークンのリフレッシュに失敗 (User ID: {user_id}): {str(e)}")
+        return None
+    if not tokens:
+        logger.warning(f"⚠️ トークンのないユーザーの通知です (User ID: {user_id})")
+        return False
+
+    limiter = lambda_function.rate_limiter_for(user_id)
+    max_wait = max(0.0, (_remaining_seconds(context) or 60) - DRAIN_TIME_MARGIN_SECONDS)
+    fitbit_data, status_map = lambda_function.fetch_all_fitbit_data(
+        tokens['access_token'], date, max_wait=max_wait, rate_limiter=limiter, collections=collections, user_id=user_id
+    )
+    if any(status == 401 for status in status_map.values()):
+        logger.info(f"401 が検出されたためトークンを取り直して再取得します: {status_map}")
+        tokens = token_manager.handle_unauthorized()
+        fitbit_data, status_map = lambda_function.fetch_all_fitbit_data(
+            tokens['access_token'], date, max_wait=max_wait, rate_limiter=limiter, collections=collections, user_id=user_id
+        )
+    if any(status == 429 for status in status_map.values()):
+        raise RateLimitExceeded(limiter.seconds_until_reset())
+    if all(status != 200 for status in status_map.values()):
+        logger.warning(f"⚠️ {user_id}/{date} の取得がすべて失敗しました: {status_map}")
+        return None
+
+    # 取得できなかったコレクションは保存せず、_summary.json には前回の内容を引き継ぐ
+    saved = {data_type: data for data_type, data in fitbit_data.items() if status_map.get(data_type) == 200}
+    lambda_function.save_to_s3(date, saved, context, user_id=user_id)
+    logger.info(f"✅ {user_id}/{date} の {', '.join(saved)} を取り込みました")
+    return True
+
+
+def _remaining_seconds(context) -> Optional[float]:
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return None
+    return context.get_remaining_time_in_millis() / 1000
@@ -107,19 +107,29 @@ def save_to_dynamodb(token_data):
     # 有効期限を計算
     expires_at = datetime.now() + timedelta(seconds=token_data.get('expires_in', 28800))
     
-    # DynamoDBに保存するアイテム
-    item = {
-        'user_id': USER_ID,
-        'access_token': token_data['access_token'],
-        'refresh_token': token_data.get('refresh_token', ''),
-        'expires_at': int(expires_at.timestamp()),
-        'scope': token_data.get('scope', ''),
-        'updated_at': datetime.now().isoformat(),
-        'created_at': datetime.now().isoformat()
-    }
-    
+    # トークンの属性だけを更新する（put_item で項目ごと置き換えると、同じ項目にある
+    # 睡眠同期カーソル sleep_sync_cursor などが消えてしまう）
+    # version を進めて、実行中のLambdaが古いリフレッシュトークンの結果で上書きしないようにする
+    now = datetime.now().isoformat()
     try:
-        table.put_item(Item=item)
+        table.update_item(
+            Key={'user_id': USER_ID},
+            UpdateExpression=(
+                'SET access_token = :access_token, refresh_token = :refresh_token, expires_at = :expires_at, '
+                '#scope = :scope, updated_at = :now, created_at = if_not_exists(created_at, :now) '
+                'ADD #version :one '
+                'REMOVE refresh_claim, refresh_claim_expires'
+            ),
+            ExpressionAttributeNames={'#scope': 'scope', '#version': 'version'},
+            ExpressionAttributeValues={
+                ':access_token': token_data['access_token'],
+                ':refresh_token': token_data.get('refresh_token', ''),
+                ':expires_at': int(expires_at.timestamp()),
+                ':scope': token_data.get('scope', ''),
+                ':now': now,
+                ':one': 1
+            }
+        )
         print(f"\n✅ トークンをDynamoDBに保存しました！")
         print(f"   テーブル: {DYNAMODB_TABLE}")
         print(f"   ユーザーID: {USER_ID}")
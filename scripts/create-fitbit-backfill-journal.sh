@@ -0,0 +1,32 @@
+#!/bin/bash
+
+# Fitbitバックフィル（コーディネーターモード）の進捗ジャーナル用テーブルを作成
+
+TABLE_NAME="fitbit_backfill_journal"
+REGION="ap-northeast-1"
+
+echo "${TABLE_NAME} を作成します..."
+
+aws dynamodb describe-table --table-name $TABLE_NAME --region $REGION >/dev/null 2>&1
+if [ $? -eq 0 ]; then
+  echo "${TABLE_NAME} は既に存在します。"
+  exit 0
+fi
+
+# job_id ごとにジョブ項目（item_key=job）とシャード項目（item_key=shard#NNNN）を保存する
+aws dynamodb create-table \
+  --table-name $TABLE_NAME \
+  --region $REGION \
+  --attribute-definitions \
+    AttributeName=job_id,AttributeType=S \
+    AttributeName=item_key,AttributeType=S \
+  --key-schema \
+    AttributeName=job_id,KeyType=HASH \
+    AttributeName=item_key,KeyType=RANGE \
+  --billing-mode PAY_PER_REQUEST >/dev/null
+
+echo ""
+echo "テーブル作成リクエストを送信しました。"
+echo ""
+echo "ステータス確認コマンド:"
+echo "aws dynamodb describe-table --table-name $TABLE_NAME --region $REGION --query 'Table.TableStatus' --output text"
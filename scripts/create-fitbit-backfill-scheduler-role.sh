@@ -0,0 +1,48 @@
+#!/bin/bash
+
+# Fitbitバックフィル（コーディネーターモード）がレート制限のリセット後に再開するための
+# EventBridge Scheduler の実行ロールを作成
+# Webhook Lambda の drain（延期した通知の取得）の予約にも同じロールを使う
+
+ROLE_NAME="fitbit-backfill-scheduler-role"
+REGION="ap-northeast-1"
+ACCOUNT_ID="800860245583"
+FUNCTION_ARN="arn:aws:lambda:${REGION}:${ACCOUNT_ID}:function:moderation-craft-fitbit-backfill"
+WEBHOOK_FUNCTION_ARN="arn:aws:lambda:${REGION}:${ACCOUNT_ID}:function:moderation-craft-fitbit-webhook"
+
+echo "${ROLE_NAME} を作成します..."
+
+aws iam get-role --role-name $ROLE_NAME >/dev/null 2>&1
+if [ $? -eq 0 ]; then
+  echo "${ROLE_NAME} は既に存在します。起動できる関数のポリシーだけ更新します。"
+else
+  aws iam create-role \
+    --role-name $ROLE_NAME \
+    --assume-role-policy-document '{
+      "Version": "2012-10-17",
+      "Statement": [{
+        "Effect": "Allow",
+        "Principal": {"Service": "scheduler.amazonaws.com"},
+        "Action": "sts:AssumeRole",
+        "Condition": {"StringEquals": {"aws:SourceAccount": "'"$ACCOUNT_ID"'"}}
+      }]
+    }' >/dev/null
+fi
+
+# 予約した時刻にバックフィル・Webhook のLambdaを起動する権限だけを付与する
+aws iam put-role-policy \
+  --role-name $ROLE_NAME \
+  --policy-name invoke-fitbit-backfill \
+  --policy-document '{
+    "Version": "2012-10-17",
+    "Statement": [{
+      "Effect": "Allow",
+      "Action": "lambda:InvokeFunction",
+      "Resource": ["'"$FUNCTION_ARN"'", "'"$WEBHOOK_FUNCTION_ARN"'"]
+    }]
+  }'
+
+echo ""
+echo "ロールを作成しました。各Lambdaの環境変数に設定してください（deploy.sh / deploy-webhook.sh が設定します）:"
+echo "FITBIT_BACKFILL_SCHEDULER_ROLE_ARN=arn:aws:iam::${ACCOUNT_ID}:role/${ROLE_NAME}"
+echo "FITBIT_WEBHOOK_SCHEDULER_ROLE_ARN=arn:aws:iam::${ACCOUNT_ID}:role/${ROLE_NAME}"
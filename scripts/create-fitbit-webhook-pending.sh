@@ -0,0 +1,76 @@
+#!/bin/bash
+
+# Fitbitサブスクリプション通知（Webhook）の取得待ちキュー用テーブルを作成
+# 既にテーブルがあり、取得待ちのインデックス（due_at-index）がなければ追加する
+
+TABLE_NAME="fitbit_webhook_pending"
+INDEX_NAME="due_at-index"
+REGION="ap-northeast-1"
+
+# 取得待ちの項目だけが queue=pending を持ち、drain は due_at 順に Query する
+# drain の実行中リース（user_id=item_key=__drain__）は queue を持たないためインデックスに載らない
+INDEX_DEFINITION='{
+  "IndexName": "due_at-index",
+  "KeySchema": [
+    {"AttributeName": "queue", "KeyType": "HASH"},
+    {"AttributeName": "due_at", "KeyType": "RANGE"}
+  ],
+  "Projection": {
+    "ProjectionType": "ALL"
+  }
+}'
+
+echo "${TABLE_NAME} を作成します..."
+
+aws dynamodb describe-table --table-name $TABLE_NAME --region $REGION >/dev/null 2>&1
+if [ $? -eq 0 ]; then
+  echo "${TABLE_NAME} は既に存在します。"
+  EXISTING_INDEX=$(aws dynamodb describe-table \
+    --table-name $TABLE_NAME \
+    --region $REGION \
+    --query "Table.GlobalSecondaryIndexes[?IndexName=='${INDEX_NAME}'].IndexName" \
+    --output text)
+  if [ -n "$EXISTING_INDEX" ] && [ "$EXISTING_INDEX" != "None" ]; then
+    echo "${INDEX_NAME} も既に存在します。"
+    exit 0
+  fi
+
+  echo "${INDEX_NAME} を追加します..."
+  aws dynamodb update-table \
+    --table-name $TABLE_NAME \
+    --region $REGION \
+    --attribute-definitions \
+      AttributeName=queue,AttributeType=S \
+      AttributeName=due_at,AttributeType=N \
+    --global-secondary-index-updates "[{\"Create\": ${INDEX_DEFINITION}}]" >/dev/null
+
+  echo ""
+  echo "GSI追加リクエストを送信しました。作成完了まで数分かかります。"
+  echo "追加前からある取得待ちの項目は、次の通知でインデックスに載ります。"
+  echo ""
+  echo "ステータス確認コマンド:"
+  echo "aws dynamodb describe-table --table-name $TABLE_NAME --region $REGION --query 'Table.GlobalSecondaryIndexes[?IndexName==\`${INDEX_NAME}\`].IndexStatus' --output text"
+  exit 0
+fi
+
+# user_id ごとに取得待ちの通知（item_key=<collectionType>#<YYYY-MM-DD>）を保存する
+# drain の実行中リースは user_id=item_key=__drain__ の1項目
+aws dynamodb create-table \
+  --table-name $TABLE_NAME \
+  --region $REGION \
+  --attribute-definitions \
+    AttributeName=user_id,AttributeType=S \
+    AttributeName=item_key,AttributeType=S \
+    AttributeName=queue,AttributeType=S \
+    AttributeName=due_at,AttributeType=N \
+  --key-schema \
+    AttributeName=user_id,KeyType=HASH \
+    AttributeName=item_key,KeyType=RANGE \
+  --global-secondary-indexes "[${INDEX_DEFINITION}]" \
+  --billing-mode PAY_PER_REQUEST >/dev/null
+
+echo ""
+echo "テーブル作成リクエストを送信しました。"
+echo ""
+echo "ステータス確認コマンド:"
+echo "aws dynamodb describe-table --table-name $TABLE_NAME --region $REGION --query 'Table.TableStatus' --output text"
@@ -3,6 +3,7 @@ ModerationCraft Analytics Dashboard - dbtモデル表示版（実データ・ド
 """
 import streamlit as st
 import pandas as pd
+import pyarrow.compute as pc
 import json
 from datetime import datetime
 from utils.database import get_connection, run_query, get_available_tables
@@ -218,9 +219,10 @@ for group_name, tab in zip(model_groups.keys(), tabs):
             query = f"SELECT * FROM {table_name} LIMIT 100"
 
             try:
-                df = run_query(query, conn)
+                # 幅の広いファクトテーブルは pandas に変換せず Arrow のまま受け取る
+                df = run_query(query, conn, arrow=is_fact_table)
 
-                if df is not None and not df.empty:
+                if df is not None and len(df) > 0:
                     # データ概要
                     col1, col2, col3 = st.columns(3)
                     with col1:
@@ -285,22 +287,22 @@ for group_name, tab in zip(model_groups.keys(), tabs):
                         st.markdown("### データプレビュー")
 
                         # メトリクスカラムとディメンションカラムを分離
-                        metric_columns = [col for col in df.columns if any(keyword in col.lower()
+                        metric_columns = [col for col in df.column_names if any(keyword in col.lower()
                                          for keyword in ['duration', 'score', 'level', 'rating', 'minutes', 'seconds'])]
-                        dimension_columns = [col for col in df.columns if '_key' in col.lower() or
+                        dimension_columns = [col for col in df.column_names if '_key' in col.lower() or
                                            col.lower() in ['project_id', 'small_task_id', 'user_id']]
 
-                        # カラム情報
+                        # カラム情報（Arrowのスキーマ・NULL数から計算し、DataFrameには変換しない）
                         with st.expander("カラム情報"):
                             unique_counts = []
-                            for col in df.columns:
+                            for col in df.column_names:
                                 try:
-                                    unique_counts.append(df[col].nunique())
+                                    unique_counts.append(pc.count_distinct(df.column(col)).as_py())
                                 except:
                                     unique_counts.append('N/A')
 
                             column_type = []
-                            for col in df.columns:
+                            for col in df.column_names:
                                 if col in metric_columns:
                                     column_type.append('[Metric]')
                                 elif col in dimension_columns:
@@ -309,10 +311,10 @@ for group_name, tab in zip(model_groups.keys(), tabs):
                                     column_type.append('[Attribute]')
 
                             column_info = pd.DataFrame({
-                                'カラム名': df.columns,
+                                'カラム名': df.column_names,
                                 'タイプ': column_type,
-                                'データ型': df.dtypes.astype(str),
-                                'NULL値': df.isnull().sum(),
+                                'データ型': [str(field.type) for field in df.schema],
+                                'NULL値': [df.column(col).null_count for col in df.column_names],
                                 'ユニーク値': unique_counts
                             })
                             st.dataframe(column_info, use_container_width=True)
@@ -330,18 +332,18 @@ for group_name, tab in zip(model_groups.keys(), tabs):
                         else:
                             n_rows = len(df)
 
-                        # データフレーム表示
+                        # データフレーム表示（Arrowのテーブルをそのまま渡す）
                         st.dataframe(
-                            df.head(n_rows),
+                            df.slice(0, n_rows),
                             use_container_width=True,
                             height=400
                         )
 
-                        # メトリクスの統計情報
+                        # メトリクスの統計情報（describe に使う列だけ pandas に変換）
                         if metric_columns:
                             with st.expander("メトリクス統計"):
                                 st.dataframe(
-                                    df[metric_columns].describe().round(2),
+                                    df.select(metric_columns).to_pandas().describe().round(2),
                                     use_container_width=True
                                 )
 
@@ -9,7 +9,7 @@ from datetime import datetime
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils.database import get_connection, run_query, get_available_tables, get_table_schema
+from utils.database import get_connection, run_query, get_available_tables, get_table_schema, start_query
 from utils.mock_data import setup_mock_database
 
 # ページ設定
@@ -25,6 +25,15 @@ st.markdown("SQLエディタでデータを自由に探索")
 # データベース接続
 conn = get_connection()
 
+# SQLエディタのクエリのタイムアウト（秒）の初期値
+DEFAULT_QUERY_TIMEOUT_SECONDS = int(os.environ.get("EXPLORER_QUERY_TIMEOUT_SECONDS", "30"))
+
+
+def cancel_query(job):
+    """キャンセルボタン: 実行中のクエリを conn.interrupt() で中断する"""
+    job.cancel()
+    st.session_state['query_cancelled_after'] = job.elapsed
+
 # サイドバー
 with st.sidebar:
     st.header("探索ツール")
@@ -119,20 +128,48 @@ with tab1:
     
     with col2:
         clear_button = st.button("🗑️ クリア")
+
+    with col3:
+        timeout_seconds = st.number_input(
+            "タイムアウト（秒）",
+            min_value=1,
+            max_value=600,
+            value=DEFAULT_QUERY_TIMEOUT_SECONDS,
+            step=5
+        )
     
     if clear_button:
         st.session_state['sql_query'] = ""
         st.rerun()
+
+    if 'query_cancelled_after' in st.session_state:
+        st.warning(f"⏹️ クエリをキャンセルしました（{st.session_state.pop('query_cancelled_after'):.1f}秒）")
     
     if execute_button and sql_query:
-        with st.spinner("クエリ実行中..."):
+        # ワーカースレッドで実行し、経過時間を表示しながら待つ（タイムアウト・キャンセルで中断）
+        job = start_query(sql_query, timeout=timeout_seconds)
+        status = st.empty()
+        cancel_button = st.empty()
+        if not job.done:
+            cancel_button.button("⏹️ キャンセル", on_click=cancel_query, args=(job,))
+        try:
+            while not job.wait(0.2):
+                status.info(f"⏳ クエリ実行中... {job.elapsed:.1f}秒（タイムアウト: {timeout_seconds}秒）")
+        finally:
+            # 再実行・セッション終了でスクリプトが止まった場合もクエリを中断する
+            job.cancel()
+        status.empty()
+        cancel_button.empty()
+
+        if job.error is not None:
+            st.error(f"❌ エラー: {str(job.error)}")
+        else:
             try:
-                # クエリ実行
-                result_df = run_query(sql_query)
+                result_df = job.result
                 
                 if not result_df.empty:
                     # 結果の統計
-                    st.success(f"✅ 成功: {len(result_df)}行を取得しました")
+                    st.success(f"✅ 成功: {len(result_df)}行を取得しました（{job.elapsed:.2f}秒）")
                     
                     # 結果表示
                     st.markdown("### クエリ結果")
@@ -210,8 +247,8 @@ with tab2:
         preview_rows = st.slider("プレビュー行数", 10, 1000, 100, step=10)
         
         # データ取得
-        preview_query = f"SELECT * FROM {table_name} LIMIT {preview_rows}"
-        preview_df = run_query(preview_query)
+        preview_query = f"SELECT * FROM {table_name} LIMIT $rows"
+        preview_df = run_query(preview_query, params={'rows': preview_rows})
         
         if not preview_df.empty:
             # 基本統計
@@ -25,7 +25,6 @@ st.title("睡眠の質が翌日の作業時間に与える影響")
 st.markdown("前日の睡眠データと当日の作業時間の関係を分析します")
 
 # プロジェクト一覧取得
-@st.cache_data(ttl=3600)
 def get_available_projects():
     """利用可能なプロジェクト一覧を取得（dim_projectから）"""
     query = """
@@ -92,13 +91,10 @@ with st.sidebar:
     """)
 
 # データ取得
-@st.cache_data(ttl=3600)
 def load_sleep_work_data(days: int, project_ids: list):
     """睡眠と作業時間のデータを取得（mart_sleep_work_correlationから）"""
-    # プロジェクトIDのリストをSQLに埋め込む形式に変換
-    project_filter = "','".join(project_ids) if project_ids else ""
-
-    query = f"""
+    # 期間とプロジェクトはパラメータで渡す（フィルタを変えてもSQLは同じ。プロジェクト未指定なら全件）
+    query = """
     SELECT
         date,
         day_of_week,
@@ -136,14 +132,14 @@ def load_sleep_work_data(days: int, project_ids: list):
         is_low_productivity_day
 
     FROM main_gold.mart_sleep_work_correlation
-    WHERE date >= CURRENT_DATE - INTERVAL '{days} days'
-        {f"AND project_id IN ('{project_filter}')" if project_filter else ""}
+    WHERE date >= CURRENT_DATE - INTERVAL (CAST($days AS INTEGER)) DAY
+        AND (len($project_ids) = 0 OR list_contains($project_ids, project_id))
     ORDER BY date
     """
 
     try:
         conn = get_connection()
-        df = run_query(query, conn)
+        df = run_query(query, conn, params={'days': days, 'project_ids': list(project_ids or [])})
 
         if df.empty:
             st.warning("データが見つかりませんでした。dbt runを実行してください。")
@@ -0,0 +1,41 @@
+"""
+streamlit のテスト共通設定
+
+ページと同じく utils パッケージを import できるよう streamlit ディレクトリをパスに通し、
+テストごとに一時ディレクトリの DuckDB ファイルと、それを開く接続・クエリキャッシュに差し替える。
+"""
+import os
+import sys
+
+import pytest
+
+STREAMLIT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if STREAMLIT_DIR not in sys.path:
+    sys.path.insert(0, STREAMLIT_DIR)
+
+from duckdb_helpers import create_duckdb_file  # noqa: E402
+from utils import database  # noqa: E402
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = tmp_path / "moderation_craft_dev.duckdb"
+    create_duckdb_file(path)
+    return path
+
+
+@pytest.fixture
+def use_database(monkeypatch):
+    """database のプロセス共有の接続・キャッシュを、path を開く新しいものに差し替える関数を返す"""
+    managers = []
+
+    def use(path, idle_close_seconds: float = 0, cache_mb: float = 16) -> database.ConnectionManager:
+        manager = database.ConnectionManager(path, idle_close_seconds=idle_close_seconds)
+        managers.append(manager)
+        monkeypatch.setattr(database, "_manager", manager)
+        monkeypatch.setattr(database, "_query_cache", database.QueryCache(int(cache_mb * 1024 * 1024)))
+        return manager
+
+    yield use
+    for manager in managers:
+        manager.close()
@@ -0,0 +1,28 @@
+"""テスト用の DuckDB ファイルの作成と、dbt run の代わりに別プロセスから書き込む補助関数"""
+import subprocess
+import sys
+import time
+
+
+def create_duckdb_file(path, rows=(1, 2, 3)) -> None:
+    """rows を持つテーブル t だけの DuckDB ファイルを作成する"""
+    import duckdb
+
+    conn = duckdb.connect(str(path))
+    conn.execute("CREATE TABLE t AS SELECT * FROM (VALUES " + ", ".join(f"({row})" for row in rows) + ") v(a)")
+    conn.close()
+
+
+def write_from_other_process(path, sql: str) -> subprocess.CompletedProcess:
+    """dbt run の代わりに、別プロセスから書き込み用に開いて sql を実行する（ロックが取れなければ失敗する）"""
+    script = "import sys, duckdb\nconn = duckdb.connect(sys.argv[1])\nconn.execute(sys.argv[2])\nconn.close()\n"
+    return subprocess.run([sys.executable, "-c", script, str(path), sql], capture_output=True, text=True)
+
+
+def wait_for(predicate, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return predicate()
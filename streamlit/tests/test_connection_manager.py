@@ -0,0 +1,85 @@
+"""プロセス共有のDuckDB接続（アイドル時のクローズとメモリDBへのフォールバック）"""
+import subprocess
+import sys
+import time
+
+from duckdb_helpers import wait_for, write_from_other_process
+from utils import database
+from utils.mock_data import setup_mock_database
+
+IDLE_CLOSE_SECONDS = 0.2
+
+
+def _count():
+    return int(database.run_query("SELECT COUNT(*) AS n FROM t")["n"][0])
+
+
+def test_idle_close_releases_lock_for_dbt_run(db_path, use_database):
+    manager = use_database(db_path, idle_close_seconds=IDLE_CLOSE_SECONDS)
+    assert _count() == 3
+
+    # 開いている間は dbt run（書き込み用の接続）がロックを取れない
+    assert write_from_other_process(db_path, "INSERT INTO t VALUES (4)").returncode != 0
+
+    assert wait_for(lambda: manager.stats["idle_closes"] == 1)
+    assert write_from_other_process(db_path, "INSERT INTO t VALUES (4)").returncode == 0
+    # 次のクエリで開き直し、ファイルのバージョンが変わったのでキャッシュではなく新しいデータを返す
+    assert _count() == 4
+    assert manager.stats["connects"] == 2
+
+
+def test_connection_stays_open_while_query_in_use(db_path, use_database):
+    manager = use_database(db_path, idle_close_seconds=IDLE_CLOSE_SECONDS)
+    with manager.in_use():
+        database.get_connection().execute("SELECT 1").fetchone()
+        time.sleep(IDLE_CLOSE_SECONDS * 3)
+        assert manager.stats["idle_closes"] == 0
+    assert wait_for(lambda: manager.stats["idle_closes"] == 1)
+
+
+def test_reruns_within_idle_timeout_reuse_connection(db_path, use_database):
+    manager = use_database(db_path, idle_close_seconds=60)
+    for _ in range(5):
+        database.run_query("SELECT a FROM t", cache=False)
+    assert manager.stats["connects"] == 1
+    assert database.IDLE_CLOSE_SECONDS >= 60
+
+
+def test_memory_fallback_is_not_closed_when_idle(tmp_path, use_database):
+    manager = use_database(tmp_path / "missing.duckdb", idle_close_seconds=IDLE_CLOSE_SECONDS)
+    tables = setup_mock_database(database.get_connection(), days=3)
+    assert sorted(database.get_available_tables()) == sorted(tables)
+
+    time.sleep(IDLE_CLOSE_SECONDS * 3)
+
+    # モックデータのテーブルはメモリDBの接続とともに消えるため、閉じずに残す
+    assert manager.stats["idle_closes"] == 0
+    assert sorted(database.get_available_tables()) == sorted(tables)
+
+
+def test_locked_file_falls_back_without_caching_then_reopens(db_path, use_database):
+    manager = use_database(db_path)
+    script = (
+        "import sys, time, duckdb\n"
+        "conn = duckdb.connect(sys.argv[1])\n"
+        "conn.execute('INSERT INTO t VALUES (4)')\n"
+        "print('locked', flush=True)\n"
+        "sys.stdin.readline()\n"
+        "conn.close()\n"
+    )
+    writer = subprocess.Popen(
+        [sys.executable, "-c", script, str(db_path)], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True
+    )
+    try:
+        assert writer.stdout.readline().strip() == "locked"
+        # dbt run がロックしている間はメモリDBで空の結果になり、その結果はキャッシュしない
+        assert database.get_available_tables() == []
+        assert manager.version() is None
+        assert database.query_cache_stats()["entries"] == 0
+    finally:
+        writer.communicate("\n")
+
+    # 書き込みでファイルが更新されたので、次のクエリで開き直す
+    assert database.get_available_tables() == ["t"]
+    assert _count() == 4
+    assert manager.stats["reconnects"] == 1
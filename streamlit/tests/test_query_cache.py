@@ -0,0 +1,108 @@
+"""クエリ結果のキャッシュ（キー・無効化・サイズの上限）"""
+import pandas as pd
+import pytest
+
+from duckdb_helpers import write_from_other_process
+from utils import database
+
+
+@pytest.fixture
+def manager(db_path, use_database):
+    return use_database(db_path)
+
+
+def _values(df):
+    return df["a"].tolist()
+
+
+def test_normalize_sql_ignores_whitespace_but_not_literals():
+    assert database.normalize_sql("SELECT a\n  FROM   t ;") == "SELECT a FROM t"
+    assert database.normalize_sql("SELECT 'a  b' AS \"x  y\"") == "SELECT 'a  b' AS \"x  y\""
+    assert database.normalize_sql("SELECT 'a  b'") != database.normalize_sql("SELECT 'a b'")
+
+
+def test_same_query_is_served_from_cache_as_copy(manager):
+    first = database.run_query("SELECT a FROM t ORDER BY a")
+    first["a"] = 0
+
+    # 空白だけが違うクエリは同じキー。ページ側で書き換えた結果はキャッシュに影響しない
+    second = database.run_query("SELECT a\n    FROM t\n    ORDER BY a;")
+
+    assert _values(second) == [1, 2, 3]
+    assert database.query_cache_stats()["hits"] == 1
+    second["a"] = 0
+    assert _values(database.run_query("SELECT a FROM t ORDER BY a")) == [1, 2, 3]
+
+
+def test_file_update_invalidates_cached_results(manager, db_path):
+    assert _values(database.run_query("SELECT a FROM t ORDER BY a")) == [1, 2, 3]
+
+    # dbt run の代わりに別プロセスで書き換える（読み取り専用の接続を閉じてロックを外す）
+    manager.close()
+    assert write_from_other_process(db_path, "INSERT INTO t VALUES (4)").returncode == 0
+
+    assert _values(database.run_query("SELECT a FROM t ORDER BY a")) == [1, 2, 3, 4]
+    stats = database.query_cache_stats()
+    assert stats["hits"] == 0
+    # 古いバージョンの結果は捨てる
+    assert stats["entries"] == 1
+
+
+def test_volatile_query_is_not_cached(manager):
+    database.run_query("SELECT random() AS r")
+    database.run_query("SELECT a, now() AS at FROM t")
+
+    assert database.query_cache_stats()["entries"] == 0
+
+
+def test_cache_false_and_failed_queries_are_not_cached(manager):
+    database.run_query("SELECT a FROM t", cache=False)
+    assert database.run_query("SELECT missing FROM t").empty
+
+    assert database.query_cache_stats()["entries"] == 0
+
+
+def test_lru_evicts_oldest_entry_over_size_limit():
+    cache = database.QueryCache(max_bytes=100)
+    cache.put(("a",), "A", 40)
+    cache.put(("b",), "B", 40)
+    assert cache.get(("a",)) == "A"
+
+    cache.put(("c",), "C", 40)
+
+    # 直前に読んだ a は残り、最も古い b を追い出す
+    assert cache.get(("b",)) is None
+    assert cache.get(("a",)) == "A" and cache.get(("c",)) == "C"
+    assert cache.info()["bytes"] == 80
+    assert cache.info()["evictions"] == 1
+
+
+def test_result_larger_than_cache_is_not_stored(db_path, use_database):
+    use_database(db_path, cache_mb=0.001)
+
+    result = database.run_query("SELECT range AS a FROM range(10000)")
+
+    assert len(result) == 10000
+    assert database.query_cache_stats()["entries"] == 0
+    assert isinstance(result, pd.DataFrame)
+
+
+def test_arrow_result_is_cached_separately_without_copy(manager):
+    import pyarrow as pa
+
+    table = database.run_query("SELECT a FROM t ORDER BY a", arrow=True)
+    assert isinstance(table, pa.Table)
+    assert table.column("a").to_pylist() == [1, 2, 3]
+
+    # Arrow のテーブルは変更できないので、キャッシュの同じオブジェクトを返す
+    assert database.run_query("SELECT a FROM t ORDER BY a", arrow=True) is table
+    # DataFrame の結果とはキーが別
+    assert isinstance(database.run_query("SELECT a FROM t ORDER BY a"), pd.DataFrame)
+    assert database.query_cache_stats()["entries"] == 2
+
+
+def test_failed_arrow_query_returns_empty_table(manager):
+    table = database.run_query("SELECT missing FROM t", arrow=True)
+
+    assert table.num_rows == 0
+    assert database.query_cache_stats()["entries"] == 0
@@ -0,0 +1,71 @@
+"""ワーカースレッドでのクエリ実行（start_query / QueryJob）"""
+import threading
+
+import pytest
+
+from utils import database
+
+# 中断しない限り数十秒以上かかるクエリ
+SLOW_QUERY = "SELECT SUM(a.range * b.range) AS s FROM range(200000) a, range(200000) b"
+
+
+@pytest.fixture
+def manager(db_path, use_database):
+    return use_database(db_path)
+
+
+def test_parallel_queries_create_one_cursor_each(manager):
+    jobs = [database.start_query(f"SELECT COUNT(*) + {i} AS n FROM t", cache=False) for i in range(3)]
+    for job in jobs:
+        assert job.wait(10)
+        assert job.error is None
+
+    assert [int(job.result["n"][0]) for job in jobs] == [3, 4, 5]
+    # ワーカー用のカーソルだけを作り、呼び出し元のスレッドのカーソルは作らない
+    assert manager.stats["cursors"] == 3
+    assert manager.stats["connects"] == 1
+
+
+def test_timeout_interrupts_query(manager):
+    job = database.start_query(SLOW_QUERY, cache=False, timeout=0.5)
+
+    assert job.wait(10)
+    assert job.timed_out
+    assert isinstance(job.error, database.QueryInterrupted)
+    assert "タイムアウト" in str(job.error)
+    assert job.result is None
+    assert database.query_cache_stats()["entries"] == 0
+    # 中断後も同じ接続で次のクエリを実行できる
+    assert int(database.run_query("SELECT COUNT(*) AS n FROM t")["n"][0]) == 3
+
+
+def test_cancel_interrupts_query(manager):
+    job = database.start_query(SLOW_QUERY, cache=False)
+    assert not job.wait(0.3)
+
+    job.cancel()
+
+    assert job.wait(10)
+    assert job.cancelled and not job.timed_out
+    assert isinstance(job.error, database.QueryInterrupted)
+    assert "キャンセル" in str(job.error)
+
+
+def test_cancel_after_finish_keeps_result(manager):
+    job = database.start_query("SELECT COUNT(*) AS n FROM t")
+    assert job.wait(10)
+
+    job.cancel()
+
+    assert not job.cancelled
+    assert int(job.result["n"][0]) == 3
+
+
+def test_cached_result_returns_finished_job_without_thread(manager, monkeypatch):
+    assert database.start_query("SELECT a FROM t ORDER BY a").wait(10)
+    monkeypatch.setattr(threading, "Thread", lambda *args, **kwargs: pytest.fail("cached query must not start a thread"))
+
+    job = database.start_query("SELECT a FROM t ORDER BY a")
+
+    assert job.done
+    assert job.result["a"].tolist() == [1, 2, 3]
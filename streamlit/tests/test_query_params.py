@@ -0,0 +1,47 @@
+"""SQLに埋め込まずに渡すクエリのパラメータ"""
+import pytest
+
+from utils import database
+
+
+@pytest.fixture
+def manager(db_path, use_database):
+    return use_database(db_path)
+
+
+def test_positional_and_named_params(manager):
+    assert database.run_query("SELECT a FROM t WHERE a >= ? ORDER BY a", params=[2])["a"].tolist() == [2, 3]
+    assert database.run_query("SELECT a FROM t WHERE a = $a", params={"a": 3})["a"].tolist() == [3]
+
+
+def test_list_param_with_list_contains(manager):
+    result = database.run_query("SELECT a FROM t WHERE list_contains($ids, a) ORDER BY a", params={"ids": [1, 3]})
+
+    assert result["a"].tolist() == [1, 3]
+
+
+def test_param_value_is_not_interpreted_as_sql(manager):
+    result = database.run_query("SELECT COUNT(*) AS n FROM t WHERE CAST(a AS VARCHAR) = $a", params={"a": "1' OR '1'='1"})
+
+    assert int(result["n"][0]) == 0
+
+
+def test_cache_key_includes_params(manager):
+    query = "SELECT a FROM t WHERE list_contains($ids, a) ORDER BY a"
+    assert database.run_query(query, params={"ids": [1]})["a"].tolist() == [1]
+    assert database.run_query(query, params={"ids": [2, 3]})["a"].tolist() == [2, 3]
+    assert database.query_cache_stats()["hits"] == 0
+
+    # 同じ値（辞書の順序が違うだけのものも含む）はキャッシュから返す
+    database.run_query("SELECT a FROM t WHERE a = $a AND a < $b", params={"a": 1, "b": 5})
+    assert database.run_query("SELECT a FROM t WHERE a = $a AND a < $b", params={"b": 5, "a": 1})["a"].tolist() == [1]
+    assert database.run_query(query, params={"ids": [2, 3]})["a"].tolist() == [2, 3]
+    assert database.query_cache_stats()["hits"] == 2
+
+
+def test_get_table_schema_binds_table_name(manager):
+    schema = database.get_table_schema("main.t")
+
+    assert schema["column_name"].tolist() == ["a"]
+    assert database.get_table_schema("t'; DROP TABLE t; --").empty
+    assert database.get_available_tables() == ["t"]
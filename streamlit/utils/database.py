@@ -1,52 +1,559 @@
 """
 DuckDB接続ユーティリティ（実データ用）
+
+DuckDBファイルはプロセスで1つの読み取り専用の接続で開き、Streamlitのセッション（スクリプトのスレッド）には
+その接続から作ったスレッドごとのカーソルを渡す。カーソルは同じデータベースを共有するため、
+閲覧者が増えてもファイルハンドルは1つのまま。
+
+DuckDBは開いている間ファイルをロックし、読み取り専用の接続があると dbt run は書き込み用に開けない。
+そのため、クエリを実行していない状態が DUCKDB_IDLE_CLOSE_SECONDS 秒続いたら接続を閉じ、次のクエリで開き直す。
+dbt run の実行中はファイルを開けないので、クエリは失敗して空の結果を返す（dbt run が終われば次のクエリで開ける）。
+
+run_query の結果は、正規化したSQLとDBファイルのバージョン（inode・更新時刻・サイズ）をキーにキャッシュする。
+dbt run でファイルが更新されるとキーが変わるため、古い結果を返すことはない。キャッシュにある結果は接続を開かずに返す。
 """
+import contextlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+from pathlib import Path
+from typing import Any, Dict, Hashable, Iterator, Optional, Sequence, Tuple, Union
+
 import duckdb
 import pandas as pd
-from pathlib import Path
+import pyarrow as pa
+
+# DuckDBファイルのパス（streamlitディレクトリの兄弟の dbt ディレクトリ）
+DUCKDB_PATH = Path(__file__).parent.parent.parent / "dbt" / "moderation_craft_dev.duckdb"
+
+# スレッドごとのカーソルが生きているかを確認する間隔（秒）
+HEALTH_CHECK_INTERVAL_SECONDS = 30
+
+# クエリを実行していない状態がこの秒数続いたら接続を閉じ、dbt run がファイルを書き込めるようにする。0 で閉じない
+# （閲覧中は再実行のたびに開き直さないよう、数分にしておく）
+IDLE_CLOSE_SECONDS = float(os.environ.get("DUCKDB_IDLE_CLOSE_SECONDS", "120"))
+
+# クエリ結果キャッシュの上限（MB）。QUERY_CACHE_MAX_MB=0 でキャッシュしない
+QUERY_CACHE_MAX_MB = float(os.environ.get("QUERY_CACHE_MAX_MB", "256"))
+
+# 実行するたびに結果が変わる関数を含むクエリはキャッシュしない
+_VOLATILE_SQL = re.compile(r"\b(random|uuid|gen_random_uuid|now|current_timestamp|current_time|get_current_time|get_current_timestamp|localtime|localtimestamp)\b", re.IGNORECASE)
+# 日付が変わると結果が変わるクエリは、今日の日付もキーに含める
+_DATE_DEPENDENT_SQL = re.compile(r"\b(current_date|today)\b", re.IGNORECASE)
+_QUOTED_SQL = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+
+# run_query の params（位置パラメータのリスト、または名前付きパラメータの辞書）
+QueryParams = Optional[Union[Sequence[Any], Dict[str, Any]]]
+
+
+class ConnectionManager:
+    """
+    プロセスで1つの読み取り専用DuckDB接続と、スレッドごとのカーソルを管理する
+
+    クエリは in_use() の中で実行する。実行中のクエリがない状態が idle_close_seconds 秒続くと接続を閉じ、
+    DuckDBのファイルロックを解放する（閉じた接続のカーソルも閉じられ、次の cursor() で作り直す）。
+    メモリDBへのフォールバック中はロックするファイルがなく、閉じるとモックデータのテーブルが消えるため閉じない。
+    """
+
+    def __init__(self, path: Path = DUCKDB_PATH, idle_close_seconds: float = IDLE_CLOSE_SECONDS):
+        self.path = path
+        self.idle_close_seconds = idle_close_seconds
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._conn: Optional[duckdb.DuckDBPyConnection] = None
+        self._file_id: Optional[Tuple[int, int, int]] = None
+        self._fallback = False
+        self._generation = 0
+        self._in_use = 0
+        self._last_used = time.monotonic()
+        self._idle_timer: Optional[threading.Timer] = None
+        self.stats = {"connects": 0, "reconnects": 0, "idle_closes": 0, "cursors": 0, "health_check_failures": 0}
+
+    def cursor(self) -> duckdb.DuckDBPyConnection:
+        """このスレッドのカーソルを返す（DBファイルが差し替えられていたら接続し直す）"""
+        self._reconnect_if_replaced()
+        local = self._local
+        cursor = getattr(local, "cursor", None)
+        if cursor is not None and local.generation == self._generation:
+            if time.monotonic() - local.checked_at < HEALTH_CHECK_INTERVAL_SECONDS or self._is_healthy(cursor):
+                return cursor
+
+        with self._lock:
+            conn = self._connect_locked()
+            cursor = conn.cursor()
+            local.cursor = cursor
+            local.generation = self._generation
+            local.checked_at = time.monotonic()
+            self.stats["cursors"] += 1
+        return cursor
+
+    def new_cursor(self) -> duckdb.DuckDBPyConnection:
+        """スレッドに結び付かないカーソル（start_query のワーカー用。使い終わったら close する）"""
+        self._reconnect_if_replaced()
+        with self._lock:
+            conn = self._connect_locked()
+            self.stats["cursors"] += 1
+            return conn.cursor()
+
+    @contextlib.contextmanager
+    def in_use(self) -> Iterator[None]:
+        """この中で実行しているクエリがある間は、アイドル時に接続を閉じない"""
+        with self._lock:
+            self._in_use += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_use -= 1
+                self._last_used = time.monotonic()
+                self._schedule_idle_close_locked(self.idle_close_seconds)
+
+    def version(self) -> Optional[Hashable]:
+        """キャッシュのキーに使うDBファイルのバージョン（接続は開かない）。メモリDBを使っている場合は None"""
+        if self._conn is not None and self._fallback:
+            return None
+        return _file_id(self.path)
+
+    def reconnect(self, reason: str) -> None:
+        """接続を閉じて次の cursor() で開き直す（既存のカーソルも閉じられる）"""
+        with self._lock:
+            if self._conn is None:
+                return
+            print(f"[WARNING] DuckDBに再接続します: {reason}")
+            self._close_locked()
+            self.stats["reconnects"] += 1
+
+    def close(self) -> None:
+        with self._lock:
+            self._close_locked()
+
+    def _reconnect_if_replaced(self) -> None:
+        if self._conn is not None and self._file_id != _file_id(self.path):
+            # 開けなかったファイル（dbt run の実行中）が使えるようになった、またはファイルが差し替えられた
+            self.reconnect("DuckDBファイルが更新されました")
+
+    def _schedule_idle_close_locked(self, delay: float) -> None:
+        if self.idle_close_seconds <= 0 or self._conn is None or self._fallback or self._idle_timer is not None:
+            return
+        self._idle_timer = threading.Timer(delay, self._close_if_idle)
+        self._idle_timer.daemon = True
+        self._idle_timer.start()
+
+    def _close_if_idle(self) -> None:
+        with self._lock:
+            self._idle_timer = None
+            if self._conn is None or self._fallback or self._in_use:
+                return
+            idle = time.monotonic() - self._last_used
+            if idle < self.idle_close_seconds:
+                self._schedule_idle_close_locked(self.idle_close_seconds - idle)
+                return
+            self._close_locked()
+            self.stats["idle_closes"] += 1
+
+    def _is_healthy(self, cursor: duckdb.DuckDBPyConnection) -> bool:
+        try:
+            cursor.execute("SELECT 1").fetchone()
+        except Exception as e:
+            print(f"[WARNING] DuckDBのヘルスチェックに失敗: {e}")
+            self.stats["health_check_failures"] += 1
+            self._local.cursor = None
+            # 接続自体が使えなくなっている場合は開き直す
+            try:
+                with self._lock:
+                    if self._conn is not None:
+                        self._conn.execute("SELECT 1").fetchone()
+            except Exception:
+                self.reconnect(str(e))
+            return False
+        self._local.checked_at = time.monotonic()
+        return True
+
+    def _connect_locked(self) -> duckdb.DuckDBPyConnection:
+        if self._conn is not None:
+            return self._conn
+
+        file_id = _file_id(self.path)
+        self._fallback = True
+        if file_id is not None:
+            try:
+                self._conn = duckdb.connect(str(self.path), read_only=True)
+                self._fallback = False
+                print(f"[OK] DuckDB接続成功: {self.path}")
+            except Exception as e:
+                print(f"[ERROR] DuckDB接続エラー: {e}")
+                # エラーの場合はメモリDBにフォールバック。dbt run がロックしている間なら、終わって
+                # ファイルが更新されたときに cursor() が開き直す
+                print("[WARNING] メモリDBにフォールバック")
+                self._conn = duckdb.connect(":memory:")
+        else:
+            print(f"[ERROR] DuckDBファイルが見つかりません: {self.path}")
+            # ファイルが存在しない場合はメモリDBを使用
+            self._conn = duckdb.connect(":memory:")
+        self._file_id = file_id
+        self._generation += 1
+        self._last_used = time.monotonic()
+        self._schedule_idle_close_locked(self.idle_close_seconds)
+        self.stats["connects"] += 1
+        return self._conn
+
+    def _close_locked(self) -> None:
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+        self._conn = None
+        self._file_id = None
+        self._generation += 1
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+
+
+class QueryCache:
+    """(正規化したSQL, DBのバージョン) をキーにしたクエリ結果のLRUキャッシュ（合計サイズの上限付き）"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Hashable, Tuple[Any, int]]" = OrderedDict()
+        self._bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, size: int) -> None:
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.stats["evictions"] += 1
+
+    def discard_stale(self, version: Hashable) -> None:
+        """現在のバージョン以外の結果を捨てる（dbt run 後に古い結果がメモリに残らないように）"""
+        with self._lock:
+            for key in [key for key in self._entries if key[1] != version]:
+                self._bytes -= self._entries.pop(key)[1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def info(self) -> dict:
+        with self._lock:
+            return {**self.stats, "entries": len(self._entries), "bytes": self._bytes, "max_bytes": self.max_bytes}
+
+
+def _file_id(path: Path) -> Optional[Tuple[int, int, int]]:
+    """ファイルの同一性（inode・更新時刻・サイズ）。ファイルがなければ None"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def normalize_sql(query: str) -> str:
+    """キャッシュのキー用に、空白の違いと末尾のセミコロンを無視する（文字列リテラル・引用符付きの識別子はそのまま）"""
+    parts = _QUOTED_SQL.split(query)
+    # split の結果は「引用符の外, 引用符の中, 外, ...」の順に並ぶ
+    for index in range(0, len(parts), 2):
+        parts[index] = re.sub(r"\s+", " ", parts[index])
+    return "".join(parts).strip().rstrip(";").strip()
+
+
+_manager = ConnectionManager()
+_query_cache = QueryCache(int(QUERY_CACHE_MAX_MB * 1024 * 1024))
+
 
 def get_connection():
-    """実際のDuckDBファイルへの接続を取得"""
-    # DuckDBファイルのパスを設定
-    current_dir = Path(__file__).parent.parent  # streamlitディレクトリ
-    duckdb_path = current_dir.parent / "dbt" / "moderation_craft_dev.duckdb"
+    """DuckDBへの接続（このスレッドのカーソル）を取得"""
+    return _manager.cursor()
 
-    # ファイルが存在する場合は読み取り専用で接続
-    if duckdb_path.exists():
+
+def connection_stats() -> dict:
+    """接続・再接続・作成したカーソルの回数（デバッグ表示用）"""
+    return dict(_manager.stats)
+
+
+def query_cache_stats() -> dict:
+    """クエリ結果キャッシュのヒット・ミス・追い出しの回数と使用量（デバッグ表示用）"""
+    return _query_cache.info()
+
+
+def clear_query_cache() -> None:
+    _query_cache.clear()
+
+
+def run_query(
+    query: str,
+    conn=None,
+    params: QueryParams = None,
+    cache: bool = True,
+    arrow: bool = False,
+    timeout: Optional[float] = None,
+):
+    """
+    SQLクエリを実行してDataFrameを返す（arrow=True の場合は pyarrow.Table）
+
+    フィルタの値はSQLに埋め込まず params で渡す（位置パラメータ ? はリスト、名前付き $name は辞書）。
+    リストの値は DuckDB の LIST として渡るので、IN の代わりに list_contains($ids, column) で使う。
+    値だけが変わってもSQLの文字列は同じなので、キャッシュは (SQL, params) ごとに効く。
+
+    arrow=True では DuckDB の結果を pandas に変換せずに返す。st.dataframe などはそのまま表示でき、
+    pandas の操作が必要な列だけ table.select([...]).to_pandas() で変換すればよい。
+
+    共有の接続（get_connection()）で実行した結果はキャッシュし、同じクエリには実行せずに返す
+    （DataFrame はページ側で書き換えてもキャッシュが変わらないようにコピーを返す。Arrow のテーブルは変更できないのでそのまま）。
+    別の接続を渡す場合は cache=False にする。
+
+    timeout（秒）を指定するとワーカースレッドで実行し、超えたら conn.interrupt() で中断して空の結果を返す。
+    """
+    if timeout is not None:
+        job = start_query(query, conn, params=params, cache=cache, arrow=arrow, timeout=timeout)
         try:
-            conn = duckdb.connect(str(duckdb_path), read_only=True)
-            print(f"[OK] DuckDB接続成功: {duckdb_path}")
-            return conn
+            job.wait()
+        finally:
+            # Streamlitの再実行・停止でこのスレッドが抜けた場合もクエリを止める
+            job.cancel()
+        if job.error is not None:
+            print(f"クエリエラー: {job.error}")
+            return _empty_result(arrow)
+        return job.result
+
+    key = _cache_key(query, params, arrow) if cache else None
+    cached = _cached_result(key, arrow)
+    if cached is not None:
+        return cached
+
+    result, ok = _execute(query, conn, params, arrow)
+    if ok:
+        _store_result(key, result, arrow)
+    return result
+
+
+class QueryInterrupted(Exception):
+    """タイムアウトまたはキャンセルで中断したクエリ"""
+
+
+class QueryJob:
+    """
+    ワーカースレッドで実行中のクエリ（start_query() で作成）
+
+    Streamlitのスクリプトは wait(0.1) を繰り返して経過時間を表示し、キャンセルボタンで cancel() を呼ぶ。
+    timeout を過ぎるとタイマーが conn.interrupt() で中断するため、待っているセッションがいなくなっても止まる。
+    """
+
+    def __init__(self, query: str, timeout: Optional[float] = None):
+        self.query = query
+        self.timeout = timeout
+        self.result: Any = None
+        self.error: Optional[Exception] = None
+        self.cancelled = False
+        self.timed_out = False
+        self._started_at = time.monotonic()
+        self._finished_at: Optional[float] = None
+        self._cursor: Optional[duckdb.DuckDBPyConnection] = None
+        self._done = threading.Event()
+        self._timer: Optional[threading.Timer] = None
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    @property
+    def elapsed(self) -> float:
+        """実行開始からの秒数（終了後は所要時間）"""
+        return (self._finished_at or time.monotonic()) - self._started_at
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """終了まで（timeout 秒まで）待ち、終了していれば True"""
+        return self._done.wait(timeout)
+
+    def cancel(self) -> None:
+        """実行中なら conn.interrupt() で中断する（終了後に呼んでも何もしない）"""
+        if self.done:
+            return
+        self.cancelled = True
+        cursor = self._cursor
+        if cursor is not None:
+            cursor.interrupt()
+
+    def _expire(self) -> None:
+        if not self.done:
+            self.timed_out = True
+            self.cancel()
+
+    def _start(self, conn, params: QueryParams, arrow: bool, key: Optional[Hashable]) -> "QueryJob":
+        if self.timeout is not None:
+            self._timer = threading.Timer(self.timeout, self._expire)
+            self._timer.daemon = True
+            self._timer.start()
+        threading.Thread(target=self._run, args=(conn, params, arrow, key), name="duckdb-query", daemon=True).start()
+        return self
+
+    def _run(self, conn, params: QueryParams, arrow: bool, key: Optional[Hashable]) -> None:
+        own_cursor = conn is None
+        try:
+            with _manager.in_use():
+                self._cursor = _manager.new_cursor() if own_cursor else conn
+                if self.cancelled:
+                    raise QueryInterrupted("クエリは開始前にキャンセルされました")
+                self.result = _fetch(self._cursor, self.query, params, arrow)
+            _store_result(key, self.result, arrow)
+        except duckdb.InterruptException:
+            if self.timed_out:
+                self.error = QueryInterrupted(f"タイムアウト（{self.timeout:g}秒）によりクエリを中断しました")
+            else:
+                self.error = QueryInterrupted(f"キャンセルによりクエリを中断しました（{self.elapsed:.1f}秒）")
         except Exception as e:
-            print(f"[ERROR] DuckDB接続エラー: {e}")
-            # エラーの場合はメモリDBにフォールバック
-            print("[WARNING] メモリDBにフォールバック")
-            return duckdb.connect(":memory:")
+            self.error = e
+        finally:
+            if self._timer is not None:
+                self._timer.cancel()
+            if own_cursor and self._cursor is not None:
+                self._cursor.close()
+            self._finished_at = time.monotonic()
+            self._done.set()
+
+
+def start_query(
+    query: str,
+    conn=None,
+    params: QueryParams = None,
+    cache: bool = True,
+    arrow: bool = False,
+    timeout: Optional[float] = None,
+) -> QueryJob:
+    """
+    クエリをワーカースレッドで実行し、すぐに QueryJob を返す
+
+    DuckDBは実行中にGILを解放するため、重いクエリの実行中もStreamlitの他のセッションは動き続ける。
+    キャッシュ済みの結果があれば実行せずに終了済みの QueryJob を返す。
+    """
+    job = QueryJob(query, timeout)
+    key = _cache_key(query, params, arrow) if cache else None
+    cached = _cached_result(key, arrow)
+    if cached is not None:
+        job.result = cached
+        job._finished_at = time.monotonic()
+        job._done.set()
+        return job
+    return job._start(conn, params, arrow, key)
+
+
+def _cached_result(key: Optional[Hashable], arrow: bool) -> Any:
+    if key is None:
+        return None
+    cached = _query_cache.get(key)
+    if cached is None:
+        return None
+    return cached if arrow else cached.copy()
+
+
+def _store_result(key: Optional[Hashable], result: Any, arrow: bool) -> None:
+    if key is None or _manager.version() != key[1]:
+        # 実行中にファイルが更新された、またはメモリDBにフォールバックして得た結果はキャッシュしない
+        return
+    _query_cache.discard_stale(key[1])
+    if arrow:
+        _query_cache.put(key, result, result.nbytes)
     else:
-        print(f"[ERROR] DuckDBファイルが見つかりません: {duckdb_path}")
-        # ファイルが存在しない場合はメモリDBを使用
-        return duckdb.connect(":memory:")
+        _query_cache.put(key, result.copy(), int(result.memory_usage(deep=True).sum()))
 
-def run_query(query: str, conn=None) -> pd.DataFrame:
-    """SQLクエリを実行してDataFrameを返す"""
-    if conn is None:
-        conn = get_connection()
 
+def _cache_key(query: str, params: QueryParams, arrow: bool) -> Optional[Hashable]:
+    if _query_cache.max_bytes <= 0 or _VOLATILE_SQL.search(query):
+        return None
     try:
-        result = conn.execute(query).df()
-        return result
-    except Exception as e:
-        print(f"クエリエラー: {e}")
-        return pd.DataFrame()
+        frozen_params = _freeze(params)
+        hash(frozen_params)
+    except TypeError:
+        return None
+    version = _manager.version()
+    if version is None:
+        return None
+    today = date.today().isoformat() if _DATE_DEPENDENT_SQL.search(query) else None
+    return (normalize_sql(query), version, today, arrow, frozen_params)
+
+
+def _freeze(value: Any) -> Hashable:
+    """キャッシュのキー用に、パラメータのリスト・辞書をタプルにする"""
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
 
-def get_available_tables(conn) -> list:
+def _execute(query: str, conn, params: QueryParams, arrow: bool) -> Tuple[Any, bool]:
+    """クエリを実行し、(結果, 成功したか) を返す。失敗した場合は空の結果"""
+    with _manager.in_use():
+        if conn is None:
+            conn = get_connection()
+
+        try:
+            return _fetch(conn, query, params, arrow), True
+        except duckdb.ConnectionException as e:
+            # 再接続・アイドル時のクローズで閉じられたカーソルだった場合は、新しいカーソルで1回だけやり直す
+            print(f"[WARNING] 接続エラーのため再実行します: {e}")
+            try:
+                return _fetch(get_connection(), query, params, arrow), True
+            except Exception as e:
+                print(f"クエリエラー: {e}")
+        except Exception as e:
+            print(f"クエリエラー: {e}")
+        return _empty_result(arrow), False
+
+
+def _empty_result(arrow: bool):
+    return pa.table({}) if arrow else pd.DataFrame()
+
+
+def _fetch(conn, query: str, params: QueryParams, arrow: bool):
+    result = conn.execute(query, params) if params is not None else conn.execute(query)
+    return result.fetch_arrow_table() if arrow else result.df()
+
+
+def get_available_tables(conn=None) -> list:
     """利用可能なテーブル一覧を取得"""
-    try:
-        tables = conn.execute("""
-            SELECT table_name
-            FROM information_schema.tables
-            WHERE table_schema NOT IN ('information_schema', 'pg_catalog')
-        """).df()
-        return tables['table_name'].tolist()
-    except:
-        return []
\ No newline at end of file
+    tables = run_query("""
+        SELECT table_name
+        FROM information_schema.tables
+        WHERE table_schema NOT IN ('information_schema', 'pg_catalog')
+    """, conn)
+    if tables.empty:
+        return []
+    return tables['table_name'].tolist()
+
+
+def get_table_schema(table_name: str, conn=None) -> pd.DataFrame:
+    """テーブルのカラム一覧（column_name, data_type, is_nullable）を取得（"スキーマ.テーブル" も可）"""
+    schema, _, name = table_name.rpartition(".")
+    return run_query("""
+        SELECT column_name, data_type, is_nullable
+        FROM information_schema.columns
+        WHERE table_name = $table_name
+            AND ($table_schema = '' OR table_schema = $table_schema)
+        ORDER BY ordinal_position
+    """, conn, params={"table_name": name, "table_schema": schema})
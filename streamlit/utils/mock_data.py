@@ -330,3 +330,13 @@ def generate_mock_data(days: int = 30) -> dict:
         'mart_productivity_daily': mart_productivity_daily,
         'mart_wellness_correlation': mart_wellness_correlation,
     }
+
+
+def setup_mock_database(conn, days: int = 90) -> list:
+    """モックデータをDuckDB（メモリDB）のテーブルとして作成し、テーブル名の一覧を返す"""
+    tables = generate_mock_data(days)
+    for table_name, df in tables.items():
+        conn.register("mock_df", df)
+        conn.execute(f"CREATE OR REPLACE TABLE {table_name} AS SELECT * FROM mock_df")
+        conn.unregister("mock_df")
+    return list(tables.keys())